@@ -4,16 +4,42 @@ Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
 
 __version__ = "0.1.10"
 
+from bz3.array import compress_array, decompress_array
 from bz3.backends import (
+    FILTER_BITSHUFFLE,
+    FILTER_DELTA,
+    FILTER_NONE,
+    FILTER_SHUFFLE,
+    STREAM_STORED,
+    BZ3State,
+    alloc_configure,
+    alloc_stats,
+    alloc_trim,
     bound,
     compress_file,
     compress_into,
-    decompress_file,
     decompress_into,
     libversion,
     min_memory_needed,
     orig_size_sufficient_for_decode,
     recover_file,
+    resume_output,
     test_file,
+    unfilter_into,
 )
-from bz3.bz3 import BZ3File, compress, decompress, open
+from bz3.blocks import (
+    BlockInfo,
+    StreamHeader,
+    iter_blocks,
+    make_stream_header,
+    parse_stream_header,
+    read_stream_header,
+)
+from bz3.bz3 import BZ3File, compress, decompress, decompress_file, open
+from bz3.cache import BlockCache, CacheInfo
+from bz3.executor import Executor, get_default_executor, set_default_executor
+from bz3.pickle import dumps, loads
+from bz3.search import grep
+from bz3.shards import Shard, open_shard, plan_shards
+from bz3.threads import available_cpus, resolve_threads
+from bz3.transcode import TranscodeStats, transcode
@@ -0,0 +1,278 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import argparse
+import os
+import sys
+import time
+from typing import IO, List, Optional, Tuple
+
+from bz3.backends import BZ3Decompressor, compress_file, recover_file
+from bz3.executor import imap
+from bz3.threads import resolve_threads
+
+try:
+    from bz3.backends import BZ3OmpCompressor, BZ3OmpDecompressor
+except ImportError:
+    BZ3OmpCompressor = BZ3OmpDecompressor = None
+
+SUFFIX = ".bz3"
+
+
+class _CountingIO:
+    """Wrap a binary file object and count the bytes passing through it."""
+
+    def __init__(self, fp: IO):
+        self._fp = fp
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self._fp.read(size)
+        self.count += len(data)
+        return data
+
+    def write(self, data):
+        ret = self._fp.write(data)
+        self.count += len(data)
+        return ret
+
+    def flush(self):
+        return self._fp.flush()
+
+
+def _parallel_compress(inp: IO, out: IO, block_size: int, num_threads: int) -> None:
+    compressor = BZ3OmpCompressor(block_size, num_threads)
+    chunk_size = block_size * num_threads
+    out.write(compressor.compress(b""))  # magic header
+    while True:
+        data = inp.read(chunk_size)
+        if not data:
+            break
+        out.write(compressor.compress(data))
+    out.write(compressor.flush())
+    out.flush()
+
+
+def _decompress(inp: IO, out: Optional[IO], num_threads: int) -> None:
+    """Decode inp to out, or just check it without out. Unlike decompress_file,
+    which stops at a torn last block, a truncated input is an error."""
+    if num_threads > 1 and BZ3OmpDecompressor is not None:
+        decompressor = BZ3OmpDecompressor(num_threads)
+    else:
+        decompressor = BZ3Decompressor()
+    while True:
+        data = inp.read(1024 * 1024)
+        if not data:
+            break
+        decompressed = decompressor.decompress(data)
+        if out is not None:
+            out.write(decompressed)
+    if decompressor.unused_data:
+        raise ValueError("The input file is truncated")
+    if out is not None:
+        out.flush()
+
+
+def _run(
+    mode: str, inp: IO, out: Optional[IO], block_size: int, num_threads: int
+) -> None:
+    """Process one input stream, raises ValueError on corrupted input."""
+    parallel = num_threads > 1 and BZ3OmpCompressor is not None
+    if mode == "encode":
+        if parallel:
+            _parallel_compress(inp, out, block_size, num_threads)
+        else:
+            compress_file(inp, out, block_size)
+    elif mode == "decode":
+        _decompress(inp, out, num_threads)
+    elif mode == "test":
+        _decompress(inp, None, num_threads)
+    elif mode == "recover":
+        recover_file(inp, out)
+
+
+def _output_name(mode: str, path: str) -> Optional[str]:
+    if mode == "encode":
+        return path + SUFFIX
+    if mode in ("decode", "recover"):
+        if path.endswith(SUFFIX):
+            return path[: -len(SUFFIX)]
+        return path + ".out"
+    return None
+
+
+def _report(name: str, nin: int, nout: int, elapsed: float) -> None:
+    elapsed = max(elapsed, 1e-9)
+    ratio = nout / nin if nin else 0.0
+    print(
+        "%s: %d -> %d bytes, ratio %.3f, %.2f s, %.2f MiB/s"
+        % (name, nin, nout, ratio, elapsed, nin / elapsed / (1024 * 1024)),
+        file=sys.stderr,
+    )
+
+
+def _process_file(
+    mode: str,
+    path: str,
+    to_stdout: bool,
+    force: bool,
+    block_size: int,
+    num_threads: int,
+    verbose: bool,
+    out_path: Optional[str] = None,
+) -> Tuple[int, int]:
+    """(de)compress a file on disk, returns (bytes read, bytes written).
+    The output goes to out_path if given, otherwise next to the input."""
+    if mode == "test":
+        out_path = None
+    elif out_path is None and not to_stdout:
+        out_path = _output_name(mode, path)
+    if out_path is not None and not force and os.path.exists(out_path):
+        raise FileExistsError("%s already exists, use -f to overwrite" % out_path)
+    start = time.perf_counter()
+    with open(path, "rb") as raw_inp:
+        inp = _CountingIO(raw_inp)
+        if mode == "test":
+            _run(mode, inp, None, block_size, num_threads)
+            out = None
+        elif out_path is None:
+            out = _CountingIO(sys.stdout.buffer)
+            _run(mode, inp, out, block_size, num_threads)
+        else:
+            try:
+                with open(out_path, "wb") as raw_out:
+                    out = _CountingIO(raw_out)
+                    _run(mode, inp, out, block_size, num_threads)
+            except BaseException:
+                os.remove(out_path)
+                raise
+    nout = out.count if out is not None else 0
+    if verbose:
+        _report(path, inp.count, nout, time.perf_counter() - start)
+    return inp.count, nout
+
+
+def _expand(paths: List[str], mode: str) -> List[str]:
+    """Expand directories into the files they contain for batch mode."""
+    ret = []
+    for path in paths:
+        if not os.path.isdir(path):
+            ret.append(path)
+            continue
+        for root, _, files in os.walk(path):
+            for name in sorted(files):
+                if (mode == "encode") == name.endswith(SUFFIX):
+                    continue  # don't compress twice, don't decode plain files
+                ret.append(os.path.join(root, name))
+    return ret
+
+
+def _parse_args(argv: Optional[List[str]]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="bz3", description="bzip3 compression with parallel support"
+    )
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument(
+        "-e", "-z", "--encode", dest="mode", action="store_const", const="encode"
+    )
+    modes.add_argument(
+        "-d", "--decode", dest="mode", action="store_const", const="decode"
+    )
+    modes.add_argument("-t", "--test", dest="mode", action="store_const", const="test")
+    modes.add_argument(
+        "-r", "--recover", dest="mode", action="store_const", const="recover"
+    )
+    parser.add_argument(
+        "-c", "--stdout", action="store_true", help="write the output to stdout"
+    )
+    parser.add_argument(
+        "-f", "--force", action="store_true", help="overwrite existing output files"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="print throughput statistics"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of threads to use, 0 for every CPU available",
+    )
+    parser.add_argument(
+        "-b",
+        "--block",
+        type=int,
+        default=16,
+        help="block size in MiB, between 1 and 511 (default: 16)",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="treat every argument as an input file or directory "
+        "and process them concurrently",
+    )
+    parser.add_argument("files", nargs="*", help="input (and output) files")
+    args = parser.parse_args(argv)
+    if args.mode is None:
+        args.mode = "encode"
+    if args.jobs < 0:
+        parser.error("-j must be at least 0")
+    args.jobs = resolve_threads(args.jobs)
+    if not 1 <= args.block <= 511:
+        parser.error("-b must be between 1 and 511")
+    if args.batch and args.stdout and args.mode != "test":
+        # the files are processed concurrently, their outputs would interleave
+        parser.error("--batch can't write to stdout")
+    if not args.batch and len(args.files) > 2:
+        parser.error("too many files, use --batch to process several inputs")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _parse_args(argv)
+    block_size = args.block * 1024 * 1024
+    start = time.perf_counter()
+    try:
+        if args.batch:
+            files = _expand(args.files, args.mode)
+            # each worker owns a whole file, so the executor keeps every core
+            # busy without splitting single files across threads
+            jobs = (
+                (args.mode, path, args.stdout, args.force, block_size, 1, args.verbose)
+                for path in files
+            )
+            totals = list(imap(_process_file, jobs, args.jobs, None))
+            if args.verbose:
+                _report(
+                    "total",
+                    sum(t[0] for t in totals),
+                    sum(t[1] for t in totals),
+                    time.perf_counter() - start,
+                )
+        elif not args.files or args.files[0] == "-":
+            inp = _CountingIO(sys.stdin.buffer)
+            out = None if args.mode == "test" else _CountingIO(sys.stdout.buffer)
+            _run(args.mode, inp, out, block_size, args.jobs)
+            if args.verbose:
+                nout = out.count if out is not None else 0
+                _report("<stdin>", inp.count, nout, time.perf_counter() - start)
+        else:
+            _process_file(
+                args.mode,
+                args.files[0],
+                args.stdout,
+                args.force,
+                block_size,
+                args.jobs,
+                args.verbose,
+                args.files[1] if len(args.files) == 2 else None,
+            )
+    except (OSError, ValueError) as e:
+        print("bz3: %s" % e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import ast
+import struct
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+from bz3.backends import FILTER_SHUFFLE, bound, unfilter_into
+from bz3.blocks import _FRAME, parse_stream_header
+from bz3.bz3 import compress
+from bz3.executor import Executor, decode_block, get_buffer, imap
+
+if TYPE_CHECKING:
+    import numpy as np
+
+ARRAY_MAGIC = b"BZ3A"
+
+_ARRAY_HEADER = struct.Struct("<4sI")  # magic, length of the dtype and shape header
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:  # pragma: no cover
+        raise ImportError("compress_array and decompress_array require numpy")
+    return numpy
+
+
+def compress_array(
+    arr: "np.ndarray",
+    block_size: int = 1024 * 1024,
+    num_threads: int = 1,
+    filter: int = FILTER_SHUFFLE,
+    typesize: Optional[int] = None,
+    executor: Optional[Executor] = None,
+) -> bytes:
+    """Compress an ndarray, keeping its dtype and shape.
+
+    The raw bytes of the array in C order are compressed as a filtered
+    stream, by default byte-shuffled with typesize set to the itemsize of
+    the dtype, which groups the bytes of equal significance together.
+    typesize must be between 1 and 255. Blocks are encoded by num_threads
+    workers, or by executor, as for compress().
+    """
+    np = _numpy()
+    arr = np.ascontiguousarray(arr).reshape(np.shape(arr))  # keeps 0-d arrays 0-d
+    if arr.dtype.hasobject:
+        raise ValueError("Arrays of Python objects can't be compressed")
+    if typesize is None:
+        typesize = min(max(arr.dtype.itemsize, 1), 255)
+    header = repr(
+        {"descr": np.lib.format.dtype_to_descr(arr.dtype), "shape": arr.shape}
+    ).encode()
+    data = arr.reshape(-1).view(np.uint8)
+    return b"".join(
+        (
+            _ARRAY_HEADER.pack(ARRAY_MAGIC, len(header)),
+            header,
+            compress(
+                data, block_size, num_threads, filter, typesize, executor=executor
+            ),
+        )
+    )
+
+
+def _parse_stream(data: memoryview) -> Tuple[int, int, int, List[Tuple[int, int, int]]]:
+    """Returns block_size, filter, typesize and the (offset, compressed_size,
+    original_size) of every block of a filtered stream"""
+    header = parse_stream_header(data)
+    if header is None:
+        raise ValueError("Invalid file. Reason: Smaller than magic header")
+    block_size = header.block_size
+    pos = header.size
+    limit = bound(block_size)
+    blocks = []
+    while pos < len(data):
+        if len(data) - pos < _FRAME.size:
+            raise ValueError("The input file is truncated")
+        new_size, old_size = _FRAME.unpack_from(data, pos)
+        if not 0 <= new_size <= limit or not 0 <= old_size <= block_size:
+            raise ValueError("Failed to decode a block: Inconsistent headers.")
+        pos += _FRAME.size
+        if len(data) - pos < new_size:
+            raise ValueError("The input file is truncated")
+        blocks.append((pos, new_size, old_size))
+        pos += new_size
+    return block_size, header.filter, header.typesize, blocks
+
+
+def decompress_array(
+    data: bytes,
+    out: Optional["np.ndarray"] = None,
+    num_threads: int = 1,
+    executor: Optional[Executor] = None,
+) -> "np.ndarray":
+    """Decompress the output of compress_array().
+
+    Blocks are decoded by num_threads workers, or by executor, and
+    unfiltered straight into the memory of the returned array. out, if
+    given, must be a writable, C-contiguous array of the stored dtype and
+    shape, and is filled and returned instead of a new array.
+    """
+    np = _numpy()
+    if num_threads < 1:
+        raise ValueError("num_threads must be at least 1")
+    data = memoryview(data).cast("B")
+    if len(data) < _ARRAY_HEADER.size:
+        raise ValueError("Invalid file. Reason: Smaller than magic header")
+    magic, header_size = _ARRAY_HEADER.unpack_from(data)
+    if magic != ARRAY_MAGIC:
+        raise ValueError("Invalid signature")
+    pos = _ARRAY_HEADER.size + header_size
+    try:
+        header = ast.literal_eval(bytes(data[_ARRAY_HEADER.size : pos]).decode())
+        dtype = np.lib.format.descr_to_dtype(header["descr"])
+        shape = tuple(header["shape"])
+    except (ValueError, SyntaxError, KeyError, TypeError, UnicodeDecodeError):
+        raise ValueError("The input file is corrupted. Reason: Invalid array header")
+    if out is None:
+        out = np.empty(shape, dtype)
+    elif out.dtype != dtype or out.shape != shape:
+        raise ValueError(
+            "out must have dtype %s and shape %s, got %s and %s"
+            % (dtype, shape, out.dtype, out.shape)
+        )
+    elif not out.flags.c_contiguous or not out.flags.writeable:
+        raise ValueError("out must be writable and C-contiguous")
+    block_size, filter, typesize, blocks = _parse_stream(data[pos:])
+    dst = memoryview(out.reshape(-1).view(np.uint8))
+    stream = data[pos:]
+    starts = []
+    total = 0
+    for _, _, old_size in blocks:
+        starts.append(total)
+        total += old_size
+    if total != len(dst):
+        raise ValueError(
+            "The input file is corrupted. Reason: %d bytes of data for an array of %d bytes"
+            % (total, len(dst))
+        )
+
+    def decode(i: int) -> None:
+        buffer = get_buffer(block_size)
+        offset, new_size, old_size = blocks[i]
+        buffer[:new_size] = stream[offset : offset + new_size]
+        view = decode_block(buffer, new_size, old_size, block_size)
+        unfilter_into(view, dst[starts[i] : starts[i] + len(view)], filter, typesize)
+
+    jobs = ((i,) for i in range(len(blocks)))
+    for _ in imap(decode, jobs, min(num_threads, len(blocks)), executor):
+        pass
+    return out
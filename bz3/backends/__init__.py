@@ -20,11 +20,21 @@ def _should_use_cffi() -> bool:
 
 if not _should_use_cffi():
     from bz3.backends.cython import (
+        FILTER_BITSHUFFLE,
+        FILTER_DELTA,
+        FILTER_NONE,
+        FILTER_SHUFFLE,
+        STREAM_STORED,
         BZ3Compressor,
         BZ3Decompressor,
         BZ3OmpCompressor,
         BZ3OmpDecompressor,
+        BZ3State,
+        alloc_configure,
+        alloc_stats,
+        alloc_trim,
         bound,
+        cdc_cut,
         compress_file,
         compress_into,
         decompress_file,
@@ -33,13 +43,29 @@ if not _should_use_cffi():
         min_memory_needed,
         orig_size_sufficient_for_decode,
         recover_file,
+        resume_output,
         test_file,
+        trace_clear,
+        trace_disable,
+        trace_enable,
+        trace_events,
+        unfilter_into,
     )
 else:
     from bz3.backends.cffi import (
+        FILTER_BITSHUFFLE,
+        FILTER_DELTA,
+        FILTER_NONE,
+        FILTER_SHUFFLE,
+        STREAM_STORED,
         BZ3Compressor,
         BZ3Decompressor,
+        BZ3State,
+        alloc_configure,
+        alloc_stats,
+        alloc_trim,
         bound,
+        cdc_cut,
         compress_file,
         compress_into,
         decompress_file,
@@ -48,5 +74,11 @@ else:
         min_memory_needed,
         orig_size_sufficient_for_decode,
         recover_file,
+        resume_output,
         test_file,
+        trace_clear,
+        trace_disable,
+        trace_enable,
+        trace_events,
+        unfilter_into,
     )
@@ -0,0 +1,283 @@
+/*
+ * Native allocation of block states and work buffers, shared by the cython and cffi backends.
+ * Work buffers of mmap_threshold bytes and up are mapped aligned to 2 MiB with MADV_HUGEPAGE,
+ * so the random access of the BWT over them misses the TLB less. Released states and mapped
+ * buffers go to a cache, up to cache_limit bytes, and are handed out again to the next
+ * compressor of the same block size, which then skips the allocation and the page faults.
+ * libbzip3 allocates the insides of a state with malloc, states are reused but not remapped.
+ */
+#ifndef BZ3_ALLOC_H
+#define BZ3_ALLOC_H
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "libbz3.h"
+
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <pthread.h>
+#include <sys/mman.h>
+#endif
+
+#define BZ3_ALLOC_HUGE_PAGE ((size_t)2 << 20)
+#define BZ3_ALLOC_HEADER 64 /* in front of every buffer, keeps the rest cache line aligned */
+#define BZ3_ALLOC_SLOTS 64
+#define BZ3_ALLOC_MALLOC 0
+#define BZ3_ALLOC_MMAP 1
+
+typedef struct
+{
+    uint64_t allocs;       /* states and buffers handed out */
+    uint64_t cache_hits;   /* of which came from the cache */
+    uint64_t huge_allocs;  /* buffers the kernel took MADV_HUGEPAGE for */
+    uint64_t mapped_bytes; /* bytes of buffers mapped now, in use or cached */
+    uint64_t cached_bytes; /* bytes of states and buffers held by the cache */
+    uint64_t cached;       /* states and buffers held by the cache */
+} bz3_alloc_stats;
+
+typedef struct
+{
+    void *ptr;          /* a bz3_state, or the mapping of a buffer */
+    size_t size;        /* the bytes it holds, the mapping size for buffers */
+    int32_t block_size; /* 0 for buffers */
+} bz3_alloc_slot;
+
+typedef struct
+{
+    size_t kind; /* BZ3_ALLOC_MALLOC or BZ3_ALLOC_MMAP */
+    size_t size; /* of the whole allocation, header included */
+} bz3_alloc_header;
+
+static int bz3_alloc_huge_pages = 1;
+static size_t bz3_alloc_cache_limit = (size_t)256 << 20;
+static size_t bz3_alloc_mmap_threshold = (size_t)4 << 20;
+static bz3_alloc_stats bz3_alloc_counters;
+static bz3_alloc_slot bz3_alloc_cache[BZ3_ALLOC_SLOTS]; /* oldest first */
+static int bz3_alloc_cached = 0;
+
+#ifdef _WIN32
+static SRWLOCK bz3_alloc_mutex = SRWLOCK_INIT;
+#define bz3_alloc_lock() AcquireSRWLockExclusive(&bz3_alloc_mutex)
+#define bz3_alloc_unlock() ReleaseSRWLockExclusive(&bz3_alloc_mutex)
+#else
+static pthread_mutex_t bz3_alloc_mutex = PTHREAD_MUTEX_INITIALIZER;
+#define bz3_alloc_lock() pthread_mutex_lock(&bz3_alloc_mutex)
+#define bz3_alloc_unlock() pthread_mutex_unlock(&bz3_alloc_mutex)
+#endif
+
+/* free an entry evicted from the cache, without the lock */
+static void bz3_alloc_drop(bz3_alloc_slot slot)
+{
+    if (slot.block_size)
+        bz3_free((struct bz3_state *)slot.ptr);
+#ifndef _WIN32
+    else
+        munmap(slot.ptr, slot.size);
+#endif
+}
+
+/* take the cached entry of block_size (0 for a buffer mapping of size), under the lock */
+static void *bz3_alloc_take(int32_t block_size, size_t size)
+{
+    for (int i = bz3_alloc_cached - 1; i >= 0; i--)
+    {
+        bz3_alloc_slot *slot = &bz3_alloc_cache[i];
+        if (slot->block_size == block_size && (block_size || slot->size == size))
+        {
+            void *ptr = slot->ptr;
+            bz3_alloc_counters.cached_bytes -= slot->size;
+            bz3_alloc_counters.cached--;
+            bz3_alloc_counters.cache_hits++;
+            memmove(slot, slot + 1, (size_t)(bz3_alloc_cached - i - 1) * sizeof(bz3_alloc_slot));
+            bz3_alloc_cached--;
+            return ptr;
+        }
+    }
+    return NULL;
+}
+
+/* move the oldest entries out of the cache until it holds limit bytes in count slots at most,
+ * under the lock. Returns how many were moved to out, for bz3_alloc_drop() */
+static int bz3_alloc_evict(size_t limit, int count, bz3_alloc_slot *out)
+{
+    int n = 0;
+    uint64_t bytes = bz3_alloc_counters.cached_bytes;
+    while (n < bz3_alloc_cached && (bz3_alloc_cached - n > count || bytes > limit))
+        bytes -= bz3_alloc_cache[n++].size;
+    for (int i = 0; i < n; i++)
+    {
+        out[i] = bz3_alloc_cache[i];
+        bz3_alloc_counters.cached_bytes -= out[i].size;
+        bz3_alloc_counters.cached--;
+        if (!out[i].block_size)
+            bz3_alloc_counters.mapped_bytes -= out[i].size;
+    }
+    memmove(bz3_alloc_cache, bz3_alloc_cache + n, (size_t)(bz3_alloc_cached - n) * sizeof(bz3_alloc_slot));
+    bz3_alloc_cached -= n;
+    return n;
+}
+
+/* hand an entry to the cache, or free it if it doesn't fit */
+static void bz3_alloc_give(void *ptr, size_t size, int32_t block_size)
+{
+    bz3_alloc_slot slot = {ptr, size, block_size};
+    bz3_alloc_slot evicted[BZ3_ALLOC_SLOTS];
+    int n = 0;
+    bz3_alloc_lock();
+    if (size <= bz3_alloc_cache_limit)
+    {
+        n = bz3_alloc_evict(bz3_alloc_cache_limit - size, BZ3_ALLOC_SLOTS - 1, evicted);
+        bz3_alloc_cache[bz3_alloc_cached++] = slot;
+        bz3_alloc_counters.cached_bytes += size;
+        bz3_alloc_counters.cached++;
+    }
+    else
+    {
+        evicted[n++] = slot;
+        if (!block_size)
+            bz3_alloc_counters.mapped_bytes -= size;
+    }
+    bz3_alloc_unlock();
+    for (int i = 0; i < n; i++)
+        bz3_alloc_drop(evicted[i]);
+}
+
+/* a block state for block_size, from the cache if one was released. NULL when out of memory */
+static struct bz3_state *bz3_state_acquire(int32_t block_size)
+{
+    struct bz3_state *state;
+    bz3_alloc_lock();
+    bz3_alloc_counters.allocs++;
+    state = (struct bz3_state *)bz3_alloc_take(block_size, 0);
+    bz3_alloc_unlock();
+    return state != NULL ? state : bz3_new(block_size);
+}
+
+/* give back a state of acquire(block_size), NULL is ignored. libbz3 has no way to reset the
+ * error of a state, so a state holding one is freed rather than handed to the next user */
+static void bz3_state_release(struct bz3_state *state, int32_t block_size)
+{
+    if (state == NULL)
+        return;
+    if (block_size > 0 && bz3_last_error(state) == BZ3_OK)
+        bz3_alloc_give(state, bz3_min_memory_needed(block_size), block_size);
+    else
+        bz3_free(state);
+}
+
+/* a work buffer of size bytes, NULL when out of memory */
+static void *bz3_buffer_alloc(size_t size)
+{
+    bz3_alloc_header *header = NULL;
+    size_t total = size + BZ3_ALLOC_HEADER;
+#ifndef _WIN32
+    if (size >= bz3_alloc_mmap_threshold)
+    {
+        size_t mapped = (total + BZ3_ALLOC_HUGE_PAGE - 1) & ~(BZ3_ALLOC_HUGE_PAGE - 1);
+        bz3_alloc_lock();
+        bz3_alloc_counters.allocs++;
+        header = (bz3_alloc_header *)bz3_alloc_take(0, mapped);
+        bz3_alloc_unlock();
+        if (header == NULL)
+        {
+            /* over-map by a huge page and cut the ends, for a 2 MiB aligned start */
+            uint8_t *base = (uint8_t *)mmap(NULL, mapped + BZ3_ALLOC_HUGE_PAGE, PROT_READ | PROT_WRITE,
+                                            MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+            uint8_t *start;
+            int huge = 0;
+            if (base == (uint8_t *)MAP_FAILED)
+                return NULL;
+            start = (uint8_t *)(((uintptr_t)base + BZ3_ALLOC_HUGE_PAGE - 1) & ~(uintptr_t)(BZ3_ALLOC_HUGE_PAGE - 1));
+            if (start > base)
+                munmap(base, (size_t)(start - base));
+            munmap(start + mapped, BZ3_ALLOC_HUGE_PAGE - (size_t)(start - base));
+            header = (bz3_alloc_header *)start;
+            header->kind = BZ3_ALLOC_MMAP;
+            header->size = mapped;
+#ifdef MADV_HUGEPAGE
+            huge = bz3_alloc_huge_pages && madvise(start, mapped, MADV_HUGEPAGE) == 0;
+#endif
+            bz3_alloc_lock();
+            bz3_alloc_counters.huge_allocs += huge;
+            bz3_alloc_counters.mapped_bytes += mapped;
+            bz3_alloc_unlock();
+        }
+        return (uint8_t *)header + BZ3_ALLOC_HEADER;
+    }
+#endif
+    header = (bz3_alloc_header *)malloc(total);
+    if (header == NULL)
+        return NULL;
+    header->kind = BZ3_ALLOC_MALLOC;
+    header->size = total;
+    bz3_alloc_lock();
+    bz3_alloc_counters.allocs++;
+    bz3_alloc_unlock();
+    return (uint8_t *)header + BZ3_ALLOC_HEADER;
+}
+
+/* give back a buffer of bz3_buffer_alloc, NULL is ignored */
+static void bz3_buffer_free(void *ptr)
+{
+    bz3_alloc_header *header;
+    if (ptr == NULL)
+        return;
+    header = (bz3_alloc_header *)((uint8_t *)ptr - BZ3_ALLOC_HEADER);
+    if (header->kind == BZ3_ALLOC_MMAP)
+        bz3_alloc_give(header, header->size, 0);
+    else
+        free(header);
+}
+
+/* free everything the cache holds */
+static void bz3_alloc_trim(void)
+{
+    bz3_alloc_slot evicted[BZ3_ALLOC_SLOTS];
+    int n;
+    bz3_alloc_lock();
+    n = bz3_alloc_evict(0, 0, evicted);
+    bz3_alloc_unlock();
+    for (int i = 0; i < n; i++)
+        bz3_alloc_drop(evicted[i]);
+}
+
+/* change the settings, a negative value keeps one. A smaller cache_limit trims the cache */
+static void bz3_alloc_configure(int huge_pages, int64_t cache_limit, int64_t mmap_threshold)
+{
+    bz3_alloc_slot evicted[BZ3_ALLOC_SLOTS];
+    int n = 0;
+    bz3_alloc_lock();
+    if (huge_pages >= 0)
+        bz3_alloc_huge_pages = huge_pages != 0;
+    if (mmap_threshold >= 0)
+        bz3_alloc_mmap_threshold = (size_t)mmap_threshold;
+    if (cache_limit >= 0)
+    {
+        bz3_alloc_cache_limit = (size_t)cache_limit;
+        n = bz3_alloc_evict(bz3_alloc_cache_limit, BZ3_ALLOC_SLOTS, evicted);
+    }
+    bz3_alloc_unlock();
+    for (int i = 0; i < n; i++)
+        bz3_alloc_drop(evicted[i]);
+}
+
+static void bz3_alloc_get_config(int *huge_pages, uint64_t *cache_limit, uint64_t *mmap_threshold)
+{
+    bz3_alloc_lock();
+    *huge_pages = bz3_alloc_huge_pages;
+    *cache_limit = bz3_alloc_cache_limit;
+    *mmap_threshold = bz3_alloc_mmap_threshold;
+    bz3_alloc_unlock();
+}
+
+static void bz3_alloc_get_stats(bz3_alloc_stats *out)
+{
+    bz3_alloc_lock();
+    *out = bz3_alloc_counters;
+    bz3_alloc_unlock();
+}
+
+#endif
@@ -0,0 +1,117 @@
+/*
+ * Content-defined chunking (FastCDC), shared by the cython and cffi backends.
+ * A gear hash over the last 64 bytes picks the block boundaries, so the same data
+ * is cut the same way wherever it sits in the stream: inserting or removing bytes
+ * only changes the blocks around the edit.
+ */
+#ifndef BZ3_CDC_H
+#define BZ3_CDC_H
+
+#include <stddef.h>
+#include <stdint.h>
+
+/* blocks are between block_size / 8 + 1 and block_size bytes, about block_size / 4 on average */
+#define BZ3_CDC_MIN(block_size) ((size_t)(block_size) / 8)
+
+/* 256 random 64-bit values, splitmix64 seeded with "bz3cdc", never to change: they define the cuts */
+static const uint64_t bz3_gear[256] = {
+    0xf3eb87112d0b6366ull, 0x35d1a68a4730963aull, 0x068f705eceeeaa55ull, 0xcecde038b51b240bull,
+    0x6945f3ff22b58f25ull, 0x27f8db36df13decdull, 0x39ae7a1bd40415caull, 0xc7eab167eba7040full,
+    0xf82d6ac73c266695ull, 0x2ee18835e65466bfull, 0xa83a38fd2ebd74ccull, 0xf73e5bc616db4cf3ull,
+    0xfc63f10e2a653f96ull, 0x2d1498e71ec795f3ull, 0xe2900afb66bb1b9eull, 0x54f41dece948ee02ull,
+    0x075f826ebf756f0dull, 0xe7b371912e77f666ull, 0xb7e54d52b2afdd26ull, 0x0c865fad32899972ull,
+    0x659691fc94e9c8eaull, 0x0e60d88042849751ull, 0x3bd5056b0a97f63full, 0x20ac48b404280ed8ull,
+    0xb528f9ac52bd20c3ull, 0x09ac78734a0d63f7ull, 0x73d655a6a7a5be2eull, 0x6c923d0aa4fb7b79ull,
+    0x9a5a80461b9caf07ull, 0xe327c91b944cbe30ull, 0x9c84563d1fbb7542ull, 0x19f2036931b62dceull,
+    0xb8e5ece2eea46eb9ull, 0x82a92737de07f423ull, 0x408711cd07833aa7ull, 0xe3cda3117875e4aaull,
+    0xfc4f3f030867aa3cull, 0x5645f55590d6fc1cull, 0xe3554457c23eb852ull, 0xa56cd90fc9559fdbull,
+    0x17974b86660197f4ull, 0xdea103088a034e07ull, 0x7c11b9687c7b3dc5ull, 0x91a6df86aa9d7f91ull,
+    0x10cd1b772b19c6d5ull, 0x741bbb1b0ab87a17ull, 0xe0ed3ba8488f154full, 0xfa23cb386296db80ull,
+    0x3318a24147a2ed75ull, 0xa986f727162260a5ull, 0x70f796a00a1fe7fcull, 0x164333b3c5134c73ull,
+    0xff48a5b462ab243dull, 0x440861064244b956ull, 0x20eebaaac690067aull, 0xb39a085ed5007226ull,
+    0xdd7c4e876663b864ull, 0xc91b472eb992e7d6ull, 0x7815a54acc30bc45ull, 0xe4bbbe3941b5e6ceull,
+    0x39575e85d141d7c2ull, 0x19792907f0e1668bull, 0xf756cbca0e200bbcull, 0x50c1c29e4c940c3aull,
+    0x8848a0fc9358f718ull, 0x554a8303bde39635ull, 0x85d3cde1664c1123ull, 0x810ec141eafde00eull,
+    0xb749ac1c647bb431ull, 0xa4a14d3122479949ull, 0x689caae582a83766ull, 0x9af9e15b5e2e3e5full,
+    0x6b0230d1f303dccbull, 0x992a53b8ddaa581bull, 0xcefb91d35d4d0a9cull, 0x4f61afffb25de287ull,
+    0x70b694e0aabe6db7ull, 0xc5192491b85b6f61ull, 0x73949c9e0fa58549ull, 0x1ab7999c16171beaull,
+    0x4f8824b1077cb58bull, 0x3692f8ee616e618aull, 0x8909f01a1923175full, 0x251979c596b046f8ull,
+    0xe6cd2b9557d54c66ull, 0xe8dee229accd6a32ull, 0x5a2ba37d424f8df7ull, 0x16a67520280ea16cull,
+    0xb9c21d5f0474fcd8ull, 0xe730988ea7a3affdull, 0x71040d52e86e2ce6ull, 0xf06fb306c27ab1f1ull,
+    0xcf4243985d4cbd5cull, 0xf3261ba0cda98c84ull, 0x231f471e02433975ull, 0x6ac281e15b31eb3bull,
+    0x26e31cb52230b201ull, 0xa1a29d125789ab79ull, 0x1475e63e3696d23cull, 0xdbf07f1f6fc8b6baull,
+    0x61c6f0fe119068adull, 0x0e65ffe5f156495cull, 0x44710eaeff32dcd4ull, 0x9912c13514e7f441ull,
+    0x14e2888b6ef4e166ull, 0x026c6e59609b3ed7ull, 0x47b149d7c5c5b9d2ull, 0x1a619c6e3ec6b9c1ull,
+    0xa6c08479f66fdfa3ull, 0x35b70a5be3a4ca50ull, 0x12407da0185a6b31ull, 0x47969368e8baf5deull,
+    0x2e7a785a6aa78a35ull, 0x1ea10d38b20027efull, 0xe2a95e76a52a0476ull, 0xee080d6316f7bab3ull,
+    0x51a8dde04c91f94dull, 0x9909a04a5f189d3full, 0xfb01c116126f697dull, 0x23b4d3a35cf459d2ull,
+    0xc674aef8529fa9c5ull, 0x9d6a47a7ee9966a9ull, 0xc0854c4f993904a2ull, 0xf52f08eccb8916efull,
+    0x3bd6e33aa67782d1ull, 0x25c7ed4b5ca7dfbeull, 0x180a73030d5b9092ull, 0x129652ff2f3d69d5ull,
+    0x3bf5340af32ed98full, 0x601a6e1d772cfdb7ull, 0xfaafbbab84918552ull, 0x607b786a28d87052ull,
+    0xd835bc2b45f1e28cull, 0xb30849921c714015ull, 0xcfb72a83f89193c9ull, 0x9138e99507df1be4ull,
+    0x0735ab712105def9ull, 0xd752db1c00614a86ull, 0xfc36445e4ada7922ull, 0xb936dd10a53b8eefull,
+    0xe3cc3d6a0d989c44ull, 0x61c9b2fccc112f71ull, 0xad696534e6df549cull, 0x4071572ca38dbbcfull,
+    0x6dd320dc91865fb0ull, 0xb1cd696f45a9147full, 0x00af0a706645e819ull, 0x04c9b0105b33785aull,
+    0x226eb4ba4b69f3d2ull, 0x50a7205f7f9b4e39ull, 0xab57dfd51d6fe5c2ull, 0x9b03aaa489b3a92full,
+    0x8c67ea1f8bc0aa4cull, 0x4590fabb560d5d24ull, 0xef8c4fc218cc7ce4ull, 0xe914cc1b823e4e44ull,
+    0x319dfc99412b4beaull, 0xad1ed939e1b2a583ull, 0x1ae37c4bd9dfc267ull, 0xc7f55e3320b5ed27ull,
+    0xcd09103c33b1986cull, 0xdde58d68f20d5bd7ull, 0x32e8fe129c652407ull, 0x9e8c1761cdc5342bull,
+    0x92f8bbdf18b7c857ull, 0x06f9e46845a79d87ull, 0xb454351ec058a625ull, 0x927e2412cf8db20bull,
+    0x634df80fe6aca1adull, 0xc58a8438914d9859ull, 0xd74cb6e18849913eull, 0xb34cf885887046e2ull,
+    0xe5c7fa29e23ff0d1ull, 0xb738191cdf64337bull, 0x90b70e7d45fa29beull, 0x99eb30500a83d035ull,
+    0x407ea18510240fd0ull, 0x258e0c7abaf5b19cull, 0x4de85bd7c2ad7796ull, 0x139873879204a5ecull,
+    0x12d8e7496d0b80c8ull, 0xc842a795266162a0ull, 0x62a35a8c520026e7ull, 0xf8cbb19f690fe4bfull,
+    0x9c4504d4881fe60eull, 0x35ab8f8fc7b6dff4ull, 0xf045354cf55ba2deull, 0x2897e34475ea4da2ull,
+    0x7472135bb3bbca7full, 0xee26f72e4534b23eull, 0xab51cb1c29b919afull, 0xcdffcfa07a177e3dull,
+    0x8603e1cce21bd809ull, 0xa7d15fcad42c4722ull, 0x4114df80f3611b46ull, 0x52ebbe87728bf2deull,
+    0xb71b3366fe6c0aa8ull, 0x5748b40a4724d606ull, 0xedb1dea18ebef343ull, 0x4d115ae300d15d12ull,
+    0x604e9f18153e57acull, 0xdfe7348bb19ec777ull, 0xd11a5de390e8c5f6ull, 0xc24e44a6178efa79ull,
+    0xfc834fb9f74c34b1ull, 0x290b7d638b3c28cfull, 0x8910eb7e029e75d6ull, 0xede550ef3a8afc8cull,
+    0xad210d1af0ae3dbbull, 0xcc2d90d02596223full, 0x5d0e08298a209035ull, 0x0926d9c1d50ddf67ull,
+    0x1319c9d62af88042ull, 0x586526e93e851ff4ull, 0x50d01fe131f5ccecull, 0x9bc8d1ebb9854ff3ull,
+    0xe095eb83651e2124ull, 0x1f29efa2bd54285dull, 0x57e949f0e653e58aull, 0x5594b20a0d89860dull,
+    0x8d01d4a1d3d150d4ull, 0x6c3c0521be43175full, 0x61754f0d71a46206ull, 0xf7541eedd272dafaull,
+    0xd21f589d844f2dbeull, 0xafda3e3804b6c2c0ull, 0x4e17d7e0452ea479ull, 0xfeefa1a76bf7b314ull,
+    0x363eb4558c452009ull, 0x147ba2aa8d29097cull, 0xd87eff79d4b6679eull, 0xbbae2939b4937e8full,
+    0xe5cbd4b09b2760b8ull, 0xe774d3b682b88b57ull, 0x85f5d6961c055e22ull, 0x07f7746ddbdf9a50ull,
+    0x6c0e37ecb7adab32ull, 0xded2047561f98d9eull, 0xfec6250da7ebfdc3ull, 0x8ac981ea5524cab0ull,
+    0x0cc054ca1e2f795full, 0x3b1917718f806470ull, 0x8f7475cba44d4767ull, 0xa06e56ddc8d58ec0ull,
+    0x7839322b82b56442ull, 0xf6cdde8a9aec0cf0ull, 0x31d89b25ffc8e98full, 0x5181026be983fea1ull,
+    0x95cf251957359890ull, 0xe65acbd9c097a112ull, 0x1a7846d5a9551afaull, 0x64879385f0b276e2ull,
+    0x1c72ace03f5bca3dull, 0x4696ac02ed72adf8ull, 0x4c2aa61ba6bf59fbull, 0xfd778e7f50da8b2eull,
+};
+
+/* the size of the first block of buf, at most size bytes. size is the whole
+ * buffer when no boundary is found before it, so callers cut size = block_size
+ * bytes at a time until the end of the data, then whatever is left */
+static inline size_t bz3_cdc_cut(const uint8_t *buf, size_t size, size_t block_size)
+{
+    size_t min = BZ3_CDC_MIN(block_size), avg, i;
+    uint64_t hash = 0, mask_s, mask_l;
+    int bits = 1;
+    while (((size_t)2 << bits) <= block_size / 4)
+        bits++;
+    avg = (size_t)1 << bits;
+    /* normalized chunking: a boundary is less likely before avg and more likely after it */
+    mask_s = ~(uint64_t)0 << (64 - (bits + 1));
+    mask_l = ~(uint64_t)0 << (64 - (bits - 1));
+    if (size > block_size)
+        size = block_size;
+    if (size <= min)
+        return size;
+    for (i = min; i < size && i < avg; i++)
+    {
+        hash = (hash << 1) + bz3_gear[buf[i]];
+        if (!(hash & mask_s))
+            return i + 1;
+    }
+    for (; i < size; i++)
+    {
+        hash = (hash << 1) + bz3_gear[buf[i]];
+        if (!(hash & mask_l))
+            return i + 1;
+    }
+    return size;
+}
+
+#endif
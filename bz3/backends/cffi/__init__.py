@@ -1,5 +1,8 @@
+import os
+import struct
 import sys
-from typing import IO, Optional
+from threading import Lock
+from typing import IO, Optional, Tuple
 
 from bz3.backends.cffi._bz3 import ffi, lib
 
@@ -12,98 +15,458 @@ def MiB(x: int) -> int:
     return x * 1024 * 1024
 
 
+FILTER_NONE = lib.BZ3_FILTER_NONE
+FILTER_SHUFFLE = lib.BZ3_FILTER_SHUFFLE
+FILTER_BITSHUFFLE = lib.BZ3_FILTER_BITSHUFFLE
+FILTER_DELTA = lib.BZ3_FILTER_DELTA
+STREAM_STORED = lib.BZ3_STREAM_STORED
+
+
+def check_filter(filter: int, typesize: int) -> None:
+    if lib.bz3_filter_check(filter, typesize) != 0:
+        raise ValueError(
+            "filter must be one of the FILTER_* constants and typesize between 1 and 255"
+        )
+
+
+def check_probe(probe: float) -> None:
+    if not 0 <= probe <= 8:
+        raise ValueError("probe must be between 0 and 8 bits per byte")
+
+
+def store_probe(probe: float, allow_stored: bool) -> float:
+    """The probe a compressor runs: stored blocks are an extension libbz3 and the
+    bzip3 tool can't read, so blocks are only stored, and probed, when the caller
+    allows it"""
+    check_probe(probe)
+    return probe if allow_stored else 0.0
+
+
+def stream_flags(probe: float) -> int:
+    """The flags of the stream header for a compressor with probe"""
+    return lib.BZ3_STREAM_STORED if probe > 0 else 0
+
+
+def make_stream_header(
+    block_size: int, filter: int, typesize: int, flags: int
+) -> bytes:
+    """The stream header. Filtered streams, and streams with stored blocks, are
+    prefixed with "BZ3F", the filter, the typesize, the flags and a reserved byte"""
+    header = bytearray(b"BZ3v1\x00\x00\x00\x00")
+    lib.write_neutral_s32(ffi.from_buffer("uint8_t[]", header) + 5, block_size)
+    if filter != FILTER_NONE or flags != 0:
+        header[:0] = b"BZ3F" + bytes((filter, typesize, flags, 0))
+    return bytes(header)
+
+
+def parse_stream_header(data: bytearray) -> Optional[Tuple[int, int, int, int]]:
+    """Parse the stream header at the start of data, returns
+    (header_size, block_size, filter, typesize) or None if more data is needed"""
+    if len(data) < 9:
+        return None
+    pos = 0
+    filter = FILTER_NONE
+    typesize = 1
+    if bytes(data[:4]) == b"BZ3F":
+        if len(data) < lib.BZ3_FILTER_HEADER_SIZE + 9:
+            return None
+        filter = data[4]
+        typesize = data[5]
+        if lib.bz3_filter_check(filter, typesize) != 0:
+            raise ValueError(
+                "The input file is corrupted. Reason: Invalid filter in the header"
+            )
+        # a prefix that neither filters nor flags anything isn't written either
+        flags = data[6]
+        if (
+            flags & ~lib.BZ3_STREAM_STORED
+            or data[7] != 0
+            or (filter == FILTER_NONE and flags == 0)
+        ):
+            raise ValueError(
+                "The input file is corrupted. Reason: Invalid flags in the header"
+            )
+        pos = lib.BZ3_FILTER_HEADER_SIZE
+    if bytes(data[pos : pos + 5]) != b"BZ3v1":
+        raise ValueError("Invalid signature")
+    temp = data[pos + 5 : pos + 9]
+    block_size = lib.read_neutral_s32(ffi.cast("uint8_t*", ffi.from_buffer(temp)))
+    if block_size < KiB(65) or block_size > MiB(511):
+        raise ValueError(
+            "The input file is corrupted. Reason: Invalid block size in the header"
+        )
+    return pos + 9, block_size, filter, typesize
+
+
+def read_stream_header(input: IO) -> Tuple[int, int, int]:
+    """Read and parse the stream header at the position of input, 9 bytes or 17
+    with the "BZ3F" prefix. Returns (block_size, filter, typesize)"""
+    data = input.read(9)
+    if len(data) == 9 and data[:4] == b"BZ3F":
+        data += input.read(lib.BZ3_FILTER_HEADER_SIZE)
+    header = parse_stream_header(data)
+    if header is None:
+        raise ValueError("Invalid file. Reason: Smaller than magic header")
+    return header[1:]
+
+
+def extend_unfiltered(ret: bytearray, src, size: int, filter: int, typesize: int):
+    """Append size decoded bytes to ret, reversing the filter on the way"""
+    pos = len(ret)
+    ret.extend(bytes(size))
+    lib.bz3_unfilter(
+        ffi.from_buffer("uint8_t[]", ret) + pos, src, size, filter, typesize
+    )
+
+
+def unfilter_into(src, out, filter: int, typesize: int) -> None:
+    """Reverse filter on src, writing len(src) bytes to the start of out. Used to decode
+    blocks of filtered streams straight into caller-owned memory"""
+    check_filter(filter, typesize)
+    src = ffi.from_buffer("uint8_t[]", src)
+    dst = ffi.from_buffer("uint8_t[]", out, require_writable=True)
+    if len(dst) < len(src):
+        raise ValueError("out is too small, need %d more bytes" % (len(src) - len(dst)))
+    lib.bz3_unfilter(dst, src, len(src), filter, typesize)
+
+
+def cdc_cut(data, block_size: int) -> int:
+    """The size of the first content-defined block of data, as BZ3Compressor cuts
+    with cdc. block_size bytes (or all of data, if shorter) when no boundary is found"""
+    if block_size < KiB(65) or block_size > MiB(511):
+        raise ValueError("Block size must be between 65 KiB and 511 MiB")
+    src = ffi.from_buffer("uint8_t[]", data)
+    return lib.bz3_cdc_cut(src, min(len(src), block_size), block_size)
+
+
 def check_file(file) -> bool:
     if hasattr(file, "read") and hasattr(file, "write"):
         return True
     return False
 
 
+def write_to(out, buffers) -> int:
+    """Write buffers to out, a file descriptor (with writev when available) or a
+    binary file object, returns the number of bytes written"""
+    t0 = lib.bz3_trace_begin()
+    views = [memoryview(buffer).cast("B") for buffer in buffers]
+    total = sum(len(view) for view in views)
+    if isinstance(out, int):
+        if hasattr(os, "writev"):
+            while views:
+                n = os.writev(out, views)
+                while views and n >= len(views[0]):
+                    n -= len(views.pop(0))
+                if views:
+                    views[0] = views[0][n:]
+        else:
+            for view in views:
+                while view:
+                    view = view[os.write(out, view) :]
+    elif hasattr(out, "write"):
+        for view in views:
+            while view:
+                n = out.write(view)
+                if n is None:  # writers returning None are assumed to take everything
+                    break
+                view = view[n:]
+    else:
+        raise TypeError("out must be a file descriptor or a binary file object")
+    lib.bz3_trace_end(lib.BZ3_TRACE_WRITE, len(buffers) // 2, t0)
+    return total
+
+
 class BZ3Compressor:
-    def __init__(self, block_size: int):
+    def __init__(
+        self,
+        block_size: int,
+        filter: int = FILTER_NONE,
+        typesize: int = 1,
+        probe: float = 0.0,
+        cdc: bool = False,
+        allow_stored: bool = False,
+    ):
+        self.state = self.buffer = ffi.NULL
+        self._lock = Lock()  # serializes concurrent calls on the same object
         if block_size < KiB(65) or block_size > MiB(511):
             raise ValueError("Block size must be between 65 KiB and 511 MiB")
+        check_filter(filter, typesize)
+        probe = store_probe(probe, allow_stored)
         self.block_size = block_size
-        self.state = lib.bz3_new(block_size)
+        self.filter = filter  # FILTER_* applied to every block before encoding
+        self.typesize = typesize
+        # entropy threshold in bits per byte with allow_stored, 0 encodes every block
+        self.probe = probe
+        self.blocks = 0  # blocks written so far
+        self.stored_blocks = 0  # of which stored as is
+        # content-defined block boundaries instead of every block_size bytes
+        self.cdc = cdc
+        self.header = make_stream_header(
+            block_size, filter, typesize, stream_flags(probe)
+        )
+        self.state = lib.bz3_state_acquire(block_size)
         if self.state == ffi.NULL:
             raise MemoryError("Failed to create a block encoder state")
-        self.buffer = ffi.cast("uint8_t*", lib.PyMem_Malloc(lib.bz3_bound(block_size)))
+        self.buffer = ffi.cast(
+            "uint8_t*", lib.bz3_buffer_alloc(lib.bz3_bound(block_size))
+        )
         if self.buffer == ffi.NULL:
-            lib.bz3_free(self.state)
+            lib.bz3_state_release(self.state, self.block_size)
             raise MemoryError("Failed to allocate memory")
         self.uncompressed = bytearray()
         self.have_magic_number = False  # 还没有写入magic number
-        self.byteswap_buf = ffi.new(
-            "uint8_t[4]"
-        )  # fixme: multithread concurrent competition, e.g. single instance in multithread
+        self.byteswap_buf = ffi.new("uint8_t[4]")  # only used under self._lock
+        self.frame_buf = ffi.new("uint8_t[8]")  # only used under self._lock
 
     def __del__(self):
         if self.state != ffi.NULL:
-            lib.bz3_free(self.state)
+            lib.bz3_state_release(self.state, self.block_size)
         if self.buffer != ffi.NULL:
-            lib.PyMem_Free(self.buffer)
+            lib.bz3_buffer_free(self.buffer)
 
-    def compress(self, data: bytes) -> bytes:
-        input_size: int = len(data)
-        ret = bytearray()
-        if not self.have_magic_number:
-            ret.extend(b"BZ3v1")
-            lib.write_neutral_s32(
-                ffi.cast("uint8_t*", self.byteswap_buf), self.block_size
+    def _encode(self, buffer, size: int) -> int:
+        """Encode, or store when the probe predicts no gain, size bytes at buffer in place"""
+        new_size = lib.bz3_encode_block_probed(self.state, buffer, size, self.probe)
+        if new_size == -1:
+            raise ValueError(
+                "Failed to encode a block: %s" % lib.bz3_strerror(self.state)
             )
-            ret.extend(ffi.unpack(ffi.cast("char*", self.byteswap_buf), 4))
-            self.have_magic_number = True
+        self.blocks += 1
+        if lib.bz3_is_stored(buffer, new_size):
+            self.stored_blocks += 1
+        return new_size
 
-        if input_size > 0:
-            self.uncompressed.extend(data)
-            while len(self.uncompressed) >= self.block_size:
-                lib.memcpy(
-                    self.buffer, ffi.from_buffer(self.uncompressed), self.block_size
-                )
-                # make a copy
-                new_size = lib.bz3_encode_block(
-                    self.state, self.buffer, self.block_size
-                )
-                if new_size == -1:
-                    raise ValueError(
-                        "Failed to encode a block: %s" % lib.bz3_strerror(self.state)
+    def _next_block(self, final: bool) -> int:
+        """The size of the next block to encode from uncompressed, 0 if there is none yet.
+        Before final only full windows of block_size bytes are cut, so the blocks don't
+        depend on how the data was split across calls"""
+        size = len(self.uncompressed)
+        if size == 0 or (size < self.block_size and not final):
+            return 0
+        size = min(size, self.block_size)
+        if self.cdc:
+            return lib.bz3_cdc_cut(
+                ffi.from_buffer("uint8_t[]", self.uncompressed), size, self.block_size
+            )
+        return size
+
+    def _frame(self, new_size: int, old_size: int) -> list:
+        """8-byte block header and encoded payload, both over native memory"""
+        lib.write_neutral_s32(self.frame_buf, new_size)
+        lib.write_neutral_s32(self.frame_buf + 4, old_size)
+        return [ffi.buffer(self.frame_buf), ffi.buffer(self.buffer, new_size)]
+
+    def compress(self, data: bytes) -> bytes:
+        with self._lock:
+            input_size: int = len(data)
+            ret = bytearray()
+            if not self.have_magic_number:
+                ret.extend(self.header)
+                self.have_magic_number = True
+
+            if input_size > 0:
+                self.uncompressed.extend(data)
+                while True:
+                    old_size = self._next_block(False)
+                    if old_size == 0:
+                        break
+                    lib.bz3_filter(
+                        self.buffer,
+                        ffi.from_buffer("uint8_t[]", self.uncompressed),
+                        old_size,
+                        self.filter,
+                        self.typesize,
                     )
+                    # make a copy
+                    new_size = self._encode(self.buffer, old_size)
+
+                    lib.write_neutral_s32(
+                        ffi.cast("uint8_t*", self.byteswap_buf), new_size
+                    )
+                    ret.extend(ffi.unpack(ffi.cast("char*", self.byteswap_buf), 4))
+                    lib.write_neutral_s32(
+                        ffi.cast("uint8_t*", self.byteswap_buf), old_size
+                    )
+                    ret.extend(ffi.unpack(ffi.cast("char*", self.byteswap_buf), 4))
+                    ret.extend(ffi.unpack(ffi.cast("char*", self.buffer), new_size))
+
+                    del self.uncompressed[:old_size]
+            return bytes(ret)
 
+    def flush(self) -> bytes:
+        with self._lock:
+            ret = bytearray()
+            while True:  # a single block, unless cdc cuts what is left
+                old_size = self._next_block(True)
+                if old_size == 0:
+                    break
+                lib.bz3_filter(
+                    self.buffer,
+                    ffi.from_buffer("uint8_t[]", self.uncompressed),
+                    old_size,
+                    self.filter,
+                    self.typesize,
+                )
+                new_size = self._encode(self.buffer, old_size)
+                # ret = PyBytes_FromStringAndSize(NULL, new_size + 8)
+                # if not ret:
+                #     raise
                 lib.write_neutral_s32(ffi.cast("uint8_t*", self.byteswap_buf), new_size)
                 ret.extend(ffi.unpack(ffi.cast("char*", self.byteswap_buf), 4))
-                lib.write_neutral_s32(
-                    ffi.cast("uint8_t*", self.byteswap_buf), self.block_size
-                )
+                lib.write_neutral_s32(ffi.cast("uint8_t*", self.byteswap_buf), old_size)
                 ret.extend(ffi.unpack(ffi.cast("char*", self.byteswap_buf), 4))
                 ret.extend(ffi.unpack(ffi.cast("char*", self.buffer), new_size))
+                del self.uncompressed[:old_size]
+            return bytes(ret)
 
-                del self.uncompressed[: self.block_size]
-        return bytes(ret)
+    def compress_to(self, data, out) -> int:
+        """Like compress(), but write the output to out, a file descriptor or a binary file object,
+        straight from the native buffer. Returns the number of bytes written"""
+        with self._lock:
+            written = 0
+            head = []
+            if not self.have_magic_number:
+                head.append(self.header)
+            self.uncompressed.extend(data)
+            while True:
+                old_size = self._next_block(False)
+                if old_size == 0:
+                    break
+                lib.bz3_filter(
+                    self.buffer,
+                    ffi.from_buffer("uint8_t[]", self.uncompressed),
+                    old_size,
+                    self.filter,
+                    self.typesize,
+                )
+                new_size = self._encode(self.buffer, old_size)
+                written += write_to(out, head + self._frame(new_size, old_size))
+                head = []
+                self.have_magic_number = True
+                del self.uncompressed[:old_size]
+            if head:
+                written += write_to(out, head)
+                self.have_magic_number = True
+            return written
 
-    def flush(self) -> bytes:
-        ret = bytearray()
-        if self.uncompressed:
-            lib.memcpy(
-                self.buffer, ffi.from_buffer(self.uncompressed), len(self.uncompressed)
-            )
-            new_size = lib.bz3_encode_block(
-                self.state, self.buffer, len(self.uncompressed)
-            )
-            if new_size == -1:
+    def flush_to(self, out) -> int:
+        """Like flush(), but write the output to out, returns the number of bytes written"""
+        with self._lock:
+            written = 0
+            while True:
+                old_size = self._next_block(True)
+                if old_size == 0:
+                    break
+                lib.bz3_filter(
+                    self.buffer,
+                    ffi.from_buffer("uint8_t[]", self.uncompressed),
+                    old_size,
+                    self.filter,
+                    self.typesize,
+                )
+                new_size = self._encode(self.buffer, old_size)
+                written += write_to(out, self._frame(new_size, old_size))
+                del self.uncompressed[:old_size]
+            return written
+
+    def _compress_bound(self, size: int) -> int:
+        total = len(self.uncompressed) + size
+        blocks = total // self.block_size
+        header = 0 if self.have_magic_number else len(self.header)
+        if self.cdc and blocks:
+            # more and smaller blocks, each over BZ3_CDC_MIN bytes. bz3_bound is linear plus
+            # a constant, so the blocks need at most bz3_bound(total) and the constant per block
+            blocks = total // lib.BZ3_CDC_MIN(self.block_size)
+            return header + blocks * (8 + lib.bz3_bound(0)) + lib.bz3_bound(total)
+        return header + blocks * (8 + lib.bz3_bound(self.block_size))
+
+    def _flush_bound(self) -> int:
+        size = len(self.uncompressed)
+        if self.cdc and size:
+            blocks = size // lib.BZ3_CDC_MIN(self.block_size) + 1
+            return blocks * (8 + lib.bz3_bound(0)) + lib.bz3_bound(size)
+        return 8 + lib.bz3_bound(size) if size else 0
+
+    def compress_bound(self, size: int) -> int:
+        """Worst-case number of bytes compress_into() writes for size bytes of input"""
+        with self._lock:
+            return self._compress_bound(size)
+
+    def flush_bound(self) -> int:
+        """Worst-case number of bytes flush_into() writes"""
+        with self._lock:
+            return self._flush_bound()
+
+    def compress_into(self, data, out) -> int:
+        """Like compress(), but write the output into out, a writable buffer. Blocks are encoded
+        in place inside out. Returns the number of bytes written, raises ValueError before
+        touching anything if out can't hold compress_bound(len(data)) bytes"""
+        with self._lock:
+            input_size = len(memoryview(data).cast("B"))
+            dst = ffi.from_buffer("uint8_t[]", out, require_writable=True)
+            needed = self._compress_bound(input_size)
+            if len(dst) < needed:
                 raise ValueError(
-                    "Failed to encode a block: %s" % lib.bz3_strerror(self.state)
+                    "out is too small, need %d more bytes" % (needed - len(dst))
                 )
-            # ret = PyBytes_FromStringAndSize(NULL, new_size + 8)
-            # if not ret:
-            #     raise
-            lib.write_neutral_s32(ffi.cast("uint8_t*", self.byteswap_buf), new_size)
-            ret.extend(ffi.unpack(ffi.cast("char*", self.byteswap_buf), 4))
-            lib.write_neutral_s32(
-                ffi.cast("uint8_t*", self.byteswap_buf), len(self.uncompressed)
-            )
-            ret.extend(ffi.unpack(ffi.cast("char*", self.byteswap_buf), 4))
-            ret.extend(ffi.unpack(ffi.cast("char*", self.buffer), new_size))
-            self.uncompressed.clear()
-        return bytes(ret)
+            pos = 0
+            if not self.have_magic_number:
+                ffi.memmove(dst, self.header, len(self.header))
+                pos = len(self.header)
+                self.have_magic_number = True
+            self.uncompressed.extend(data)
+            while True:
+                old_size = self._next_block(False)
+                if old_size == 0:
+                    break
+                lib.bz3_filter(
+                    dst + pos + 8,
+                    ffi.from_buffer("uint8_t[]", self.uncompressed),
+                    old_size,
+                    self.filter,
+                    self.typesize,
+                )
+                new_size = self._encode(dst + pos + 8, old_size)
+                lib.write_neutral_s32(dst + pos, new_size)
+                lib.write_neutral_s32(dst + pos + 4, old_size)
+                pos += 8 + new_size
+                del self.uncompressed[:old_size]
+            return pos
+
+    def flush_into(self, out) -> int:
+        """Like flush(), but write the output into out, returns the number of bytes written.
+        out must hold at least flush_bound() bytes"""
+        with self._lock:
+            dst = ffi.from_buffer("uint8_t[]", out, require_writable=True)
+            needed = self._flush_bound()
+            if len(dst) < needed:
+                raise ValueError(
+                    "out is too small, need %d more bytes" % (needed - len(dst))
+                )
+            pos = 0
+            while True:
+                old_size = self._next_block(True)
+                if old_size == 0:
+                    break
+                lib.bz3_filter(
+                    dst + pos + 8,
+                    ffi.from_buffer("uint8_t[]", self.uncompressed),
+                    old_size,
+                    self.filter,
+                    self.typesize,
+                )
+                new_size = self._encode(dst + pos + 8, old_size)
+                lib.write_neutral_s32(dst + pos, new_size)
+                lib.write_neutral_s32(dst + pos + 4, old_size)
+                pos += 8 + new_size
+                del self.uncompressed[:old_size]
+            return pos
+
+    @property
+    def buffered(self) -> int:
+        """Uncompressed bytes held back until they fill a block or are flushed."""
+        with self._lock:
+            return len(self.uncompressed)
 
     def error(self) -> str:
         if lib.bz3_last_error(self.state) != lib.BZ3_OK:
@@ -127,73 +490,188 @@ class BZ3Decompressor:
     def init_state(self, block_size: int) -> int:
         """should exec only once"""
         self.block_size = block_size
-        self.state = lib.bz3_new(block_size)
+        self.state = lib.bz3_state_acquire(block_size)
         if self.state == ffi.NULL:
             raise MemoryError("Failed to create a block encoder state")
         self.buffer_size = lib.bz3_bound(block_size)
-        self.buffer = ffi.cast("uint8_t*", lib.PyMem_Malloc(self.buffer_size))
+        self.buffer = ffi.cast("uint8_t*", lib.bz3_buffer_alloc(self.buffer_size))
         if self.buffer == ffi.NULL:
-            lib.bz3_free(self.state)
+            lib.bz3_state_release(self.state, self.block_size)
             self.state = ffi.NULL
             raise MemoryError("Failed to allocate memory")
 
     def __init__(self, ignore_error: bool = False):
+        self.state = self.buffer = ffi.NULL
+        self._lock = Lock()  # serializes concurrent calls on the same object
         self.unused = bytearray()
         self.have_magic_number = False  # 还没有读到magic number
         self.ignore_error = ignore_error
+        self.filter = FILTER_NONE  # read from the stream header
+        self.typesize = 1
+        self.pending = memoryview(
+            b""
+        )  # decoded by decompress_into, not written to out yet
 
     def __del__(self):
         if self.state != ffi.NULL:
-            lib.bz3_free(self.state)
+            lib.bz3_state_release(self.state, self.block_size)
         if self.buffer != ffi.NULL:
-            lib.PyMem_Free(self.buffer)
+            lib.bz3_buffer_free(self.buffer)
 
     def decompress(self, data: bytes) -> bytes:
-        input_size: int = len(data)
-        ret = bytearray()
-        # cdef int32_t new_size, old_size, block_size
-        if input_size > 0:
-            # if PyByteArray_Resize(self.unused, input_size+PyByteArray_GET_SIZE(self.unused)) < 0:
-            #     raise
-            # memcpy(&(PyByteArray_AS_STRING(self.unused)[PyByteArray_GET_SIZE(self.unused)-input_size]), &data[0], input_size) # self.unused.extend
-            self.unused.extend(data)
-            if (
-                len(self.unused) >= 9 and not self.have_magic_number
-            ):  # 9 bytes magic number
-                if bytes(self.unused[:5]) != b"BZ3v1":
-                    raise ValueError("Invalid signature")
-                temp = self.unused[5:9]
-                block_size = lib.read_neutral_s32(
-                    ffi.cast("uint8_t*", ffi.from_buffer(temp))
-                )
-                if block_size < KiB(65) or block_size > MiB(511):
-                    raise ValueError(
-                        "The input file is corrupted. Reason: Invalid block size in the header"
+        with self._lock:
+            input_size: int = len(data)
+            ret = bytearray()
+            if self.pending:  # left over by decompress_into
+                ret.extend(self.pending)
+                self.pending = memoryview(b"")
+            # cdef int32_t new_size, old_size, block_size
+            if input_size > 0:
+                # if PyByteArray_Resize(self.unused, input_size+PyByteArray_GET_SIZE(self.unused)) < 0:
+                #     raise
+                # memcpy(&(PyByteArray_AS_STRING(self.unused)[PyByteArray_GET_SIZE(self.unused)-input_size]), &data[0], input_size) # self.unused.extend
+                self.unused.extend(data)
+                if (
+                    not self.have_magic_number
+                ):  # 9 bytes magic number, 17 with the "BZ3F" prefix
+                    header = parse_stream_header(self.unused)
+                    if header is None:  # wait for the rest of the header
+                        return b""
+                    header_size, block_size, self.filter, self.typesize = header
+                    self.init_state(block_size)
+                    del self.unused[:header_size]
+                    self.have_magic_number = True
+
+                while True:
+                    if len(self.unused) < 8:  # 8 byte的 header都不够 直接返回
+                        break
+                    new_size = lib.read_neutral_s32(
+                        ffi.cast("uint8_t*", ffi.from_buffer(self.unused))
+                    )  # todo gcc warning but bytes is contst
+                    temp = self.unused[4:8]
+                    old_size = lib.read_neutral_s32(
+                        ffi.cast("uint8_t*", ffi.from_buffer(temp))
                     )
-                self.init_state(block_size)
-                del self.unused[:9]
-                self.have_magic_number = True
+                    if old_size > lib.bz3_bound(
+                        self.block_size
+                    ) or new_size > lib.bz3_bound(self.block_size):
+                        raise ValueError(
+                            "Failed to decode a block: Inconsistent headers."
+                        )
+                    if len(self.unused) < new_size + 8:  # 数据段不够
+                        break
+                    temp = self.unused[8:]
+                    lib.memcpy(self.buffer, ffi.from_buffer(temp), new_size)
 
-            while True:
-                if len(self.unused) < 8:  # 8 byte的 header都不够 直接返回
-                    break
-                new_size = lib.read_neutral_s32(
-                    ffi.cast("uint8_t*", ffi.from_buffer(self.unused))
-                )  # todo gcc warning but bytes is contst
-                temp = self.unused[4:8]
-                old_size = lib.read_neutral_s32(
-                    ffi.cast("uint8_t*", ffi.from_buffer(temp))
-                )
-                if old_size > lib.bz3_bound(
-                    self.block_size
-                ) or new_size > lib.bz3_bound(self.block_size):
-                    raise ValueError("Failed to decode a block: Inconsistent headers.")
-                if len(self.unused) < new_size + 8:  # 数据段不够
-                    break
-                temp = self.unused[8:]
-                lib.memcpy(self.buffer, ffi.from_buffer(temp), new_size)
+                    code = lib.bz3_decode_block_stored(
+                        self.state, self.buffer, self.buffer_size, new_size, old_size
+                    )
+                    if code == -1:
+                        if self.ignore_error:
+                            print(
+                                f"Writing invalid block: {lib.bz3_strerror(self.state)}",
+                                file=sys.stderr,
+                            )
+                        else:
+                            raise ValueError(
+                                "Failed to decode a block: %s"
+                                % lib.bz3_strerror(self.state)
+                            )
+                    extend_unfiltered(
+                        ret, self.buffer, old_size, self.filter, self.typesize
+                    )
+                    del self.unused[: new_size + 8]
+            return bytes(ret)
+
+    def _next_frame(self, data: memoryview) -> Tuple[int, int, int]:
+        """Copy the payload of the next block to self.buffer, taking what self.unused
+        holds first, then data. Returns (consumed, new_size, old_size), new_size is -1
+        if the block is incomplete, the bytes taken are then kept in self.unused"""
+        limit = lib.bz3_bound(self.block_size)
+        taken = 0
+        direct = not self.unused and len(data) >= 8
+        if direct:
+            header = data
+        else:
+            if len(self.unused) < 8:
+                taken = min(8 - len(self.unused), len(data))
+                self.unused += data[:taken]
+                if len(self.unused) < 8:
+                    return taken, -1, 0
+            header = self.unused
+        new_size, old_size = struct.unpack_from("<ii", header)
+        if not 0 <= new_size <= limit or not 0 <= old_size <= limit:
+            raise ValueError("Failed to decode a block: Inconsistent headers.")
+        if direct:
+            if len(data) < new_size + 8:  # keep the partial block for the next call
+                self.unused += data
+                return len(data), -1, 0
+            payload = data[8 : new_size + 8]
+            taken = new_size + 8
+        else:
+            if len(self.unused) < new_size + 8:
+                n = min(new_size + 8 - len(self.unused), len(data) - taken)
+                self.unused += data[taken : taken + n]
+                taken += n
+                if len(self.unused) < new_size + 8:
+                    return taken, -1, 0
+            payload = memoryview(self.unused)[8 : new_size + 8]
+        lib.memcpy(self.buffer, ffi.from_buffer(payload), new_size)
+        del payload
+        if not direct:
+            del self.unused[: new_size + 8]
+        return taken, new_size, old_size
+
+    def _keep_pending(self, size: int) -> None:
+        """hold on to the decoded block which doesn't fit in out"""
+        if self.filter == FILTER_NONE:
+            self.pending = memoryview(ffi.buffer(self.buffer, size))
+        else:
+            pending = bytearray(size)
+            lib.bz3_unfilter(
+                ffi.from_buffer("uint8_t[]", pending),
+                self.buffer,
+                size,
+                self.filter,
+                self.typesize,
+            )
+            self.pending = memoryview(pending)
 
-                code = lib.bz3_decode_block(
+    def decompress_into(self, data, out) -> Tuple[int, int]:
+        """Decompress data straight into out, returns (written, consumed).
+        Stops once out is full, data[consumed:] must then be passed again. Decoded bytes
+        which don't fit in out are kept and written first by the next call"""
+        with self._lock:
+            src = memoryview(data).cast("B")
+            dst = ffi.from_buffer("uint8_t[]", out, require_writable=True)
+            view = memoryview(out).cast("B")
+            out_size = len(view)
+            written = consumed = 0
+            while written < out_size:
+                if self.pending:
+                    n = min(len(self.pending), out_size - written)
+                    view[written : written + n] = self.pending[:n]
+                    self.pending = self.pending[n:]
+                    written += n
+                    continue
+                if not self.have_magic_number:
+                    n = max(lib.BZ3_FILTER_HEADER_SIZE + 9 - len(self.unused), 0)
+                    n = min(len(src) - consumed, n)
+                    self.unused += src[consumed : consumed + n]
+                    consumed += n
+                    header = parse_stream_header(self.unused)
+                    if header is None:  # wait for the rest of the header
+                        break
+                    header_size, block_size, self.filter, self.typesize = header
+                    self.init_state(block_size)
+                    del self.unused[:header_size]
+                    self.have_magic_number = True
+                    continue
+                n, new_size, old_size = self._next_frame(src[consumed:])
+                consumed += n
+                if new_size < 0:  # wait for the rest of the block
+                    break
+                code = lib.bz3_decode_block_stored(
                     self.state, self.buffer, self.buffer_size, new_size, old_size
                 )
                 if code == -1:
@@ -207,9 +685,14 @@ class BZ3Decompressor:
                             "Failed to decode a block: %s"
                             % lib.bz3_strerror(self.state)
                         )
-                ret.extend(ffi.unpack(ffi.cast("char*", self.buffer), old_size))
-                del self.unused[: new_size + 8]
-        return bytes(ret)
+                if old_size <= out_size - written:
+                    lib.bz3_unfilter(
+                        dst + written, self.buffer, old_size, self.filter, self.typesize
+                    )
+                    written += old_size
+                else:
+                    self._keep_pending(old_size)
+            return written, consumed
 
     @property
     def unused_data(self):
@@ -222,7 +705,208 @@ class BZ3Decompressor:
         return None
 
 
-def compress_file(input: IO, output: IO, block_size: int) -> None:
+class BZ3State:
+    """Low level block encoder/decoder working in place on caller-owned buffers"""
+
+    def __init__(self, block_size: int):
+        self.state = ffi.NULL
+        self._lock = Lock()  # serializes concurrent calls on the same object
+        if block_size < KiB(65) or block_size > MiB(511):
+            raise ValueError("Block size must be between 65 KiB and 511 MiB")
+        self.block_size = block_size
+        # the last call failed, libbz3 keeps an error past some successful calls
+        self._failed = False
+        self.state = lib.bz3_state_acquire(block_size)
+        if self.state == ffi.NULL:
+            raise MemoryError("Failed to create a block encoder state")
+
+    def __del__(self):
+        if self.state != ffi.NULL:
+            lib.bz3_state_release(self.state, self.block_size)
+            self.state = ffi.NULL
+
+    def encode_block(self, buf, size: int, probe: float = 0.0) -> int:
+        """Encode the first size bytes of buf in place, returns the compressed size.
+        buf must be writable and hold at least bound(size) bytes. probe works as for
+        BZ3Compressor with allow_stored, a block at or above it is stored as is, which
+        only streams flagged STREAM_STORED may hold"""
+        check_probe(probe)
+        with self._lock:
+            if size < 0 or size > self.block_size:
+                raise ValueError("size must be between 0 and block_size")
+            buffer = ffi.from_buffer("uint8_t[]", buf, require_writable=True)
+            if len(buffer) < lib.bz3_bound(size):
+                raise ValueError("buf must hold at least bound(size) bytes")
+            new_size = lib.bz3_encode_block_probed(self.state, buffer, size, probe)
+            self._failed = new_size == -1
+            if self._failed:
+                raise ValueError(
+                    "Failed to encode a block: %s" % lib.bz3_strerror(self.state)
+                )
+            return new_size
+
+    def decode_block(self, buf, compressed_size: int, orig_size: int) -> int:
+        """Decode the first compressed_size bytes of buf in place, returns the decoded size.
+        buf must be writable and hold at least max(compressed_size, orig_size) bytes"""
+        with self._lock:
+            if compressed_size < 0 or orig_size < 0 or orig_size > self.block_size:
+                raise ValueError("Failed to decode a block: Inconsistent headers.")
+            buffer = ffi.from_buffer("uint8_t[]", buf, require_writable=True)
+            if len(buffer) < max(compressed_size, orig_size, 1):
+                raise ValueError("buf is smaller than the block")
+            code = lib.bz3_decode_block_stored(
+                self.state, buffer, len(buffer), compressed_size, orig_size
+            )
+            self._failed = code == -1
+            if self._failed:
+                raise ValueError(
+                    "Failed to decode a block: %s" % lib.bz3_strerror(self.state)
+                )
+            return code
+
+    @property
+    def last_error(self) -> int:
+        """The bzip3 error code of the last operation, 0 means BZ3_OK"""
+        return lib.bz3_last_error(self.state) if self._failed else lib.BZ3_OK
+
+    def error(self) -> Optional[str]:
+        if self._failed:
+            return ffi.string(lib.bz3_strerror(self.state)).decode()
+        return None
+
+
+def readinto_full(input: IO, view: memoryview) -> int:
+    """Fill view with input.readinto, short only at the end of the file"""
+    done = 0
+    while done < len(view):
+        n = input.readinto(view if done == 0 else view[done:])
+        if not n:
+            break
+        done += n
+    return done
+
+
+def trim_output(
+    output: IO, block_size: int, probe: float, state, buffer, buffer_size: int
+) -> int:
+    """Keep the complete blocks of a partial compress_file output, truncate whatever a
+    crash left behind them and leave output positioned at its new end. Returns how
+    many input bytes the kept blocks hold, or -1 when output holds no stream header yet
+    """
+    data: bytes = output.read(9)
+    if len(data) == 9 and data[:4] == b"BZ3F":
+        data += output.read(lib.BZ3_FILTER_HEADER_SIZE)
+    header = parse_stream_header(data)
+    if header is None:  # the crash came before the header made it out
+        output.seek(0)
+        output.truncate()
+        return -1
+    pos, size, filter, _ = header
+    if size != block_size:
+        raise ValueError(
+            "The output was written with a block size of %d, not %d"
+            % (size, block_size)
+        )
+    if filter != FILTER_NONE:
+        raise ValueError(
+            "The output is a filtered stream, which compress_file doesn't write"
+        )
+    if probe > 0 and (pos == 9 or not data[6] & lib.BZ3_STREAM_STORED):
+        raise ValueError(
+            "The output was written without stored blocks, they can't be added to it"
+        )
+    end = output.seek(0, 2)
+    last = -1
+    last_new = last_old = 0
+    total = 0
+    output.seek(pos)
+    while pos + 8 <= end:
+        new_size, old_size = struct.unpack("<ii", output.read(8))
+        # an encoded block is never shorter than its crc and index, a zero filled
+        # tail stops here as well
+        if (
+            new_size <= 8
+            or old_size <= 0
+            or old_size > block_size
+            or new_size > buffer_size
+        ):
+            break
+        if pos + 8 + new_size > end:  # torn
+            break
+        last, last_new, last_old = pos, new_size, old_size
+        total += old_size
+        pos += 8 + new_size
+        output.seek(pos)
+    if last != -1:
+        # the headers of the last block may have made it to disk before its payload did
+        output.seek(last + 8)
+        view = memoryview(ffi.buffer(buffer, last_new))
+        if (
+            readinto_full(output, view) < last_new
+            or lib.bz3_decode_block_stored(
+                state, buffer, buffer_size, last_new, last_old
+            )
+            == -1
+        ):
+            pos = last
+            total -= last_old
+    output.seek(pos)
+    output.truncate()
+    return total
+
+
+def skip_input(input: IO, offset: int, view: memoryview) -> None:
+    """Move input past the offset bytes a resumed output already holds"""
+    if hasattr(input, "seekable") and input.seekable():
+        pos = input.seek(offset, 1)
+        if pos > input.seek(0, 2):
+            raise ValueError("The input is shorter than the output resumed from it")
+        input.seek(pos)
+        return
+    while offset > 0:
+        n = min(len(view), offset)
+        if hasattr(input, "readinto"):
+            n = readinto_full(input, view[:n])
+        else:
+            n = len(input.read(n))
+        if n == 0:
+            raise ValueError("The input is shorter than the output resumed from it")
+        offset -= n
+
+
+def resume_output(
+    output: IO, block_size: int, probe: float = 0.0, allow_stored: bool = False
+) -> int:
+    probe = store_probe(probe, allow_stored)
+    if not check_file(output):
+        raise TypeError(
+            "output except a file-like object, got %s" % type(output).__name__
+        )
+    state = lib.bz3_state_acquire(block_size)
+    if state == ffi.NULL:
+        raise MemoryError("Failed to create a block encoder state")
+    buffer_size = lib.bz3_bound(block_size)
+    buffer = ffi.cast("uint8_t*", lib.bz3_buffer_alloc(buffer_size))
+    if buffer == ffi.NULL:
+        lib.bz3_state_release(state, block_size)
+        raise MemoryError("Failed to allocate memory")
+    try:
+        output.seek(0)
+        return trim_output(output, block_size, probe, state, buffer, buffer_size)
+    finally:
+        lib.bz3_state_release(state, block_size)
+        lib.bz3_buffer_free(buffer)
+
+
+def compress_file(
+    input: IO,
+    output: IO,
+    block_size: int,
+    probe: float = 0.0,
+    resume: bool = False,
+    allow_stored: bool = False,
+) -> None:
+    probe = store_probe(probe, allow_stored)
     if not check_file(input):
         raise TypeError(
             "input except a file-like object, got %s" % type(input).__name__
@@ -231,39 +915,56 @@ def compress_file(input: IO, output: IO, block_size: int) -> None:
         raise TypeError(
             "output except a file-like object, got %s" % type(output).__name__
         )
-    state = lib.bz3_new(block_size)
+    state = lib.bz3_state_acquire(block_size)
     if state == ffi.NULL:
         raise MemoryError("Failed to create a block encoder state")
-    buffer = ffi.cast("uint8_t*", lib.PyMem_Malloc(lib.bz3_bound(block_size)))
+    buffer_size = lib.bz3_bound(block_size)
+    buffer = ffi.cast("uint8_t*", lib.bz3_buffer_alloc(buffer_size))
     if buffer == ffi.NULL:
-        lib.bz3_free(state)
+        lib.bz3_state_release(state, block_size)
         raise MemoryError
-    byteswap_buf = ffi.new("uint8_t[4]")
-    output.write(b"BZ3v1")
-    lib.write_neutral_s32(byteswap_buf, block_size)
-    output.write(ffi.unpack(ffi.cast("char*", byteswap_buf), 4))  # magic header
+    has_readinto = hasattr(input, "readinto")
+    # views over the native buffers are created once, blocks are read into and
+    # written from them directly
+    buffer_view = memoryview(ffi.buffer(buffer, buffer_size))
+    block_view = buffer_view[:block_size]
+    frame = ffi.new("uint8_t[8]")
+    frame_view = memoryview(ffi.buffer(frame, 8))
 
     try:
+        offset = -1
+        if resume:  # carry on after the last block that made it out intact
+            output.seek(0)
+            offset = trim_output(output, block_size, probe, state, buffer, buffer_size)
+        if offset == -1:
+            output.write(  # magic header
+                make_stream_header(block_size, FILTER_NONE, 1, stream_flags(probe))
+            )
+        else:
+            skip_input(input, offset, block_view)
         while True:
-            data = input.read(block_size)
-            if not data:
+            if has_readinto:
+                old_size = readinto_full(input, block_view)
+            else:
+                data = input.read(block_size)
+                old_size = len(data)
+                lib.memcpy(buffer, ffi.from_buffer(data), old_size)
+            if old_size == 0:
                 break
-            lib.memcpy(buffer, ffi.from_buffer(data), len(data))
-            new_size = lib.bz3_encode_block(state, buffer, len(data))
+            new_size = lib.bz3_encode_block_probed(state, buffer, old_size, probe)
             if new_size == -1:
                 raise ValueError(
                     "Failed to encode a block: %s" % lib.bz3_strerror(state)
                 )
-            lib.write_neutral_s32(byteswap_buf, new_size)
-            output.write(ffi.unpack(ffi.cast("char*", byteswap_buf), 4))
-            lib.write_neutral_s32(byteswap_buf, len(data))
-            output.write(ffi.unpack(ffi.cast("char*", byteswap_buf), 4))
-            output.write(ffi.unpack(ffi.cast("char*", buffer), new_size))
+            lib.write_neutral_s32(frame, new_size)
+            lib.write_neutral_s32(frame + 4, old_size)
+            output.write(frame_view)
+            output.write(buffer_view[:new_size])
             output.flush()
     finally:
         output.flush()
-        lib.bz3_free(state)
-        lib.PyMem_Free(buffer)
+        lib.bz3_state_release(state, block_size)
+        lib.bz3_buffer_free(buffer)
 
 
 def decompress_file(input: IO, output: IO) -> None:
@@ -275,59 +976,65 @@ def decompress_file(input: IO, output: IO) -> None:
         raise TypeError(
             "output except a file-like object, got %s" % type(output).__name__
         )
-    # cdef bytes data
-    # cdef int32_t block_size
-    data: bytes = input.read(9)  # magic and block_size type: bytes len = 9
-    if len(data) < 9:
-        raise ValueError("Invalid file. Reason: Smaller than magic header")
-    if data[:5] != b"BZ3v1":
-        raise ValueError("Invalid signature")
-    block_size: int = lib.read_neutral_s32(
-        ffi.cast("uint8_t*", ffi.from_buffer(data[5:]))
-    )
-    if block_size < KiB(65) or block_size > MiB(511):
-        raise ValueError(
-            "The input file is corrupted. Reason: Invalid block size in the header"
-        )
-    state = lib.bz3_new(block_size)
+    block_size, filter, typesize = read_stream_header(input)
+    state = lib.bz3_state_acquire(block_size)
     if state == ffi.NULL:
         raise MemoryError("Failed to create a block encoder state")
     buffer_size = lib.bz3_bound(block_size)
-    buffer = ffi.cast("uint8_t*", lib.PyMem_Malloc(buffer_size))
-    if buffer == ffi.NULL:
-        lib.bz3_free(state)
+    buffer = ffi.cast("uint8_t*", lib.bz3_buffer_alloc(buffer_size))
+    # blocks of filtered streams are unfiltered into a second buffer
+    unfiltered = ffi.NULL
+    if buffer != ffi.NULL and filter != FILTER_NONE:
+        unfiltered = ffi.cast("uint8_t*", lib.bz3_buffer_alloc(buffer_size))
+    if buffer == ffi.NULL or (filter != FILTER_NONE and unfiltered == ffi.NULL):
+        lib.bz3_state_release(state, block_size)
+        lib.bz3_buffer_free(buffer)
         raise MemoryError("Failed to allocate memory")
-    # cdef uint8_t byteswap_buf[4]
-    # cdef int32_t new_size, old_size, code
+    has_readinto = hasattr(input, "readinto")
+    buffer_view = memoryview(ffi.buffer(buffer, buffer_size))
+    output_view = buffer_view
+    if unfiltered != ffi.NULL:
+        output_view = memoryview(ffi.buffer(unfiltered, buffer_size))
+    frame = ffi.new("uint8_t[8]")
+    frame_view = memoryview(ffi.buffer(frame))
     try:
         while True:
-            data = input.read(4)
-            if len(data) < 4:
-                break
-            new_size = lib.read_neutral_s32(ffi.cast("uint8_t*", ffi.from_buffer(data)))
-            data = input.read(4)
-            if len(data) < 4:
-                break
-            old_size = lib.read_neutral_s32(ffi.cast("uint8_t*", ffi.from_buffer(data)))
-            if old_size > lib.bz3_bound(block_size) or new_size > lib.bz3_bound(
-                block_size
-            ):
+            if has_readinto:
+                if readinto_full(input, frame_view) < 8:
+                    break
+            else:
+                data = input.read(8)
+                if len(data) < 8:
+                    break
+                frame_view[:] = data
+            new_size = lib.read_neutral_s32(frame)
+            old_size = lib.read_neutral_s32(frame + 4)
+            if not 0 <= old_size <= buffer_size or not 0 <= new_size <= buffer_size:
                 raise ValueError("Failed to decode a block: Inconsistent headers.")
-            data = input.read(new_size)  # type: bytes
-            if len(data) < new_size:
-                break
-            lib.memcpy(buffer, ffi.cast("uint8_t*", ffi.from_buffer(data)), new_size)
-            code = lib.bz3_decode_block(state, buffer, buffer_size, new_size, old_size)
+            if has_readinto:
+                if readinto_full(input, buffer_view[:new_size]) < new_size:
+                    break
+            else:
+                data = input.read(new_size)  # type: bytes
+                if len(data) < new_size:
+                    break
+                buffer_view[:new_size] = data
+            code = lib.bz3_decode_block_stored(
+                state, buffer, buffer_size, new_size, old_size
+            )
             if code == -1:
                 raise ValueError(
                     "Failed to decode a block: %s" % lib.bz3_strerror(state)
                 )
-            output.write(ffi.unpack(ffi.cast("char*", buffer), old_size))
+            if unfiltered != ffi.NULL:
+                lib.bz3_unfilter(unfiltered, buffer, old_size, filter, typesize)
+            output.write(output_view[:old_size])
             output.flush()
     finally:
         output.flush()
-        lib.bz3_free(state)
-        lib.PyMem_Free(buffer)
+        lib.bz3_state_release(state, block_size)
+        lib.bz3_buffer_free(buffer)
+        lib.bz3_buffer_free(unfiltered)
 
 
 def recover_file(input: IO, output: IO) -> None:
@@ -339,27 +1046,19 @@ def recover_file(input: IO, output: IO) -> None:
         raise TypeError(
             "output except a file-like object, got %s" % type(output).__name__
         )
-    # cdef bytes data
-    # cdef int32_t block_size
-    data: bytes = input.read(9)  # magic and block_size type: bytes len = 9
-    if len(data) < 9:
-        raise ValueError("Invalid file. Reason: Smaller than magic header")
-    if data[:5] != b"BZ3v1":
-        raise ValueError("Invalid signature")
-    block_size: int = lib.read_neutral_s32(
-        ffi.cast("uint8_t*", ffi.from_buffer(data[5:]))
-    )
-    if block_size < KiB(65) or block_size > MiB(511):
-        raise ValueError(
-            "The input file is corrupted. Reason: Invalid block size in the header"
-        )
-    state = lib.bz3_new(block_size)
+    block_size, filter, typesize = read_stream_header(input)
+    state = lib.bz3_state_acquire(block_size)
     if state == ffi.NULL:
         raise MemoryError("Failed to create a block encoder state")
     buffer_size = lib.bz3_bound(block_size)
-    buffer = ffi.cast("uint8_t*", lib.PyMem_Malloc(buffer_size))
-    if buffer == ffi.NULL:
-        lib.bz3_free(state)
+    buffer = ffi.cast("uint8_t*", lib.bz3_buffer_alloc(buffer_size))
+    # blocks of filtered streams are unfiltered into a second buffer
+    unfiltered = ffi.NULL
+    if buffer != ffi.NULL and filter != FILTER_NONE:
+        unfiltered = ffi.cast("uint8_t*", lib.bz3_buffer_alloc(buffer_size))
+    if buffer == ffi.NULL or (filter != FILTER_NONE and unfiltered == ffi.NULL):
+        lib.bz3_state_release(state, block_size)
+        lib.bz3_buffer_free(buffer)
         raise MemoryError("Failed to allocate memory")
     # cdef uint8_t byteswap_buf[4]
     # cdef int32_t new_size, old_size, code
@@ -381,17 +1080,24 @@ def recover_file(input: IO, output: IO) -> None:
             if len(data) < new_size:
                 break
             lib.memcpy(buffer, ffi.cast("uint8_t*", ffi.from_buffer(data)), new_size)
-            code = lib.bz3_decode_block(state, buffer, buffer_size, new_size, old_size)
+            code = lib.bz3_decode_block_stored(
+                state, buffer, buffer_size, new_size, old_size
+            )
             if code == -1:
                 print(
                     f"Writing invalid block: {lib.bz3_strerror(state)}", file=sys.stderr
                 )
-            output.write(ffi.unpack(ffi.cast("char*", buffer), old_size))
+            if unfiltered != ffi.NULL:
+                lib.bz3_unfilter(unfiltered, buffer, old_size, filter, typesize)
+                output.write(ffi.unpack(ffi.cast("char*", unfiltered), old_size))
+            else:
+                output.write(ffi.unpack(ffi.cast("char*", buffer), old_size))
             output.flush()
     finally:
         output.flush()
-        lib.bz3_free(state)
-        lib.PyMem_Free(buffer)
+        lib.bz3_state_release(state, block_size)
+        lib.bz3_buffer_free(buffer)
+        lib.bz3_buffer_free(unfiltered)
 
 
 def test_file(input: IO, should_raise: bool = False) -> bool:
@@ -399,33 +1105,19 @@ def test_file(input: IO, should_raise: bool = False) -> bool:
         raise TypeError(
             "input except a file-like object, got %s" % type(input).__name__
         )
-    # cdef bytes data
-    # cdef int32_t block_size
-    data: bytes = input.read(9)  # magic and block_size type: bytes len = 9
-    if len(data) < 9:
-        if should_raise:
-            raise ValueError("Invalid file. Reason: Smaller than magic header")
-        return False
-    if data[:5] != b"BZ3v1":
-        if should_raise:
-            raise ValueError("Invalid signature")
-        return False
-    block_size: int = lib.read_neutral_s32(
-        ffi.cast("uint8_t*", ffi.from_buffer(data[5:]))
-    )
-    if block_size < KiB(65) or block_size > MiB(511):
+    try:
+        block_size = read_stream_header(input)[0]
+    except ValueError:
         if should_raise:
-            raise ValueError(
-                "The input file is corrupted. Reason: Invalid block size in the header"
-            )
+            raise
         return False
-    state = lib.bz3_new(block_size)
+    state = lib.bz3_state_acquire(block_size)
     if state == ffi.NULL:
         raise MemoryError("Failed to create a block encoder state")
     buffer_size = lib.bz3_bound(block_size)
-    buffer = ffi.cast("uint8_t*", lib.PyMem_Malloc(buffer_size))
+    buffer = ffi.cast("uint8_t*", lib.bz3_buffer_alloc(buffer_size))
     if buffer == ffi.NULL:
-        lib.bz3_free(state)
+        lib.bz3_state_release(state, block_size)
         raise MemoryError("Failed to allocate memory")
     # cdef uint8_t byteswap_buf[4]
     # cdef int32_t new_size, old_size, code
@@ -447,7 +1139,9 @@ def test_file(input: IO, should_raise: bool = False) -> bool:
             if len(data) < new_size:
                 break
             lib.memcpy(buffer, ffi.cast("uint8_t*", ffi.from_buffer(data)), new_size)
-            code = lib.bz3_decode_block(state, buffer, buffer_size, new_size, old_size)
+            code = lib.bz3_decode_block_stored(
+                state, buffer, buffer_size, new_size, old_size
+            )
             if code == -1:
                 if should_raise:
                     raise ValueError(
@@ -456,8 +1150,8 @@ def test_file(input: IO, should_raise: bool = False) -> bool:
                 return False
         return True
     finally:
-        lib.bz3_free(state)
-        lib.PyMem_Free(buffer)
+        lib.bz3_state_release(state, block_size)
+        lib.bz3_buffer_free(buffer)
 
 
 def bound(input_size: int) -> int:
@@ -498,3 +1192,85 @@ def orig_size_sufficient_for_decode(block: bytes, orig_size: int) -> int:
 
 def libversion() -> str:
     return ffi.string(lib.bz3_version()).decode()
+
+
+def trace_enable(capacity: int = 65536) -> None:
+    """Start recording per-block trace events into a ring buffer keeping the newest
+    capacity events. Events recorded before are kept unless the capacity changes"""
+    if capacity < 1:
+        raise ValueError("capacity must be at least 1")
+    if lib.bz3_trace_enable(capacity) < 0:
+        raise MemoryError
+
+
+def trace_disable() -> None:
+    """Stop recording trace events, those recorded stay readable"""
+    lib.bz3_trace_disable()
+
+
+def trace_clear() -> None:
+    """Forget the trace events recorded so far"""
+    lib.bz3_trace_clear()
+
+
+def trace_events() -> list:
+    """The trace events kept, oldest first, as (kind, thread_id, start_ns, end_ns, arg)
+    tuples. arg is the block size, the number of blocks for waves and writes"""
+    capacity = lib.bz3_trace_capacity()
+    if capacity == 0:
+        return []
+    events = ffi.new("bz3_trace_event[]", capacity)
+    n = lib.bz3_trace_read(events, capacity)
+    return [
+        (e.kind, e.tid, e.start_ns, e.end_ns, e.arg)
+        for e in (events[i] for i in range(n))
+    ]
+
+
+def alloc_configure(
+    huge_pages: Optional[bool] = None,
+    cache_limit: Optional[int] = None,
+    mmap_threshold: Optional[int] = None,
+) -> dict:
+    """Change the settings of the allocator of block states and work buffers, those
+    left None are kept, and return them all as a dict. Buffers of mmap_threshold bytes
+    and up are mapped, with MADV_HUGEPAGE if huge_pages. Released states and mapped
+    buffers are kept for reuse up to cache_limit bytes, 0 turns the cache off"""
+    if cache_limit is not None and cache_limit < 0:
+        raise ValueError("cache_limit must not be negative")
+    if mmap_threshold is not None and mmap_threshold < 0:
+        raise ValueError("mmap_threshold must not be negative")
+    lib.bz3_alloc_configure(
+        -1 if huge_pages is None else bool(huge_pages),
+        -1 if cache_limit is None else cache_limit,
+        -1 if mmap_threshold is None else mmap_threshold,
+    )
+    huge = ffi.new("int *")
+    limit = ffi.new("uint64_t *")
+    threshold = ffi.new("uint64_t *")
+    lib.bz3_alloc_get_config(huge, limit, threshold)
+    return {
+        "huge_pages": bool(huge[0]),
+        "cache_limit": limit[0],
+        "mmap_threshold": threshold[0],
+    }
+
+
+def alloc_stats() -> dict:
+    """Counters of the allocator: allocs, cache_hits, huge_allocs, mapped_bytes,
+    cached_bytes and cached"""
+    stats = ffi.new("bz3_alloc_stats *")
+    lib.bz3_alloc_get_stats(stats)
+    return {
+        "allocs": stats.allocs,
+        "cache_hits": stats.cache_hits,
+        "huge_allocs": stats.huge_allocs,
+        "mapped_bytes": stats.mapped_bytes,
+        "cached_bytes": stats.cached_bytes,
+        "cached": stats.cached,
+    }
+
+
+def alloc_trim() -> None:
+    """Free the states and buffers the allocator keeps for reuse"""
+    lib.bz3_alloc_trim()
@@ -144,6 +144,70 @@ void* PyMem_Malloc(size_t n);
 void PyMem_Free(void* p);
 int strncmp (const char *s1, const char *s2, size_t size);
 void *memcpy  (void *pto, const void *pfrom, size_t size);
+
+#define BZ3_FILTER_NONE 0
+#define BZ3_FILTER_SHUFFLE 1
+#define BZ3_FILTER_BITSHUFFLE 2
+#define BZ3_FILTER_DELTA 3
+#define BZ3_FILTER_HEADER_SIZE 8
+#define BZ3_STREAM_STORED 1
+
+int bz3_filter_check(int filter, int typesize);
+void bz3_filter(uint8_t *dst, const uint8_t *src, size_t size, int filter, int typesize);
+void bz3_unfilter(uint8_t *dst, const uint8_t *src, size_t size, int filter, int typesize);
+
+int bz3_probe(const uint8_t *buf, int32_t size, double threshold);
+int bz3_is_stored(const uint8_t *buffer, int32_t size);
+int32_t bz3_encode_block_probed(struct bz3_state *state, uint8_t *buffer, int32_t size, double probe);
+int32_t bz3_decode_block_stored(struct bz3_state *state, uint8_t *buffer, size_t buffer_size,
+                                int32_t data_size, int32_t orig_size);
+
+#define BZ3_TRACE_STAGE 0
+#define BZ3_TRACE_ENCODE 1
+#define BZ3_TRACE_DECODE 2
+#define BZ3_TRACE_ASSEMBLE 3
+#define BZ3_TRACE_WAVE 4
+#define BZ3_TRACE_WRITE 5
+
+typedef struct
+{
+    uint64_t seq;
+    uint64_t start_ns;
+    uint64_t end_ns;
+    uint64_t tid;
+    int32_t kind;
+    int32_t arg;
+} bz3_trace_event;
+
+uint64_t bz3_trace_begin(void);
+void bz3_trace_end(int kind, int32_t arg, uint64_t t0);
+int bz3_trace_enable(uint64_t capacity);
+void bz3_trace_disable(void);
+void bz3_trace_clear(void);
+uint64_t bz3_trace_capacity(void);
+uint64_t bz3_trace_read(bz3_trace_event *out, uint64_t size);
+
+size_t BZ3_CDC_MIN(size_t block_size);
+size_t bz3_cdc_cut(const uint8_t *buf, size_t size, size_t block_size);
+
+typedef struct
+{
+    uint64_t allocs;
+    uint64_t cache_hits;
+    uint64_t huge_allocs;
+    uint64_t mapped_bytes;
+    uint64_t cached_bytes;
+    uint64_t cached;
+} bz3_alloc_stats;
+
+struct bz3_state *bz3_state_acquire(int32_t block_size);
+void bz3_state_release(struct bz3_state *state, int32_t block_size);
+void *bz3_buffer_alloc(size_t size);
+void bz3_buffer_free(void *ptr);
+void bz3_alloc_trim(void);
+void bz3_alloc_configure(int huge_pages, int64_t cache_limit, int64_t mmap_threshold);
+void bz3_alloc_get_config(int *huge_pages, uint64_t *cache_limit, uint64_t *mmap_threshold);
+void bz3_alloc_get_stats(bz3_alloc_stats *out);
     """
 )
 
@@ -153,6 +217,11 @@ source = """
 #include "common.h"
 #include "libbz3.h"
 #include "libsais.h"
+#include "filters.h"
+#include "probe.h"
+#include "trace.h"
+#include "cdc.h"
+#include "alloc.h"
 """
 c_sources = glob.glob("./dep/src/*.c")
 c_sources = list(filter(lambda x: "main" not in x, c_sources))
@@ -162,7 +231,7 @@ ffibuilder.set_source(
     "bz3.backends.cffi._bz3",
     source,
     sources=c_sources,
-    include_dirs=["./dep/include"],
+    include_dirs=["./dep/include", "./bz3/backends"],
     define_macros=[("VERSION", '"1.5.3.r3-gfe3b43d"')],
 )
 
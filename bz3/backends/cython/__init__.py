@@ -3,11 +3,21 @@ Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
 """
 
 from bz3.backends.cython._bz3 import (
+    FILTER_BITSHUFFLE,
+    FILTER_DELTA,
+    FILTER_NONE,
+    FILTER_SHUFFLE,
+    STREAM_STORED,
     BZ3Compressor,
     BZ3Decompressor,
     BZ3OmpCompressor,
     BZ3OmpDecompressor,
+    BZ3State,
+    alloc_configure,
+    alloc_stats,
+    alloc_trim,
     bound,
+    cdc_cut,
     compress_file,
     compress_into,
     decompress_file,
@@ -16,5 +26,11 @@ from bz3.backends.cython._bz3 import (
     min_memory_needed,
     orig_size_sufficient_for_decode,
     recover_file,
+    resume_output,
     test_file,
+    trace_clear,
+    trace_disable,
+    trace_enable,
+    trace_events,
+    unfilter_into,
 )
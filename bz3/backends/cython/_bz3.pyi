@@ -1,42 +1,130 @@
-from typing import IO, List
+from typing import IO, Dict, List, Optional, Tuple, Union
+
+FILTER_NONE: int
+FILTER_SHUFFLE: int
+FILTER_BITSHUFFLE: int
+FILTER_DELTA: int
+STREAM_STORED: int
 
 class BZ3Compressor:
     block_size: int
-    def __init__(self, block_size: int) -> None: ...
+    blocks: int
+    buffered: int
+    cdc: bool
+    filter: int
+    probe: float
+    stored_blocks: int
+    typesize: int
+    def __init__(
+        self,
+        block_size: int,
+        filter: int = ...,
+        typesize: int = 1,
+        probe: float = 0,
+        cdc: bool = False,
+        allow_stored: bool = False,
+    ) -> None: ...
     def compress(self, data: bytes) -> bytes: ...
     def error(self) -> str: ...
     def flush(self) -> bytes: ...
+    def compress_to(self, data: bytes, out: Union[int, IO[bytes]]) -> int: ...
+    def flush_to(self, out: Union[int, IO[bytes]]) -> int: ...
+    def compress_bound(self, size: int) -> int: ...
+    def flush_bound(self) -> int: ...
+    def compress_into(self, data: bytes, out: bytearray) -> int: ...
+    def flush_into(self, out: bytearray) -> int: ...
 
 class BZ3Decompressor:
     block_size: int
+    filter: int
     ignore_error: bool
+    typesize: int
     unused_data: bytes
     def __init__(self, ignore_error: bool = False) -> None: ...
     def decompress(self, data: bytes) -> bytes: ...
+    def decompress_into(self, data: bytes, out: bytearray) -> Tuple[int, int]: ...
     def error(self) -> str: ...
 
 class BZ3OmpCompressor:
     block_size: int
+    blocks: int
+    buffered: int
+    filter: int
     numthreads: int
-    def __init__(self, block_size: int, numthreads: int) -> None: ...
+    probe: float
+    stored_blocks: int
+    typesize: int
+    def __init__(
+        self,
+        block_size: int,
+        numthreads: Union[int, str],
+        filter: int = ...,
+        typesize: int = 1,
+        probe: float = 0,
+        allow_stored: bool = False,
+    ) -> None: ...
     def compress(self, data: bytes) -> bytes: ...
     def error(self) -> List[str]: ...
     def flush(self) -> bytes: ...
+    def compress_to(self, data: bytes, out: Union[int, IO[bytes]]) -> int: ...
+    def flush_to(self, out: Union[int, IO[bytes]]) -> int: ...
+    def compress_bound(self, size: int) -> int: ...
+    def flush_bound(self) -> int: ...
+    def compress_into(self, data: bytes, out: bytearray) -> int: ...
+    def flush_into(self, out: bytearray) -> int: ...
 
 class BZ3OmpDecompressor:
     block_size: int
+    filter: int
     ignore_error: bool
     numthreads: int
+    typesize: int
     unused_data: int
-    def __init__(self, numthreads: int, ignore_error: bool = False) -> None: ...
+    def __init__(
+        self, numthreads: Union[int, str], ignore_error: bool = False
+    ) -> None: ...
     def decompress(self, data: bytes) -> bytes: ...
+    def decompress_into(self, data: bytes, out: bytearray) -> Tuple[int, int]: ...
     def error(self) -> List[str]: ...
 
+class BZ3State:
+    block_size: int
+    last_error: int
+    def __init__(self, block_size: int) -> None: ...
+    def encode_block(self, buf: bytearray, size: int, probe: float = 0) -> int: ...
+    def decode_block(
+        self, buf: bytearray, compressed_size: int, orig_size: int
+    ) -> int: ...
+    def error(self) -> Optional[str]: ...
+
+def alloc_configure(
+    huge_pages: Optional[bool] = None,
+    cache_limit: Optional[int] = None,
+    mmap_threshold: Optional[int] = None,
+) -> Dict[str, Union[bool, int]]: ...
+def alloc_stats() -> Dict[str, int]: ...
+def alloc_trim() -> None: ...
 def bound(input_size: int) -> int: ...
-def compress_file(input: IO[bytes], output: IO[bytes], block_size: int) -> None: ...
+def cdc_cut(data: bytes, block_size: int) -> int: ...
+def compress_file(
+    input: IO[bytes],
+    output: IO[bytes],
+    block_size: int,
+    probe: float = 0,
+    resume: bool = False,
+    allow_stored: bool = False,
+) -> None: ...
 def compress_into(data: bytes, out: bytearray, block_size: int = 1000000) -> int: ...
 def decompress_file(input: IO[bytes], output: IO[bytes]) -> None: ...
 def decompress_into(data: bytes, out: bytearray) -> int: ...
 def libversion() -> str: ...
 def recover_file(input: IO[bytes], output: IO[bytes]) -> None: ...
+def resume_output(
+    output: IO[bytes], block_size: int, probe: float = 0, allow_stored: bool = False
+) -> int: ...
 def test_file(input, should_raise: bool = False) -> bool: ...
+def trace_clear() -> None: ...
+def trace_disable() -> None: ...
+def trace_enable(capacity: int = 65536) -> None: ...
+def trace_events() -> List[Tuple[int, int, int, int, int]]: ...
+def unfilter_into(src: bytes, out: bytearray, filter: int, typesize: int) -> int: ...
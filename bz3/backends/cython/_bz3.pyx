@@ -1,53 +1,318 @@
 # cython: language_level=3
 # cython: cdivision=True
 cimport cython
-from cpython.bytearray cimport PyByteArray_AS_STRING, PyByteArray_GET_SIZE
+from cpython.bytearray cimport (PyByteArray_AS_STRING, PyByteArray_GET_SIZE,
+                                PyByteArray_Resize)
+from cpython.buffer cimport PyBUF_READ, PyBUF_WRITE
 from cpython.bytes cimport (PyBytes_AS_STRING, PyBytes_FromStringAndSize,
                             PyBytes_GET_SIZE)
+from cpython.exc cimport PyErr_SetFromErrno
 from cpython.mem cimport PyMem_Calloc, PyMem_Free, PyMem_Malloc
+from cpython.memoryview cimport PyMemoryView_FromMemory
 from cpython.object cimport PyObject_HasAttrString
-from libc.stdint cimport int32_t, uint8_t, uint32_t
+from libc.stdint cimport int32_t, int64_t, uint8_t, uint32_t, uint64_t
 from libc.stdio cimport fprintf, stderr
 from libc.string cimport memcpy, strncmp
 
-from bz3.backends.cython.bzip3 cimport (BZ3_OK, MEMLOG, KiB, MiB, bz3_bound,
+from bz3.backends.cython.bzip3 cimport (BZ3_FILTER_BITSHUFFLE, BZ3_FILTER_DELTA,
+                                        BZ3_FILTER_HEADER_SIZE, BZ3_FILTER_NONE,
+                                        BZ3_FILTER_SHUFFLE, BZ3_OK, BZ3_STREAM_STORED, MEMLOG, KiB,
+                                        MiB, bz3_bound,
                                         bz3_compress, bz3_decode_block,
                                         bz3_decompress, bz3_encode_block,
-                                        bz3_free, bz3_last_error,
-                                        bz3_min_memory_needed, bz3_new,
+                                        bz3_filter, bz3_filter_check,
+                                        bz3_last_error,
+                                        bz3_min_memory_needed,
                                         bz3_orig_size_sufficient_for_decode,
-                                        bz3_state, bz3_strerror, bz3_version,
+                                        bz3_decode_block_stored,
+                                        bz3_encode_block_probed, bz3_iovec,
+                                        bz3_is_stored, bz3_state, bz3_strerror,
+                                        bz3_unfilter, bz3_version, bz3_writev_all,
                                         read_neutral_s32, write_neutral_s32)
+from bz3.backends.cython.bzip3 cimport (BZ3_TRACE_ASSEMBLE, BZ3_TRACE_WAVE,
+                                        BZ3_TRACE_WRITE, bz3_trace_begin,
+                                        bz3_trace_capacity, bz3_trace_clear,
+                                        bz3_trace_disable,
+                                        bz3_trace_enable, bz3_trace_end,
+                                        bz3_trace_event, bz3_trace_read)
+from bz3.backends.cython.bzip3 cimport BZ3_CDC_MIN, bz3_cdc_cut
+from bz3.backends.cython.bzip3 cimport (bz3_alloc_configure, bz3_alloc_get_config,
+                                        bz3_alloc_get_stats, bz3_alloc_stats,
+                                        bz3_alloc_trim, bz3_buffer_alloc,
+                                        bz3_buffer_free, bz3_state_acquire,
+                                        bz3_state_release)
+
+from bz3.threads import resolve_threads
 
 
 cdef const char* magic = "BZ3v1"
+cdef const char* filter_magic = "BZ3F"
+
+FILTER_NONE = BZ3_FILTER_NONE
+FILTER_SHUFFLE = BZ3_FILTER_SHUFFLE
+FILTER_BITSHUFFLE = BZ3_FILTER_BITSHUFFLE
+FILTER_DELTA = BZ3_FILTER_DELTA
+STREAM_STORED = BZ3_STREAM_STORED
+
+cdef inline int check_filter(int filter, int typesize) except -1:
+    if bz3_filter_check(filter, typesize) != 0:
+        raise ValueError("filter must be one of the FILTER_* constants and typesize between 1 and 255")
+    return 0
+
+cdef inline int check_probe(double probe) except -1:
+    if not 0 <= probe <= 8:
+        raise ValueError("probe must be between 0 and 8 bits per byte")
+    return 0
+
+cdef inline double store_probe(double probe, bint allow_stored) except -1:
+    """the probe a compressor runs: stored blocks are an extension libbz3 and the bzip3 tool
+    can't read, so blocks are only stored, and probed, when the caller allows it"""
+    check_probe(probe)
+    return probe if allow_stored else 0
+
+cdef inline int stream_flags(double probe) noexcept:
+    """the flags of the stream header for a compressor with probe"""
+    return BZ3_STREAM_STORED if probe > 0 else 0
+
+cdef inline Py_ssize_t make_stream_header(uint8_t* dst, int32_t block_size, int filter, int typesize, int flags) noexcept:
+    """write the stream header to dst, at most 17 bytes, returns its size. Filtered streams, and
+    streams with stored blocks, are prefixed with "BZ3F", the filter, the typesize, the flags and
+    a reserved byte"""
+    cdef Py_ssize_t pos = 0
+    if filter != BZ3_FILTER_NONE or flags != 0:
+        memcpy(dst, filter_magic, 4)
+        dst[4] = <uint8_t>filter
+        dst[5] = <uint8_t>typesize
+        dst[6] = <uint8_t>flags
+        dst[7] = 0
+        pos = BZ3_FILTER_HEADER_SIZE
+    memcpy(&dst[pos], magic, 5)
+    write_neutral_s32(&dst[pos + 5], block_size)
+    return pos + 9
+
+cdef Py_ssize_t parse_stream_header(const uint8_t* src, Py_ssize_t size, int32_t* block_size,
+                                    int* filter, int* typesize) except -1:
+    """parse the stream header at the start of src, returns its size or 0 if more data is needed"""
+    cdef Py_ssize_t pos = 0
+    if size < 9:
+        return 0
+    filter[0] = BZ3_FILTER_NONE
+    typesize[0] = 1
+    if strncmp(<const char*>src, filter_magic, 4) == 0:
+        if size < BZ3_FILTER_HEADER_SIZE + 9:
+            return 0
+        filter[0] = src[4]
+        typesize[0] = src[5]
+        if bz3_filter_check(filter[0], typesize[0]) != 0:
+            raise ValueError("The input file is corrupted. Reason: Invalid filter in the header")
+        # a prefix that neither filters nor flags anything isn't written either
+        if src[6] & ~BZ3_STREAM_STORED or src[7] != 0 or (filter[0] == BZ3_FILTER_NONE and src[6] == 0):
+            raise ValueError("The input file is corrupted. Reason: Invalid flags in the header")
+        pos = BZ3_FILTER_HEADER_SIZE
+    if strncmp(<const char*>&src[pos], magic, 5) != 0:
+        raise ValueError("Invalid signature")
+    block_size[0] = read_neutral_s32(&src[pos + 5])
+    if block_size[0] < KiB(65) or block_size[0] > MiB(511):
+        raise ValueError("The input file is corrupted. Reason: Invalid block size in the header")
+    return pos + 9
+
+cdef int read_stream_header(object input, int32_t* block_size, int* filter, int* typesize) except -1:
+    """read and parse the stream header at the position of input, 9 bytes or 17 with the "BZ3F" prefix"""
+    cdef bytes data = input.read(9)
+    if PyBytes_GET_SIZE(data) == 9 and strncmp(PyBytes_AS_STRING(data), filter_magic, 4) == 0:
+        data += input.read(BZ3_FILTER_HEADER_SIZE)
+    if parse_stream_header(<const uint8_t*>PyBytes_AS_STRING(data), PyBytes_GET_SIZE(data),
+                           block_size, filter, typesize) == 0:
+        raise ValueError("Invalid file. Reason: Smaller than magic header")
+    return 0
+
+cdef inline int extend_unfiltered(bytearray ret, const uint8_t* src, int32_t size, int filter, int typesize) except -1:
+    """append size decoded bytes to ret, reversing the filter on the way"""
+    cdef Py_ssize_t pos = PyByteArray_GET_SIZE(ret)
+    if PyByteArray_Resize(ret, pos + size) < 0:
+        raise MemoryError
+    bz3_unfilter(<uint8_t*>&PyByteArray_AS_STRING(ret)[pos], src, <size_t>size, filter, typesize)
+    return 0
+
+cdef inline int append_bytes(bytearray ret, const uint8_t* src, Py_ssize_t size) except -1:
+    """ret.extend() without a temporary bytes object"""
+    cdef Py_ssize_t pos = PyByteArray_GET_SIZE(ret)
+    if size <= 0:
+        return 0
+    if PyByteArray_Resize(ret, pos + size) < 0:
+        raise MemoryError
+    memcpy(&PyByteArray_AS_STRING(ret)[pos], src, <size_t>size)
+    return 0
+
+cdef Py_ssize_t next_frame(bytearray unused, const uint8_t* data, Py_ssize_t size, uint8_t* dst,
+                           int32_t limit, int32_t* new_size, int32_t* old_size) except -1:
+    """Copy the payload of the next block to dst, taking what unused holds first, then data.
+    Returns the number of bytes of data consumed. An incomplete block is kept in unused,
+    with new_size set to -1. A block entirely in data is copied without going through unused"""
+    cdef Py_ssize_t have = PyByteArray_GET_SIZE(unused)
+    cdef Py_ssize_t taken = 0, n
+    cdef bint direct = have == 0 and size >= 8
+    cdef const uint8_t* header
+    cdef int32_t frame_new, frame_old
+    new_size[0] = -1
+    if direct:
+        header = data
+    else:
+        if have < 8:
+            taken = min(8 - have, size)
+            append_bytes(unused, data, taken)
+            have += taken
+            if have < 8:
+                return taken
+        header = <const uint8_t*>PyByteArray_AS_STRING(unused)
+    frame_new = read_neutral_s32(<uint8_t*>header)
+    frame_old = read_neutral_s32(<uint8_t*>&header[4])
+    if frame_new < 0 or frame_old < 0 or frame_new > limit or frame_old > limit:
+        raise ValueError("Failed to decode a block: Inconsistent headers.")
+    if direct:
+        if size < frame_new + 8:  # keep the partial block for the next call
+            append_bytes(unused, data, size)
+            return size
+        memcpy(dst, &data[8], <size_t>frame_new)
+        taken = frame_new + 8
+    else:
+        if have < frame_new + 8:
+            n = min(frame_new + 8 - have, size - taken)
+            append_bytes(unused, &data[taken], n)
+            taken += n
+            have += n
+            if have < frame_new + 8:
+                return taken
+        memcpy(dst, &PyByteArray_AS_STRING(unused)[8], <size_t>frame_new)
+        del unused[:frame_new + 8]
+    new_size[0] = frame_new
+    old_size[0] = frame_old
+    return taken
+
+cpdef inline int unfilter_into(const uint8_t[::1] src, uint8_t[::1] out, int filter, int typesize) except -1:
+    """Reverse filter on src, writing len(src) bytes to the start of out. Used to decode
+    blocks of filtered streams straight into caller-owned memory"""
+    check_filter(filter, typesize)
+    if out.shape[0] < src.shape[0]:
+        raise ValueError("out is too small, need %d more bytes" % (src.shape[0] - out.shape[0]))
+    if src.shape[0] == 0:
+        return 0
+    with nogil:
+        bz3_unfilter(&out[0], &src[0], <size_t>src.shape[0], filter, typesize)
+    return 0
+
+cpdef inline Py_ssize_t cdc_cut(const uint8_t[::1] data, int32_t block_size) except -1:
+    """The size of the first content-defined block of data, as BZ3Compressor cuts
+    with cdc. block_size bytes (or all of data, if shorter) when no boundary is found"""
+    if block_size < KiB(65) or block_size > MiB(511):
+        raise ValueError("Block size must be between 65 KiB and 511 MiB")
+    if data.shape[0] == 0:
+        return 0
+    return <Py_ssize_t>bz3_cdc_cut(&data[0], <size_t>min(data.shape[0], <Py_ssize_t>block_size), <size_t>block_size)
 
 cdef inline uint8_t PyFile_Check(object file):
     if PyObject_HasAttrString(file, "read") and PyObject_HasAttrString(file, "write"):  # should we check seek method?
         return 1
     return 0
 
+cdef inline int write_all(object out, const uint8_t* data, Py_ssize_t size) except -1:
+    """write native memory to a file object through a memoryview, without a bytes copy"""
+    cdef object view = PyMemoryView_FromMemory(<char*>data, size, PyBUF_READ)
+    cdef Py_ssize_t done = 0
+    cdef object n
+    while done < size:
+        n = out.write(view[done:])
+        if n is None:  # writers returning None are assumed to take everything
+            break
+        done += <Py_ssize_t>n
+    return 0
+
+cdef Py_ssize_t write_blocks(object out, const uint8_t* head, Py_ssize_t head_size,
+                             uint8_t** buffers, int32_t* sizes, int32_t* old_sizes, int32_t n) except -1:
+    """write an optional stream header and n encoded blocks with their 8-byte headers
+    to out, a file descriptor (one writev call) or a binary file object"""
+    cdef Py_ssize_t total = head_size
+    cdef int32_t i
+    cdef int fd
+    cdef int ret
+    cdef bz3_iovec* iov
+    cdef uint8_t* frames = <uint8_t*>PyMem_Malloc(8 * <size_t>n + 1)
+    if frames == NULL:
+        raise MemoryError
+    cdef uint64_t t0 = bz3_trace_begin()
+    try:
+        for i in range(n):
+            write_neutral_s32(&frames[8 * i], sizes[i])
+            write_neutral_s32(&frames[8 * i + 4], old_sizes[i])
+            total += 8 + sizes[i]
+        if isinstance(out, int):
+            fd = out
+            iov = <bz3_iovec*>PyMem_Malloc(sizeof(bz3_iovec) * (2 * <size_t>n + 1))
+            if iov == NULL:
+                raise MemoryError
+            iov[0].iov_base = <void*>head
+            iov[0].iov_len = <size_t>head_size
+            for i in range(n):
+                iov[2 * i + 1].iov_base = <void*>&frames[8 * i]
+                iov[2 * i + 1].iov_len = 8
+                iov[2 * i + 2].iov_base = <void*>buffers[i]
+                iov[2 * i + 2].iov_len = <size_t>sizes[i]
+            with nogil:
+                ret = bz3_writev_all(fd, iov, 2 * n + 1)
+            PyMem_Free(iov)
+            if ret < 0:
+                PyErr_SetFromErrno(OSError)
+        elif PyObject_HasAttrString(out, "write"):
+            if head_size:
+                write_all(out, head, head_size)
+            for i in range(n):
+                write_all(out, &frames[8 * i], 8)
+                write_all(out, buffers[i], sizes[i])
+        else:
+            raise TypeError("out must be a file descriptor or a binary file object")
+    finally:
+        PyMem_Free(frames)
+    bz3_trace_end(BZ3_TRACE_WRITE, n, t0)
+    return total
+
 @cython.freelist(8)
 @cython.no_gc
 @cython.final
 cdef class BZ3Compressor:
     cdef:
+        cython.pymutex lock  # serializes concurrent calls on the same object
         bz3_state * state
         uint8_t * buffer
         readonly int32_t block_size
         bytearray uncompressed
         bint have_magic_number
-
-    def __cinit__(self, int32_t block_size):
+        readonly int filter  # FILTER_* applied to every block before encoding
+        readonly int typesize
+        uint8_t header[17]  # stream header, written once
+        Py_ssize_t header_size
+        readonly double probe  # entropy threshold in bits per byte with allow_stored, 0 encodes every block
+        readonly uint64_t blocks  # blocks written so far
+        readonly uint64_t stored_blocks  # of which stored as is
+        readonly bint cdc  # content-defined block boundaries instead of every block_size bytes
+
+    def __cinit__(self, int32_t block_size, int filter = BZ3_FILTER_NONE, int typesize = 1, double probe = 0,
+                  bint cdc = False, bint allow_stored = False):
         if block_size < KiB(65) or block_size > MiB(511):
             raise ValueError("Block size must be between 65 KiB and 511 MiB")
+        check_filter(filter, typesize)
+        probe = store_probe(probe, allow_stored)
         self.block_size = block_size
-        self.state = bz3_new(block_size)
+        self.filter = filter
+        self.typesize = typesize
+        self.probe = probe
+        self.cdc = cdc
+        self.header_size = make_stream_header(self.header, block_size, filter, typesize, stream_flags(probe))
+        self.state = bz3_state_acquire(block_size)
         if self.state == NULL:
             raise MemoryError("Failed to create a block encoder state")
-        self.buffer = <uint8_t *>PyMem_Malloc(bz3_bound(block_size))
+        self.buffer = <uint8_t *> bz3_buffer_alloc(bz3_bound(block_size))
         if self.buffer == NULL:
-            bz3_free(self.state)
+            bz3_state_release(self.state, self.block_size)
             self.state = NULL
             raise MemoryError("Failed to allocate memory")
         self.uncompressed = bytearray()
@@ -55,64 +320,246 @@ cdef class BZ3Compressor:
 
     def __dealloc__(self):
         if self.state != NULL:
-            bz3_free(self.state)
+            bz3_state_release(self.state, self.block_size)
             self.state = NULL
         if self.buffer !=NULL:
-            PyMem_Free(self.buffer)
+            bz3_buffer_free(self.buffer)
             self.buffer = NULL
 
+    cdef inline void count_block(self, const uint8_t* buffer, int32_t size) noexcept:
+        self.blocks += 1
+        if bz3_is_stored(buffer, size):
+            self.stored_blocks += 1
+
+    cdef inline int32_t next_block(self, bint final) noexcept:
+        """The size of the next block to encode from uncompressed, 0 if there is none yet.
+        Before final only full windows of block_size bytes are cut, so the blocks don't
+        depend on how the data was split across calls"""
+        cdef Py_ssize_t size = PyByteArray_GET_SIZE(self.uncompressed)
+        if size == 0 or (size < self.block_size and not final):
+            return 0
+        if size > self.block_size:
+            size = self.block_size
+        if self.cdc:
+            return <int32_t>bz3_cdc_cut(<const uint8_t*>PyByteArray_AS_STRING(self.uncompressed), <size_t>size, <size_t>self.block_size)
+        return <int32_t>size
+
     cpdef inline bytes compress(self, const uint8_t[::1] data):
         cdef Py_ssize_t input_size = data.shape[0]
-        cdef int32_t new_size
+        cdef int32_t new_size, old_size
+        cdef bytearray ret = bytearray()
+        with self.lock:
+            if not self.have_magic_number:
+                # if PyByteArray_Resize(ret, 9) < 0:
+                #     raise
+                # memcpy(PyByteArray_AS_STRING(ret), magic, 5)
+                ret.extend(<bytes>self.header[:self.header_size])  # 9 bytes, 17 with the "BZ3F" prefix
+                self.have_magic_number = 1
+
+            if input_size > 0:
+                # if PyByteArray_Resize(self.uncompressed, input_size+PyByteArray_GET_SIZE(self.uncompressed)) < 0:
+                #     raise
+                # memcpy(&(PyByteArray_AS_STRING(self.uncompressed)[PyByteArray_GET_SIZE(self.uncompressed)-input_size]), &data[0], input_size) # todo? direct copy to bytearray
+                self.uncompressed.extend(data)
+                while True:
+                    old_size = self.next_block(0)
+                    if old_size == 0:
+                        break
+                    bz3_filter(self.buffer, <const uint8_t*>PyByteArray_AS_STRING(self.uncompressed), <size_t>old_size, self.filter, self.typesize)
+                    # make a copy
+                    with nogil:
+                        new_size = bz3_encode_block_probed(self.state, self.buffer, old_size, self.probe)
+                    if new_size == -1:
+                        raise ValueError("Failed to encode a block: %s" % bz3_strerror(self.state))
+                    self.count_block(self.buffer, new_size)
+                    # if PyByteArray_Resize(ret, PyByteArray_GET_SIZE(ret) + new_size + 8) < 0:
+                    #     raise
+                    ret.extend((new_size + 8)*b"\x00")
+                    write_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret)-new_size-8]), new_size)
+                    write_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret)-new_size-4]), old_size)
+                    memcpy(&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret)-new_size]), self.buffer, <size_t>new_size)
+
+                    del self.uncompressed[:old_size]
+            return bytes(ret)
+
+    cpdef inline bytes flush(self):
         cdef bytearray ret = bytearray()
-        if not self.have_magic_number:
-            # if PyByteArray_Resize(ret, 9) < 0:
-            #     raise
-            # memcpy(PyByteArray_AS_STRING(ret), magic, 5)
-            ret.extend(<bytes>magic[:5]+b"\x00\x00\x00\x00")  # 9 bytes
-            write_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(ret)[5]), self.block_size)
-            self.have_magic_number = 1
-
-        if input_size > 0:
-            # if PyByteArray_Resize(self.uncompressed, input_size+PyByteArray_GET_SIZE(self.uncompressed)) < 0:
-            #     raise
-            # memcpy(&(PyByteArray_AS_STRING(self.uncompressed)[PyByteArray_GET_SIZE(self.uncompressed)-input_size]), &data[0], input_size) # todo? direct copy to bytearray
-            self.uncompressed.extend(data)
-            while PyByteArray_GET_SIZE(self.uncompressed)>=self.block_size:
-                memcpy(self.buffer, PyByteArray_AS_STRING(self.uncompressed), <size_t>self.block_size)
-                # make a copy
+        cdef int32_t new_size
+        cdef int32_t old_size
+        with self.lock:
+            while True:  # a single block, unless cdc cuts what is left
+                old_size = self.next_block(1)
+                if old_size == 0:
+                    break
+                bz3_filter(self.buffer, <const uint8_t*>PyByteArray_AS_STRING(self.uncompressed), <size_t>old_size, self.filter, self.typesize)
                 with nogil:
-                    new_size = bz3_encode_block(self.state, self.buffer, self.block_size)
+                    new_size = bz3_encode_block_probed(self.state, self.buffer, old_size, self.probe)
                 if new_size == -1:
                     raise ValueError("Failed to encode a block: %s" % bz3_strerror(self.state))
-                # if PyByteArray_Resize(ret, PyByteArray_GET_SIZE(ret) + new_size + 8) < 0:
-                #     raise
-                ret.extend((new_size + 8)*b"\x00")
+                self.count_block(self.buffer, new_size)
+                ret.extend((new_size + 8) * b"\x00")
                 write_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret)-new_size-8]), new_size)
-                write_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret)-new_size-4]), self.block_size)
+                write_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret)-new_size-4]), old_size)
                 memcpy(&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret)-new_size]), self.buffer, <size_t>new_size)
+                del self.uncompressed[:old_size]
+            return bytes(ret)
 
-                del self.uncompressed[:self.block_size]
-        return bytes(ret)
+    cpdef inline Py_ssize_t compress_to(self, const uint8_t[::1] data, object out) except -1:
+        """Like compress(), but write the output to out, a file descriptor or a binary file object,
+        straight from the native buffer. Returns the number of bytes written"""
+        cdef Py_ssize_t input_size = data.shape[0]
+        cdef int32_t new_size, old_size
+        cdef uint8_t head[17]
+        cdef Py_ssize_t head_size = 0
+        cdef Py_ssize_t written = 0
+        with self.lock:
+            if not self.have_magic_number:
+                memcpy(head, self.header, <size_t>self.header_size)
+                head_size = self.header_size
+            if input_size > 0:
+                self.uncompressed.extend(data)
+                while True:
+                    old_size = self.next_block(0)
+                    if old_size == 0:
+                        break
+                    bz3_filter(self.buffer, <const uint8_t*>PyByteArray_AS_STRING(self.uncompressed), <size_t>old_size, self.filter, self.typesize)
+                    with nogil:
+                        new_size = bz3_encode_block_probed(self.state, self.buffer, old_size, self.probe)
+                    if new_size == -1:
+                        raise ValueError("Failed to encode a block: %s" % bz3_strerror(self.state))
+                    self.count_block(self.buffer, new_size)
+                    written += write_blocks(out, head, head_size, &self.buffer, &new_size, &old_size, 1)
+                    head_size = 0
+                    self.have_magic_number = 1
+                    del self.uncompressed[:old_size]
+            if head_size:
+                written += write_blocks(out, head, head_size, NULL, NULL, NULL, 0)
+                self.have_magic_number = 1
+            return written
 
-    cpdef inline bytes flush(self):
-        cdef bytes ret = b""
+    cpdef inline Py_ssize_t flush_to(self, object out) except -1:
+        """Like flush(), but write the output to out, returns the number of bytes written"""
         cdef int32_t new_size
-        cdef int32_t old_size = <int32_t>PyByteArray_GET_SIZE(self.uncompressed)
-        if self.uncompressed:
-            memcpy(self.buffer, PyByteArray_AS_STRING(self.uncompressed), <size_t>old_size)
-            with nogil:
-                new_size = bz3_encode_block(self.state, self.buffer, old_size)
-            if new_size == -1:
-                raise ValueError("Failed to encode a block: %s" % bz3_strerror(self.state))
-            ret = PyBytes_FromStringAndSize(NULL, new_size + 8)
-            if not ret:
-                raise
-            write_neutral_s32(<uint8_t*>PyBytes_AS_STRING(ret), new_size)
-            write_neutral_s32(<uint8_t*>&(PyBytes_AS_STRING(ret)[4]), old_size)
-            memcpy(&(PyBytes_AS_STRING(ret)[8]), self.buffer, <size_t> new_size)
-            self.uncompressed.clear()
-        return ret
+        cdef int32_t old_size
+        cdef Py_ssize_t written = 0
+        with self.lock:
+            while True:
+                old_size = self.next_block(1)
+                if old_size == 0:
+                    break
+                bz3_filter(self.buffer, <const uint8_t*>PyByteArray_AS_STRING(self.uncompressed), <size_t>old_size, self.filter, self.typesize)
+                with nogil:
+                    new_size = bz3_encode_block_probed(self.state, self.buffer, old_size, self.probe)
+                if new_size == -1:
+                    raise ValueError("Failed to encode a block: %s" % bz3_strerror(self.state))
+                self.count_block(self.buffer, new_size)
+                written += write_blocks(out, NULL, 0, &self.buffer, &new_size, &old_size, 1)
+                del self.uncompressed[:old_size]
+            return written
+
+    cdef inline Py_ssize_t _compress_bound(self, Py_ssize_t size) noexcept:
+        cdef Py_ssize_t total = PyByteArray_GET_SIZE(self.uncompressed) + size
+        cdef Py_ssize_t blocks = total // self.block_size
+        cdef Py_ssize_t head = 0 if self.have_magic_number else self.header_size
+        if self.cdc and blocks:
+            # more and smaller blocks, each over BZ3_CDC_MIN bytes. bz3_bound is linear plus
+            # a constant, so the blocks need at most bz3_bound(total) and the constant per block
+            blocks = total // <Py_ssize_t>BZ3_CDC_MIN(self.block_size)
+            return head + blocks * (8 + <Py_ssize_t>bz3_bound(0)) + <Py_ssize_t>bz3_bound(total)
+        return head + blocks * (8 + <Py_ssize_t>bz3_bound(self.block_size))
+
+    cdef inline Py_ssize_t _flush_bound(self) noexcept:
+        cdef Py_ssize_t size = PyByteArray_GET_SIZE(self.uncompressed)
+        if self.cdc and size:
+            return (size // <Py_ssize_t>BZ3_CDC_MIN(self.block_size) + 1) * (8 + <Py_ssize_t>bz3_bound(0)) + <Py_ssize_t>bz3_bound(size)
+        return 8 + <Py_ssize_t>bz3_bound(size) if size else 0
+
+    cpdef inline Py_ssize_t compress_bound(self, Py_ssize_t size):
+        """Worst-case number of bytes compress_into() writes for size bytes of input"""
+        with self.lock:
+            return self._compress_bound(size)
+
+    cpdef inline Py_ssize_t flush_bound(self):
+        """Worst-case number of bytes flush_into() writes"""
+        with self.lock:
+            return self._flush_bound()
+
+    cpdef inline Py_ssize_t compress_into(self, const uint8_t[::1] data, uint8_t[::1] out) except -1:
+        """Like compress(), but write the output into out, a writable buffer. Blocks are encoded
+        in place inside out. Returns the number of bytes written, raises ValueError before
+        touching anything if out can't hold compress_bound(len(data)) bytes"""
+        cdef Py_ssize_t input_size = data.shape[0]
+        cdef Py_ssize_t needed
+        cdef Py_ssize_t pos = 0
+        cdef int32_t new_size, old_size
+        cdef uint8_t* dst
+        with self.lock:
+            needed = self._compress_bound(input_size)
+            if out.shape[0] < needed:
+                raise ValueError("out is too small, need %d more bytes" % (needed - out.shape[0]))
+            if needed == 0:
+                if input_size > 0:
+                    self.uncompressed.extend(data)
+                return 0
+            dst = &out[0]
+            if not self.have_magic_number:
+                memcpy(dst, self.header, <size_t>self.header_size)
+                pos = self.header_size
+                self.have_magic_number = 1
+            if input_size > 0:
+                self.uncompressed.extend(data)
+                while True:
+                    old_size = self.next_block(0)
+                    if old_size == 0:
+                        break
+                    bz3_filter(&dst[pos + 8], <const uint8_t*>PyByteArray_AS_STRING(self.uncompressed), <size_t>old_size, self.filter, self.typesize)
+                    with nogil:
+                        new_size = bz3_encode_block_probed(self.state, &dst[pos + 8], old_size, self.probe)
+                    if new_size == -1:
+                        raise ValueError("Failed to encode a block: %s" % bz3_strerror(self.state))
+                    self.count_block(&dst[pos + 8], new_size)
+                    write_neutral_s32(&dst[pos], new_size)
+                    write_neutral_s32(&dst[pos + 4], old_size)
+                    pos += 8 + new_size
+                    del self.uncompressed[:old_size]
+            return pos
+
+    cpdef inline Py_ssize_t flush_into(self, uint8_t[::1] out) except -1:
+        """Like flush(), but write the output into out, returns the number of bytes written.
+        out must hold at least flush_bound() bytes"""
+        cdef Py_ssize_t needed
+        cdef Py_ssize_t pos = 0
+        cdef int32_t new_size
+        cdef int32_t old_size
+        cdef uint8_t* dst
+        with self.lock:
+            needed = self._flush_bound()
+            if out.shape[0] < needed:
+                raise ValueError("out is too small, need %d more bytes" % (needed - out.shape[0]))
+            if needed == 0:
+                return 0
+            dst = &out[0]
+            while True:
+                old_size = self.next_block(1)
+                if old_size == 0:
+                    break
+                bz3_filter(&dst[pos + 8], <const uint8_t*>PyByteArray_AS_STRING(self.uncompressed), <size_t>old_size, self.filter, self.typesize)
+                with nogil:
+                    new_size = bz3_encode_block_probed(self.state, &dst[pos + 8], old_size, self.probe)
+                if new_size == -1:
+                    raise ValueError("Failed to encode a block: %s" % bz3_strerror(self.state))
+                self.count_block(&dst[pos + 8], new_size)
+                write_neutral_s32(&dst[pos], new_size)
+                write_neutral_s32(&dst[pos + 4], old_size)
+                pos += 8 + new_size
+                del self.uncompressed[:old_size]
+            return pos
+
+    @property
+    def buffered(self):
+        """Uncompressed bytes held back until they fill a block or are flushed."""
+        with self.lock:
+            return PyByteArray_GET_SIZE(self.uncompressed)
 
     cpdef inline str error(self):
         if bz3_last_error(self.state) != BZ3_OK:
@@ -124,6 +571,7 @@ cdef class BZ3Compressor:
 @cython.final
 cdef class BZ3Decompressor:
     cdef:
+        cython.pymutex lock  # serializes concurrent calls on the same object
         bz3_state * state
         uint8_t * buffer
         size_t buffer_size
@@ -131,17 +579,22 @@ cdef class BZ3Decompressor:
         bytearray unused  # 还没解压的数据
         bint have_magic_number
         readonly bint ignore_error # 是否忽略decode错误
+        readonly int filter  # read from the stream header
+        readonly int typesize
+        uint8_t * pending  # decoded by decompress_into, not written to out yet
+        Py_ssize_t pending_size
+        uint8_t * filter_buffer  # unfiltered block held in pending, filtered streams only
 
     cdef inline int init_state(self, int32_t block_size) except -1:
         """should exec only once"""
         self.block_size = block_size
-        self.state = bz3_new(block_size)
+        self.state = bz3_state_acquire(block_size)
         if self.state == NULL:
             raise MemoryError("Failed to create a block encoder state")
         self.buffer_size = bz3_bound(block_size)
-        self.buffer = <uint8_t *> PyMem_Malloc(self.buffer_size)
+        self.buffer = <uint8_t *> bz3_buffer_alloc(self.buffer_size)
         if self.buffer == NULL:
-            bz3_free(self.state)
+            bz3_state_release(self.state, self.block_size)
             self.state = NULL
             raise MemoryError("Failed to allocate memory")
 
@@ -149,58 +602,130 @@ cdef class BZ3Decompressor:
         self.unused = bytearray()
         self.have_magic_number = 0 # 还没有读到magic number
         self.ignore_error = ignore_error
+        self.filter = BZ3_FILTER_NONE
+        self.typesize = 1
 
     def __dealloc__(self):
         if self.state != NULL:
-            bz3_free(self.state)
+            bz3_state_release(self.state, self.block_size)
             self.state = NULL
         if self.buffer !=NULL:
-            PyMem_Free(self.buffer)
+            bz3_buffer_free(self.buffer)
             self.buffer = NULL
+        if self.filter_buffer != NULL:
+            bz3_buffer_free(self.filter_buffer)
+            self.filter_buffer = NULL
 
     cpdef inline bytes decompress(self, const uint8_t[::1] data):
         cdef Py_ssize_t input_size = data.shape[0]
         cdef int32_t code
         cdef bytearray ret = bytearray()
         cdef int32_t new_size, old_size, block_size
-        if input_size > 0:
-            # if PyByteArray_Resize(self.unused, input_size+PyByteArray_GET_SIZE(self.unused)) < 0:
-            #     raise
-            # memcpy(&(PyByteArray_AS_STRING(self.unused)[PyByteArray_GET_SIZE(self.unused)-input_size]), &data[0], input_size) # self.unused.extend
-            self.unused.extend(data)
-            if PyByteArray_GET_SIZE(self.unused) >= 9 and not self.have_magic_number: # 9 bytes magic number
-                if strncmp(PyByteArray_AS_STRING(self.unused), magic, 5) != 0:
-                    raise ValueError("Invalid signature")
-                block_size = read_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(self.unused)[5]))
-                if block_size < KiB(65) or block_size > MiB(511):
-                    raise ValueError("The input file is corrupted. Reason: Invalid block size in the header")
-                self.init_state(block_size)
-                del self.unused[:9]
-                self.have_magic_number = 1
+        cdef Py_ssize_t header_size
+        with self.lock:
+            if self.pending_size:  # left over by decompress_into
+                append_bytes(ret, self.pending, self.pending_size)
+                self.pending_size = 0
+            if input_size > 0:
+                # if PyByteArray_Resize(self.unused, input_size+PyByteArray_GET_SIZE(self.unused)) < 0:
+                #     raise
+                # memcpy(&(PyByteArray_AS_STRING(self.unused)[PyByteArray_GET_SIZE(self.unused)-input_size]), &data[0], input_size) # self.unused.extend
+                self.unused.extend(data)
+                if not self.have_magic_number: # 9 bytes magic number, 17 with the "BZ3F" prefix
+                    header_size = parse_stream_header(<uint8_t*>PyByteArray_AS_STRING(self.unused), PyByteArray_GET_SIZE(self.unused),
+                                                      &block_size, &self.filter, &self.typesize)
+                    if header_size == 0:  # wait for the rest of the header
+                        return b""
+                    self.init_state(block_size)
+                    del self.unused[:header_size]
+                    self.have_magic_number = 1
+
+                while True:
+                    if PyByteArray_GET_SIZE(self.unused)<8: # 8 byte的 header都不够 直接返回
+                        break
+                    new_size = read_neutral_s32(<uint8_t*>PyByteArray_AS_STRING(self.unused)) # todo gcc warning but bytes is contst
+                    old_size = read_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(self.unused)[4]))
+                    if old_size > <int32_t>bz3_bound(self.block_size) or new_size > <int32_t>bz3_bound(self.block_size):
+                        raise ValueError("Failed to decode a block: Inconsistent headers.")
+                    if PyByteArray_GET_SIZE(self.unused) < new_size+8: # 数据段不够
+                        break
+                    memcpy(self.buffer, &(PyByteArray_AS_STRING(self.unused)[8]), <size_t>new_size)
+                    with nogil:
+                        code = bz3_decode_block_stored(self.state, self.buffer, self.buffer_size, new_size, old_size)
+                    if code == -1:
+                        if self.ignore_error:
+                            fprintf(stderr, "Writing invalid block: %s\n", bz3_strerror(self.state))
+                        else:
+                            raise ValueError("Failed to decode a block: %s" % bz3_strerror(self.state))
+                    # if PyByteArray_Resize(ret, PyByteArray_GET_SIZE(ret) + old_size) < 0:
+                    #     raise
+                    extend_unfiltered(ret, self.buffer, old_size, self.filter, self.typesize)
+                    # memcpy(&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret)-old_size]), self.buffer, <size_t>old_size)
+                    del self.unused[:new_size+8]
+            return bytes(ret)
+
+    cdef inline int keep_pending(self, const uint8_t* block, int32_t size) except -1:
+        """hold on to a decoded block which doesn't fit in out"""
+        if self.filter == BZ3_FILTER_NONE:
+            self.pending = <uint8_t*>block
+        else:
+            if self.filter_buffer == NULL:
+                self.filter_buffer = <uint8_t *> bz3_buffer_alloc(self.buffer_size)
+                if self.filter_buffer == NULL:
+                    raise MemoryError("Failed to allocate memory")
+            bz3_unfilter(self.filter_buffer, block, <size_t>size, self.filter, self.typesize)
+            self.pending = self.filter_buffer
+        self.pending_size = size
+        return 0
 
-            while True:
-                if PyByteArray_GET_SIZE(self.unused)<8: # 8 byte的 header都不够 直接返回
-                    break
-                new_size = read_neutral_s32(<uint8_t*>PyByteArray_AS_STRING(self.unused)) # todo gcc warning but bytes is contst
-                old_size = read_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(self.unused)[4]))
-                if old_size > <int32_t>bz3_bound(self.block_size) or new_size > <int32_t>bz3_bound(self.block_size):
-                    raise ValueError("Failed to decode a block: Inconsistent headers.")
-                if PyByteArray_GET_SIZE(self.unused) < new_size+8: # 数据段不够
+    cpdef inline tuple decompress_into(self, const uint8_t[::1] data, uint8_t[::1] out):
+        """Decompress data straight into out, returns (written, consumed).
+        Stops once out is full, data[consumed:] must then be passed again. Decoded bytes
+        which don't fit in out are kept and written first by the next call"""
+        cdef Py_ssize_t input_size = data.shape[0], out_size = out.shape[0]
+        cdef Py_ssize_t written = 0, consumed = 0, n, header_size
+        cdef const uint8_t* src = &data[0] if input_size > 0 else NULL
+        cdef uint8_t* dst = &out[0] if out_size > 0 else NULL
+        cdef int32_t new_size, old_size, block_size, code
+        with self.lock:
+            while written < out_size:
+                if self.pending_size:
+                    n = min(self.pending_size, out_size - written)
+                    memcpy(&dst[written], self.pending, <size_t>n)
+                    self.pending += n
+                    self.pending_size -= n
+                    written += n
+                    continue
+                if not self.have_magic_number:
+                    n = min(input_size - consumed, max(BZ3_FILTER_HEADER_SIZE + 9 - PyByteArray_GET_SIZE(self.unused), 0))
+                    append_bytes(self.unused, &src[consumed], n)
+                    consumed += n
+                    header_size = parse_stream_header(<uint8_t*>PyByteArray_AS_STRING(self.unused), PyByteArray_GET_SIZE(self.unused),
+                                                      &block_size, &self.filter, &self.typesize)
+                    if header_size == 0:  # wait for the rest of the header
+                        break
+                    self.init_state(block_size)
+                    del self.unused[:header_size]
+                    self.have_magic_number = 1
+                    continue
+                consumed += next_frame(self.unused, &src[consumed], input_size - consumed, self.buffer,
+                                       <int32_t>bz3_bound(self.block_size), &new_size, &old_size)
+                if new_size < 0:  # wait for the rest of the block
                     break
-                memcpy(self.buffer, &(PyByteArray_AS_STRING(self.unused)[8]), <size_t>new_size)
                 with nogil:
-                    code = bz3_decode_block(self.state, self.buffer, self.buffer_size, new_size, old_size)
+                    code = bz3_decode_block_stored(self.state, self.buffer, self.buffer_size, new_size, old_size)
                 if code == -1:
                     if self.ignore_error:
                         fprintf(stderr, "Writing invalid block: %s\n", bz3_strerror(self.state))
                     else:
                         raise ValueError("Failed to decode a block: %s" % bz3_strerror(self.state))
-                # if PyByteArray_Resize(ret, PyByteArray_GET_SIZE(ret) + old_size) < 0:
-                #     raise
-                ret.extend(<bytes>self.buffer[:old_size])
-                # memcpy(&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret)-old_size]), self.buffer, <size_t>old_size)
-                del self.unused[:new_size+8]
-        return bytes(ret)
+                if old_size <= out_size - written:
+                    with nogil:
+                        bz3_unfilter(&dst[written], self.buffer, <size_t>old_size, self.filter, self.typesize)
+                    written += old_size
+                else:
+                    self.keep_pending(self.buffer, old_size)
+            return written, consumed
 
     @property
     def unused_data(self):
@@ -212,50 +737,245 @@ cdef class BZ3Decompressor:
             return (<bytes> bz3_strerror(self.state)).decode()
         return None
 
+@cython.freelist(8)
+@cython.no_gc
+@cython.final
+cdef class BZ3State:
+    """Low level block encoder/decoder working in place on caller-owned buffers"""
+    cdef:
+        cython.pymutex lock  # serializes concurrent calls on the same object
+        bz3_state * state
+        readonly int32_t block_size
+        bint failed  # the last call failed, libbz3 keeps an error past some successful calls
+
+    def __cinit__(self, int32_t block_size):
+        if block_size < KiB(65) or block_size > MiB(511):
+            raise ValueError("Block size must be between 65 KiB and 511 MiB")
+        self.block_size = block_size
+        self.state = bz3_state_acquire(block_size)
+        if self.state == NULL:
+            raise MemoryError("Failed to create a block encoder state")
+
+    def __dealloc__(self):
+        if self.state != NULL:
+            bz3_state_release(self.state, self.block_size)
+            self.state = NULL
+
+    cpdef inline int32_t encode_block(self, uint8_t[::1] buf, int32_t size, double probe = 0) except -1:
+        """Encode the first size bytes of buf in place, returns the compressed size.
+        buf must be writable and hold at least bound(size) bytes. probe works as for
+        BZ3Compressor with allow_stored, a block at or above it is stored as is, which only
+        streams flagged STREAM_STORED may hold"""
+        cdef int32_t new_size
+        check_probe(probe)
+        with self.lock:
+            if size < 0 or size > self.block_size:
+                raise ValueError("size must be between 0 and block_size")
+            if <size_t>buf.shape[0] < bz3_bound(<size_t>size):
+                raise ValueError("buf must hold at least bound(size) bytes")
+            with nogil:
+                new_size = bz3_encode_block_probed(self.state, &buf[0], size, probe)
+            self.failed = new_size == -1
+            if self.failed:
+                raise ValueError("Failed to encode a block: %s" % bz3_strerror(self.state))
+            return new_size
 
-def compress_file(object input, object output, int32_t block_size):
+    cpdef inline int32_t decode_block(self, uint8_t[::1] buf, int32_t compressed_size, int32_t orig_size) except -1:
+        """Decode the first compressed_size bytes of buf in place, returns the decoded size.
+        buf must be writable and hold at least max(compressed_size, orig_size) bytes"""
+        cdef int32_t code
+        with self.lock:
+            if compressed_size < 0 or orig_size < 0 or orig_size > self.block_size:
+                raise ValueError("Failed to decode a block: Inconsistent headers.")
+            if buf.shape[0] < compressed_size or buf.shape[0] < orig_size or buf.shape[0] == 0:
+                raise ValueError("buf is smaller than the block")
+            with nogil:
+                code = bz3_decode_block_stored(self.state, &buf[0], <size_t>buf.shape[0], compressed_size, orig_size)
+            self.failed = code == -1
+            if self.failed:
+                raise ValueError("Failed to decode a block: %s" % bz3_strerror(self.state))
+            return code
+
+    @property
+    def last_error(self):
+        """The bzip3 error code of the last operation, 0 means BZ3_OK"""
+        return bz3_last_error(self.state) if self.failed else BZ3_OK
+
+    cpdef inline str error(self):
+        if self.failed:
+            return (<bytes>bz3_strerror(self.state)).decode()
+        return None
+
+
+cdef Py_ssize_t readinto_full(object input, object view, Py_ssize_t size) except -1:
+    """fill view, which holds size bytes, with input.readinto, short only at the end of the file"""
+    cdef Py_ssize_t done = 0
+    cdef object n
+    while done < size:
+        n = input.readinto(view if done == 0 else view[done:])
+        if not n:
+            break
+        done += <Py_ssize_t>n
+    return done
+
+cdef long long trim_output(object output, int32_t block_size, double probe, bz3_state* state,
+                           uint8_t* buffer, size_t buffer_size) except -2:
+    """keep the complete blocks of a partial compress_file output, truncate whatever a crash
+    left behind them and leave output positioned at its new end. Returns how many input
+    bytes the kept blocks hold, or -1 when output holds no stream header yet"""
+    cdef bytes data = output.read(9)
+    cdef long long end
+    cdef long long pos
+    cdef long long last = -1
+    cdef long long total = 0
+    cdef int32_t new_size, old_size, last_new = 0, last_old = 0, header_block_size
+    cdef int filter, typesize
+    if PyBytes_GET_SIZE(data) == 9 and strncmp(PyBytes_AS_STRING(data), filter_magic, 4) == 0:
+        data += output.read(BZ3_FILTER_HEADER_SIZE)
+    pos = parse_stream_header(<const uint8_t*>PyBytes_AS_STRING(data), PyBytes_GET_SIZE(data),
+                              &header_block_size, &filter, &typesize)
+    if pos == 0:  # the crash came before the header made it out
+        output.seek(0)
+        output.truncate()
+        return -1
+    if header_block_size != block_size:
+        raise ValueError("The output was written with a block size of %d, not %d" % (header_block_size, block_size))
+    if filter != BZ3_FILTER_NONE:
+        raise ValueError("The output is a filtered stream, which compress_file doesn't write")
+    if probe > 0 and (pos == 9 or not (<uint8_t>PyBytes_AS_STRING(data)[6] & BZ3_STREAM_STORED)):
+        raise ValueError("The output was written without stored blocks, they can't be added to it")
+    end = output.seek(0, 2)
+    output.seek(pos)
+    while pos + 8 <= end:
+        data = output.read(8)
+        new_size = read_neutral_s32(<uint8_t *> PyBytes_AS_STRING(data))
+        old_size = read_neutral_s32(<uint8_t *> &(PyBytes_AS_STRING(data)[4]))
+        # an encoded block is never shorter than its crc and index, a zero filled tail
+        # stops here as well
+        if new_size <= 8 or old_size <= 0 or old_size > block_size or new_size > <int32_t>buffer_size:
+            break
+        if pos + 8 + new_size > end:  # torn
+            break
+        last = pos
+        last_new = new_size
+        last_old = old_size
+        total += old_size
+        pos += 8 + new_size
+        output.seek(pos)
+    if last != -1:
+        # the headers of the last block may have made it to disk before its payload did
+        output.seek(last + 8)
+        if readinto_full(output, PyMemoryView_FromMemory(<char*>buffer, last_new, PyBUF_WRITE), last_new) < last_new \
+                or bz3_decode_block_stored(state, buffer, buffer_size, last_new, last_old) == -1:
+            pos = last
+            total -= last_old
+    output.seek(pos)
+    output.truncate()
+    return total
+
+cdef int skip_input(object input, long long offset, object view, Py_ssize_t size) except -1:
+    """move input past the offset bytes a resumed output already holds, view holds size bytes"""
+    cdef long long pos
+    cdef Py_ssize_t n
+    if PyObject_HasAttrString(input, "seekable") and input.seekable():
+        pos = input.seek(offset, 1)
+        if pos > input.seek(0, 2):
+            raise ValueError("The input is shorter than the output resumed from it")
+        input.seek(pos)
+        return 0
+    while offset > 0:
+        n = <Py_ssize_t>min(<long long>size, offset)
+        if PyObject_HasAttrString(input, "readinto"):
+            n = readinto_full(input, view[:n], n)
+        else:
+            n = PyBytes_GET_SIZE(input.read(n))
+        if n == 0:
+            raise ValueError("The input is shorter than the output resumed from it")
+        offset -= n
+    return 0
+
+def resume_output(object output, int32_t block_size, double probe = 0, bint allow_stored = False):
+    probe = store_probe(probe, allow_stored)
+    if not PyFile_Check(output):
+        raise TypeError("output except a file-like object, got %s" % type(output).__name__)
+    cdef bz3_state *state = bz3_state_acquire(block_size)
+    if state == NULL:
+        raise MemoryError("Failed to create a block encoder state")
+    cdef size_t buffer_size = bz3_bound(block_size)
+    cdef uint8_t *buffer = <uint8_t *> bz3_buffer_alloc(buffer_size)
+    if buffer == NULL:
+        bz3_state_release(state, block_size)
+        state = NULL
+        raise MemoryError("Failed to allocate memory")
+    try:
+        output.seek(0)
+        return trim_output(output, block_size, probe, state, buffer, buffer_size)
+    finally:
+        bz3_state_release(state, block_size)
+        state = NULL
+        bz3_buffer_free(buffer)
+        buffer = NULL
+
+def compress_file(object input, object output, int32_t block_size, double probe = 0, bint resume = False,
+                  bint allow_stored = False):
+    probe = store_probe(probe, allow_stored)
     if not PyFile_Check(input):
         raise TypeError("input except a file-like object, got %s" % type(input).__name__)
     if not PyFile_Check(output):
         raise TypeError("output except a file-like object, got %s" % type(output).__name__)
-    cdef bz3_state *state = bz3_new(block_size)
+    cdef bz3_state *state = bz3_state_acquire(block_size)
     if state == NULL:
         raise MemoryError("Failed to create a block encoder state")
-    cdef uint8_t * buffer = <uint8_t *>PyMem_Malloc(bz3_bound(block_size))
+    cdef size_t buffer_size = bz3_bound(block_size)
+    cdef uint8_t * buffer = <uint8_t *> bz3_buffer_alloc(buffer_size)
     if buffer == NULL:
-        bz3_free(state)
+        bz3_state_release(state, block_size)
         state = NULL
         raise MemoryError
     cdef bytes data
     cdef int32_t new_size
-    cdef uint8_t byteswap_buf[4]
-
-    output.write(b"BZ3v1")
-    write_neutral_s32(byteswap_buf, block_size)
-    output.write(PyBytes_FromStringAndSize(<char*>&byteswap_buf[0], 4))  # magic header
     cdef int32_t old_size
+    cdef uint8_t frame[17]  # the stream header, then the header of every block
+    cdef bint has_readinto = PyObject_HasAttrString(input, "readinto")
+    # views over the native buffers are created once, blocks are read into and written
+    # from them directly
+    cdef object buffer_view = PyMemoryView_FromMemory(<char*>buffer, <Py_ssize_t>buffer_size, PyBUF_WRITE)
+    cdef object block_view = buffer_view[:block_size]
+    cdef object frame_view = PyMemoryView_FromMemory(<char*>frame, 8, PyBUF_READ)
+
+    cdef long long offset = -1
     try:
+        if resume:  # carry on after the last block that made it out intact
+            output.seek(0)
+            offset = trim_output(output, block_size, probe, state, buffer, buffer_size)
+        if offset == -1:
+            output.write(PyMemoryView_FromMemory(<char*>frame, make_stream_header(
+                frame, block_size, BZ3_FILTER_NONE, 1, stream_flags(probe)), PyBUF_READ))  # magic header
+        else:
+            skip_input(input, offset, block_view, block_size)
         while True:
-            data = input.read(block_size)
-            if not data:
+            if has_readinto:
+                old_size = <int32_t>readinto_full(input, block_view, block_size)
+            else:
+                data = input.read(block_size)
+                old_size = <int32_t>PyBytes_GET_SIZE(data)
+                memcpy(buffer, PyBytes_AS_STRING(data), <size_t>old_size)
+            if old_size == 0:
                 break
-            old_size = <int32_t>PyBytes_GET_SIZE(data)
-            memcpy(buffer, PyBytes_AS_STRING(data), <size_t>old_size)
             with nogil:
-                new_size = bz3_encode_block(state, buffer, old_size)
+                new_size = bz3_encode_block_probed(state, buffer, old_size, probe)
             if new_size == -1:
                 raise ValueError("Failed to encode a block: %s" % bz3_strerror(state))
-            write_neutral_s32(byteswap_buf, new_size)
-            output.write(PyBytes_FromStringAndSize(<char*>&byteswap_buf[0], 4))
-            write_neutral_s32(byteswap_buf, old_size)
-            output.write(PyBytes_FromStringAndSize(<char*>&byteswap_buf[0], 4))
-            output.write(PyBytes_FromStringAndSize(<char*>buffer, new_size))
+            write_neutral_s32(frame, new_size)
+            write_neutral_s32(&frame[4], old_size)
+            output.write(frame_view)
+            output.write(buffer_view[:new_size])
             output.flush()
     finally:
         output.flush()
-        bz3_free(state)
+        bz3_state_release(state, block_size)
         state = NULL
-        PyMem_Free(buffer)
+        bz3_buffer_free(buffer)
         buffer = NULL
 
 def decompress_file(object input, object output):
@@ -265,53 +985,71 @@ def decompress_file(object input, object output):
         raise TypeError("output except a file-like object, got %s" % type(output).__name__)
     cdef bytes data
     cdef int32_t block_size
-    data = input.read(9) # magic and block_size type: bytes len = 9
-    if PyBytes_GET_SIZE(data) < 9:
-        raise ValueError("Invalid file. Reason: Smaller than magic header")
-    if strncmp(PyBytes_AS_STRING(data), magic, 5) != 0:
-        raise ValueError("Invalid signature")
-    block_size = read_neutral_s32(<uint8_t*>&(PyBytes_AS_STRING(data)[5]))
-    if block_size < KiB(65) or block_size > MiB(511):
-        raise ValueError("The input file is corrupted. Reason: Invalid block size in the header")
-    cdef bz3_state *state = bz3_new(block_size)
+    cdef int filter, typesize
+    read_stream_header(input, &block_size, &filter, &typesize)
+    cdef bz3_state *state = bz3_state_acquire(block_size)
     if state == NULL:
         raise MemoryError("Failed to create a block encoder state")
     cdef size_t buffer_size = bz3_bound(block_size)
-    cdef uint8_t *buffer = <uint8_t *> PyMem_Malloc(buffer_size)
-    if buffer == NULL:
-        bz3_free(state)
+    cdef uint8_t *buffer = <uint8_t *> bz3_buffer_alloc(buffer_size)
+    # blocks of filtered streams are unfiltered into a second buffer
+    cdef uint8_t *unfiltered = NULL
+    if buffer != NULL and filter != BZ3_FILTER_NONE:
+        unfiltered = <uint8_t *> bz3_buffer_alloc(buffer_size)
+    if buffer == NULL or (filter != BZ3_FILTER_NONE and unfiltered == NULL):
+        bz3_state_release(state, block_size)
         state = NULL
+        bz3_buffer_free(buffer)
+        buffer = NULL
         raise MemoryError("Failed to allocate memory")
     cdef int32_t new_size, old_size, code
+    cdef uint8_t frame[8]
+    cdef bint has_readinto = PyObject_HasAttrString(input, "readinto")
+    cdef object buffer_view = PyMemoryView_FromMemory(<char*>buffer, <Py_ssize_t>buffer_size, PyBUF_WRITE)
+    cdef object output_view = buffer_view
+    cdef object frame_view = PyMemoryView_FromMemory(<char*>frame, 8, PyBUF_WRITE)
+    if unfiltered != NULL:
+        output_view = PyMemoryView_FromMemory(<char*>unfiltered, <Py_ssize_t>buffer_size, PyBUF_READ)
 
     try:
         while True:
-            data = input.read(4)
-            if PyBytes_GET_SIZE(data) < 4:
-                break
-            new_size = read_neutral_s32(<uint8_t*>PyBytes_AS_STRING(data))
-            data = input.read(4)
-            if PyBytes_GET_SIZE(data) < 4:
-                break
-            old_size = read_neutral_s32(<uint8_t *> PyBytes_AS_STRING(data))
-            if old_size > <int32_t>bz3_bound(block_size) or new_size > <int32_t>bz3_bound(block_size):
+            if has_readinto:
+                if readinto_full(input, frame_view, 8) < 8:
+                    break
+            else:
+                data = input.read(8)
+                if PyBytes_GET_SIZE(data) < 8:
+                    break
+                memcpy(frame, PyBytes_AS_STRING(data), 8)
+            new_size = read_neutral_s32(frame)
+            old_size = read_neutral_s32(&frame[4])
+            if new_size < 0 or old_size < 0 or old_size > <int32_t>buffer_size or new_size > <int32_t>buffer_size:
                 raise ValueError("Failed to decode a block: Inconsistent headers.")
-            data = input.read(new_size) # type: bytes
-            if PyBytes_GET_SIZE(data) < new_size:
-                break
-            memcpy(buffer, PyBytes_AS_STRING(data), <size_t> new_size)
+            if has_readinto:
+                if readinto_full(input, buffer_view[:new_size], new_size) < new_size:
+                    break
+            else:
+                data = input.read(new_size) # type: bytes
+                if PyBytes_GET_SIZE(data) < new_size:
+                    break
+                memcpy(buffer, PyBytes_AS_STRING(data), <size_t> new_size)
             with nogil:
-                code = bz3_decode_block(state, buffer, buffer_size, new_size, old_size)
+                code = bz3_decode_block_stored(state, buffer, buffer_size, new_size, old_size)
             if code == -1:
                 raise ValueError("Failed to decode a block: %s" % bz3_strerror(state))
-            output.write(PyBytes_FromStringAndSize(<char*>buffer, old_size))
+            if unfiltered != NULL:
+                with nogil:
+                    bz3_unfilter(unfiltered, buffer, <size_t>old_size, filter, typesize)
+            output.write(output_view[:old_size])
             output.flush()
     finally:
         output.flush()
-        bz3_free(state)
+        bz3_state_release(state, block_size)
         state = NULL
-        PyMem_Free(buffer)
+        bz3_buffer_free(buffer)
         buffer = NULL
+        bz3_buffer_free(unfiltered)
+        unfiltered = NULL
 
 def recover_file(object input, object output):
     if not PyFile_Check(input):
@@ -320,22 +1058,22 @@ def recover_file(object input, object output):
         raise TypeError("output except a file-like object, got %s" % type(output).__name__)
     cdef bytes data
     cdef int32_t block_size
-    data = input.read(9) # magic and block_size type: bytes len = 9
-    if PyBytes_GET_SIZE(data) < 9:
-        raise ValueError("Invalid file. Reason: Smaller than magic header")
-    if strncmp(PyBytes_AS_STRING(data), magic, 5) != 0:
-        raise ValueError("Invalid signature")
-    block_size = read_neutral_s32(<uint8_t*>&(PyBytes_AS_STRING(data)[5]))
-    if block_size < KiB(65) or block_size > MiB(511):
-        raise ValueError("The input file is corrupted. Reason: Invalid block size in the header")
-    cdef bz3_state *state = bz3_new(block_size)
+    cdef int filter, typesize
+    read_stream_header(input, &block_size, &filter, &typesize)
+    cdef bz3_state *state = bz3_state_acquire(block_size)
     if state == NULL:
         raise MemoryError("Failed to create a block encoder state")
     cdef size_t buffer_size = bz3_bound(block_size)
-    cdef uint8_t *buffer = <uint8_t *> PyMem_Malloc(buffer_size)
-    if buffer == NULL:
-        bz3_free(state)
+    cdef uint8_t *buffer = <uint8_t *> bz3_buffer_alloc(buffer_size)
+    # blocks of filtered streams are unfiltered into a second buffer
+    cdef uint8_t *unfiltered = NULL
+    if buffer != NULL and filter != BZ3_FILTER_NONE:
+        unfiltered = <uint8_t *> bz3_buffer_alloc(buffer_size)
+    if buffer == NULL or (filter != BZ3_FILTER_NONE and unfiltered == NULL):
+        bz3_state_release(state, block_size)
         state = NULL
+        bz3_buffer_free(buffer)
+        buffer = NULL
         raise MemoryError("Failed to allocate memory")
     cdef int32_t new_size, old_size, code
 
@@ -356,44 +1094,43 @@ def recover_file(object input, object output):
                 break
             memcpy(buffer, PyBytes_AS_STRING(data), <size_t> new_size)
             with nogil:
-                code = bz3_decode_block(state, buffer, buffer_size, new_size, old_size)
+                code = bz3_decode_block_stored(state, buffer, buffer_size, new_size, old_size)
             if code == -1:
                 fprintf(stderr, "Writing invalid block: %s\n", bz3_strerror(state))
-            output.write(PyBytes_FromStringAndSize(<char*>buffer, old_size))
+            if unfiltered != NULL:
+                bz3_unfilter(unfiltered, buffer, <size_t>old_size, filter, typesize)
+                output.write(PyBytes_FromStringAndSize(<char*>unfiltered, old_size))
+            else:
+                output.write(PyBytes_FromStringAndSize(<char*>buffer, old_size))
             output.flush()
     finally:
         output.flush()
-        bz3_free(state)
+        bz3_state_release(state, block_size)
         state = NULL
-        PyMem_Free(buffer)
+        bz3_buffer_free(buffer)
         buffer = NULL
+        bz3_buffer_free(unfiltered)
+        unfiltered = NULL
 
 cpdef inline bint test_file(object input, bint should_raise = False) except? 0:
     if not PyFile_Check(input):
         raise TypeError("input except a file-like object, got %s" % type(input).__name__)
     cdef bytes data
     cdef int32_t block_size
-    data = input.read(9)  # magic and block_size type: bytes len = 9
-    if PyBytes_GET_SIZE(data) < 9:
-        if should_raise:
-            raise ValueError("Invalid file. Reason: Smaller than magic header")
-        return 0
-    if strncmp(PyBytes_AS_STRING(data), magic, 5) != 0:
-        if should_raise:
-            raise ValueError("Invalid signature")
-        return 0
-    block_size = read_neutral_s32(<uint8_t *> &(PyBytes_AS_STRING(data)[5]))
-    if block_size < KiB(65) or block_size > MiB(511):
+    cdef int filter, typesize
+    try:
+        read_stream_header(input, &block_size, &filter, &typesize)
+    except ValueError:
         if should_raise:
-            raise ValueError("The input file is corrupted. Reason: Invalid block size in the header")
+            raise
         return 0
-    cdef bz3_state *state = bz3_new(block_size)
+    cdef bz3_state *state = bz3_state_acquire(block_size)
     if state == NULL:
         raise MemoryError("Failed to create a block encoder state")
     cdef size_t buffer_size = bz3_bound(block_size)
-    cdef uint8_t *buffer = <uint8_t *> PyMem_Malloc(buffer_size)
+    cdef uint8_t *buffer = <uint8_t *> bz3_buffer_alloc(buffer_size)
     if buffer == NULL:
-        bz3_free(state)
+        bz3_state_release(state, block_size)
         state = NULL
         raise MemoryError("Failed to allocate memory")
     cdef int32_t new_size, old_size, code
@@ -417,7 +1154,7 @@ cpdef inline bint test_file(object input, bint should_raise = False) except? 0:
                 break
             memcpy(buffer, PyBytes_AS_STRING(data), <size_t> new_size)
             with nogil:
-                code = bz3_decode_block(state, buffer, buffer_size, new_size, old_size)
+                code = bz3_decode_block_stored(state, buffer, buffer_size, new_size, old_size)
             # print(f"newsize {new_size} oldsize {old_size}") # todo
             if code == -1:
                 if should_raise:
@@ -425,9 +1162,9 @@ cpdef inline bint test_file(object input, bint should_raise = False) except? 0:
                 return 0
         return 1
     finally:
-        bz3_free(state)
+        bz3_state_release(state, block_size)
         state = NULL
-        PyMem_Free(buffer)
+        bz3_buffer_free(buffer)
         buffer = NULL
 
 cpdef inline size_t bound(size_t input_size) nogil:
@@ -469,15 +1206,90 @@ cpdef inline int orig_size_sufficient_for_decode(const uint8_t[::1] block, int32
 cpdef inline str libversion():
     return (<bytes>bz3_version()).decode()
 
+def trace_enable(Py_ssize_t capacity = 65536):
+    """Start recording per-block trace events into a ring buffer keeping the newest
+    capacity events. Events recorded before are kept unless the capacity changes"""
+    if capacity < 1:
+        raise ValueError("capacity must be at least 1")
+    if bz3_trace_enable(<uint64_t>capacity) < 0:
+        raise MemoryError
+
+def trace_disable():
+    """Stop recording trace events, those recorded stay readable"""
+    bz3_trace_disable()
+
+def trace_clear():
+    """Forget the trace events recorded so far"""
+    bz3_trace_clear()
+
+def trace_events():
+    """The trace events kept, oldest first, as (kind, thread_id, start_ns, end_ns, arg)
+    tuples. arg is the block size, the number of blocks for waves and writes"""
+    cdef uint64_t capacity = bz3_trace_capacity()
+    cdef uint64_t n, i
+    cdef bz3_trace_event* events
+    cdef list ret = []
+    if capacity == 0:
+        return ret
+    events = <bz3_trace_event*>PyMem_Malloc(sizeof(bz3_trace_event) * capacity)
+    if events == NULL:
+        raise MemoryError
+    try:
+        with nogil:
+            n = bz3_trace_read(events, capacity)
+        for i in range(n):
+            ret.append((events[i].kind, events[i].tid, events[i].start_ns, events[i].end_ns, events[i].arg))
+    finally:
+        PyMem_Free(events)
+    return ret
+
+def alloc_configure(object huge_pages = None, object cache_limit = None, object mmap_threshold = None):
+    """Change the settings of the allocator of block states and work buffers, those
+    left None are kept, and return them all as a dict. Buffers of mmap_threshold bytes
+    and up are mapped, with MADV_HUGEPAGE if huge_pages. Released states and mapped
+    buffers are kept for reuse up to cache_limit bytes, 0 turns the cache off"""
+    cdef int huge
+    cdef uint64_t limit, threshold
+    if cache_limit is not None and cache_limit < 0:
+        raise ValueError("cache_limit must not be negative")
+    if mmap_threshold is not None and mmap_threshold < 0:
+        raise ValueError("mmap_threshold must not be negative")
+    bz3_alloc_configure(-1 if huge_pages is None else bool(huge_pages),
+                        -1 if cache_limit is None else <int64_t>cache_limit,
+                        -1 if mmap_threshold is None else <int64_t>mmap_threshold)
+    bz3_alloc_get_config(&huge, &limit, &threshold)
+    return {"huge_pages": bool(huge), "cache_limit": limit, "mmap_threshold": threshold}
+
+def alloc_stats():
+    """Counters of the allocator: allocs, cache_hits, huge_allocs, mapped_bytes,
+    cached_bytes and cached"""
+    cdef bz3_alloc_stats stats
+    bz3_alloc_get_stats(&stats)
+    return {
+        "allocs": stats.allocs,
+        "cache_hits": stats.cache_hits,
+        "huge_allocs": stats.huge_allocs,
+        "mapped_bytes": stats.mapped_bytes,
+        "cached_bytes": stats.cached_bytes,
+        "cached": stats.cached,
+    }
+
+def alloc_trim():
+    """Free the states and buffers the allocator keeps for reuse"""
+    with nogil:
+        bz3_alloc_trim()
+
 # openmp
 from cython.parallel cimport prange
 
 
-cdef void bz3_encode_blocks(bz3_state ** states, uint8_t ** buffers, int32_t *sizes, int32_t numthreads) noexcept:
+cdef void bz3_encode_blocks(bz3_state ** states, uint8_t ** buffers, int32_t *sizes, int32_t numthreads, double probe) noexcept:
     # sizes: read and write
     cdef int32_t i
+    cdef uint64_t t0 = bz3_trace_begin()  # a wave lasts until its slowest block is done
     for i in prange(numthreads, nogil=True, schedule="static", num_threads=numthreads):
-        sizes[i] = bz3_encode_block(states[i], buffers[i], sizes[i])
+        sizes[i] = bz3_encode_block_probed(states[i], buffers[i], sizes[i], probe)
+    bz3_trace_end(BZ3_TRACE_WAVE, numthreads, t0)
 
 
 @cython.freelist(8)
@@ -485,6 +1297,7 @@ cdef void bz3_encode_blocks(bz3_state ** states, uint8_t ** buffers, int32_t *si
 @cython.final
 cdef class BZ3OmpCompressor:
     cdef:
+        cython.pymutex lock  # serializes concurrent calls on the same object
         bz3_state ** states
         uint8_t ** buffers
         int32_t * sizes   # compressed
@@ -493,22 +1306,37 @@ cdef class BZ3OmpCompressor:
         bytearray uncompressed
         bint have_magic_number
         readonly uint32_t numthreads  # how many threads to use
-
-    def __cinit__(self, int32_t block_size, uint32_t numthreads):
+        readonly int filter  # FILTER_* applied to every block before encoding
+        readonly int typesize
+        uint8_t header[17]  # stream header, written once
+        Py_ssize_t header_size
+        readonly double probe  # entropy threshold in bits per byte with allow_stored, 0 encodes every block
+        readonly uint64_t blocks  # blocks written so far
+        readonly uint64_t stored_blocks  # of which stored as is
+
+    def __cinit__(self, int32_t block_size, object numthreads, int filter = BZ3_FILTER_NONE, int typesize = 1,
+                  double probe = 0, bint allow_stored = False):
         if block_size < KiB(65) or block_size > MiB(511):
             raise ValueError("Block size must be between 65 KiB and 511 MiB")
+        check_filter(filter, typesize)
+        probe = store_probe(probe, allow_stored)
+        self.numthreads = resolve_threads(numthreads)
         self.block_size = block_size
-        self.states = <bz3_state **>PyMem_Calloc(<size_t>numthreads, sizeof(bz3_state *)) # prepare the array
+        self.filter = filter
+        self.typesize = typesize
+        self.probe = probe
+        self.header_size = make_stream_header(self.header, block_size, filter, typesize, stream_flags(probe))
+        self.states = <bz3_state **>PyMem_Calloc(<size_t>self.numthreads, sizeof(bz3_state *)) # prepare the array
         if not self.states:
             raise MemoryError
         MEMLOG("PyMem_Malloc %p\n", self.states)
-        self.buffers = <uint8_t **>PyMem_Calloc(<size_t>numthreads, sizeof(uint8_t *))
+        self.buffers = <uint8_t **>PyMem_Calloc(<size_t>self.numthreads, sizeof(uint8_t *))
         if not self.buffers:
             PyMem_Free(self.states)
             self.states = NULL
             raise MemoryError
         MEMLOG("PyMem_Malloc %p\n", self.buffers)
-        self.sizes = <int32_t *>PyMem_Malloc(sizeof(int32_t) * numthreads)
+        self.sizes = <int32_t *>PyMem_Malloc(sizeof(int32_t) * self.numthreads)
         if not self.sizes:
             PyMem_Free(self.states)
             MEMLOG("PyMem_Free %p\n", self.states)
@@ -518,7 +1346,7 @@ cdef class BZ3OmpCompressor:
             self.buffers = NULL
             raise MemoryError
         MEMLOG("PyMem_Malloc %p\n", self.sizes)
-        self.old_sizes = <int32_t *> PyMem_Malloc(sizeof(int32_t) * numthreads)
+        self.old_sizes = <int32_t *> PyMem_Malloc(sizeof(int32_t) * self.numthreads)
         if not self.old_sizes:
             PyMem_Free(self.states)
             MEMLOG("PyMem_Free %p\n", self.states)
@@ -534,12 +1362,12 @@ cdef class BZ3OmpCompressor:
 
         cdef uint32_t i
         try:
-            for i in range(numthreads):
-                self.states[i] = bz3_new(block_size)
+            for i in range(self.numthreads):
+                self.states[i] = bz3_state_acquire(block_size)
                 if self.states[i] == NULL:
                     raise MemoryError("Failed to create a block encoder state")  # todo 如何善后
                 MEMLOG("bz3_new %p\n", self.states[i])
-                self.buffers[i] = <uint8_t *>PyMem_Malloc(bz3_bound(block_size))
+                self.buffers[i] = <uint8_t *> bz3_buffer_alloc(bz3_bound(block_size))
                 if self.buffers[i] == NULL:
                     raise MemoryError("Failed to allocate memory")
                 MEMLOG("PyMem_Malloc %p\n", self.buffers[i])
@@ -561,14 +1389,20 @@ cdef class BZ3OmpCompressor:
             raise
         self.uncompressed = bytearray()
         self.have_magic_number = 0 # 还没有写入magic number
-        self.numthreads = numthreads
+
+    cdef inline void count_blocks(self, int32_t n) noexcept:
+        cdef int32_t i
+        for i in range(n):
+            self.blocks += 1
+            if bz3_is_stored(self.buffers[i], self.sizes[i]):
+                self.stored_blocks += 1
 
     cdef inline void free_states(self):
         cdef uint32_t i
         if self.states:
             for i in range(self.numthreads):
                 if self.states[i]:
-                    bz3_free(self.states[i])
+                    bz3_state_release(self.states[i], self.block_size)
                     MEMLOG("bz3_free %p\n", self.states[i])
                     self.states[i] = NULL
 
@@ -577,7 +1411,7 @@ cdef class BZ3OmpCompressor:
         if self.buffers:
             for i in range(self.numthreads):
                 if self.buffers[i]:
-                    PyMem_Free(self.buffers[i])
+                    bz3_buffer_free(self.buffers[i])
                     MEMLOG("PyMem_Free %p\n", self.buffers[i])
                     self.buffers[i] = NULL
 
@@ -606,75 +1440,243 @@ cdef class BZ3OmpCompressor:
         cdef int32_t new_size
         cdef bytearray ret = bytearray()
         cdef int32_t all_blocks_size = self.block_size * self.numthreads
-        if not self.have_magic_number:
-            # if PyByteArray_Resize(ret, 9) < 0:
-            #     raise
-            # memcpy(PyByteArray_AS_STRING(ret), magic, 5)
-            ret.extend(<bytes>magic[:5]+b"\x00\x00\x00\x00")  # 9 bytes
-            write_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(ret)[5]), self.block_size)
-            self.have_magic_number = 1
         cdef uint32_t i
-        if input_size > 0:
-            # if PyByteArray_Resize(self.uncompressed, input_size+PyByteArray_GET_SIZE(self.uncompressed)) < 0:
-            #     raise
-            # memcpy(&(PyByteArray_AS_STRING(self.uncompressed)[PyByteArray_GET_SIZE(self.uncompressed)-input_size]), &data[0], input_size) # todo? direct copy to bytearray
-            self.uncompressed.extend(data)
-            if PyByteArray_GET_SIZE(self.uncompressed) >= all_blocks_size:  # able to perform a compress
-                while PyByteArray_GET_SIZE(self.uncompressed) >= all_blocks_size:  # ensure fill all blocks
-                    for i in range(self.numthreads):
-                        self.sizes[i] = self.block_size  # fill the sizes array
-                        memcpy(self.buffers[i], &PyByteArray_AS_STRING(self.uncompressed)[i*self.block_size], <size_t>self.block_size)
-                        # make a copy
-                    bz3_encode_blocks(self.states, self.buffers, self.sizes, <int32_t>self.numthreads)
-                    for i in range(self.numthreads):
-                        if bz3_last_error(self.states[i]) != BZ3_OK:
-                            raise ValueError("Failed to encode a block: %s" % bz3_strerror(self.states[i]))
-                        # if PyByteArray_Resize(ret, PyByteArray_GET_SIZE(ret) + new_size + 8) < 0:
-                        #     raise
-                        ret.extend((self.sizes[i] + 8)*b"\x00")
-                        write_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret)-self.sizes[i]-8]), self.sizes[i])
-                        write_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret)-self.sizes[i]-4]), self.block_size)
-                        memcpy(&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret)-self.sizes[i]]), self.buffers[i], <size_t>self.sizes[i])
-
-                    del self.uncompressed[:all_blocks_size]
-        return bytes(ret)
+        cdef uint64_t t0
+        with self.lock:
+            if not self.have_magic_number:
+                # if PyByteArray_Resize(ret, 9) < 0:
+                #     raise
+                # memcpy(PyByteArray_AS_STRING(ret), magic, 5)
+                ret.extend(<bytes>self.header[:self.header_size])  # 9 bytes, 17 with the "BZ3F" prefix
+                self.have_magic_number = 1
+            if input_size > 0:
+                # if PyByteArray_Resize(self.uncompressed, input_size+PyByteArray_GET_SIZE(self.uncompressed)) < 0:
+                #     raise
+                # memcpy(&(PyByteArray_AS_STRING(self.uncompressed)[PyByteArray_GET_SIZE(self.uncompressed)-input_size]), &data[0], input_size) # todo? direct copy to bytearray
+                self.uncompressed.extend(data)
+                if PyByteArray_GET_SIZE(self.uncompressed) >= all_blocks_size:  # able to perform a compress
+                    while PyByteArray_GET_SIZE(self.uncompressed) >= all_blocks_size:  # ensure fill all blocks
+                        for i in range(self.numthreads):
+                            self.sizes[i] = self.block_size  # fill the sizes array
+                            bz3_filter(self.buffers[i], <const uint8_t*>&PyByteArray_AS_STRING(self.uncompressed)[i*self.block_size], <size_t>self.block_size, self.filter, self.typesize)
+                            # make a copy
+                        bz3_encode_blocks(self.states, self.buffers, self.sizes, <int32_t>self.numthreads, self.probe)
+                        self.count_blocks(<int32_t>self.numthreads)
+                        for i in range(self.numthreads):
+                            if self.sizes[i] == -1:
+                                raise ValueError("Failed to encode a block: %s" % bz3_strerror(self.states[i]))
+                            t0 = bz3_trace_begin()
+                            # if PyByteArray_Resize(ret, PyByteArray_GET_SIZE(ret) + new_size + 8) < 0:
+                            #     raise
+                            ret.extend((self.sizes[i] + 8)*b"\x00")
+                            write_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret)-self.sizes[i]-8]), self.sizes[i])
+                            write_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret)-self.sizes[i]-4]), self.block_size)
+                            memcpy(&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret)-self.sizes[i]]), self.buffers[i], <size_t>self.sizes[i])
+                            bz3_trace_end(BZ3_TRACE_ASSEMBLE, self.sizes[i], t0)
+
+                        del self.uncompressed[:all_blocks_size]
+            return bytes(ret)
 
     cpdef inline bytes flush(self):
         cdef bytearray ret = bytearray()
         cdef int32_t new_size
-        cdef int32_t remain_size = <int32_t>PyByteArray_GET_SIZE(self.uncompressed)
+        cdef int32_t remain_size
+        cdef uint64_t t0
         cdef:
             int i = 0  # thread count
             int j
-        if self.uncompressed:  # will perform a compress
+        with self.lock:
+            remain_size = <int32_t>PyByteArray_GET_SIZE(self.uncompressed)
+            if self.uncompressed:  # will perform a compress
+                while self.block_size * (i+1) < remain_size:
+                    bz3_filter(self.buffers[i], <const uint8_t*>&PyByteArray_AS_STRING(self.uncompressed)[i*self.block_size], <size_t>self.block_size, self.filter, self.typesize)
+                    self.sizes[i] = self.old_sizes[i] = self.block_size
+                    # old_sizes[i] = self.block_size
+                    i += 1
+                bz3_filter(self.buffers[i], <const uint8_t*>&PyByteArray_AS_STRING(self.uncompressed)[i * self.block_size], <size_t> (remain_size-i*self.block_size), self.filter, self.typesize)  # fill as many blocks as possible
+                self.sizes[i] = self.old_sizes[i] = remain_size-i*self.block_size
+                # old_sizes[i] = remain_size-i*self.block_size
+                i += 1
+                bz3_encode_blocks(self.states, self.buffers, self.sizes, i, self.probe)
+                self.count_blocks(i)
+                for j in range(i):  # state index
+                    if self.sizes[j] == -1:
+                        raise ValueError("Failed to encode a block: %s" % bz3_strerror(self.states[j]))
+                    t0 = bz3_trace_begin()
+                    ret.extend((self.sizes[j] + 8) * b"\x00")
+                    write_neutral_s32(<uint8_t *> &(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret) - self.sizes[j] - 8]),
+                                      self.sizes[j])
+                    write_neutral_s32(<uint8_t *> &(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret) - self.sizes[j] - 4]),
+                                      self.old_sizes[j])
+                    memcpy(&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret) - self.sizes[j]]), self.buffers[j],
+                           <size_t> self.sizes[j])
+                    bz3_trace_end(BZ3_TRACE_ASSEMBLE, self.sizes[j], t0)
+
+                self.uncompressed.clear()
+            return bytes(ret)
+
+    cpdef inline Py_ssize_t compress_to(self, const uint8_t[::1] data, object out) except -1:
+        """Like compress(), but write the output to out, a file descriptor or a binary file object,
+        straight from the native buffers with one writev call per round of blocks.
+        Returns the number of bytes written"""
+        cdef Py_ssize_t input_size = data.shape[0]
+        cdef int32_t all_blocks_size = self.block_size * self.numthreads
+        cdef uint8_t head[17]
+        cdef Py_ssize_t head_size = 0
+        cdef Py_ssize_t written = 0
+        cdef uint32_t i
+        with self.lock:
+            if not self.have_magic_number:
+                memcpy(head, self.header, <size_t>self.header_size)
+                head_size = self.header_size
+            if input_size > 0:
+                self.uncompressed.extend(data)
+                while PyByteArray_GET_SIZE(self.uncompressed) >= all_blocks_size:
+                    for i in range(self.numthreads):
+                        self.sizes[i] = self.old_sizes[i] = self.block_size
+                        bz3_filter(self.buffers[i], <const uint8_t*>&PyByteArray_AS_STRING(self.uncompressed)[i*self.block_size], <size_t>self.block_size, self.filter, self.typesize)
+                    bz3_encode_blocks(self.states, self.buffers, self.sizes, <int32_t>self.numthreads, self.probe)
+                    self.count_blocks(<int32_t>self.numthreads)
+                    for i in range(self.numthreads):
+                        if self.sizes[i] == -1:
+                            raise ValueError("Failed to encode a block: %s" % bz3_strerror(self.states[i]))
+                    written += write_blocks(out, head, head_size, self.buffers, self.sizes, self.old_sizes, <int32_t>self.numthreads)
+                    head_size = 0
+                    self.have_magic_number = 1
+                    del self.uncompressed[:all_blocks_size]
+            if head_size:
+                written += write_blocks(out, head, head_size, NULL, NULL, NULL, 0)
+                self.have_magic_number = 1
+            return written
+
+    cpdef inline Py_ssize_t flush_to(self, object out) except -1:
+        """Like flush(), but write the output to out, returns the number of bytes written"""
+        cdef int32_t remain_size
+        cdef int i = 0  # thread count
+        cdef int j
+        cdef Py_ssize_t written = 0
+        with self.lock:
+            remain_size = <int32_t>PyByteArray_GET_SIZE(self.uncompressed)
+            if self.uncompressed:
+                while self.block_size * (i+1) < remain_size:
+                    bz3_filter(self.buffers[i], <const uint8_t*>&PyByteArray_AS_STRING(self.uncompressed)[i*self.block_size], <size_t>self.block_size, self.filter, self.typesize)
+                    self.sizes[i] = self.old_sizes[i] = self.block_size
+                    i += 1
+                bz3_filter(self.buffers[i], <const uint8_t*>&PyByteArray_AS_STRING(self.uncompressed)[i * self.block_size], <size_t> (remain_size-i*self.block_size), self.filter, self.typesize)
+                self.sizes[i] = self.old_sizes[i] = remain_size-i*self.block_size
+                i += 1
+                bz3_encode_blocks(self.states, self.buffers, self.sizes, i, self.probe)
+                self.count_blocks(i)
+                for j in range(i):
+                    if self.sizes[j] == -1:
+                        raise ValueError("Failed to encode a block: %s" % bz3_strerror(self.states[j]))
+                written = write_blocks(out, NULL, 0, self.buffers, self.sizes, self.old_sizes, i)
+                self.uncompressed.clear()
+            return written
+
+    cdef inline Py_ssize_t _compress_bound(self, Py_ssize_t size) noexcept:
+        cdef Py_ssize_t rounds = (PyByteArray_GET_SIZE(self.uncompressed) + size) // (<Py_ssize_t>self.block_size * self.numthreads)
+        return (0 if self.have_magic_number else self.header_size) + rounds * self.numthreads * (8 + <Py_ssize_t>bz3_bound(self.block_size))
+
+    cdef inline Py_ssize_t _flush_bound(self) noexcept:
+        cdef Py_ssize_t size = PyByteArray_GET_SIZE(self.uncompressed)
+        cdef Py_ssize_t full = size // self.block_size
+        cdef Py_ssize_t rest = size - full * self.block_size
+        return full * (8 + <Py_ssize_t>bz3_bound(self.block_size)) + (8 + <Py_ssize_t>bz3_bound(rest) if rest else 0)
+
+    cpdef inline Py_ssize_t compress_bound(self, Py_ssize_t size):
+        """Worst-case number of bytes compress_into() writes for size bytes of input"""
+        with self.lock:
+            return self._compress_bound(size)
+
+    cpdef inline Py_ssize_t flush_bound(self):
+        """Worst-case number of bytes flush_into() writes"""
+        with self.lock:
+            return self._flush_bound()
+
+    cdef inline Py_ssize_t copy_blocks(self, uint8_t* dst, int n) noexcept:
+        """copy n encoded blocks with their headers to dst, returns the bytes copied"""
+        cdef Py_ssize_t pos = 0
+        cdef int i
+        for i in range(n):
+            write_neutral_s32(&dst[pos], self.sizes[i])
+            write_neutral_s32(&dst[pos + 4], self.old_sizes[i])
+            memcpy(&dst[pos + 8], self.buffers[i], <size_t>self.sizes[i])
+            pos += 8 + self.sizes[i]
+        return pos
+
+    cpdef inline Py_ssize_t compress_into(self, const uint8_t[::1] data, uint8_t[::1] out) except -1:
+        """Like compress(), but write the output into out, a writable buffer. Returns the number
+        of bytes written, raises ValueError before touching anything if out can't hold
+        compress_bound(len(data)) bytes"""
+        cdef Py_ssize_t input_size = data.shape[0]
+        cdef int32_t all_blocks_size = self.block_size * self.numthreads
+        cdef Py_ssize_t needed
+        cdef Py_ssize_t pos = 0
+        cdef uint8_t* dst
+        cdef uint32_t i
+        with self.lock:
+            needed = self._compress_bound(input_size)
+            if out.shape[0] < needed:
+                raise ValueError("out is too small, need %d more bytes" % (needed - out.shape[0]))
+            if needed == 0:
+                if input_size > 0:
+                    self.uncompressed.extend(data)
+                return 0
+            dst = &out[0]
+            if not self.have_magic_number:
+                memcpy(dst, self.header, <size_t>self.header_size)
+                pos = self.header_size
+                self.have_magic_number = 1
+            if input_size > 0:
+                self.uncompressed.extend(data)
+                while PyByteArray_GET_SIZE(self.uncompressed) >= all_blocks_size:
+                    for i in range(self.numthreads):
+                        self.sizes[i] = self.old_sizes[i] = self.block_size
+                        bz3_filter(self.buffers[i], <const uint8_t*>&PyByteArray_AS_STRING(self.uncompressed)[i*self.block_size], <size_t>self.block_size, self.filter, self.typesize)
+                    bz3_encode_blocks(self.states, self.buffers, self.sizes, <int32_t>self.numthreads, self.probe)
+                    self.count_blocks(<int32_t>self.numthreads)
+                    for i in range(self.numthreads):
+                        if self.sizes[i] == -1:
+                            raise ValueError("Failed to encode a block: %s" % bz3_strerror(self.states[i]))
+                    pos += self.copy_blocks(&dst[pos], <int>self.numthreads)
+                    del self.uncompressed[:all_blocks_size]
+            return pos
+
+    cpdef inline Py_ssize_t flush_into(self, uint8_t[::1] out) except -1:
+        """Like flush(), but write the output into out, returns the number of bytes written.
+        out must hold at least flush_bound() bytes"""
+        cdef Py_ssize_t needed
+        cdef int32_t remain_size
+        cdef int i = 0  # thread count
+        cdef int j
+        with self.lock:
+            needed = self._flush_bound()
+            if out.shape[0] < needed:
+                raise ValueError("out is too small, need %d more bytes" % (needed - out.shape[0]))
+            if needed == 0:
+                return 0
+            remain_size = <int32_t>PyByteArray_GET_SIZE(self.uncompressed)
             while self.block_size * (i+1) < remain_size:
-                memcpy(self.buffers[i],
-                       &PyByteArray_AS_STRING(self.uncompressed)[i*self.block_size],
-                       <size_t>self.block_size)
+                bz3_filter(self.buffers[i], <const uint8_t*>&PyByteArray_AS_STRING(self.uncompressed)[i*self.block_size], <size_t>self.block_size, self.filter, self.typesize)
                 self.sizes[i] = self.old_sizes[i] = self.block_size
-                # old_sizes[i] = self.block_size
                 i += 1
-            memcpy(self.buffers[i],
-                   &PyByteArray_AS_STRING(self.uncompressed)[i * self.block_size],
-                   <size_t> (remain_size-i*self.block_size))  # fill as many blocks as possible
+            bz3_filter(self.buffers[i], <const uint8_t*>&PyByteArray_AS_STRING(self.uncompressed)[i * self.block_size], <size_t> (remain_size-i*self.block_size), self.filter, self.typesize)
             self.sizes[i] = self.old_sizes[i] = remain_size-i*self.block_size
-            # old_sizes[i] = remain_size-i*self.block_size
             i += 1
-            bz3_encode_blocks(self.states, self.buffers, self.sizes, i)
-            for j in range(i):  # state index
-                if bz3_last_error(self.states[j]) != BZ3_OK:
+            bz3_encode_blocks(self.states, self.buffers, self.sizes, i, self.probe)
+            self.count_blocks(i)
+            for j in range(i):
+                if self.sizes[j] == -1:
                     raise ValueError("Failed to encode a block: %s" % bz3_strerror(self.states[j]))
-
-                ret.extend((self.sizes[j] + 8) * b"\x00")
-                write_neutral_s32(<uint8_t *> &(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret) - self.sizes[j] - 8]),
-                                  self.sizes[j])
-                write_neutral_s32(<uint8_t *> &(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret) - self.sizes[j] - 4]),
-                                  self.old_sizes[j])
-                memcpy(&(PyByteArray_AS_STRING(ret)[PyByteArray_GET_SIZE(ret) - self.sizes[j]]), self.buffers[j],
-                       <size_t> self.sizes[j])
-
             self.uncompressed.clear()
-        return bytes(ret)
+            return self.copy_blocks(&out[0], i)
+
+    @property
+    def buffered(self):
+        """Uncompressed bytes held back until they fill a round of blocks or are flushed."""
+        with self.lock:
+            return PyByteArray_GET_SIZE(self.uncompressed)
 
     cpdef inline list error(self):
         cdef uint32_t i
@@ -686,9 +1688,12 @@ cdef class BZ3OmpCompressor:
 
 
 cdef void bz3_decode_blocks(bz3_state ** states, uint8_t ** buffers, size_t *buffer_sizes, int32_t* sizes, int32_t* orig_size, int32_t numthreads) noexcept:
+    # sizes: the compressed sizes in, the decoded sizes or -1 out
     cdef int32_t i
+    cdef uint64_t t0 = bz3_trace_begin()
     for i in prange(numthreads, nogil=True, schedule='static', num_threads=numthreads):
-        bz3_decode_block(states[i], buffers[i], buffer_sizes[i], sizes[i], orig_size[i])
+        sizes[i] = bz3_decode_block_stored(states[i], buffers[i], buffer_sizes[i], sizes[i], orig_size[i])
+    bz3_trace_end(BZ3_TRACE_WAVE, numthreads, t0)
 
 
 @cython.freelist(8)
@@ -696,6 +1701,7 @@ cdef void bz3_decode_blocks(bz3_state ** states, uint8_t ** buffers, size_t *buf
 @cython.final
 cdef class BZ3OmpDecompressor:
     cdef:
+        cython.pymutex lock  # serializes concurrent calls on the same object
         bz3_state ** states
         uint8_t ** buffers
         size_t* buffer_sizes
@@ -706,6 +1712,13 @@ cdef class BZ3OmpDecompressor:
         bint have_magic_number
         readonly uint32_t numthreads  # how many threads to use
         readonly bint ignore_error  # 是否忽略decode错误
+        readonly int filter  # read from the stream header
+        readonly int typesize
+        uint32_t decoded_blocks  # blocks decoded by decompress_into in buffers
+        uint32_t next_block  # the first of them not written to out yet
+        uint8_t * pending  # rest of the block being written to out
+        Py_ssize_t pending_size
+        uint8_t * filter_buffer  # unfiltered block held in pending, filtered streams only
 
     cdef inline int init_state(self, int32_t block_size) except -1:
         """should exec only once"""
@@ -726,14 +1739,15 @@ cdef class BZ3OmpDecompressor:
             MEMLOG("PyMem_Malloc %p\n", self.buffer_sizes)
         cdef size_t buffer_size = bz3_bound(block_size)
         cdef uint32_t i
+        self.block_size = block_size  # the states are given back for it
         try:
             for i in range(self.numthreads):
                 self.buffer_sizes[i] = buffer_size
-                self.states[i] = bz3_new(block_size)
+                self.states[i] = bz3_state_acquire(block_size)
                 if self.states[i] == NULL:
                     raise MemoryError("Failed to create a block encoder state")  # todo 如何善后
                 MEMLOG("bz3_new %p\n", self.states[i])
-                self.buffers[i] = <uint8_t *> PyMem_Malloc(buffer_size)
+                self.buffers[i] = <uint8_t *> bz3_buffer_alloc(buffer_size)
                 if self.buffers[i] == NULL:
                     raise MemoryError("Failed to allocate memory")
                 MEMLOG("PyMem_Malloc %p\n", self.buffers[i])
@@ -741,22 +1755,23 @@ cdef class BZ3OmpDecompressor:
             self.free_states()
             self.free_buffers()
             raise
-        self.block_size = block_size
 
-    def __cinit__(self,  uint32_t numthreads, bint ignore_error = False):
+    def __cinit__(self, object numthreads, bint ignore_error = False):
         self.states = NULL
         self.buffers = NULL
         self.buffer_sizes = NULL
         self.unused = bytearray()
         self.have_magic_number = 0 # 还没有读到magic number
-        self.numthreads = numthreads
+        self.numthreads = resolve_threads(numthreads)
         self.ignore_error = ignore_error
+        self.filter = BZ3_FILTER_NONE
+        self.typesize = 1
 
-        self.sizes = <int32_t *> PyMem_Malloc(sizeof(int32_t) * numthreads)
+        self.sizes = <int32_t *> PyMem_Malloc(sizeof(int32_t) * self.numthreads)
         if not self.sizes:
             raise MemoryError
         MEMLOG("PyMem_Malloc %p\n", self.sizes)
-        self.old_sizes = <int32_t *> PyMem_Malloc(sizeof(int32_t) * numthreads)
+        self.old_sizes = <int32_t *> PyMem_Malloc(sizeof(int32_t) * self.numthreads)
         if not self.old_sizes:
             PyMem_Free(self.sizes)
             self.sizes = NULL
@@ -769,7 +1784,7 @@ cdef class BZ3OmpDecompressor:
         if self.states: # states数组是否初始化，即是否调用过init_states
             for i in range(self.numthreads):
                 if self.states[i]:
-                    bz3_free(self.states[i])
+                    bz3_state_release(self.states[i], self.block_size)
                     MEMLOG("bz3_free %p\n", self.states[i])
                     self.states[i] = NULL
 
@@ -778,7 +1793,7 @@ cdef class BZ3OmpDecompressor:
         if self.buffers: # states数组是否初始化，即是否调用过init_states
             for i in range(self.numthreads):
                 if self.buffers[i]:
-                    PyMem_Free(self.buffers[i])
+                    bz3_buffer_free(self.buffers[i])
                     MEMLOG("PyMem_Free %p\n", self.buffers[i])
                     self.buffers[i] = NULL
 
@@ -805,8 +1820,19 @@ cdef class BZ3OmpDecompressor:
             PyMem_Free(self.buffer_sizes)
             MEMLOG("PyMem_Free %p\n", self.buffer_sizes)
             self.buffer_sizes = NULL
+        if self.filter_buffer:
+            bz3_buffer_free(self.filter_buffer)
+            self.filter_buffer = NULL
         MEMLOG("BZ3OmpDecompressor __dealloc__ %p\n", <void *> self)
 
+    cdef inline int check_block(self, uint32_t j) except -1:
+        if self.sizes[j] == -1:  # the decoded size, see bz3_decode_blocks()
+            if self.ignore_error:
+                fprintf(stderr, "Writing invalid block: %s\n", bz3_strerror(self.states[j]))
+            else:
+                raise ValueError("Failed to decode data: %s" % bz3_strerror(self.states[j]))
+        return 0
+
     cpdef inline bytes decompress(self, const uint8_t[::1] data):
         cdef Py_ssize_t input_size = data.shape[0]
         cdef int32_t code
@@ -814,50 +1840,126 @@ cdef class BZ3OmpDecompressor:
         cdef int32_t  block_size
         cdef uint32_t i, thread_count, j, should_delete=0
         cdef int should_break = 0
-        if input_size > 0:
-            # if PyByteArray_Resize(self.unused, input_size+PyByteArray_GET_SIZE(self.unused)) < 0:
-            #     raise
-            # memcpy(&(PyByteArray_AS_STRING(self.unused)[PyByteArray_GET_SIZE(self.unused)-input_size]), &data[0], input_size) # self.unused.extend
-            self.unused.extend(data) # read header
-            if PyByteArray_GET_SIZE(self.unused) >= 9 and not self.have_magic_number: # 9 bytes magic number
-                if strncmp(PyByteArray_AS_STRING(self.unused), magic, 5) != 0:
-                    raise ValueError("Invalid signature")
-                block_size = read_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(self.unused)[5]))
-                if block_size < KiB(65) or block_size > MiB(511):
-                    raise ValueError("The input file is corrupted. Reason: Invalid block size in the header")
-                self.init_state(block_size)
-                del self.unused[:9]
-                self.have_magic_number = 1
-            # 有几个block就用几个
-            while not should_break:
-                thread_count = 0  # 这一波能用上几个thread
-                # should_delete = 0 # 讀取完成后從self.unused刪多少
-                for i in range(self.numthreads):
-                    if (PyByteArray_GET_SIZE(self.unused)-should_delete) < 8: # 8 byte的 header都不够 直接返回
-                        should_break = 1
+        cdef Py_ssize_t header_size
+        with self.lock:
+            if self.pending_size:  # left over by decompress_into
+                append_bytes(ret, self.pending, self.pending_size)
+                self.pending_size = 0
+            while self.next_block < self.decoded_blocks:
+                j = self.next_block
+                self.next_block += 1
+                self.check_block(j)
+                extend_unfiltered(ret, self.buffers[j], self.old_sizes[j], self.filter, self.typesize)
+            if input_size > 0:
+                # if PyByteArray_Resize(self.unused, input_size+PyByteArray_GET_SIZE(self.unused)) < 0:
+                #     raise
+                # memcpy(&(PyByteArray_AS_STRING(self.unused)[PyByteArray_GET_SIZE(self.unused)-input_size]), &data[0], input_size) # self.unused.extend
+                self.unused.extend(data) # read header
+                if not self.have_magic_number: # 9 bytes magic number, 17 with the "BZ3F" prefix
+                    header_size = parse_stream_header(<uint8_t*>PyByteArray_AS_STRING(self.unused), PyByteArray_GET_SIZE(self.unused),
+                                                      &block_size, &self.filter, &self.typesize)
+                    if header_size == 0:  # wait for the rest of the header
+                        return b""
+                    self.init_state(block_size)
+                    del self.unused[:header_size]
+                    self.have_magic_number = 1
+                # 有几个block就用几个
+                while not should_break:
+                    thread_count = 0  # 这一波能用上几个thread
+                    # should_delete = 0 # 讀取完成后從self.unused刪多少
+                    for i in range(self.numthreads):
+                        if (PyByteArray_GET_SIZE(self.unused)-should_delete) < 8: # 8 byte的 header都不够 直接返回
+                            should_break = 1
+                            break
+                        self.sizes[i] = read_neutral_s32(<uint8_t*>&PyByteArray_AS_STRING(self.unused)[should_delete]) # todo gcc warning but bytes is const
+                        self.old_sizes[i] = read_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(self.unused)[should_delete+4]))
+                        if self.old_sizes[i] > <int32_t>bz3_bound(self.block_size) or self.sizes[i] > <int32_t>bz3_bound(self.block_size):
+                            raise ValueError("Failed to decode a block: Inconsistent headers.")
+                        if (PyByteArray_GET_SIZE(self.unused)-should_delete) < self.sizes[i]+8: # 数据段不够
+                            should_break = 1
+                            break
+                        memcpy(self.buffers[i], &(PyByteArray_AS_STRING(self.unused)[should_delete+8]), <size_t>self.sizes[i])
+                        should_delete += (self.sizes[i] + 8)
+                        thread_count += 1
+                    if thread_count:  # 一个block都凑不齐decode个jb
+                        bz3_decode_blocks(self.states, self.buffers, self.buffer_sizes, self.sizes, self.old_sizes, <int32_t>thread_count)
+                    for j in range(thread_count):
+                        self.check_block(j)
+                        extend_unfiltered(ret, self.buffers[j], self.old_sizes[j], self.filter, self.typesize)
+                if should_delete:
+                    del self.unused[:should_delete]
+            return bytes(ret)
+
+    cdef inline int keep_pending(self, const uint8_t* block, int32_t size) except -1:
+        """hold on to a decoded block which doesn't fit in out"""
+        if self.filter == BZ3_FILTER_NONE:
+            self.pending = <uint8_t*>block
+        else:
+            if self.filter_buffer == NULL:
+                self.filter_buffer = <uint8_t *> bz3_buffer_alloc(bz3_bound(self.block_size))
+                if self.filter_buffer == NULL:
+                    raise MemoryError("Failed to allocate memory")
+            bz3_unfilter(self.filter_buffer, block, <size_t>size, self.filter, self.typesize)
+            self.pending = self.filter_buffer
+        self.pending_size = size
+        return 0
+
+    cpdef inline tuple decompress_into(self, const uint8_t[::1] data, uint8_t[::1] out):
+        """Decompress data straight into out, returns (written, consumed).
+        Stops once out is full, data[consumed:] must then be passed again. Up to numthreads
+        blocks are decoded at once, the ones which don't fit in out are written first by the
+        next call"""
+        cdef Py_ssize_t input_size = data.shape[0], out_size = out.shape[0]
+        cdef Py_ssize_t written = 0, consumed = 0, n, header_size
+        cdef const uint8_t* src = &data[0] if input_size > 0 else NULL
+        cdef uint8_t* dst = &out[0] if out_size > 0 else NULL
+        cdef int32_t block_size
+        cdef uint32_t i, j, thread_count
+        with self.lock:
+            while written < out_size:
+                if self.pending_size:
+                    n = min(self.pending_size, out_size - written)
+                    memcpy(&dst[written], self.pending, <size_t>n)
+                    self.pending += n
+                    self.pending_size -= n
+                    written += n
+                    continue
+                if self.next_block < self.decoded_blocks:
+                    j = self.next_block
+                    self.next_block += 1
+                    self.check_block(j)
+                    if self.old_sizes[j] <= out_size - written:
+                        with nogil:
+                            bz3_unfilter(&dst[written], self.buffers[j], <size_t>self.old_sizes[j], self.filter, self.typesize)
+                        written += self.old_sizes[j]
+                    else:
+                        self.keep_pending(self.buffers[j], self.old_sizes[j])
+                    continue
+                if not self.have_magic_number:
+                    n = min(input_size - consumed, max(BZ3_FILTER_HEADER_SIZE + 9 - PyByteArray_GET_SIZE(self.unused), 0))
+                    append_bytes(self.unused, &src[consumed], n)
+                    consumed += n
+                    header_size = parse_stream_header(<uint8_t*>PyByteArray_AS_STRING(self.unused), PyByteArray_GET_SIZE(self.unused),
+                                                      &block_size, &self.filter, &self.typesize)
+                    if header_size == 0:  # wait for the rest of the header
                         break
-                    self.sizes[i] = read_neutral_s32(<uint8_t*>&PyByteArray_AS_STRING(self.unused)[should_delete]) # todo gcc warning but bytes is const
-                    self.old_sizes[i] = read_neutral_s32(<uint8_t*>&(PyByteArray_AS_STRING(self.unused)[should_delete+4]))
-                    if self.old_sizes[i] > <int32_t>bz3_bound(self.block_size) or self.sizes[i] > <int32_t>bz3_bound(self.block_size):
-                        raise ValueError("Failed to decode a block: Inconsistent headers.")
-                    if (PyByteArray_GET_SIZE(self.unused)-should_delete) < self.sizes[i]+8: # 数据段不够
-                        should_break = 1
+                    self.init_state(block_size)
+                    del self.unused[:header_size]
+                    self.have_magic_number = 1
+                    continue
+                thread_count = 0
+                for i in range(self.numthreads):
+                    consumed += next_frame(self.unused, &src[consumed], input_size - consumed, self.buffers[i],
+                                           <int32_t>bz3_bound(self.block_size), &self.sizes[i], &self.old_sizes[i])
+                    if self.sizes[i] < 0:  # wait for the rest of the block
                         break
-                    memcpy(self.buffers[i], &(PyByteArray_AS_STRING(self.unused)[should_delete+8]), <size_t>self.sizes[i])
-                    should_delete += (self.sizes[i] + 8)
                     thread_count += 1
-                if thread_count:  # 一个block都凑不齐decode个jb
-                    bz3_decode_blocks(self.states, self.buffers, self.buffer_sizes, self.sizes, self.old_sizes, <int32_t>thread_count)
-                for j in range(thread_count):
-                    if bz3_last_error(self.states[j]) != BZ3_OK:
-                        if self.ignore_error:
-                            fprintf(stderr, "Writing invalid block: %s\n", bz3_strerror(self.states[j]))
-                        else:
-                            raise ValueError("Failed to decode data: %s" % bz3_strerror(self.states[j]))
-                    ret.extend(<bytes>self.buffers[j][:self.old_sizes[j]])
-            if should_delete:
-                del self.unused[:should_delete]
-        return bytes(ret)
+                if not thread_count:
+                    break
+                bz3_decode_blocks(self.states, self.buffers, self.buffer_sizes, self.sizes, self.old_sizes, <int32_t>thread_count)
+                self.next_block = 0
+                self.decoded_blocks = thread_count
+            return written, consumed
 
     @property
     def unused_data(self):
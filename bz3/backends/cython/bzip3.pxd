@@ -1,6 +1,6 @@
 # cython: language_level=3
 # cython: cdivision=True
-from libc.stdint cimport (int8_t, int16_t, int32_t, uint8_t, uint16_t,
+from libc.stdint cimport (int8_t, int16_t, int32_t, int64_t, uint8_t, uint16_t,
                           uint32_t, uint64_t)
 
 
@@ -55,4 +55,119 @@ cdef extern from "<stdio.h>" nogil:
     #define MEMLOG(...)
 #endif
     """
-    void MEMLOG(const char* fmt, ...)
\ No newline at end of file
+    void MEMLOG(const char* fmt, ...)
+
+cdef extern from * nogil:
+    """
+#include <errno.h>
+#ifdef _WIN32
+#include <io.h>
+typedef struct {
+    void *iov_base;
+    size_t iov_len;
+} bz3_iovec;
+#else
+#include <sys/uio.h>
+typedef struct iovec bz3_iovec;
+#endif
+
+/* write every buffer of iov to fd, retrying short writes, returns -1 and sets errno on error */
+static int bz3_writev_all(int fd, bz3_iovec *iov, int n)
+{
+    while (n > 0)
+    {
+#ifdef _WIN32
+        Py_ssize_t ret = _write(fd, iov->iov_base, (unsigned int)iov->iov_len);
+#else
+        Py_ssize_t ret = writev(fd, iov, n > 512 ? 512 : n);
+#endif
+        if (ret < 0)
+        {
+            if (errno == EINTR)
+                continue;
+            return -1;
+        }
+        while (n > 0 && (size_t)ret >= iov->iov_len)
+        {
+            ret -= (Py_ssize_t)iov->iov_len;
+            iov++;
+            n--;
+        }
+        if (n > 0)
+        {
+            iov->iov_base = (char *)iov->iov_base + ret;
+            iov->iov_len -= (size_t)ret;
+        }
+    }
+    return 0;
+}
+    """
+    ctypedef struct bz3_iovec:
+        void * iov_base
+        size_t iov_len
+    int bz3_writev_all(int fd, bz3_iovec * iov, int n)
+
+cdef extern from "filters.h" nogil:
+    int BZ3_FILTER_NONE
+    int BZ3_FILTER_SHUFFLE
+    int BZ3_FILTER_BITSHUFFLE
+    int BZ3_FILTER_DELTA
+    int BZ3_FILTER_HEADER_SIZE
+    int BZ3_STREAM_STORED
+
+    int bz3_filter_check(int filter, int typesize)
+    void bz3_filter(uint8_t * dst, const uint8_t * src, size_t size, int filter, int typesize)
+    void bz3_unfilter(uint8_t * dst, const uint8_t * src, size_t size, int filter, int typesize)
+
+cdef extern from "probe.h" nogil:
+    int bz3_probe(const uint8_t * buf, int32_t size, double threshold)
+    int bz3_is_stored(const uint8_t * buffer, int32_t size)
+    int32_t bz3_encode_block_probed(bz3_state * state, uint8_t * buffer, int32_t size, double probe)
+    int32_t bz3_decode_block_stored(bz3_state * state, uint8_t * buffer, size_t buffer_size, int32_t data_size, int32_t orig_size)
+
+cdef extern from "trace.h" nogil:
+    int BZ3_TRACE_STAGE
+    int BZ3_TRACE_ENCODE
+    int BZ3_TRACE_DECODE
+    int BZ3_TRACE_ASSEMBLE
+    int BZ3_TRACE_WAVE
+    int BZ3_TRACE_WRITE
+
+    ctypedef struct bz3_trace_event:
+        uint64_t seq
+        uint64_t start_ns
+        uint64_t end_ns
+        uint64_t tid
+        int32_t kind
+        int32_t arg
+
+    uint64_t bz3_trace_now()
+    uint64_t bz3_trace_begin()
+    void bz3_trace_end(int kind, int32_t arg, uint64_t t0)
+    int bz3_trace_enable(uint64_t capacity)
+    void bz3_trace_disable()
+    void bz3_trace_clear()
+    uint64_t bz3_trace_capacity()
+    uint64_t bz3_trace_read(bz3_trace_event * out, uint64_t size)
+
+cdef extern from "cdc.h" nogil:
+    size_t BZ3_CDC_MIN(size_t block_size)
+    size_t bz3_cdc_cut(const uint8_t * buf, size_t size, size_t block_size)
+
+cdef extern from "alloc.h" nogil:
+    ctypedef struct bz3_alloc_stats:
+        uint64_t allocs
+        uint64_t cache_hits
+        uint64_t huge_allocs
+        uint64_t mapped_bytes
+        uint64_t cached_bytes
+        uint64_t cached
+
+    bz3_state * bz3_state_acquire(int32_t block_size)
+    void bz3_state_release(bz3_state * state, int32_t block_size)
+    void * bz3_buffer_alloc(size_t size)
+    void bz3_buffer_free(void * ptr)
+    void bz3_alloc_trim()
+    void bz3_alloc_configure(int huge_pages, int64_t cache_limit, int64_t mmap_threshold)
+    void bz3_alloc_get_config(int * huge_pages, uint64_t * cache_limit, uint64_t * mmap_threshold)
+    void bz3_alloc_get_stats(bz3_alloc_stats * out)
@@ -0,0 +1,169 @@
+/*
+ * Byte-shuffle, bit-shuffle and delta pre-filters, shared by the cython and cffi backends.
+ * Filters work per block: every call transforms size bytes from src to dst, the trailing
+ * bytes that don't make up a whole element (or, for bit-shuffle, a group of 8 elements)
+ * are copied unchanged, so any block size round-trips.
+ */
+#ifndef BZ3_FILTERS_H
+#define BZ3_FILTERS_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include <string.h>
+
+#include "trace.h"
+
+#ifdef _MSC_VER
+#define BZ3_RESTRICT __restrict
+#else
+#define BZ3_RESTRICT restrict
+#endif
+
+#define BZ3_FILTER_NONE 0
+#define BZ3_FILTER_SHUFFLE 1
+#define BZ3_FILTER_BITSHUFFLE 2
+#define BZ3_FILTER_DELTA 3
+
+/* filtered streams, and streams with stored blocks, start with "BZ3F", filter, typesize,
+ * flags and a reserved byte, then "BZ3v1" */
+#define BZ3_FILTER_HEADER_SIZE 8
+/* flag: blocks over 64 bytes may be stored as is, see probe.h */
+#define BZ3_STREAM_STORED 1
+
+static inline int bz3_filter_check(int filter, int typesize)
+{
+    if (filter < BZ3_FILTER_NONE || filter > BZ3_FILTER_DELTA)
+        return -1;
+    if (typesize < 1 || typesize > 255)
+        return -1;
+    return 0;
+}
+
+/* the constant typesize cases let the compiler vectorize the loops */
+#define BZ3_SHUFFLE_LOOP(ts)                       \
+    for (size_t j = 0; j < (ts); j++)              \
+        for (size_t i = 0; i < n; i++)             \
+            dst[j * n + i] = src[i * (ts) + j];
+
+#define BZ3_UNSHUFFLE_LOOP(ts)                     \
+    for (size_t i = 0; i < n; i++)                 \
+        for (size_t j = 0; j < (ts); j++)          \
+            dst[i * (ts) + j] = src[j * n + i];
+
+static inline void bz3_shuffle(uint8_t *BZ3_RESTRICT dst, const uint8_t *BZ3_RESTRICT src, size_t size, size_t typesize)
+{
+    size_t n = size / typesize;
+    switch (typesize)
+    {
+    case 2: BZ3_SHUFFLE_LOOP(2) break;
+    case 4: BZ3_SHUFFLE_LOOP(4) break;
+    case 8: BZ3_SHUFFLE_LOOP(8) break;
+    default: BZ3_SHUFFLE_LOOP(typesize) break;
+    }
+    memcpy(dst + n * typesize, src + n * typesize, size - n * typesize);
+}
+
+static inline void bz3_unshuffle(uint8_t *BZ3_RESTRICT dst, const uint8_t *BZ3_RESTRICT src, size_t size, size_t typesize)
+{
+    size_t n = size / typesize;
+    switch (typesize)
+    {
+    case 2: BZ3_UNSHUFFLE_LOOP(2) break;
+    case 4: BZ3_UNSHUFFLE_LOOP(4) break;
+    case 8: BZ3_UNSHUFFLE_LOOP(8) break;
+    default: BZ3_UNSHUFFLE_LOOP(typesize) break;
+    }
+    memcpy(dst + n * typesize, src + n * typesize, size - n * typesize);
+}
+
+/* transpose an 8x8 bit matrix, byte m holds row m; the transpose is its own inverse */
+static inline uint64_t bz3_transpose8(uint64_t x)
+{
+    uint64_t t;
+    t = (x ^ (x >> 7)) & 0x00AA00AA00AA00AAULL;
+    x = x ^ t ^ (t << 7);
+    t = (x ^ (x >> 14)) & 0x0000CCCC0000CCCCULL;
+    x = x ^ t ^ (t << 14);
+    t = (x ^ (x >> 28)) & 0x00000000F0F0F0F0ULL;
+    x = x ^ t ^ (t << 28);
+    return x;
+}
+
+/* bit-plane b of byte j of every element is stored contiguously, 8 elements per byte */
+static inline void bz3_bitshuffle(uint8_t *BZ3_RESTRICT dst, const uint8_t *BZ3_RESTRICT src, size_t size, size_t typesize)
+{
+    size_t groups = size / typesize / 8;
+    for (size_t j = 0; j < typesize; j++)
+        for (size_t k = 0; k < groups; k++)
+        {
+            uint64_t x = 0;
+            for (size_t m = 0; m < 8; m++)
+                x |= (uint64_t)src[(k * 8 + m) * typesize + j] << (8 * m);
+            x = bz3_transpose8(x);
+            for (size_t b = 0; b < 8; b++)
+                dst[(j * 8 + b) * groups + k] = (uint8_t)(x >> (8 * b));
+        }
+    memcpy(dst + groups * 8 * typesize, src + groups * 8 * typesize, size - groups * 8 * typesize);
+}
+
+static inline void bz3_unbitshuffle(uint8_t *BZ3_RESTRICT dst, const uint8_t *BZ3_RESTRICT src, size_t size, size_t typesize)
+{
+    size_t groups = size / typesize / 8;
+    for (size_t j = 0; j < typesize; j++)
+        for (size_t k = 0; k < groups; k++)
+        {
+            uint64_t x = 0;
+            for (size_t b = 0; b < 8; b++)
+                x |= (uint64_t)src[(j * 8 + b) * groups + k] << (8 * b);
+            x = bz3_transpose8(x);
+            for (size_t m = 0; m < 8; m++)
+                dst[(k * 8 + m) * typesize + j] = (uint8_t)(x >> (8 * m));
+        }
+    memcpy(dst + groups * 8 * typesize, src + groups * 8 * typesize, size - groups * 8 * typesize);
+}
+
+/* byte-wise delta with a distance of typesize */
+static inline void bz3_delta(uint8_t *BZ3_RESTRICT dst, const uint8_t *BZ3_RESTRICT src, size_t size, size_t typesize)
+{
+    size_t head = size < typesize ? size : typesize;
+    memcpy(dst, src, head);
+    for (size_t i = head; i < size; i++)
+        dst[i] = (uint8_t)(src[i] - src[i - typesize]);
+}
+
+static inline void bz3_undelta(uint8_t *BZ3_RESTRICT dst, const uint8_t *BZ3_RESTRICT src, size_t size, size_t typesize)
+{
+    size_t head = size < typesize ? size : typesize;
+    memcpy(dst, src, head);
+    for (size_t i = head; i < size; i++)
+        dst[i] = (uint8_t)(src[i] + dst[i - typesize]);
+}
+
+/* dst and src must not overlap, BZ3_FILTER_NONE is a plain copy */
+static inline void bz3_filter(uint8_t *dst, const uint8_t *src, size_t size, int filter, int typesize)
+{
+    uint64_t t0 = bz3_trace_begin();
+    switch (filter)
+    {
+    case BZ3_FILTER_SHUFFLE: bz3_shuffle(dst, src, size, (size_t)typesize); break;
+    case BZ3_FILTER_BITSHUFFLE: bz3_bitshuffle(dst, src, size, (size_t)typesize); break;
+    case BZ3_FILTER_DELTA: bz3_delta(dst, src, size, (size_t)typesize); break;
+    default: memcpy(dst, src, size); break;
+    }
+    bz3_trace_end(BZ3_TRACE_STAGE, (int32_t)size, t0);
+}
+
+static inline void bz3_unfilter(uint8_t *dst, const uint8_t *src, size_t size, int filter, int typesize)
+{
+    uint64_t t0 = bz3_trace_begin();
+    switch (filter)
+    {
+    case BZ3_FILTER_SHUFFLE: bz3_unshuffle(dst, src, size, (size_t)typesize); break;
+    case BZ3_FILTER_BITSHUFFLE: bz3_unbitshuffle(dst, src, size, (size_t)typesize); break;
+    case BZ3_FILTER_DELTA: bz3_undelta(dst, src, size, (size_t)typesize); break;
+    default: memcpy(dst, src, size); break;
+    }
+    bz3_trace_end(BZ3_TRACE_ASSEMBLE, (int32_t)size, t0);
+}
+
+#endif
@@ -0,0 +1,184 @@
+/*
+ * Opt-in per-block tracing, shared by the cython and cffi backends.
+ * Events go to a ring buffer, the newest capacity events are kept. While tracing is
+ * off bz3_trace_begin() is one load of a global and recording costs nothing else.
+ * While it is on an event costs two clock reads and an atomic increment.
+ */
+#ifndef BZ3_TRACE_H
+#define BZ3_TRACE_H
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <pthread.h>
+#include <time.h>
+#ifdef __linux__
+#include <sys/syscall.h>
+#include <unistd.h>
+#endif
+#endif
+
+#define BZ3_TRACE_STAGE 0    /* input copied (and filtered) into a block buffer */
+#define BZ3_TRACE_ENCODE 1   /* one block encoded */
+#define BZ3_TRACE_DECODE 2   /* one block decoded */
+#define BZ3_TRACE_ASSEMBLE 3 /* decoded block copied (and unfiltered) to the output */
+#define BZ3_TRACE_WAVE 4     /* one parallel wave of blocks, barrier included */
+#define BZ3_TRACE_WRITE 5    /* encoded blocks written to a file */
+
+typedef struct
+{
+    uint64_t seq; /* index + 1 once the event is complete, to skip slots being written */
+    uint64_t start_ns;
+    uint64_t end_ns;
+    uint64_t tid;
+    int32_t kind;
+    int32_t arg; /* block size, or the number of blocks of a wave */
+} bz3_trace_event;
+
+typedef struct
+{
+    uint64_t capacity;
+    bz3_trace_event events[1];
+} bz3_trace_ring;
+
+static volatile int bz3_trace_on = 0;
+static bz3_trace_ring *volatile bz3_trace_buffer = NULL;
+static volatile uint64_t bz3_trace_head = 0; /* events ever recorded */
+static uint64_t bz3_trace_base = 0;           /* head at the last clear */
+
+#ifdef _MSC_VER
+#define BZ3_TRACE_TLS __declspec(thread)
+#define bz3_trace_fetch_add(p) ((uint64_t)InterlockedIncrement64((volatile LONG64 *)(p)) - 1)
+#define bz3_trace_publish(p, v) (MemoryBarrier(), *(p) = (v))
+#define bz3_trace_load(p) (*(volatile uint64_t *)(p))
+#else
+#define BZ3_TRACE_TLS __thread
+#define bz3_trace_fetch_add(p) __atomic_fetch_add((p), 1, __ATOMIC_RELAXED)
+#define bz3_trace_publish(p, v) __atomic_store_n((p), (v), __ATOMIC_RELEASE)
+#define bz3_trace_load(p) __atomic_load_n((p), __ATOMIC_ACQUIRE)
+#endif
+
+static inline uint64_t bz3_trace_now(void)
+{
+#ifdef _WIN32
+    static LARGE_INTEGER freq;
+    LARGE_INTEGER now;
+    if (!freq.QuadPart)
+        QueryPerformanceFrequency(&freq);
+    QueryPerformanceCounter(&now);
+    return (uint64_t)((double)now.QuadPart * 1e9 / (double)freq.QuadPart);
+#else
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec * 1000000000u + (uint64_t)ts.tv_nsec;
+#endif
+}
+
+static inline uint64_t bz3_trace_tid(void)
+{
+    static BZ3_TRACE_TLS uint64_t tid = 0;
+    if (!tid)
+    {
+#if defined(_WIN32)
+        tid = (uint64_t)GetCurrentThreadId();
+#elif defined(__linux__)
+        tid = (uint64_t)syscall(SYS_gettid);
+#elif defined(__APPLE__)
+        pthread_threadid_np(NULL, &tid);
+#else
+        tid = (uint64_t)(uintptr_t)pthread_self();
+#endif
+    }
+    return tid;
+}
+
+/* the start of an event, 0 while tracing is off */
+static inline uint64_t bz3_trace_begin(void)
+{
+    return bz3_trace_on ? bz3_trace_now() : 0;
+}
+
+/* record an event that started at t0, a t0 of 0 records nothing */
+static inline void bz3_trace_end(int kind, int32_t arg, uint64_t t0)
+{
+    bz3_trace_ring *ring;
+    bz3_trace_event *event;
+    uint64_t index;
+    if (!t0 || (ring = bz3_trace_buffer) == NULL)
+        return;
+    index = bz3_trace_fetch_add(&bz3_trace_head);
+    event = &ring->events[index % ring->capacity];
+    event->seq = 0;
+    event->start_ns = t0;
+    event->end_ns = bz3_trace_now();
+    event->tid = bz3_trace_tid();
+    event->kind = kind;
+    event->arg = arg;
+    bz3_trace_publish(&event->seq, index + 1);
+}
+
+/* start tracing into a ring of capacity events, returns -1 when out of memory.
+ * A ring replaced by one of another capacity is never freed, a thread that
+ * began an event before may still write to it */
+static int bz3_trace_enable(uint64_t capacity)
+{
+    bz3_trace_ring *ring = bz3_trace_buffer;
+    if (capacity < 1)
+        capacity = 1;
+    if (ring == NULL || ring->capacity != capacity)
+    {
+        ring = (bz3_trace_ring *)calloc(1, sizeof(bz3_trace_ring) + (capacity - 1) * sizeof(bz3_trace_event));
+        if (ring == NULL)
+            return -1;
+        ring->capacity = capacity;
+        bz3_trace_base = bz3_trace_head;
+        bz3_trace_buffer = ring;
+    }
+    bz3_trace_on = 1;
+    return 0;
+}
+
+static void bz3_trace_disable(void)
+{
+    bz3_trace_on = 0;
+}
+
+/* forget the events recorded so far */
+static void bz3_trace_clear(void)
+{
+    bz3_trace_base = bz3_trace_load(&bz3_trace_head);
+}
+
+/* the number of events the ring keeps, 0 before tracing was first enabled */
+static uint64_t bz3_trace_capacity(void)
+{
+    bz3_trace_ring *ring = bz3_trace_buffer;
+    return ring == NULL ? 0 : ring->capacity;
+}
+
+/* copy up to size of the events kept to out, oldest first, returns how many were copied */
+static uint64_t bz3_trace_read(bz3_trace_event *out, uint64_t size)
+{
+    bz3_trace_ring *ring = bz3_trace_buffer;
+    uint64_t head = bz3_trace_load(&bz3_trace_head), first = bz3_trace_base, n = 0;
+    if (ring == NULL)
+        return 0;
+    if (head - first > ring->capacity)
+        first = head - ring->capacity;
+    for (uint64_t i = first; i < head && n < size; i++)
+    {
+        bz3_trace_event *event = &ring->events[i % ring->capacity];
+        if (bz3_trace_load(&event->seq) != i + 1)
+            continue; /* still being written, or already overwritten */
+        out[n] = *event;
+        if (bz3_trace_load(&event->seq) == i + 1)
+            n++;
+    }
+    return n;
+}
+
+#endif
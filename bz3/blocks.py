@@ -0,0 +1,194 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import io
+import os
+import struct
+from builtins import open as _builtin_open
+from typing import IO, Iterator, NamedTuple, Optional, Union
+
+from bz3.backends import FILTER_DELTA, FILTER_NONE, STREAM_STORED, bound
+
+_FRAME = struct.Struct("<ii")  # new_size, old_size of every block
+HEADER_SIZE = 9  # "BZ3v1" + block size
+FILTER_HEADER_SIZE = 8  # "BZ3F", filter, typesize, flags, a reserved byte
+MAX_HEADER_SIZE = FILTER_HEADER_SIZE + HEADER_SIZE
+FRAME_HEADER_SIZE = _FRAME.size
+
+
+class StreamHeader(NamedTuple):
+    """The stream header of a bzip3 stream."""
+
+    size: int  # 9 bytes, 17 with the "BZ3F" prefix
+    block_size: int
+    filter: int  # FILTER_NONE, or the filter to reverse on every decoded block
+    typesize: int
+    flags: int  # STREAM_STORED if blocks may be stored as is
+
+
+class BlockInfo(NamedTuple):
+    """Location of a single block inside a bzip3 stream."""
+
+    index: int
+    offset: int  # offset of the 8-byte block header in the compressed stream
+    compressed_size: int  # size of the payload, without the block header
+    original_size: int
+    uncompressed_offset: int
+    data: Optional[memoryview]  # zero-copy payload, only for buffer input
+
+
+def make_stream_header(
+    block_size: int, filter: int = FILTER_NONE, typesize: int = 1, flags: int = 0
+) -> bytes:
+    """The stream header. Filtered streams, and streams with stored blocks, are
+    prefixed with "BZ3F", the filter, the typesize, the flags and a reserved byte."""
+    header = b"BZ3v1" + block_size.to_bytes(4, "little", signed=True)
+    if filter != FILTER_NONE or flags:
+        header = b"BZ3F" + bytes((filter, typesize, flags, 0)) + header
+    return header
+
+
+def parse_stream_header(data) -> Optional[StreamHeader]:
+    """Validate the stream header at the start of data, None if data doesn't
+    hold all of it yet, see make_stream_header()."""
+    data = bytes(data[:MAX_HEADER_SIZE])
+    pos = 0
+    filter = FILTER_NONE
+    typesize = 1
+    flags = 0
+    if len(data) < HEADER_SIZE:
+        return None
+    if data[:4] == b"BZ3F":
+        if len(data) < MAX_HEADER_SIZE:
+            return None
+        filter, typesize, flags = data[4], data[5], data[6]
+        if not FILTER_NONE <= filter <= FILTER_DELTA or typesize < 1:
+            raise ValueError(
+                "The input file is corrupted. Reason: Invalid filter in the header"
+            )
+        # a prefix that neither filters nor flags anything isn't written either
+        if flags & ~STREAM_STORED or data[7] or (filter == FILTER_NONE and not flags):
+            raise ValueError(
+                "The input file is corrupted. Reason: Invalid flags in the header"
+            )
+        pos = FILTER_HEADER_SIZE
+    if data[pos : pos + 5] != b"BZ3v1":
+        raise ValueError("Invalid signature")
+    block_size = int.from_bytes(
+        data[pos + 5 : pos + HEADER_SIZE], "little", signed=True
+    )
+    if block_size < 65 * 1024 or block_size > 511 * 1024 * 1024:
+        raise ValueError(
+            "The input file is corrupted. Reason: Invalid block size in the header"
+        )
+    return StreamHeader(pos + HEADER_SIZE, block_size, filter, typesize, flags)
+
+
+def read_stream_header(fp: IO) -> StreamHeader:
+    """Read and validate the stream header at the position of the binary file fp."""
+    data = fp.read(HEADER_SIZE)
+    if data[:4] == b"BZ3F":
+        data += fp.read(FILTER_HEADER_SIZE)
+    header = parse_stream_header(data)
+    if header is None:
+        raise ValueError("Invalid file. Reason: Smaller than magic header")
+    return header
+
+
+def parse_header(header: bytes) -> int:
+    """Validate the stream header at the start of header, returns the block size."""
+    stream_header = parse_stream_header(header)
+    if stream_header is None:
+        raise ValueError("Invalid file. Reason: Smaller than magic header")
+    return stream_header.block_size
+
+
+def _iter_buffer_blocks(view: memoryview) -> Iterator[BlockInfo]:
+    header = parse_stream_header(view)
+    if header is None:
+        raise ValueError("Invalid file. Reason: Smaller than magic header")
+    limit = bound(header.block_size)
+    total = len(view)
+    offset = header.size
+    start = 0
+    index = 0
+    unpack_from = _FRAME.unpack_from
+    while offset + FRAME_HEADER_SIZE <= total:
+        new_size, old_size = unpack_from(view, offset)
+        if not 0 <= new_size <= limit or not 0 <= old_size <= limit:
+            raise ValueError("Failed to decode a block: Inconsistent headers.")
+        end = offset + FRAME_HEADER_SIZE + new_size
+        if end > total:  # truncated block
+            break
+        yield BlockInfo(
+            index,
+            offset,
+            new_size,
+            old_size,
+            start,
+            view[offset + FRAME_HEADER_SIZE : end],
+        )
+        offset = end
+        start += old_size
+        index += 1
+
+
+def _iter_file_blocks(fp: IO) -> Iterator[BlockInfo]:
+    seekable = fp.seekable() if hasattr(fp, "seekable") else False
+    if seekable:
+        offset = fp.tell()
+        total = fp.seek(0, io.SEEK_END)
+        fp.seek(offset)
+    else:
+        offset = 0
+    header = read_stream_header(fp)
+    limit = bound(header.block_size)
+    offset += header.size
+    start = 0
+    index = 0
+    unpack = _FRAME.unpack
+    while True:
+        data = fp.read(FRAME_HEADER_SIZE)
+        if len(data) < FRAME_HEADER_SIZE:
+            break
+        new_size, old_size = unpack(data)
+        if not 0 <= new_size <= limit or not 0 <= old_size <= limit:
+            raise ValueError("Failed to decode a block: Inconsistent headers.")
+        end = offset + FRAME_HEADER_SIZE + new_size
+        if seekable:
+            if end > total:  # truncated block
+                break
+            fp.seek(new_size, io.SEEK_CUR)  # skip the payload without reading it
+        elif len(fp.read(new_size)) < new_size:
+            break
+        yield BlockInfo(index, offset, new_size, old_size, start, None)
+        offset = end
+        start += old_size
+        index += 1
+
+
+def iter_blocks(
+    source: Union[bytes, bytearray, memoryview, IO, str, os.PathLike],
+) -> Iterator[BlockInfo]:
+    """Walk the blocks of a bzip3 stream without decoding them.
+
+    source can be an object supporting the buffer protocol, a binary file
+    object positioned at the start of the stream, or a path. For buffers,
+    BlockInfo.data is a memoryview of the compressed payload, for files
+    the payloads are skipped with seek() when possible and data is None.
+    Payloads of filtered streams decode to filtered data, see
+    parse_stream_header() and unfilter_into().
+
+    A truncated trailing block is not reported.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with _builtin_open(source, "rb") as fp:
+            yield from _iter_file_blocks(fp)
+        return
+    try:
+        view = memoryview(source)
+    except TypeError:
+        yield from _iter_file_blocks(source)
+    else:
+        yield from _iter_buffer_blocks(view.cast("B"))
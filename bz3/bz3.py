@@ -4,17 +4,52 @@ Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
 
 import io
 import os
+import sys
+from bisect import bisect_right
 from builtins import open as _builtin_open
-from threading import RLock
-from typing import IO
-
-from bz3.backends import BZ3Compressor, BZ3Decompressor
-from bz3.compression import BaseStream, DecompressReader
+from threading import RLock, Timer, local
+from time import monotonic
+from typing import IO, List, Optional, Union
+
+from bz3.backends import (
+    FILTER_NONE,
+    BZ3Compressor,
+    BZ3Decompressor,
+    BZ3State,
+    bound,
+)
+from bz3.backends import decompress_file as _decompress_file
+from bz3.backends import resume_output, unfilter_into
+from bz3.blocks import (
+    FRAME_HEADER_SIZE,
+    MAX_HEADER_SIZE,
+    iter_blocks,
+    parse_stream_header,
+    read_stream_header,
+)
+from bz3.cache import BlockCache, file_key
+from bz3.compression import BaseStream, BlockReader, DecompressReader
+from bz3.executor import (
+    Executor,
+    ExecutorCompressor,
+    ExecutorDecompressor,
+    decode_block,
+    get_buffer,
+    get_unfilter_buffer,
+    imap,
+    pick_executor,
+)
+from bz3.threads import resolve_threads
 
 try:
     from bz3.backends import BZ3OmpCompressor, BZ3OmpDecompressor
 except ImportError:
-    pass
+    BZ3OmpCompressor = BZ3OmpDecompressor = None
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
 
 _MODE_CLOSED = 0
 _MODE_READ = 1
@@ -22,6 +57,72 @@ _MODE_READ = 1
 _MODE_WRITE = 3
 
 
+def _preadinto(fp: IO, view: memoryview, offset: int, lock: RLock) -> int:
+    """Read into view at offset without moving the shared file position."""
+    try:
+        fd = fp.fileno()
+    except (AttributeError, OSError):
+        fd = None
+    size = len(view)
+    done = 0
+    if fd is not None and hasattr(os, "preadv"):
+        while done < size:
+            n = os.preadv(fd, [view[done:]], offset + done)
+            if not n:
+                break
+            done += n
+        return done
+    if fd is not None and hasattr(os, "pread"):
+        while done < size:
+            chunk = os.pread(fd, size - done, offset + done)
+            if not chunk:
+                break
+            view[done : done + len(chunk)] = chunk
+            done += len(chunk)
+        return done
+    with lock:  # fall back to seek + read, and restore the position for read()
+        pos = fp.tell()
+        try:
+            fp.seek(offset)
+            while done < size:
+                n = fp.readinto(view[done:])
+                if not n:
+                    break
+                done += n
+            return done
+        finally:
+            fp.seek(pos)
+
+
+class _BlockIndex:
+    """Location of every block of a bzip3 stream, built by walking the headers."""
+
+    def __init__(self, fp: IO, lock: RLock):
+        header = bytearray(MAX_HEADER_SIZE)
+        del header[_preadinto(fp, memoryview(header), 0, lock) :]
+        self.header = parse_stream_header(header)
+        if self.header is None:
+            raise ValueError("Invalid file. Reason: Smaller than magic header")
+        self.block_size = self.header.block_size  # type: int
+        self.offsets = []  # type: List[int]  # offset of each block header
+        self.sizes = []  # type: List[int]  # compressed size, without the header
+        self.starts = []  # type: List[int]  # offset in the decompressed stream
+        self.orig_sizes = []  # type: List[int]
+        self.size = 0  # type: int
+        with lock:  # the reader keeps using fp, so give back its position
+            pos = fp.tell()
+            try:
+                fp.seek(0)
+                for block in iter_blocks(fp):
+                    self.offsets.append(block.offset)
+                    self.sizes.append(block.compressed_size)
+                    self.starts.append(block.uncompressed_offset)
+                    self.orig_sizes.append(block.original_size)
+                    self.size += block.original_size
+            finally:
+                fp.seek(pos)
+
+
 class BZ3File(BaseStream):
     """A file object providing transparent bzip3 (de)compression.
 
@@ -30,6 +131,24 @@ class BZ3File(BaseStream):
 
     Note that BZ3File provides a *binary* file interface - data read is
     returned as bytes, and data to be written should be given as bytes.
+
+    In write mode, max_latency bounds the time in seconds written data may
+    wait in a partial block, after that it is written as a short block.
+    probe, with allow_stored, stores blocks with an entropy of at least
+    probe bits per byte uncompressed, see BZ3Compressor. num_threads 0 or "auto" uses
+    as many threads as there are CPUs available to the process, see
+    bz3.available_cpus(), the count in use is num_threads. Blocks are
+    (de)compressed by executor instead of OpenMP if given, or by the default
+    executor (see bz3.set_default_executor()) if num_threads is not 1.
+
+    With resume, mode "a" picks up a stream a crashed writer left behind:
+    the blocks that made it out intact are kept, a torn last block is cut
+    off and tell() starts at the amount of data the kept blocks hold, which
+    is where the caller has to continue writing from.
+
+    With cdc, block boundaries are picked from the content instead of every
+    block_size bytes, see BZ3Compressor. Such blocks are encoded by an
+    executor or a single thread, OpenMP only cuts fixed blocks.
     """
 
     def __init__(
@@ -37,10 +156,33 @@ class BZ3File(BaseStream):
         filename,
         mode: str = "r",
         block_size: int = 1024 * 1024,
-        num_threads: int = 1,
+        num_threads: Union[int, str] = 1,
         ignore_error: bool = False,
+        block_cache: Optional[BlockCache] = None,
+        max_latency: Optional[float] = None,
+        probe: float = 0.0,
+        resume: bool = False,
+        executor: Optional[Executor] = None,
+        cdc: bool = False,
+        allow_stored: bool = False,
     ):
+        if max_latency is not None and max_latency <= 0:
+            raise ValueError("max_latency must be positive")
+        num_threads = resolve_threads(num_threads)
+        executor = pick_executor(num_threads, executor)
+        if executor is not None:
+            num_threads = executor.max_workers
+        elif BZ3OmpCompressor is None:  # no OpenMP, "auto" comes down to 1
+            num_threads = 1
+        self._num_threads = num_threads
         self._lock = RLock()
+        self._max_latency = max_latency
+        self._timer = None  # type: Optional[Timer]
+        self._buffered_since = 0.0  # when the oldest byte held back was written
+        self._index = None  # type: _BlockIndex
+        self._local = local()  # per-thread decoder state for pread()
+        self._ignore_error = ignore_error
+        self._cache = None  # type: Optional[BlockCache]
         self._fp = None  # type: IO
         self._closefp = False
         self._mode = _MODE_CLOSED
@@ -50,32 +192,33 @@ class BZ3File(BaseStream):
         elif mode in ("w", "wb"):
             mode = "wb"
             mode_code = _MODE_WRITE
-            self._compressor = (
-                BZ3Compressor(block_size)
-                if num_threads == 1
-                else BZ3OmpCompressor(block_size, num_threads)
-            )
         elif mode in ("x", "xb"):
             mode = "xb"
             mode_code = _MODE_WRITE
-            self._compressor = (
-                BZ3Compressor(block_size)
-                if num_threads == 1
-                else BZ3OmpCompressor(block_size, num_threads)
-            )
         elif mode in ("a", "ab"):
             mode = "ab"
             mode_code = _MODE_WRITE
-            self._compressor = (
-                BZ3Compressor(block_size)
-                if num_threads == 1
-                else BZ3OmpCompressor(block_size, num_threads)
-            )
         else:
             raise ValueError("Invalid mode: %r" % (mode,))
+        if resume and mode != "ab":
+            raise ValueError("resume is only supported in append mode")
+        if mode_code == _MODE_WRITE:
+            if executor is not None:
+                self._compressor = ExecutorCompressor(
+                    block_size, executor, probe, cdc, allow_stored
+                )
+            elif num_threads == 1 or cdc:
+                self._compressor = BZ3Compressor(
+                    block_size, probe=probe, cdc=cdc, allow_stored=allow_stored
+                )
+            else:
+                self._compressor = BZ3OmpCompressor(
+                    block_size, num_threads, probe=probe, allow_stored=allow_stored
+                )
 
         if isinstance(filename, (str, bytes, os.PathLike)):
-            self._fp = _builtin_open(filename, mode)
+            # resuming reads back what is already there
+            self._fp = _builtin_open(filename, "a+b" if resume else mode)
             self._closefp = True
             self._mode = mode_code
         elif hasattr(filename, "read") or hasattr(filename, "write"):
@@ -85,19 +228,38 @@ class BZ3File(BaseStream):
             raise TypeError("filename must be a str, bytes, file or PathLike object")
 
         if self._mode == _MODE_READ:
-            raw = (
-                DecompressReader(self._fp, BZ3Decompressor, ignore_error=ignore_error)
-                if num_threads == 1
-                else DecompressReader(
+            if block_cache is not None and self._fp.seekable():
+                # random access through the block index, decoded blocks are
+                # shared with every other file using the same cache
+                self._cache = block_cache
+                self._cache_key = file_key(self._fp)
+                raw = BlockReader(self.preadinto, lambda: self._block_index().size)
+            elif executor is not None:
+                raw = DecompressReader(
+                    self._fp,
+                    ExecutorDecompressor,
+                    executor=executor,
+                    ignore_error=ignore_error,
+                )
+            elif num_threads == 1:
+                raw = DecompressReader(
+                    self._fp, BZ3Decompressor, ignore_error=ignore_error
+                )
+            else:
+                raw = DecompressReader(
                     self._fp,
                     BZ3OmpDecompressor,
                     numthreads=num_threads,
                     ignore_error=ignore_error,
                 )
-            )
             self._buffer = io.BufferedReader(raw)
         else:
             self._pos = 0
+            if resume:
+                offset = resume_output(self._fp, block_size, probe, allow_stored)
+                if offset != -1:
+                    self._compressor.compress(b"")  # the stream header is already there
+                    self._pos = offset
 
     def close(self):
         """Flush and close the file.
@@ -112,7 +274,10 @@ class BZ3File(BaseStream):
                 if self._mode == _MODE_READ:
                     self._buffer.close()
                 elif self._mode == _MODE_WRITE:
-                    self._fp.write(self._compressor.flush())
+                    if self._timer is not None:
+                        self._timer.cancel()
+                        self._timer = None
+                    self._compressor.flush_to(self._fp)
                     self._compressor = None
             finally:
                 try:
@@ -124,6 +289,11 @@ class BZ3File(BaseStream):
                     self._mode = _MODE_CLOSED
                     self._buffer = None
 
+    @property
+    def num_threads(self) -> int:
+        """The number of threads (de)compressing, "auto" resolved."""
+        return self._num_threads
+
     @property
     def closed(self):
         """True if this file is closed."""
@@ -193,6 +363,92 @@ class BZ3File(BaseStream):
             self._check_can_read()
             return self._buffer.readinto(b)
 
+    def _block_index(self) -> _BlockIndex:
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = _BlockIndex(self._fp, self._lock)
+        return self._index
+
+    def _decode_block(self, index: _BlockIndex, i: int) -> memoryview:
+        state = getattr(self._local, "state", None)
+        if state is None:
+            state = self._local.state = BZ3State(index.block_size)
+            self._local.buffer = bytearray(bound(index.block_size))
+            if index.header.filter != FILTER_NONE:
+                self._local.unfiltered = bytearray(index.block_size)
+        buffer = self._local.buffer
+        size = index.sizes[i]
+        if (
+            _preadinto(
+                self._fp, memoryview(buffer)[:size], index.offsets[i] + 8, self._lock
+            )
+            < size
+        ):
+            raise ValueError("Failed to decode a block: Truncated data.")
+        try:
+            state.decode_block(buffer, size, index.orig_sizes[i])
+        except ValueError:
+            if not self._ignore_error:
+                raise
+            print("Writing invalid block: %s" % state.error(), file=sys.stderr)
+        view = memoryview(buffer)[: index.orig_sizes[i]]
+        if index.header.filter == FILTER_NONE:
+            return view
+        unfilter_into(
+            view, self._local.unfiltered, index.header.filter, index.header.typesize
+        )
+        return memoryview(self._local.unfiltered)[: len(view)]
+
+    def _get_block(self, index: _BlockIndex, i: int):
+        if self._cache is None:
+            return self._decode_block(index, i)
+        key = (self._cache_key, index.offsets[i])
+        data = self._cache.get(key)
+        if data is None:
+            data = bytes(self._decode_block(index, i))
+            self._cache.put(key, data)
+        return data
+
+    def preadinto(self, offset: int, b) -> int:
+        """Read bytes at the uncompressed offset into b.
+
+        Unlike readinto(), the file position is neither used nor changed,
+        so several threads can call this concurrently on the same file.
+        Returns the number of bytes read (0 for EOF).
+        """
+        self._check_can_read()
+        if offset < 0:
+            raise ValueError("negative offset")
+        index = self._block_index()
+        with memoryview(b) as view, view.cast("B") as byte_view:
+            size = len(byte_view)
+            written = 0
+            i = bisect_right(index.starts, offset) - 1
+            while written < size and 0 <= i < len(index.starts):
+                data = self._get_block(index, i)
+                start = offset + written - index.starts[i]
+                n = min(len(data) - start, size - written)
+                if n <= 0:  # offset is beyond EOF
+                    break
+                byte_view[written : written + n] = data[start : start + n]
+                written += n
+                i += 1
+        return written
+
+    def pread(self, offset: int, size: int) -> bytes:
+        """Read up to size uncompressed bytes at offset.
+
+        The file position is neither used nor changed. Returns b'' if
+        offset is at or beyond EOF.
+        """
+        self._check_can_read()
+        if size < 0:
+            size = max(self._block_index().size - offset, 0)
+        buf = bytearray(size)
+        del buf[self.preadinto(offset, buf) :]
+        return bytes(buf)
+
     def readline(self, size=-1):
         """Read a line of uncompressed bytes from the file.
 
@@ -228,15 +484,59 @@ class BZ3File(BaseStream):
 
         Returns the number of uncompressed bytes written, which is
         always len(data). Note that due to buffering, the file on disk
-        may not reflect the data written until close() is called.
+        may not reflect the data written until flush() or close() is called.
         """
         with self._lock:
             self._check_can_write()
-            compressed = self._compressor.compress(data)
-            self._fp.write(compressed)
+            held = self._compressor.buffered
+            self._compressor.compress_to(data, self._fp)
             self._pos += len(data)
+            if self._max_latency is not None:
+                buffered = self._compressor.buffered
+                if buffered and (not held or buffered <= len(data)):
+                    # the bytes held before were written out, the oldest
+                    # byte still held arrived with this write
+                    self._buffered_since = monotonic()
+                if buffered and self._timer is None:
+                    self._arm_timer(self._max_latency)
             return len(data)
 
+    def flush(self):
+        """Write the buffered data as a short block and flush the file.
+
+        Every block is compressed independently, so flushing often hurts
+        the compression ratio.
+        """
+        with self._lock:
+            self._check_not_closed()
+            if self._mode == _MODE_WRITE:
+                self._flush_block()
+
+    def _flush_block(self):
+        self._compressor.flush_to(self._fp)
+        if hasattr(self._fp, "flush"):
+            self._fp.flush()
+
+    def _arm_timer(self, delay: float):
+        self._timer = Timer(delay, self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            if self._mode != _MODE_WRITE:
+                return
+            self._timer = None
+            if not self._compressor.buffered:
+                return
+            # during bursts full blocks keep resetting the clock, so only a
+            # partial block that has waited max_latency is closed early
+            remaining = self._buffered_since + self._max_latency - monotonic()
+            if remaining > 0:
+                self._arm_timer(remaining)
+            else:
+                self._flush_block()
+
     def writelines(self, seq):
         """Write a sequence of byte strings to the file.
 
@@ -283,8 +583,15 @@ def open(
     encoding: str = None,
     errors: str = None,
     newline: str = None,
-    num_threads: int = 1,
+    num_threads: Union[int, str] = 1,
     ignore_error: bool = False,
+    block_cache: Optional[BlockCache] = None,
+    max_latency: Optional[float] = None,
+    probe: float = 0.0,
+    resume: bool = False,
+    executor: Optional[Executor] = None,
+    cdc: bool = False,
+    allow_stored: bool = False,
 ) -> BZ3File:
     """Open a bzip3-compressed file in binary or text mode.
 
@@ -317,7 +624,20 @@ def open(
             raise ValueError("Argument 'newline' not supported in binary mode")
 
     bz_mode = mode.replace("t", "")
-    binary_file = BZ3File(filename, bz_mode, block_size, num_threads, ignore_error)
+    binary_file = BZ3File(
+        filename,
+        bz_mode,
+        block_size,
+        num_threads,
+        ignore_error,
+        block_cache,
+        max_latency,
+        probe,
+        resume,
+        executor,
+        cdc,
+        allow_stored,
+    )
 
     if "t" in mode:
         return io.TextIOWrapper(binary_file, encoding, errors, newline)
@@ -325,33 +645,176 @@ def open(
         return binary_file
 
 
-def compress(data: bytes, block_size: int = 1024 * 1024, num_threads: int = 1) -> bytes:
+def compress(
+    data: bytes,
+    block_size: int = 1024 * 1024,
+    num_threads: Union[int, str] = 1,
+    filter: int = FILTER_NONE,
+    typesize: int = 1,
+    probe: float = 0.0,
+    executor: Optional[Executor] = None,
+    cdc: bool = False,
+    allow_stored: bool = False,
+) -> bytes:
     """Compress a block of data.
 
     block_size, if given, must be a number between 65 KiB and 511 MiB as bytes.
-    num_threads, which control how many threads to use. if given, must >= 1.
+    num_threads, which control how many threads to use. if given, must >= 1,
+    or 0/"auto" for the CPUs available to the process. Never more threads
+    than blocks are used.
+    filter, one of the FILTER_* constants, is applied to every block before
+    encoding, with elements of typesize bytes. It is recorded in the stream
+    and reversed by decompress(). probe, if not 0, stores the blocks whose
+    order-0 entropy reaches probe bits per byte as they are, skipping the
+    encoder, provided allow_stored is set: stored blocks are an extension
+    libbz3 and the bzip3 tool can't read. 7.9 catches already compressed
+    media. Blocks are encoded by
+    executor instead of OpenMP if given, or by the default executor if more
+    than one thread is used, filtered streams always use OpenMP. cdc picks
+    block boundaries from the content, see BZ3Compressor, without an
+    executor such streams are encoded by a single thread.
 
     For incremental compression, use a BZ3Compressor object instead.
     """
-    if num_threads == 1:
-        compressor = BZ3Compressor(block_size)
-    elif num_threads > 1:
-        compressor = BZ3OmpCompressor(block_size, num_threads)
+    num_threads = resolve_threads(num_threads, memoryview(data).nbytes, block_size)
+    executor = pick_executor(num_threads, executor)
+    if executor is not None and filter == FILTER_NONE:
+        compressor = ExecutorCompressor(block_size, executor, probe, cdc, allow_stored)
+    elif num_threads == 1 or BZ3OmpCompressor is None or cdc:
+        compressor = BZ3Compressor(
+            block_size, filter, typesize, probe, cdc, allow_stored
+        )
     else:
-        raise ValueError("num_threads must greater or equal to 1")
+        compressor = BZ3OmpCompressor(
+            block_size, num_threads, filter, typesize, probe, allow_stored
+        )
     return compressor.compress(data) + compressor.flush()
 
 
-def decompress(data: bytes, num_threads: int = 1) -> bytes:
+def _count_blocks(data: bytes, limit: int) -> int:
+    """Count the blocks of the bzip3 stream in data, stopping at limit."""
+    view = memoryview(data).cast("B")
+    header = parse_stream_header(view)
+    if header is None:
+        return 0
+    offset = header.size
+    count = 0
+    while count < limit and offset + FRAME_HEADER_SIZE <= len(view):
+        new_size = int.from_bytes(view[offset : offset + 4], "little", signed=True)
+        if new_size < 0:
+            break
+        offset += FRAME_HEADER_SIZE + new_size
+        count += 1
+    return count
+
+
+def decompress(
+    data: bytes, num_threads: Union[int, str] = 1, executor: Optional[Executor] = None
+) -> bytes:
     """Decompress a block of data.
-    num_threads, which control how many threads to use. if given, must >= 1.
+    num_threads, which control how many threads to use. if given, must >= 1,
+    or 0/"auto" for the CPUs available to the process. Never more threads
+    than blocks are used. Blocks are decoded by executor instead of OpenMP
+    if given, or by the default executor if more than one thread is used.
 
     For incremental decompression, use a BZ3Decompressor object instead.
     """
-    if num_threads == 1:
+    num_threads = resolve_threads(num_threads)
+    if num_threads > 1:
+        num_threads = min(num_threads, max(_count_blocks(data, num_threads), 1))
+    executor = pick_executor(num_threads, executor)
+    if executor is not None:
+        decomp = ExecutorDecompressor(executor)
+    elif num_threads == 1 or BZ3OmpDecompressor is None:
         decomp = BZ3Decompressor()
-    elif num_threads > 1:
-        decomp = BZ3OmpDecompressor(num_threads)
     else:
-        raise ValueError("num_threads must greater or equal to 1")
+        decomp = BZ3OmpDecompressor(num_threads)
     return decomp.decompress(data)
+
+
+def _fd(fp: IO) -> Optional[int]:
+    """The descriptor of a seekable real file, None for anything else."""
+    try:
+        fd = fp.fileno()
+        return fd if fp.seekable() else None
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _appends(fp: IO, fd: int) -> bool:
+    """Whether writes to fp go to the end of the file, where pwrite() writes as well
+    on Linux, whatever the offset."""
+    mode = getattr(fp, "mode", "")
+    if isinstance(mode, str) and "a" in mode:
+        return True
+    return fcntl is not None and bool(fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_APPEND)
+
+
+def _pwrite_full(fd: int, data: memoryview, offset: int) -> None:
+    while data:
+        n = os.pwrite(fd, data, offset)
+        data = data[n:]
+        offset += n
+
+
+def decompress_file(
+    input: IO,
+    output: IO,
+    num_threads: Union[int, str] = 1,
+    executor: Optional[Executor] = None,
+) -> None:
+    """Decompress the bzip3 stream of the file object input to output.
+
+    With more than one thread (or an executor), and input and output both
+    seekable real files, the block headers are read first to place every
+    block in the output, which is preallocated, then each worker reads,
+    decodes and writes its blocks with pread/pwrite on its own, in no
+    particular order and without flushing. Otherwise, output opened for
+    appending included, the stream is decoded block by block as by the
+    backends. output is positioned after the data either way.
+    """
+    num_threads = resolve_threads(num_threads)
+    in_fd = _fd(input)
+    out_fd = _fd(output)
+    if (
+        (num_threads == 1 and executor is None)
+        or in_fd is None
+        or out_fd is None
+        or not hasattr(os, "pwrite")
+        or _appends(output, out_fd)
+    ):
+        return _decompress_file(input, output)
+    start = input.tell()
+    header = read_stream_header(input)
+    block_size = header.block_size
+    input.seek(start)
+    blocks = list(iter_blocks(input))
+    size = blocks[-1].uncompressed_offset + blocks[-1].original_size if blocks else 0
+    output.flush()
+    base = output.tell()
+    if size:
+        try:
+            os.posix_fallocate(out_fd, base, size)
+        except (AttributeError, OSError):  # not on this platform or file system
+            if os.fstat(out_fd).st_size < base + size:
+                os.ftruncate(out_fd, base + size)
+    lock = RLock()
+
+    def decode(block) -> None:
+        buffer = get_buffer(block_size)
+        view = memoryview(buffer)[: block.compressed_size]
+        offset = block.offset + FRAME_HEADER_SIZE
+        if _preadinto(input, view, offset, lock) < block.compressed_size:
+            raise ValueError("The input file is truncated")
+        result = decode_block(
+            buffer, block.compressed_size, block.original_size, block_size
+        )
+        if header.filter != FILTER_NONE:
+            unfiltered = get_unfilter_buffer(block_size)
+            unfilter_into(result, unfiltered, header.filter, header.typesize)
+            result = memoryview(unfiltered)[: len(result)]
+        _pwrite_full(out_fd, result, base + block.uncompressed_offset)
+
+    for _ in imap(decode, ((block,) for block in blocks), num_threads, executor):
+        pass
+    output.seek(base + size)
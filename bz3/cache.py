@@ -0,0 +1,96 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import os
+from collections import OrderedDict
+from itertools import count
+from threading import Lock
+from typing import IO, Hashable, NamedTuple, Optional
+
+_serial = count()
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    maxsize: int  # byte budget
+    currsize: int  # bytes currently cached
+    blocks: int  # number of cached blocks
+
+
+def file_key(fp: IO) -> Hashable:
+    """Identify the file behind fp, so that every handle of it shares entries.
+
+    Files without a descriptor get a unique key per call.
+    """
+    try:
+        st = os.fstat(fp.fileno())
+    except (AttributeError, OSError):
+        return ("object", next(_serial))
+    return ("file", st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class BlockCache:
+    """A thread-safe LRU cache of decoded blocks with a byte budget.
+
+    One instance can be shared by any number of BZ3File objects opened for
+    reading, entries are keyed by file identity and block offset.
+    """
+
+    def __init__(self, maxsize: int):
+        if maxsize < 0:
+            raise ValueError("maxsize must not be negative")
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._blocks = OrderedDict()  # type: OrderedDict
+        self._currsize = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        """Return the cached block for key and mark it as recently used."""
+        with self._lock:
+            data = self._blocks.get(key)
+            if data is None:
+                self._misses += 1
+                return None
+            self._blocks.move_to_end(key)
+            self._hits += 1
+            return data
+
+    def put(self, key: Hashable, data: bytes) -> None:
+        """Insert a decoded block, evicting the least recently used ones."""
+        size = len(data)
+        if size > self.maxsize:
+            return
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self._currsize -= len(old)
+            while self._blocks and self._currsize + size > self.maxsize:
+                _, evicted = self._blocks.popitem(last=False)
+                self._currsize -= len(evicted)
+                self._evictions += 1
+            self._blocks[key] = data
+            self._currsize += size
+
+    def clear(self) -> None:
+        """Drop every cached block, statistics are kept."""
+        with self._lock:
+            self._blocks.clear()
+            self._currsize = 0
+
+    def cache_info(self) -> CacheInfo:
+        """Report hit/miss statistics and the current size of the cache."""
+        with self._lock:
+            return CacheInfo(
+                self._hits,
+                self._misses,
+                self._evictions,
+                self.maxsize,
+                self._currsize,
+                len(self._blocks),
+            )
@@ -59,9 +59,8 @@ class DecompressReader(io.RawIOBase):
         self._decomp_args = decomp_args
         self._decompressor = self._decomp_factory(**self._decomp_args)
 
-        # Exception class to catch from decompressor signifying invalid
-        # trailing data to ignore
-        self._buffer = bytearray()  # type: bytearray
+        # Compressed data read from fp and not consumed by the decompressor yet
+        self._input = memoryview(b"")
 
     def close(self) -> None:
         self._decompressor = None
@@ -71,61 +70,67 @@ class DecompressReader(io.RawIOBase):
         return self._fp.seekable()
 
     def readinto(self, b) -> int:
+        """Decompress straight into b, returns as soon as some data is written"""
+        if self._eof:
+            return 0
         with memoryview(b) as view, view.cast("B") as byte_view:
-            data = self.read(len(byte_view))
-            byte_view[: len(data)] = data
-        return len(data)
-
-    def read(self, size=-1) -> bytes:  # todo 这个是重点
+            if not len(byte_view):
+                return 0
+            while True:
+                # decoded data held back by the decompressor comes first
+                written, consumed = self._decompressor.decompress_into(
+                    self._input, byte_view
+                )
+                self._input = self._input[consumed:]
+                if written:  # don't wait for more input with data at hand
+                    break
+                rawblock = self._fp.read(BUFFER_SIZE)
+                if not rawblock:
+                    # decompressors decoding in the background may still hold blocks
+                    written, _ = self._decompressor.decompress_into(b"", byte_view)
+                    if written:
+                        break
+                    self._eof = True
+                    self._size = self._pos
+                    break
+                self._input = memoryview(rawblock)
+        self._pos += written
+        return written
+
+    def read(self, size=-1) -> bytes:
         if size < 0:
             return self.readall()
-        if size <= len(self._buffer):
-            self._pos += size
-            ret = bytes(self._buffer[:size])
-            del self._buffer[:size]
-            return ret
-        if not size or self._eof:
-            return b""
-        # data = None  # Default if EOF is encountered
-        # Depending on the input data, our call to the decompressor may not
-        # return any data. In this case, try again after reading another block.
-        # try:
-        while True:
-            rawblock = self._fp.read(BUFFER_SIZE)
-            if not rawblock:
-                break
-            self._buffer.extend(self._decompressor.decompress(rawblock))
-            if len(self._buffer) >= size:
-                break
-        if len(self._buffer) >= size:
-            self._pos += size
-            ret = bytes(self._buffer[:size])
-            del self._buffer[:size]
-        else:  # 不够长了
-            self._pos += len(self._buffer)
-            self._eof = True
-            self._size = self._pos
-            ret = bytes(self._buffer)
-            self._buffer.clear()
-        return ret
+        ret = bytearray(size)
+        with memoryview(ret) as view:
+            done = 0
+            while done < size:
+                n = self.readinto(view[done:])
+                if not n:
+                    break
+                done += n
+        del ret[done:]
+        return bytes(ret)
 
     def readall(self) -> bytes:
+        # what decompress_into holds back comes first out of decompress()
+        ret = bytearray(self._decompressor.decompress(self._input))
+        self._input = memoryview(b"")
         while True:
             rawblock = self._fp.read(BUFFER_SIZE)
             if not rawblock:
                 break
-            self._buffer.extend(self._decompressor.decompress(rawblock))
-        self._pos += len(self._buffer)
-        ret = bytes(self._buffer)
-        self._buffer.clear()
-        return ret
+            ret.extend(self._decompressor.decompress(rawblock))
+        self._pos += len(ret)
+        self._eof = True
+        self._size = self._pos
+        return bytes(ret)
 
     # Rewind the file to the beginning of the data stream.
     def _rewind(self):
         self._fp.seek(0)
         self._eof = False
         self._pos = 0
-        self._buffer.clear()
+        self._input = memoryview(b"")
         self._decompressor = self._decomp_factory(**self._decomp_args)
 
     def seek(self, offset, whence=io.SEEK_SET):
@@ -161,3 +166,39 @@ class DecompressReader(io.RawIOBase):
     def tell(self) -> int:
         """Return the current file position."""
         return self._pos
+
+
+class BlockReader(io.RawIOBase):
+    """Adapts a positional read function to a seekable RawIOBase reader"""
+
+    def __init__(self, preadinto: Callable[[int, Any], int], size: Callable[[], int]):
+        self._preadinto = preadinto
+        self._size = size  # size of the decompressed stream, for SEEK_END
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = self._preadinto(self._pos, b)
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pass
+        elif whence == io.SEEK_CUR:
+            offset = self._pos + offset
+        elif whence == io.SEEK_END:
+            offset = self._size() + offset
+        else:
+            raise ValueError("Invalid value for whence: {}".format(whence))
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def tell(self) -> int:
+        """Return the current file position."""
+        return self._pos
@@ -0,0 +1,529 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import os
+import struct
+import sys
+from collections import deque
+from concurrent import futures
+from threading import Condition, Lock, Thread, local
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from bz3.backends import (
+    FILTER_NONE,
+    STREAM_STORED,
+    BZ3State,
+    bound,
+    cdc_cut,
+    unfilter_into,
+)
+from bz3.blocks import make_stream_header, parse_stream_header
+from bz3.threads import resolve_threads
+
+_FRAME = struct.Struct("<ii")  # new_size, old_size of every block
+
+
+class Stream:
+    """The jobs of one (de)compression stream on an Executor.
+
+    Jobs of a stream run in no particular order, callers keep the futures
+    in stream order themselves. See Executor.stream().
+    """
+
+    def __init__(self, executor: "Executor"):
+        self._executor = executor
+        # (future, fn, args, kwargs) of the jobs not started yet
+        self._jobs = (
+            deque()
+        )  # type: Deque[Tuple[futures.Future, Callable, tuple, dict]]
+
+    @property
+    def executor(self) -> "Executor":
+        return self._executor
+
+    def submit(self, fn: Callable, *args, **kwargs) -> futures.Future:
+        future = futures.Future()
+        self._executor._enqueue(self, (future, fn, args, kwargs))
+        return future
+
+
+class Executor(futures.Executor):
+    """A bounded pool of worker threads shared by parallel (de)compression.
+
+    Every stream queues its block jobs separately and workers take the next
+    job round-robin across the streams with work queued, so a large file
+    doesn't hold up the others and the thread count stays at max_workers
+    however many streams are open. Workers keep a BZ3State per block size,
+    reused by every stream (see get_state()). max_workers 0 or "auto" means
+    bz3.available_cpus().
+    """
+
+    def __init__(self, max_workers: Union[int, str] = "auto"):
+        self._max_workers = resolve_threads(max_workers)
+        self._cond = Condition()
+        # streams with jobs queued, in turn order
+        self._ready = deque()  # type: Deque[Stream]
+        self._threads = []  # type: List[Thread]
+        self._idle = 0
+        self._shutdown = False
+        self._default_stream = Stream(self)
+
+    @property
+    def max_workers(self) -> int:
+        return self._max_workers
+
+    def stream(self) -> Stream:
+        """A new job queue, scheduled fairly against all the others."""
+        return Stream(self)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> futures.Future:
+        return self._default_stream.submit(fn, *args, **kwargs)
+
+    def _enqueue(self, stream: Stream, job) -> None:
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            stream._jobs.append(job)
+            if len(stream._jobs) == 1:
+                self._ready.append(stream)
+            if not self._idle and len(self._threads) < self._max_workers:
+                thread = Thread(
+                    target=self._work,
+                    name="bz3-worker-%d" % len(self._threads),
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+            else:
+                self._cond.notify()
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                while not self._ready and not self._shutdown:
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                if not self._ready:  # shut down, and nothing left to do
+                    return
+                stream = self._ready.popleft()
+                future, fn, args, kwargs = stream._jobs.popleft()
+                if stream._jobs:  # back to the end of the line
+                    self._ready.append(stream)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            del future, fn, args, kwargs
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        with self._cond:
+            self._shutdown = True
+            if cancel_futures:
+                for stream in self._ready:
+                    for future, _, _, _ in stream._jobs:
+                        future.cancel()
+                    stream._jobs.clear()
+                self._ready.clear()
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+_default_executor = None  # type: Optional[Executor]
+
+
+def set_default_executor(executor: Optional[Executor]) -> Optional[Executor]:
+    """Make executor run every parallel (de)compression that isn't given one,
+    None goes back to OpenMP. Returns the previous default."""
+    global _default_executor
+    previous = _default_executor
+    _default_executor = executor
+    return previous
+
+
+def get_default_executor() -> Optional[Executor]:
+    return _default_executor
+
+
+def pick_executor(num_threads: int, executor: Optional[Executor]) -> Optional[Executor]:
+    """The executor for a job asking for num_threads threads, None for OpenMP
+    or a single thread."""
+    if executor is not None:
+        return executor
+    if num_threads > 1:
+        return _default_executor
+    return None
+
+
+def imap(
+    fn: Callable, items: Iterable[tuple], num_threads: int, executor: Optional[Executor]
+) -> Iterator[Any]:
+    """fn(*item) for every item, in order, up to 2 * max_workers of them run
+    ahead on executor, or on a private one for more than one thread without
+    a default executor. A single thread runs them in place. Closing the
+    iterator early cancels the calls that haven't started and waits for the
+    others, so none of them runs on once it is closed."""
+    executor = pick_executor(num_threads, executor)
+    own = executor is None and num_threads > 1
+    if own:
+        executor = Executor(num_threads)
+    if executor is None:
+        for item in items:
+            yield fn(*item)
+        return
+    pending = deque()  # type: Deque
+    try:
+        stream = executor.stream()
+        window = 2 * executor.max_workers
+        for item in items:
+            pending.append(stream.submit(fn, *item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        futures.wait(pending)
+        if own:
+            executor.shutdown(wait=False)
+
+
+_local = local()
+
+
+def get_state(block_size: int) -> BZ3State:
+    """The BZ3State of the calling thread for block_size, created on first use."""
+    states = getattr(_local, "states", None)
+    if states is None:
+        states = _local.states = {}
+    state = states.get(block_size)
+    if state is None:
+        state = states[block_size] = BZ3State(block_size)
+    return state
+
+
+def get_buffer(block_size: int) -> bytearray:
+    """A buffer of the calling thread that holds any block of block_size
+    encoded, to decode it in place."""
+    buffer = getattr(_local, "buffer", None)
+    if buffer is None or len(buffer) < bound(block_size):
+        buffer = _local.buffer = bytearray(bound(block_size))
+    return buffer
+
+
+def get_unfilter_buffer(block_size: int) -> bytearray:
+    """A second buffer of the calling thread, of block_size bytes, to unfilter
+    the blocks of filtered streams decoded in the one of get_buffer() into."""
+    buffer = getattr(_local, "unfilter_buffer", None)
+    if buffer is None or len(buffer) < block_size:
+        buffer = _local.unfilter_buffer = bytearray(block_size)
+    return buffer
+
+
+def encode_frame(data, block_size: int, probe: float = 0.0) -> memoryview:
+    """Encode one block into its frame: the 8-byte block header and payload."""
+    size = len(data)
+    frame = bytearray(_FRAME.size + bound(size))
+    view = memoryview(frame)
+    view[_FRAME.size : _FRAME.size + size] = data
+    new_size = get_state(block_size).encode_block(view[_FRAME.size :], size, probe)
+    _FRAME.pack_into(frame, 0, new_size, size)
+    return view[: _FRAME.size + new_size]
+
+
+def decode_block(
+    buffer: bytearray, size: int, orig_size: int, block_size: int
+) -> memoryview:
+    """Decode one block in place, buffer must hold bound(orig_size) bytes."""
+    size = get_state(block_size).decode_block(buffer, size, orig_size)
+    return memoryview(buffer)[:size]
+
+
+def _write(out, data) -> int:
+    """write data to out, a file descriptor or a binary file object"""
+    if isinstance(out, int):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(out, view) :]
+    elif data:
+        out.write(data)
+    return len(data)
+
+
+class ExecutorCompressor:
+    """Like BZ3OmpCompressor, but the blocks are encoded by an Executor.
+
+    Data is encoded max_workers blocks at a time, the output is the same as
+    BZ3Compressor's, cdc and allow_stored included. executor defaults to the
+    default executor.
+    """
+
+    def __init__(
+        self,
+        block_size: int,
+        executor: Optional[Executor] = None,
+        probe: float = 0.0,
+        cdc: bool = False,
+        allow_stored: bool = False,
+    ):
+        if block_size < 65 * 1024 or block_size > 511 * 1024 * 1024:
+            raise ValueError("Block size must be between 65 KiB and 511 MiB")
+        if not 0 <= probe <= 8:
+            raise ValueError("probe must be between 0 and 8 bits per byte")
+        if not allow_stored:  # stored blocks are an extension libbz3 can't read
+            probe = 0.0
+        if executor is None:
+            executor = _default_executor
+            if executor is None:
+                raise ValueError("no executor given and no default executor set")
+        self.block_size = block_size
+        self.probe = probe
+        self.cdc = cdc
+        self.blocks = 0  # blocks written so far
+        self.stored_blocks = 0  # of which stored as is
+        self._executor = executor
+        self._stream = executor.stream()
+        self._lock = Lock()
+        self._buffer = bytearray()
+        self._have_magic_number = False
+
+    @property
+    def numthreads(self) -> int:
+        return self._executor.max_workers
+
+    @property
+    def buffered(self) -> int:
+        """Uncompressed bytes held back until they fill a batch or are flushed."""
+        with self._lock:
+            return len(self._buffer)
+
+    def _encode(self, final: bool, write: Callable[[Any], Any]) -> int:
+        """Encode the buffered blocks, passing the header and every frame to write
+        as they come, returns the number of bytes written."""
+        written = 0
+        if not self._have_magic_number:
+            header = make_stream_header(
+                self.block_size, flags=STREAM_STORED if self.probe > 0 else 0
+            )
+            write(header)
+            written += len(header)
+            self._have_magic_number = True
+        batch = self.block_size * self._executor.max_workers
+        size = len(self._buffer)
+        if self.cdc:
+            # the boundaries are found here, in order, the blocks still encode in parallel
+            cuts = []
+            start = 0
+            with memoryview(self._buffer) as view:
+                while size - start >= (1 if final else self.block_size):
+                    window = view[start : start + self.block_size]
+                    end = start + cdc_cut(window, self.block_size)
+                    window.release()
+                    cuts.append((start, end))
+                    start = end
+            size = start
+        else:
+            if not final:
+                size -= size % batch
+            cuts = [
+                (start, start + self.block_size)
+                for start in range(0, size, self.block_size)
+            ]
+        pending = [
+            self._stream.submit(
+                encode_frame,
+                bytes(self._buffer[start:end]),
+                self.block_size,
+                self.probe,
+            )
+            for start, end in cuts
+        ]
+        del self._buffer[:size]
+        for future in pending:
+            frame = future.result()
+            self.blocks += 1
+            # the layout of stored blocks, see bz3_is_stored
+            if frame[_FRAME.size + 4 : _FRAME.size + 8] == b"\xff\xff\xff\xff":
+                self.stored_blocks += 1
+            write(frame)
+            written += len(frame)
+        return written
+
+    def _append(self, data) -> None:
+        with memoryview(data) as view, view.cast("B") as byte_view:
+            self._buffer += byte_view
+
+    def compress(self, data) -> bytes:
+        ret = bytearray()
+        with self._lock:
+            self._append(data)
+            self._encode(False, ret.extend)
+        return bytes(ret)
+
+    def flush(self) -> bytes:
+        ret = bytearray()
+        with self._lock:
+            self._encode(True, ret.extend)
+        return bytes(ret)
+
+    def compress_to(self, data, out) -> int:
+        """Like compress(), but every frame is written to out, a file
+        descriptor or a binary file object, as soon as it is encoded."""
+        with self._lock:
+            self._append(data)
+            return self._encode(False, lambda frame: _write(out, frame))
+
+    def flush_to(self, out) -> int:
+        with self._lock:
+            return self._encode(True, lambda frame: _write(out, frame))
+
+
+class ExecutorDecompressor:
+    """Like BZ3OmpDecompressor, but the blocks are decoded by an Executor.
+
+    Complete blocks are handed to the executor as soon as they come in, up to
+    2 * max_workers of them are decoded ahead. Filtered streams are
+    unfiltered by the workers as well. executor defaults to the default
+    executor.
+    """
+
+    def __init__(self, executor: Optional[Executor] = None, ignore_error: bool = False):
+        if executor is None:
+            executor = _default_executor
+            if executor is None:
+                raise ValueError("no executor given and no default executor set")
+        self.ignore_error = ignore_error
+        self.block_size = 0
+        self.filter = FILTER_NONE
+        self.typesize = 1
+        self._executor = executor
+        self._stream = executor.stream()
+        self._window = 2 * executor.max_workers
+        self._lock = Lock()
+        self._unused = bytearray()
+        self._have_magic_number = False
+        self._pending = deque()  # type: Deque[futures.Future]  # in stream order
+        self._chunk = memoryview(b"")  # rest of the block being handed out
+
+    @property
+    def numthreads(self) -> int:
+        return self._executor.max_workers
+
+    @property
+    def unused_data(self) -> bytes:
+        return bytes(self._unused)
+
+    def _parse_header(self) -> bool:
+        header = parse_stream_header(self._unused)
+        if header is None:
+            return False
+        self.block_size = header.block_size
+        self.filter = header.filter
+        self.typesize = header.typesize
+        self._have_magic_number = True
+        del self._unused[: header.size]
+        return True
+
+    def _decode(self, buffer: bytearray, size: int, orig_size: int) -> memoryview:
+        try:
+            view = decode_block(buffer, size, orig_size, self.block_size)
+        except ValueError:
+            if not self.ignore_error:
+                raise
+            print(
+                "Writing invalid block: %s" % get_state(self.block_size).error(),
+                file=sys.stderr,
+            )
+            view = memoryview(buffer)[:orig_size]
+        if self.filter == FILTER_NONE:
+            return view
+        out = bytearray(len(view))
+        unfilter_into(view, out, self.filter, self.typesize)
+        return memoryview(out)
+
+    def _submit(self) -> None:
+        """Hand the complete blocks in unused to the executor, while there is room"""
+        if not self._have_magic_number and not self._parse_header():
+            return
+        data = self._unused
+        limit = bound(self.block_size)
+        pos = 0
+        while len(self._pending) < self._window and pos + _FRAME.size <= len(data):
+            new_size, old_size = _FRAME.unpack_from(data, pos)
+            if not 0 <= new_size <= limit or not 0 <= old_size <= self.block_size:
+                raise ValueError("Failed to decode a block: Inconsistent headers.")
+            end = pos + _FRAME.size + new_size
+            if end > len(data):
+                break
+            buffer = bytearray(
+                max(new_size, bound(old_size))
+            )  # decoding needs the slack
+            buffer[:new_size] = data[pos + _FRAME.size : end]
+            self._pending.append(
+                self._stream.submit(self._decode, buffer, new_size, old_size)
+            )
+            pos = end
+        del data[:pos]
+
+    def decompress(self, data) -> bytes:
+        with self._lock:
+            ret = bytearray(self._chunk)
+            self._chunk = memoryview(b"")
+            with memoryview(data) as view, view.cast("B") as byte_view:
+                self._unused += byte_view
+            self._submit()
+            while self._pending:
+                ret += self._pending.popleft().result()
+                self._submit()
+            return bytes(ret)
+
+    def decompress_into(self, data, out) -> Tuple[int, int]:
+        """Decompress into out, returns (written, consumed).
+
+        All of data is taken in. Without data, this waits for the next block
+        held by the decompressor, otherwise only blocks already decoded are
+        written, unless 2 * max_workers are in flight.
+        """
+        with self._lock:
+            with memoryview(data) as view, view.cast("B") as byte_view:
+                consumed = len(byte_view)
+                self._unused += byte_view
+            self._submit()
+            written = 0
+            with memoryview(out) as view, view.cast("B") as byte_view:
+                size = len(byte_view)
+                while written < size:
+                    if not self._chunk:
+                        if not self._pending:
+                            break
+                        head = self._pending[0]
+                        if not head.done() and (
+                            written or (consumed and len(self._pending) < self._window)
+                        ):
+                            break
+                        self._chunk = self._pending.popleft().result()
+                        self._submit()
+                        continue
+                    n = min(size - written, len(self._chunk))
+                    byte_view[written : written + n] = self._chunk[:n]
+                    self._chunk = self._chunk[n:]
+                    written += n
+            return written, consumed
@@ -0,0 +1,151 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import pickle
+import struct
+from typing import List, Optional, Union
+
+from bz3.backends import FILTER_NONE, STREAM_STORED, unfilter_into
+from bz3.blocks import (
+    StreamHeader,
+    iter_blocks,
+    make_stream_header,
+    parse_stream_header,
+)
+from bz3.executor import Executor, decode_block, encode_frame, get_buffer, imap
+from bz3.threads import resolve_threads
+
+PICKLE_MAGIC = b"BZ3P"
+
+_HEADER = struct.Struct("<4sI")  # magic, number of out-of-band buffers
+_ENTRY = struct.Struct("<QQ")  # compressed and original size of every stream
+
+
+def dumps(
+    obj,
+    block_size: int = 1024 * 1024,
+    num_threads: Union[int, str] = 1,
+    probe: float = 0.0,
+    executor: Optional[Executor] = None,
+    allow_stored: bool = False,
+) -> bytearray:
+    """Pickle obj with protocol 5 and compress it.
+
+    The out-of-band buffers the objects hand over (PickleBuffer, as numpy
+    arrays do) are compressed where they are, each as a bzip3 stream of its
+    own next to the one of the pickle data, without first being copied into
+    the pickle. Blocks of every stream are encoded by num_threads workers,
+    or by executor, probe and allow_stored are as for compress(). Buffers
+    that aren't contiguous are pickled in-band. The bytearray the streams
+    were assembled in is returned as is, not copied.
+    """
+    if not 0 <= probe <= 8:
+        raise ValueError("probe must be between 0 and 8 bits per byte")
+    if not allow_stored:  # stored blocks are an extension libbz3 can't read
+        probe = 0.0
+    buffers = []  # type: List[memoryview]
+
+    def callback(buffer: pickle.PickleBuffer) -> bool:
+        try:
+            buffers.append(buffer.raw())
+        except BufferError:
+            return True
+        return False
+
+    data = pickle.dumps(obj, protocol=5, buffer_callback=callback)
+    views = [memoryview(data)] + buffers
+    table = _HEADER.size + _ENTRY.size * len(views)
+    out = bytearray(table)
+    _HEADER.pack_into(out, 0, PICKLE_MAGIC, len(buffers))
+    stream_header = make_stream_header(
+        block_size, flags=STREAM_STORED if probe > 0 else 0
+    )
+    sizes = [0] * len(views)
+    jobs = (  # the blocks of every stream, in order
+        (i, view[start : start + block_size])
+        for i, view in enumerate(views)
+        for start in range(0, len(view), block_size)
+    )
+
+    def encode(i: int, block: memoryview):
+        return i, encode_frame(block, block_size, probe)
+
+    current = -1
+    results = imap(encode, jobs, resolve_threads(num_threads), executor)
+    for i, frame in results:
+        while current < i:  # the stream header, of empty streams before too
+            current += 1
+            out += stream_header
+            sizes[current] = len(stream_header)
+        out += frame
+        sizes[i] += len(frame)
+    while current < len(views) - 1:  # empty streams at the end
+        current += 1
+        out += stream_header
+        sizes[current] = len(stream_header)
+    for i, view in enumerate(views):
+        _ENTRY.pack_into(out, _HEADER.size + _ENTRY.size * i, sizes[i], len(view))
+    return out
+
+
+def loads(
+    data,
+    num_threads: Union[int, str] = 1,
+    executor: Optional[Executor] = None,
+):
+    """Decompress and unpickle the output of dumps().
+
+    Every stream is decoded by num_threads workers, or by executor, block by
+    block in a buffer of the worker thread, then copied into the buffer the
+    objects are rebuilt from. Only those buffers hold the whole uncompressed
+    data, the workers a block each.
+    """
+    view = memoryview(data).cast("B")
+    if len(view) < _HEADER.size:
+        raise ValueError("Invalid file. Reason: Smaller than magic header")
+    magic, count = _HEADER.unpack_from(view)
+    if magic != PICKLE_MAGIC:
+        raise ValueError("Invalid signature")
+    pos = _HEADER.size + _ENTRY.size * (count + 1)
+    if len(view) < pos:
+        raise ValueError("The input file is truncated")
+    outputs = []  # type: List[bytearray]
+    jobs = []
+    for i in range(count + 1):
+        compressed_size, size = _ENTRY.unpack_from(view, _HEADER.size + _ENTRY.size * i)
+        if len(view) - pos < compressed_size:
+            raise ValueError("The input file is truncated")
+        stream = view[pos : pos + compressed_size]
+        pos += compressed_size
+        output = bytearray(size)
+        dst = memoryview(output)
+        header = parse_stream_header(stream)
+        if header is None:
+            raise ValueError("Invalid file. Reason: Smaller than magic header")
+        total = 0
+        for block in iter_blocks(stream):
+            end = block.uncompressed_offset + block.original_size
+            if end > size:
+                break
+            jobs.append((block.data, dst[block.uncompressed_offset : end], header))
+            total = end
+        if total != size:
+            raise ValueError(
+                "The input file is corrupted. Reason: %d bytes of data for a buffer of %d bytes"
+                % (total, size)
+            )
+        outputs.append(output)
+
+    def decode(payload: memoryview, dst: memoryview, header: StreamHeader) -> None:
+        buffer = get_buffer(header.block_size)
+        buffer[: len(payload)] = payload
+        view = decode_block(buffer, len(payload), len(dst), header.block_size)
+        if header.filter == FILTER_NONE:
+            dst[:] = view
+        else:
+            unfilter_into(view, dst, header.filter, header.typesize)
+
+    for _ in imap(decode, jobs, resolve_threads(num_threads), executor):
+        pass
+    return pickle.loads(outputs[0], buffers=outputs[1:])
@@ -0,0 +1,168 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import os
+import re
+from builtins import open as _builtin_open
+from threading import RLock, local
+from typing import IO, Iterator, List, Optional, Pattern, Tuple, Union
+
+from bz3.backends import FILTER_NONE, BZ3State, bound, unfilter_into
+from bz3.blocks import (
+    FRAME_HEADER_SIZE,
+    MAX_HEADER_SIZE,
+    BlockInfo,
+    StreamHeader,
+    iter_blocks,
+    parse_stream_header,
+)
+from bz3.bz3 import _preadinto
+from bz3.executor import Executor, imap
+from bz3.threads import resolve_threads
+
+# lines of one block: (partial first line, complete matching lines, partial last line)
+_Result = Tuple[bytes, List[Tuple[int, bytes]], Optional[bytes]]
+
+
+class _BlockSearcher:
+    """Decode blocks and match their complete lines, one decoder per thread."""
+
+    def __init__(self, fp: IO, regex: Pattern, header: StreamHeader, lock: RLock):
+        self._fp = fp
+        self._regex = regex
+        self._header = header
+        self._block_size = header.block_size
+        self._lock = lock
+        self._local = local()
+
+    def __call__(self, block: BlockInfo) -> _Result:
+        state = getattr(self._local, "state", None)
+        if state is None:
+            state = self._local.state = BZ3State(self._block_size)
+            self._local.buffer = bytearray(bound(self._block_size))
+        buffer = self._local.buffer  # type: bytearray
+        view = memoryview(buffer)
+        size = block.compressed_size
+        offset = block.offset + FRAME_HEADER_SIZE
+        if _preadinto(self._fp, view[:size], offset, self._lock) < size:
+            raise ValueError("The input file is truncated")
+        size = state.decode_block(buffer, size, block.original_size)
+        if self._header.filter != FILTER_NONE:
+            unfiltered = getattr(self._local, "unfiltered", None)
+            if unfiltered is None:
+                unfiltered = self._local.unfiltered = bytearray(self._block_size)
+            unfilter_into(
+                view[:size], unfiltered, self._header.filter, self._header.typesize
+            )
+            buffer = unfiltered
+            view = memoryview(buffer)
+        first = buffer.find(b"\n", 0, size)
+        if first < 0:  # no line ends in this block
+            return bytes(view[:size]), [], None
+        last = buffer.rfind(b"\n", 0, size)
+        matches = []
+        pos = first + 1
+        search = self._regex.search
+        while pos <= last:
+            match = search(buffer, pos, last)
+            if match is None:
+                break
+            start = buffer.rfind(b"\n", first, match.start()) + 1
+            end = buffer.find(b"\n", match.start(), last + 1)
+            matches.append((block.uncompressed_offset + start, bytes(view[start:end])))
+            pos = end + 1
+        return bytes(view[:first]), matches, bytes(view[last + 1 : size])
+
+
+def _grep(
+    fp: IO,
+    regex: Pattern,
+    num_threads: int,
+    max_count: Optional[int],
+    executor: Optional[Executor],
+) -> Iterator[Tuple[int, bytes]]:
+    lock = RLock()
+    header = bytearray(MAX_HEADER_SIZE)
+    del header[_preadinto(fp, memoryview(header), fp.tell(), lock) :]
+    stream_header = parse_stream_header(header)
+    if stream_header is None:
+        raise ValueError("Invalid file. Reason: Smaller than magic header")
+    searcher = _BlockSearcher(fp, regex, stream_header, lock)
+    blocks = iter_blocks(fp)
+
+    def jobs() -> Iterator[Tuple[BlockInfo]]:
+        while True:
+            with lock:  # workers may fall back to seek + read on fp
+                block = next(blocks, None)
+            if block is None:
+                return
+            yield (block,)
+
+    def search(block: BlockInfo) -> Tuple[BlockInfo, _Result]:
+        return block, searcher(block)
+
+    count = 0
+    carry = bytearray()  # a line straddling block boundaries
+    carry_start = 0
+    # a bounded window keeps memory flat, closing it cancels the blocks not started
+    results = imap(search, jobs(), num_threads, executor)
+    try:
+        for block, (head, matches, tail) in results:
+            carry += head
+            if tail is None:
+                continue
+            if regex.search(carry) is not None:
+                yield carry_start, bytes(carry)
+                count += 1
+                if count == max_count:
+                    return
+            for match in matches:
+                yield match
+                count += 1
+                if count == max_count:
+                    return
+            carry = bytearray(tail)
+            carry_start = block.uncompressed_offset + block.original_size
+            carry_start -= len(tail)
+        if carry and regex.search(carry) is not None:
+            yield carry_start, bytes(carry)
+    finally:
+        results.close()
+
+
+def grep(
+    pattern: Union[bytes, Pattern],
+    source: Union[IO, str, os.PathLike],
+    num_threads: Union[int, str] = 1,
+    max_count: Optional[int] = None,
+    executor: Optional[Executor] = None,
+) -> Iterator[Tuple[int, bytes]]:
+    """Search the lines of a bzip3 stream for a regular expression.
+
+    ^ and $ match at the start and end of every line. Blocks are read and
+    decoded in parallel by num_threads workers (0 or "auto" uses
+    bz3.available_cpus()), or by executor, which also match the lines
+    contained in their block, lines spanning several blocks are matched once
+    their parts are joined. Yields
+    (uncompressed_offset, line) in file order, line without the newline.
+    Stops after max_count matching lines, use max_count=1 to find the
+    first match only.
+
+    source is a path or a seekable binary file object positioned at the
+    start of the stream.
+    """
+    num_threads = resolve_threads(num_threads)
+    if num_threads < 1:
+        raise ValueError("num_threads must be at least 1")
+    if max_count is not None and max_count < 1:
+        raise ValueError("max_count must be at least 1")
+    if isinstance(pattern, bytes):
+        pattern = re.compile(pattern)
+    # blocks are searched as a whole, so ^ and $ have to anchor at every line
+    regex = re.compile(pattern.pattern, pattern.flags | re.MULTILINE)
+    if isinstance(source, (str, os.PathLike)):
+        with _builtin_open(source, "rb") as fp:
+            yield from _grep(fp, regex, num_threads, max_count, executor)
+    else:
+        yield from _grep(source, regex, num_threads, max_count, executor)
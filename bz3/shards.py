@@ -0,0 +1,175 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import io
+import os
+from builtins import open as _builtin_open
+from typing import IO, Iterator, List, NamedTuple, Tuple, Union
+
+from bz3.backends import FILTER_NONE, BZ3State, bound, unfilter_into
+from bz3.blocks import _FRAME, iter_blocks, read_stream_header
+
+
+class Shard(NamedTuple):
+    """A range of whole blocks of a bzip3 file, picklable for worker processes."""
+
+    path: str
+    index: int
+    offset: int  # offset of the first block header in the compressed file
+    end_offset: int  # offset past the last block of the shard
+    uncompressed_start: int
+    uncompressed_end: int
+    block_size: int
+    delimiter: bytes
+    filter: int = FILTER_NONE  # of the stream, reversed on every decoded block
+    typesize: int = 1
+
+
+def plan_shards(
+    path: Union[str, os.PathLike], n: int, delimiter: bytes = b"\n"
+) -> List[Shard]:
+    """Split a bzip3 file into at most n shards of about equal decompressed size.
+
+    Only the block headers are read. Shards start and end on block
+    boundaries, open_shard() trims them to whole records: a record belongs
+    to the shard holding the delimiter that precedes it, so every record
+    is read by exactly one shard. delimiter must not overlap itself, like
+    b"\\n" or b"\\r\\n". Fewer than n shards are returned when the file
+    has fewer blocks.
+    """
+    if n < 1:
+        raise ValueError("n must be at least 1")
+    if not delimiter:
+        raise ValueError("delimiter must not be empty")
+    path = os.fspath(path)
+    with _builtin_open(path, "rb") as fp:
+        header = read_stream_header(fp)
+        fp.seek(0)
+        blocks = list(iter_blocks(fp))
+    if not blocks:
+        return []
+    total = blocks[-1].uncompressed_offset + blocks[-1].original_size
+    shards = []  # type: List[Shard]
+    first = 0
+    for i, block in enumerate(blocks):
+        end = block.uncompressed_offset + block.original_size
+        # close the shard once it reaches its share of the decompressed size
+        if i + 1 < len(blocks) and end * n < total * (len(shards) + 1):
+            continue
+        start = blocks[first]
+        shards.append(
+            Shard(
+                path,
+                len(shards),
+                start.offset,
+                block.offset + _FRAME.size + block.compressed_size,
+                start.uncompressed_offset,
+                end,
+                header.block_size,
+                delimiter,
+                header.filter,
+                header.typesize,
+            )
+        )
+        first = i + 1
+    return shards
+
+
+def _decode_blocks(fp: IO, shard: Shard) -> Iterator[Tuple[int, bytes]]:
+    """Decode the blocks from the start of shard to the end of the file."""
+    state = BZ3State(shard.block_size)
+    buffer = bytearray(bound(shard.block_size))
+    view = memoryview(buffer)
+    limit = len(buffer)
+    fp.seek(shard.offset)
+    pos = shard.uncompressed_start
+    while True:
+        header = fp.read(_FRAME.size)
+        if not header:
+            return
+        if len(header) < _FRAME.size:
+            raise ValueError("The input file is truncated")
+        new_size, old_size = _FRAME.unpack(header)
+        if not 0 <= new_size <= limit or not 0 <= old_size <= limit:
+            raise ValueError("Failed to decode a block: Inconsistent headers.")
+        if fp.readinto(view[:new_size]) < new_size:
+            raise ValueError("The input file is truncated")
+        size = state.decode_block(buffer, new_size, old_size)
+        if shard.filter == FILTER_NONE:
+            yield pos, bytes(view[:size])
+        else:
+            data = bytearray(size)
+            unfilter_into(view[:size], data, shard.filter, shard.typesize)
+            yield pos, data
+        pos += size
+
+
+def _shard_chunks(fp: IO, shard: Shard) -> Iterator[bytes]:
+    """Yield the records of shard, reading on past its end to finish the last one."""
+    delimiter = shard.delimiter
+    keep = len(delimiter) - 1  # bytes that may start a delimiter cut by a block
+    emitting = shard.uncompressed_start == 0
+    # the next delimiter starting at or after target switches phase
+    target = shard.uncompressed_end if emitting else shard.uncompressed_start
+    carry = b""
+    for start, data in _decode_blocks(fp, shard):
+        window = carry + data
+        window_start = start - len(carry)
+        offset = 0  # first byte of window not consumed yet
+        while True:
+            i = window.find(delimiter, max(target - window_start, offset))
+            if i < 0:
+                break
+            end = i + len(delimiter)
+            if emitting:  # the record after this delimiter belongs to the next shard
+                yield window[offset:end]
+                return
+            if window_start + i >= shard.uncompressed_end:
+                return  # a single record covers the whole shard
+            emitting = True
+            offset = end
+            target = shard.uncompressed_end
+        cut = max(offset, len(window) - keep)
+        if emitting and cut > offset:
+            yield window[offset:cut]
+        carry = window[cut:]
+    if emitting and carry:
+        yield carry
+
+
+class _ShardReader(io.RawIOBase):
+    def __init__(self, shard: Shard):
+        self._fp = _builtin_open(shard.path, "rb")
+        self._chunks = _shard_chunks(self._fp, shard)
+        self._chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._chunk:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._chunk = memoryview(chunk)
+        with memoryview(b) as view, view.cast("B") as byte_view:
+            size = min(len(byte_view), len(self._chunk))
+            byte_view[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._chunks.close()
+            self._fp.close()
+        super().close()
+
+
+def open_shard(shard: Shard) -> io.BufferedReader:
+    """Open a shard from plan_shards() as a binary file of whole records.
+
+    Only the blocks of the shard are decoded, plus the following ones as
+    far as needed to finish its last record.
+    """
+    return io.BufferedReader(_ShardReader(shard))
@@ -0,0 +1,489 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import io
+import os
+import shutil
+import tarfile
+from bisect import bisect_right
+from builtins import open as _builtin_open
+from collections import deque
+from concurrent.futures import Future
+from typing import IO, Deque, List, Optional, Tuple
+
+from bz3.backends import FILTER_NONE, bound, unfilter_into
+from bz3.blocks import _FRAME, iter_blocks, make_stream_header, read_stream_header
+from bz3.executor import Executor, decode_block, encode_frame, pick_executor
+
+SUFFIX = ".tar.bz3"
+FORMAT_NAME = "bz3tar"
+
+
+def _readinto_full(fp: IO, view: memoryview) -> int:
+    """readinto() until view is full or EOF, pipes return short reads"""
+    done = 0
+    while done < len(view):
+        n = fp.readinto(view[done:])
+        if not n:
+            break
+        done += n
+    return done
+
+
+def _open_executor(num_threads: int, executor: Optional[Executor]):
+    """The executor to use and whether it is private to one archive"""
+    if num_threads < 1:
+        raise ValueError("num_threads must be at least 1")
+    executor = pick_executor(num_threads, executor)
+    if executor is not None:
+        return executor, False
+    return Executor(num_threads), True
+
+
+class _BlockWriter(io.RawIOBase):
+    """Buffer writes into whole blocks, encoded by num_threads workers.
+
+    Full blocks are encoded in the background while the caller keeps
+    writing, at most 2 * num_threads of them are in flight. With an
+    executor, its workers encode the blocks instead.
+    """
+
+    def __init__(
+        self,
+        filename,
+        mode: str,
+        block_size: int,
+        num_threads: int,
+        executor: Optional[Executor] = None,
+    ):
+        if block_size < 65 * 1024 or block_size > 511 * 1024 * 1024:
+            raise ValueError("Block size must be between 65 KiB and 511 MiB")
+        executor, self._own_executor = _open_executor(num_threads, executor)
+        if isinstance(filename, (str, bytes, os.PathLike)):
+            self._fp = _builtin_open(filename, mode + "b")
+            self._closefp = True
+        elif hasattr(filename, "write"):
+            self._fp = filename
+            self._closefp = False
+        else:
+            raise TypeError("filename must be a str, bytes, file or PathLike object")
+        self._block_size = block_size
+        self._executor = executor
+        self._stream = executor.stream()
+        self._window = 2 * executor.max_workers
+        self._pending = deque()  # type: Deque[Future]
+        self._buffer = bytearray()
+        self._pos = 0
+        self._fp.write(make_stream_header(block_size))
+
+    @property
+    def name(self):
+        return getattr(self._fp, "name", None)
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def write(self, b) -> int:
+        with memoryview(b) as view, view.cast("B") as byte_view:
+            self._buffer += byte_view
+            size = len(byte_view)
+        self._pos += size
+        if len(self._buffer) >= self._block_size:
+            full = len(self._buffer) - len(self._buffer) % self._block_size
+            for start in range(0, full, self._block_size):
+                self._submit(bytes(self._buffer[start : start + self._block_size]))
+            del self._buffer[:full]
+        return size
+
+    def _submit(self, data: bytes) -> None:
+        self._pending.append(self._stream.submit(encode_frame, data, self._block_size))
+        while len(self._pending) > self._window:
+            self._fp.write(self._pending.popleft().result())
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._fp.write(self._pending.popleft().result())
+            if hasattr(self._fp, "flush"):
+                self._fp.flush()
+        finally:
+            for future in self._pending:
+                future.cancel()
+            if self._own_executor:
+                self._executor.shutdown()
+            try:
+                if self._closefp:
+                    self._fp.close()
+            finally:
+                super().close()
+
+
+class _BlockReader(io.RawIOBase):
+    """Read a stream with up to 2 * num_threads blocks decoded ahead.
+
+    Compressed blocks are read in the calling thread and decoded by
+    num_threads workers, or the workers of executor. Seeking forward
+    within the decoded window just skips data, other seeks on a seekable
+    file jump to the right block with an index of the block headers, built
+    on first use.
+    """
+
+    def __init__(self, filename, num_threads: int, executor: Optional[Executor] = None):
+        executor, self._own_executor = _open_executor(num_threads, executor)
+        if isinstance(filename, (str, bytes, os.PathLike)):
+            self._fp = _builtin_open(filename, "rb")
+            self._closefp = True
+        elif hasattr(filename, "read"):
+            self._fp = filename
+            self._closefp = False
+        else:
+            raise TypeError("filename must be a str, bytes, file or PathLike object")
+        try:
+            self._seekable = self._fp.seekable()
+            self._origin = self._fp.tell() if self._seekable else 0
+            self._header = read_stream_header(self._fp)
+        except BaseException:
+            if self._closefp:
+                self._fp.close()
+            if self._own_executor:
+                executor.shutdown()
+            raise
+        self._block_size = self._header.block_size
+        self._limit = bound(self._block_size)
+        self._executor = executor
+        self._stream = executor.stream()
+        self._window = 2 * executor.max_workers
+        # (uncompressed offset, original size, decoded block) in stream order
+        self._pending = deque()  # type: Deque[Tuple[int, int, Future]]
+        self._chunk = memoryview(b"")  # rest of the current block
+        self._pos = 0
+        self._next_start = 0  # uncompressed offset of the next block to read
+        self._eof = False
+        self._offsets = None  # type: Optional[List[int]]
+        self._starts = None  # type: Optional[List[int]]
+        self._size = 0
+
+    @property
+    def name(self):
+        return getattr(self._fp, "name", None)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return self._seekable
+
+    def tell(self) -> int:
+        return self._pos
+
+    def _read_block(self) -> bool:
+        """Read the next compressed block and queue it for decoding"""
+        if self._eof:
+            return False
+        header = self._fp.read(_FRAME.size)
+        if not header:
+            self._eof = True
+            return False
+        if len(header) < _FRAME.size:
+            raise ValueError("The input file is truncated")
+        new_size, old_size = _FRAME.unpack(header)
+        if not 0 <= new_size <= self._limit or not 0 <= old_size <= self._limit:
+            raise ValueError("Failed to decode a block: Inconsistent headers.")
+        buffer = bytearray(max(new_size, bound(old_size)))  # decoding needs the slack
+        if _readinto_full(self._fp, memoryview(buffer)[:new_size]) < new_size:
+            raise ValueError("The input file is truncated")
+        future = self._stream.submit(self._decode, buffer, new_size, old_size)
+        self._pending.append((self._next_start, old_size, future))
+        self._next_start += old_size
+        return True
+
+    def _decode(self, buffer: bytearray, new_size: int, old_size: int) -> memoryview:
+        view = decode_block(buffer, new_size, old_size, self._block_size)
+        if self._header.filter == FILTER_NONE:
+            return view
+        out = bytearray(len(view))
+        unfilter_into(view, out, self._header.filter, self._header.typesize)
+        return memoryview(out)
+
+    def _next_chunk(self) -> bool:
+        while len(self._pending) < self._window and self._read_block():
+            pass
+        if not self._pending:
+            return False
+        self._chunk = self._pending.popleft()[2].result()
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._chunk:
+            if not self._next_chunk():
+                return 0
+        with memoryview(b) as view, view.cast("B") as byte_view:
+            size = min(len(byte_view), len(self._chunk))
+            byte_view[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        self._pos += size
+        return size
+
+    def read(self, size: int = -1) -> bytes:
+        # tarfile takes a short read for the end of the data
+        if size is None or size < 0:
+            return self.readall()
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        done = 0
+        while done < size:
+            n = self.readinto(view[done:])
+            if not n:
+                break
+            done += n
+        del view
+        del buffer[done:]
+        return bytes(buffer)
+
+    def _skip(self, size: int) -> None:
+        while size > 0:
+            if not self._chunk:
+                if self._pending and self._pending[0][0] + self._pending[0][1] <= (
+                    self._pos + size
+                ):
+                    # the whole block is skipped, don't wait for it
+                    _, old_size, future = self._pending.popleft()
+                    future.cancel()
+                    self._pos += old_size
+                    size -= old_size
+                    continue
+                if not self._next_chunk():
+                    return
+            n = min(size, len(self._chunk))
+            self._chunk = self._chunk[n:]
+            self._pos += n
+            size -= n
+
+    def _build_index(self) -> None:
+        offsets = []
+        starts = []
+        pos = self._fp.tell()  # blocks ahead are still read from here
+        try:
+            self._fp.seek(self._origin)
+            for block in iter_blocks(self._fp):
+                offsets.append(block.offset)
+                starts.append(block.uncompressed_offset)
+                self._size = block.uncompressed_offset + block.original_size
+        finally:
+            self._fp.seek(pos)
+        self._offsets = offsets
+        self._starts = starts
+
+    def _jump(self, offset: int) -> None:
+        """Restart reading at the block holding offset"""
+        if self._offsets is None:
+            self._build_index()
+        for _, _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._chunk = memoryview(b"")
+        i = max(bisect_right(self._starts, offset) - 1, 0)
+        if i < len(self._offsets):
+            self._fp.seek(self._offsets[i])
+            self._pos = self._next_start = self._starts[i]
+            self._eof = False
+        else:  # empty stream
+            self._pos = self._next_start = 0
+            self._eof = True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pass
+        elif whence == io.SEEK_CUR:
+            offset = self._pos + offset
+        elif whence == io.SEEK_END:
+            if not self._seekable:
+                raise io.UnsupportedOperation("The underlying file is not seekable")
+            if self._offsets is None:
+                self._build_index()
+            offset = self._size + offset
+        else:
+            raise ValueError("Invalid value for whence: {}".format(whence))
+        offset = max(offset, 0)
+        if offset < self._pos or (offset > self._next_start and not self._eof):
+            if not self._seekable:
+                if offset < self._pos:
+                    raise io.UnsupportedOperation(
+                        "Seeking backwards needs a seekable file"
+                    )
+            else:
+                self._jump(offset)
+        self._skip(offset - self._pos)
+        return self._pos
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            for _, _, future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            self._chunk = memoryview(b"")
+            if self._own_executor:
+                self._executor.shutdown()
+        finally:
+            try:
+                if self._closefp:
+                    self._fp.close()
+            finally:
+                super().close()
+
+
+def open(
+    name=None,
+    mode: str = "r",
+    fileobj: Optional[IO] = None,
+    block_size: int = 1024 * 1024,
+    num_threads: int = 1,
+    executor: Optional[Executor] = None,
+    **kwargs
+) -> tarfile.TarFile:
+    """Open a bzip3-compressed tar archive.
+
+    mode is "r", "w" or "x", optionally followed by ":bz3" or "|bz3".
+    Stream modes ("|") work on files that can't seek, which is also all
+    "r" needs to iterate over the members in order. name is a path, or
+    fileobj a binary file object used instead.
+
+    Writes are batched into whole blocks that num_threads workers encode
+    while the archive is being written, reading decodes up to
+    2 * num_threads blocks ahead. executor, or the default executor if
+    num_threads is more than 1, does that work in place of threads of the
+    archive's own. Other keyword arguments are passed on to tarfile.TarFile.
+    """
+    filemode, _, comptype = mode.replace("|", ":").partition(":")
+    if filemode not in ("r", "w", "x") or comptype not in ("", "bz3"):
+        raise ValueError("mode must be 'r', 'w' or 'x', optionally with ':bz3'")
+    target = fileobj if fileobj is not None else name
+    if filemode == "r":
+        try:
+            bz3file = _BlockReader(target, num_threads, executor)
+        except ValueError as e:
+            raise tarfile.ReadError("not a bzip3 file") from e
+    else:
+        bz3file = _BlockWriter(target, filemode, block_size, num_threads, executor)
+    try:
+        tar = tarfile.TarFile.taropen(name, filemode, bz3file, **kwargs)
+    except (OSError, EOFError, ValueError) as e:
+        bz3file.close()
+        if filemode == "r":
+            raise tarfile.ReadError("not a bzip3 file") from e
+        raise
+    except BaseException:
+        bz3file.close()
+        raise
+    tar._extfileobj = False  # closing the archive closes bz3file
+    return tar
+
+
+def _make_tarball(
+    base_name: str,
+    base_dir: str,
+    verbose: int = 0,
+    dry_run: int = 0,
+    owner: Optional[str] = None,
+    group: Optional[str] = None,
+    logger=None,
+    root_dir: Optional[str] = None,
+    block_size: int = 1024 * 1024,
+    num_threads: int = 1,
+) -> str:
+    """shutil.make_archive() hook, creates base_name + ".tar.bz3" """
+    archive_name = base_name + SUFFIX
+    archive_dir = os.path.dirname(archive_name)
+    if archive_dir and not os.path.exists(archive_dir):
+        if logger is not None:
+            logger.info("creating %s", archive_dir)
+        if not dry_run:
+            os.makedirs(archive_dir)
+    if logger is not None:
+        logger.info("Creating tar archive")
+    uid = _get_id(owner, "pwd", "getpwnam", "pw_uid")
+    gid = _get_id(group, "grp", "getgrnam", "gr_gid")
+
+    def _set_uid_gid(tarinfo: tarfile.TarInfo) -> tarfile.TarInfo:
+        if gid is not None:
+            tarinfo.gid = gid
+            tarinfo.gname = group
+        if uid is not None:
+            tarinfo.uid = uid
+            tarinfo.uname = owner
+        return tarinfo
+
+    if not dry_run:
+        arcname = base_dir
+        if root_dir is not None:
+            base_dir = os.path.join(root_dir, base_dir)
+        with open(
+            archive_name, "w|bz3", block_size=block_size, num_threads=num_threads
+        ) as tar:
+            tar.add(base_dir, arcname, filter=_set_uid_gid)
+    if root_dir is not None:
+        archive_name = os.path.abspath(archive_name)
+    return archive_name
+
+
+_make_tarball.supports_root_dir = True
+
+
+def _get_id(name: Optional[str], module: str, getter: str, field: str) -> Optional[int]:
+    """uid or gid of a user or group name, None if unknown"""
+    if name is None:
+        return None
+    try:
+        db = __import__(module)
+        return getattr(getattr(db, getter)(name), field)
+    except (ImportError, KeyError):
+        return None
+
+
+def _unpack_tarfile(
+    filename: str, extract_dir: str, *, filter=None, num_threads: int = 1
+) -> None:
+    """shutil.unpack_archive() hook"""
+    try:
+        tar = open(filename, num_threads=num_threads)
+    except tarfile.TarError:
+        raise shutil.ReadError("%s is not a bzip3 compressed tar file" % filename)
+    with tar:
+        if filter is None:
+            tar.extractall(extract_dir)
+        else:
+            tar.extractall(extract_dir, filter=filter)
+
+
+def register_shutil(num_threads: int = 1, block_size: int = 1024 * 1024) -> None:
+    """Register the "bz3tar" format with shutil.make_archive() and
+    shutil.unpack_archive(), for ".tar.bz3" and ".tbz3" files.
+
+    Calling it again replaces the registration, with the new settings.
+    """
+    shutil.register_archive_format(
+        FORMAT_NAME,
+        _make_tarball,
+        [("block_size", block_size), ("num_threads", num_threads)],
+        "bzip3'ed tar-file",
+    )
+    if any(info[0] == FORMAT_NAME for info in shutil.get_unpack_formats()):
+        shutil.unregister_unpack_format(FORMAT_NAME)
+    shutil.register_unpack_format(
+        FORMAT_NAME,
+        [SUFFIX, ".tbz3"],
+        _unpack_tarfile,
+        [("num_threads", num_threads)],
+        "bzip3'ed tar-file",
+    )
@@ -0,0 +1,118 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import math
+import os
+from builtins import open as _builtin_open
+from typing import Optional, Union
+
+_PROC_CGROUP = "/proc/self/cgroup"
+_CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+def _read_cpu_max(path: str) -> Optional[float]:
+    """cgroup v2: "max 100000" or "<quota> <period>" in cpu.max"""
+    try:
+        with _builtin_open(os.path.join(path, "cpu.max")) as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        return None
+    if quota == "max":
+        return None
+    return int(quota) / int(period)
+
+
+def _read_cfs_quota(path: str) -> Optional[float]:
+    """cgroup v1: cpu.cfs_quota_us is -1 when unlimited"""
+    try:
+        with _builtin_open(os.path.join(path, "cpu.cfs_quota_us")) as f:
+            quota = int(f.read())
+        with _builtin_open(os.path.join(path, "cpu.cfs_period_us")) as f:
+            period = int(f.read())
+    except (OSError, ValueError):
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return quota / period
+
+
+def _walk_quota(root: str, path: str, read) -> Optional[float]:
+    """Smallest quota from the cgroup at path up to root, a parent limits its
+    children too. Inside a container path is often the host's, which doesn't
+    exist there, the walk then ends at the root the container sees."""
+    limit = None
+    path = path.strip("/")
+    while True:
+        quota = read(os.path.join(root, path))
+        if quota is not None and (limit is None or quota < limit):
+            limit = quota
+        if not path:
+            return limit
+        path = os.path.dirname(path)
+
+
+def cgroup_cpu_limit() -> Optional[float]:
+    """The CPU quota of the cgroup of this process (v2 cpu.max or v1 CFS quota)
+    in CPUs, None if there is none or it can't be read."""
+    try:
+        with _builtin_open(_PROC_CGROUP) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    limit = None
+    for line in lines:
+        parts = line.split(":", 2)
+        if len(parts) != 3:
+            continue
+        _, controllers, path = parts
+        if not controllers:  # the v2 unified hierarchy
+            quota = _walk_quota(_CGROUP_ROOT, path, _read_cpu_max)
+        elif "cpu" in controllers.split(","):
+            quota = None
+            for mount in (controllers, "cpu,cpuacct", "cpu"):
+                quota = _walk_quota(
+                    os.path.join(_CGROUP_ROOT, mount), path, _read_cfs_quota
+                )
+                if quota is not None:
+                    break
+        else:
+            continue
+        if quota is not None and (limit is None or quota < limit):
+            limit = quota
+    return limit
+
+
+def available_cpus() -> int:
+    """How many CPUs this process can actually keep busy: the CPUs it may run
+    on (sched_getaffinity), further limited by a cgroup CPU quota."""
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, math.ceil(limit))
+    return max(cpus, 1)
+
+
+def resolve_threads(
+    num_threads: Union[int, str],
+    size: Optional[int] = None,
+    block_size: Optional[int] = None,
+) -> int:
+    """The number of threads to use for a num_threads argument.
+
+    0 or "auto" means available_cpus(). With the size of the input and the
+    block_size it is cut up into, never more threads than blocks are used,
+    whether the count was chosen or given.
+    """
+    if num_threads == 0 or num_threads == "auto":
+        threads = available_cpus()
+    elif isinstance(num_threads, int) and num_threads >= 1:
+        threads = num_threads
+    else:
+        raise ValueError('num_threads must be at least 1, or 0/"auto"')
+    if size is not None and block_size is not None:
+        threads = min(threads, max(-(-size // block_size), 1))
+    return threads
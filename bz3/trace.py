@@ -0,0 +1,114 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import json
+import os
+import threading
+from builtins import open as _builtin_open
+from contextlib import contextmanager
+from typing import IO, Iterator, List, NamedTuple, Optional, Union
+
+from bz3.backends import trace_clear, trace_disable, trace_enable, trace_events
+
+# the order of the BZ3_TRACE_* kinds in trace.h
+KINDS = ("stage", "encode", "decode", "assemble", "wave", "write")
+
+
+class TraceEvent(NamedTuple):
+    """One traced step: a block staged, encoded, decoded or assembled, a
+    parallel wave of blocks or a write of encoded blocks."""
+
+    kind: str
+    thread_id: int  # the native thread id, threading.get_native_id()
+    start_ns: int  # time.monotonic_ns() clock
+    end_ns: int
+    arg: int  # the block size, the number of blocks for waves and writes
+
+
+def enable(capacity: int = 65536) -> None:
+    """Start tracing, keeping the newest capacity events. Without tracing
+    enabled the backends record nothing and pay nothing for it."""
+    trace_enable(capacity)
+
+
+def disable() -> None:
+    trace_disable()
+
+
+def clear() -> None:
+    trace_clear()
+
+
+def events() -> List[TraceEvent]:
+    """The events recorded so far, oldest first."""
+    return [
+        TraceEvent(KINDS[kind], tid, start, end, arg)
+        for kind, tid, start, end, arg in trace_events()
+    ]
+
+
+def chrome_trace(recorded: Optional[List[TraceEvent]] = None) -> dict:
+    """The events as a Chrome trace (chrome://tracing, Perfetto) object:
+    complete events in microseconds, threads named after their Python name,
+    threads Python doesn't know (OpenMP workers) after their native id."""
+    if recorded is None:
+        recorded = events()
+    pid = os.getpid()
+    names = {getattr(t, "native_id", None): t.name for t in threading.enumerate()}
+    trace = [
+        {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": pid,
+            "tid": tid,
+            "args": {"name": names.get(tid, "native-%d" % tid)},
+        }
+        for tid in sorted({e.thread_id for e in recorded})
+    ]
+    for e in recorded:
+        trace.append(
+            {
+                "name": e.kind,
+                "cat": "bz3",
+                "ph": "X",
+                "ts": e.start_ns / 1000,
+                "dur": (e.end_ns - e.start_ns) / 1000,
+                "pid": pid,
+                "tid": e.thread_id,
+                "args": {"blocks" if e.kind in ("wave", "write") else "size": e.arg},
+            }
+        )
+    return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+
+def dump(
+    file: Union[str, bytes, os.PathLike, IO[str]],
+    recorded: Optional[List[TraceEvent]] = None,
+) -> None:
+    """Write the events as Chrome trace JSON to a path or a text file object."""
+    trace = chrome_trace(recorded)
+    if isinstance(file, (str, bytes, os.PathLike)):
+        with _builtin_open(file, "w") as f:
+            json.dump(trace, f)
+    else:
+        json.dump(trace, file)
+
+
+@contextmanager
+def tracing(
+    file: Union[str, bytes, os.PathLike, IO[str], None] = None, capacity: int = 65536
+) -> Iterator[None]:
+    """Trace the body of the with statement only, dumping it to file if given.
+
+    >>> with bz3.trace.tracing("bz3.json"):
+    ...     bz3.compress(data, num_threads=8)
+    """
+    enable(capacity)
+    clear()
+    try:
+        yield
+    finally:
+        disable()
+    if file is not None:
+        dump(file)
@@ -0,0 +1,226 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import time
+from builtins import open as _builtin_open
+from threading import Thread
+from typing import IO, NamedTuple, Optional, Union
+
+from bz3.backends import BZ3Compressor
+from bz3.bz3 import BZ3File
+from bz3.executor import Executor, ExecutorCompressor, pick_executor
+from bz3.threads import resolve_threads
+
+try:
+    from bz3.backends import BZ3OmpCompressor
+except ImportError:
+    BZ3OmpCompressor = None
+
+# the longest magic number first
+_MAGIC = (
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"BZ3v1", "bz3"),
+    (b"BZ3F", "bz3"),
+    (b"BZh", "bz2"),
+    (b"\x1f\x8b", "gz"),
+)
+FORMATS = ("gz", "bz2", "xz", "bz3")
+
+
+class TranscodeStats(NamedTuple):
+    """What a transcode() went through."""
+
+    format: str  # the format of the source
+    bytes_read: Optional[int]  # compressed source bytes, None if it can't tell
+    bytes_decoded: int
+    bytes_written: int
+    seconds: float
+
+    @property
+    def throughput(self) -> float:
+        """Decoded bytes per second."""
+        return self.bytes_decoded / max(self.seconds, 1e-9)
+
+
+def detect_format(head: bytes) -> Optional[str]:
+    """The format whose magic number head starts with, one of FORMATS, or None."""
+    for magic, format in _MAGIC:
+        if head.startswith(magic):
+            return format
+    return None
+
+
+def _peek(fp: IO, size: int) -> bytes:
+    """The first size bytes of fp, without consuming them."""
+    if hasattr(fp, "peek"):
+        return fp.peek(size)[:size]
+    if fp.seekable():
+        pos = fp.tell()
+        head = fp.read(size)
+        fp.seek(pos)
+        return head
+    raise ValueError("can't detect the format of a source that can't seek, pass format")
+
+
+def _tell(fp: IO) -> Optional[int]:
+    try:
+        return fp.tell()
+    except (AttributeError, OSError):
+        return None
+
+
+def _readinto_full(source: IO, buffer: bytearray) -> int:
+    """Fill buffer from source, short only at EOF."""
+    view = memoryview(buffer)
+    size = 0
+    while size < len(view):
+        n = source.readinto(view[size:])
+        if not n:
+            break
+        size += n
+    return size
+
+
+def _read_chunks(source: IO, free: queue.Queue, full: queue.Queue) -> None:
+    """Decode the source into the buffers of free, handing them over through
+    full, until EOF or a None in free."""
+    try:
+        while True:
+            buffer = free.get()
+            if buffer is None:
+                return
+            size = _readinto_full(source, buffer)
+            full.put((buffer, size))
+            if size < len(buffer):
+                return
+    except BaseException as e:
+        full.put(e)
+
+
+def transcode(
+    src,
+    dst,
+    block_size: int = 1024 * 1024,
+    num_threads: Union[int, str] = 1,
+    format: Optional[str] = None,
+    probe: float = 0.0,
+    executor: Optional[Executor] = None,
+    allow_stored: bool = False,
+) -> TranscodeStats:
+    """Convert a gzip, bzip2, xz or bzip3 stream into a bzip3 stream of block_size
+    blocks, without an intermediate file.
+
+    src is a path or a binary file object, its format is detected from its
+    magic number unless format, one of FORMATS, is given (needed for sources
+    that can neither peek nor seek). dst is a path, a binary file object or a
+    file descriptor. The source is decoded by a thread of its own into whole
+    rounds of blocks that the encoder takes in while the next round is being
+    decoded, so at most three rounds of num_threads blocks are held. Threads,
+    executor, probe and allow_stored are as for compress(), a bzip3 source is
+    decoded with them too. A dst path is removed again if the transcode fails.
+    """
+    if format is not None and format not in FORMATS:
+        raise ValueError("format must be one of %s" % ", ".join(FORMATS))
+    num_threads = resolve_threads(num_threads)
+    executor = pick_executor(num_threads, executor)
+    if executor is not None:
+        num_threads = executor.max_workers
+        compressor = ExecutorCompressor(
+            block_size, executor, probe, allow_stored=allow_stored
+        )
+    elif num_threads == 1 or BZ3OmpCompressor is None:
+        num_threads = 1
+        compressor = BZ3Compressor(block_size, probe=probe, allow_stored=allow_stored)
+    else:
+        compressor = BZ3OmpCompressor(
+            block_size, num_threads, probe=probe, allow_stored=allow_stored
+        )
+
+    start = time.perf_counter()
+    if isinstance(src, (str, bytes, os.PathLike)):
+        src_fp = _builtin_open(src, "rb")
+        close_src = True
+    else:
+        src_fp = src
+        close_src = False
+    out = dst
+    try:
+        if format is None:
+            format = detect_format(_peek(src_fp, 6))
+            if format is None:
+                raise ValueError(
+                    "Unknown source format, expected one of %s" % ", ".join(FORMATS)
+                )
+        src_start = _tell(src_fp)
+        if format == "gz":
+            source = gzip.GzipFile(fileobj=src_fp, mode="rb")
+        elif format == "bz2":
+            source = bz2.BZ2File(src_fp)
+        elif format == "xz":
+            source = lzma.LZMAFile(src_fp)
+        else:
+            source = BZ3File(src_fp, "rb", num_threads=num_threads, executor=executor)
+        if isinstance(dst, (str, bytes, os.PathLike)):
+            out = _builtin_open(dst, "wb")
+        with source:
+            decoded, written = _transcode(
+                source, out, compressor, block_size * num_threads
+            )
+        src_end = _tell(src_fp)
+    except BaseException:
+        if out is not dst:
+            out.close()
+            os.remove(dst)
+        raise
+    finally:
+        if close_src:
+            src_fp.close()
+    if out is not dst:
+        out.close()
+    elif hasattr(out, "flush"):
+        out.flush()
+    bytes_read = None
+    if src_start is not None and src_end is not None:
+        bytes_read = src_end - src_start
+    return TranscodeStats(
+        format, bytes_read, decoded, written, time.perf_counter() - start
+    )
+
+
+def _transcode(source: IO, out, compressor, chunk_size: int):
+    """Feed source to compressor in chunk_size rounds, returns (decoded, written)."""
+    free = queue.Queue()  # type: queue.Queue
+    full = queue.Queue()  # type: queue.Queue
+    for _ in range(2):  # one being decoded while the other is encoded
+        free.put(bytearray(chunk_size))
+    reader = Thread(
+        target=_read_chunks,
+        args=(source, free, full),
+        name="bz3-transcode",
+        daemon=True,
+    )
+    reader.start()
+    decoded = written = 0
+    try:
+        while True:
+            item = full.get()
+            if isinstance(item, BaseException):
+                raise item
+            buffer, size = item
+            decoded += size
+            written += compressor.compress_to(memoryview(buffer)[:size], out)
+            if size < chunk_size:
+                break
+            free.put(buffer)
+        written += compressor.flush_to(out)
+    finally:
+        free.put(None)  # the reader stops at its next round
+        reader.join()
+    return decoded, written
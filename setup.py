@@ -83,7 +83,7 @@ extensions = [
     Extension(
         "bz3.backends.cython._bz3",
         c_sources,
-        include_dirs=["./dep/include"],
+        include_dirs=["./dep/include", "./bz3/backends"],
         define_macros=define_macros,
         extra_compile_args=extra_compile_args,
         extra_link_args=extra_link_args,
@@ -165,6 +165,7 @@ def main():
         ],
         include_package_data=True,
         zip_safe=False,
+        entry_points={"console_scripts": ["bz3 = bz3.__main__:main"]},
         cmdclass={"build_ext": build_ext_compiler_check},
         **setup_kw
     )
@@ -0,0 +1,93 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import os
+import sys
+import time
+from unittest import TestCase
+
+sys.path.append(".")
+
+import bz3
+from bz3.backends import BZ3Compressor
+
+BLOCK_SIZE = 1024 * 1024
+
+data = b"".join(b"%d,%s\n" % (i, os.urandom(i % 7)) for i in range(200000))
+
+
+class TestAlloc(TestCase):
+    def setUp(self):
+        self.config = bz3.alloc_configure()
+        bz3.alloc_trim()
+
+    def tearDown(self):
+        bz3.alloc_configure(**self.config)
+        bz3.alloc_trim()
+
+    def test_reuse(self):
+        bz3.alloc_configure(cache_limit=256 * 1024 * 1024, mmap_threshold=BLOCK_SIZE)
+        compressed = bz3.compress(data, BLOCK_SIZE)
+        hits = bz3.alloc_stats()["cache_hits"]
+        stats = bz3.alloc_stats()
+        self.assertGreaterEqual(stats["cached"], 2)  # the state and the buffer
+        self.assertEqual(bz3.compress(data, BLOCK_SIZE), compressed)
+        self.assertEqual(bz3.decompress(compressed), data)
+        self.assertGreaterEqual(bz3.alloc_stats()["cache_hits"], hits + 4)
+        bz3.alloc_trim()
+        stats = bz3.alloc_stats()
+        self.assertEqual((stats["cached"], stats["cached_bytes"]), (0, 0))
+
+    def test_reuse_error(self):
+        # libbz3 can't reset the error of a state, a state holding one isn't cached
+        state = bz3.BZ3State(BLOCK_SIZE)
+        stored = bytearray(
+            b"\0\0\0\0\xff\xff\xff\xff"
+        )  # a crc of 0 for no data is wrong
+        with self.assertRaises(ValueError):
+            state.decode_block(stored, 8, 0)
+        self.assertNotEqual(state.last_error, 0)
+        cached = bz3.alloc_stats()["cached"]
+        del state
+        self.assertEqual(bz3.alloc_stats()["cached"], cached)
+        state = bz3.BZ3State(BLOCK_SIZE)
+        self.assertEqual(state.last_error, 0)
+        del state
+        compressor = BZ3Compressor(BLOCK_SIZE, probe=7.0, allow_stored=True)
+        noise = os.urandom(2 * BLOCK_SIZE)
+        compressed = compressor.compress(noise) + compressor.flush()
+        self.assertEqual(bz3.decompress(compressed), noise)
+
+    def test_configure(self):
+        config = bz3.alloc_configure(huge_pages=False, cache_limit=0)
+        self.assertEqual((config["huge_pages"], config["cache_limit"]), (False, 0))
+        self.assertEqual(bz3.decompress(bz3.compress(data, BLOCK_SIZE)), data)
+        self.assertEqual(bz3.alloc_stats()["cached"], 0)
+        for key in ("cache_limit", "mmap_threshold"):
+            with self.assertRaises(ValueError):
+                bz3.alloc_configure(**{key: -1})
+
+    def test_benchmark(self):
+        # first-call latency (a new compressor and its first block) and encode
+        # throughput at a large block size, with and without the allocator
+        block_size = int(os.getenv("BZ3_BENCH_BLOCK_SIZE", 16 * 1024 * 1024))
+        chunk = (data * (block_size // len(data) + 1))[:block_size]
+        for huge_pages, cache_limit in ((False, 0), (True, 2 * 1024**3)):
+            bz3.alloc_configure(huge_pages=huge_pages, cache_limit=cache_limit)
+            bz3.alloc_trim()
+            BZ3Compressor(block_size).compress(chunk)  # warm the cache, if any
+            start = time.perf_counter()
+            compressor = BZ3Compressor(block_size)
+            compressor.compress(chunk)
+            first = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(3):
+                compressor.compress(chunk)
+            compressor.flush()
+            speed = 3 * block_size / (time.perf_counter() - start) / 1024**2
+            del compressor
+            print(
+                f"huge_pages={huge_pages} cache_limit={cache_limit}: "
+                f"first call {first * 1000:.1f} ms, {speed:.1f} MiB/s"
+            )
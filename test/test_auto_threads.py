@@ -0,0 +1,128 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from io import BytesIO
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+sys.path.append(".")
+
+import bz3
+import bz3.threads
+from bz3.threads import available_cpus, cgroup_cpu_limit, resolve_threads
+
+try:
+    from bz3.backends import BZ3OmpCompressor, BZ3OmpDecompressor
+except ImportError:
+    BZ3OmpCompressor = BZ3OmpDecompressor = None
+
+BLOCK_SIZE = 65 * 1024
+
+data = b"".join(b"%d\n" % i for i in range(100000))
+
+
+class TestCgroup(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.proc = os.path.join(self.tmp, "cgroup")
+        self.root = os.path.join(self.tmp, "fs")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, path: str, content: str):
+        path = os.path.join(self.tmp, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def limit(self):
+        with patch.object(bz3.threads, "_PROC_CGROUP", self.proc), patch.object(
+            bz3.threads, "_CGROUP_ROOT", self.root
+        ):
+            return cgroup_cpu_limit(), available_cpus()
+
+    def test_v2(self):
+        self.write("cgroup", "0::/kubepods/pod1/app\n")
+        self.write("fs/kubepods/pod1/app/cpu.max", "max 100000\n")
+        self.write("fs/kubepods/pod1/cpu.max", "250000 100000\n")
+        self.write("fs/kubepods/cpu.max", "max 100000\n")
+        limit, cpus = self.limit()
+        self.assertEqual(limit, 2.5)
+        self.assertEqual(cpus, min(3, available_cpus()))
+
+    def test_v2_container(self):
+        # the path is the host's, the container only sees its own cgroup at the root
+        self.write("cgroup", "0::/kubepods/pod1/app\n")
+        self.write("fs/cpu.max", "100000 100000\n")
+        self.assertEqual(self.limit(), (1.0, 1))
+
+    def test_v1(self):
+        self.write("cgroup", "5:cpuset:/\n4:cpu,cpuacct:/docker/abc\n")
+        self.write("fs/cpu,cpuacct/docker/abc/cpu.cfs_quota_us", "200000\n")
+        self.write("fs/cpu,cpuacct/docker/abc/cpu.cfs_period_us", "100000\n")
+        self.assertEqual(self.limit()[0], 2.0)
+        self.write("fs/cpu,cpuacct/docker/abc/cpu.cfs_quota_us", "-1\n")
+        self.assertEqual(self.limit()[0], None)
+
+    def test_none(self):
+        self.assertEqual(self.limit()[0], None)  # no /proc/self/cgroup
+        self.write("cgroup", "0::/\n")
+        self.assertEqual(self.limit(), (None, available_cpus()))
+
+
+class TestResolve(TestCase):
+    def test_resolve(self):
+        cpus = available_cpus()
+        self.assertGreaterEqual(cpus, 1)
+        self.assertEqual(resolve_threads("auto"), cpus)
+        self.assertEqual(resolve_threads(0), cpus)
+        self.assertEqual(resolve_threads(32), 32)
+        # never more threads than blocks
+        self.assertEqual(resolve_threads(32, 0, BLOCK_SIZE), 1)
+        self.assertEqual(resolve_threads(32, 2 * BLOCK_SIZE + 1, BLOCK_SIZE), 3)
+        self.assertEqual(resolve_threads("auto", 10, BLOCK_SIZE), 1)
+        for num_threads in (-1, "many", 1.5):
+            with self.assertRaises(ValueError):
+                resolve_threads(num_threads)
+
+    def test_roundtrip(self):
+        for num_threads in ("auto", 0, 32):
+            with self.subTest(num_threads=num_threads):
+                compressed = bz3.compress(data, BLOCK_SIZE, num_threads)
+                self.assertEqual(compressed, bz3.compress(data, BLOCK_SIZE))
+                self.assertEqual(bz3.decompress(compressed), data)
+        # a single block stream needs a single thread, OpenMP or not
+        compressed = bz3.compress(b"", BLOCK_SIZE, 32)
+        self.assertEqual(bz3.decompress(compressed, 32), b"")
+        with self.assertRaises(ValueError):
+            bz3.compress(data, BLOCK_SIZE, -1)
+
+    @skipIf(BZ3OmpCompressor is None, "no openmp backend")
+    def test_omp(self):
+        cpus = available_cpus()
+        compressor = BZ3OmpCompressor(BLOCK_SIZE, "auto")
+        self.assertEqual(compressor.numthreads, cpus)
+        compressed = compressor.compress(data) + compressor.flush()
+        decompressor = BZ3OmpDecompressor(0)
+        self.assertEqual(decompressor.numthreads, cpus)
+        self.assertEqual(decompressor.decompress(compressed), data)
+        self.assertEqual(bz3.decompress(compressed, "auto"), data)
+        with self.assertRaises(ValueError):
+            BZ3OmpDecompressor("many")
+
+    @skipIf(BZ3OmpCompressor is None, "no openmp backend")
+    def test_file(self):
+        buffer = BytesIO()
+        with bz3.open(buffer, "wb", BLOCK_SIZE, num_threads="auto") as f:
+            self.assertEqual(f.num_threads, available_cpus())
+            f.write(data)
+        with bz3.open(BytesIO(buffer.getvalue()), "rb", num_threads=0) as f:
+            self.assertEqual(f.read(), data)
+        with bz3.open(BytesIO(buffer.getvalue()), "rb") as f:
+            self.assertEqual(f.num_threads, 1)
@@ -0,0 +1,87 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import io
+import sys
+from unittest import TestCase
+
+sys.path.append(".")
+
+import bz3
+from bz3 import iter_blocks
+
+data = b"".join(b"block test %d\n" % i for i in range(60000))
+
+
+class TestBlocks(TestCase):
+    def setUp(self) -> None:
+        self.compressed = bz3.compress(data, 65 * 1024)
+
+    def check(self, blocks):
+        self.assertGreater(len(blocks), 1)
+        self.assertEqual([b.index for b in blocks], list(range(len(blocks))))
+        self.assertEqual(sum(b.original_size for b in blocks), len(data))
+        self.assertEqual(
+            blocks[-1].offset + 8 + blocks[-1].compressed_size, len(self.compressed)
+        )
+        for prev, block in zip(blocks, blocks[1:]):
+            self.assertEqual(prev.offset + 8 + prev.compressed_size, block.offset)
+            self.assertEqual(
+                prev.uncompressed_offset + prev.original_size,
+                block.uncompressed_offset,
+            )
+
+    def test_buffer(self):
+        blocks = list(iter_blocks(self.compressed))
+        self.check(blocks)
+        decompressor = bz3.backends.BZ3Decompressor()
+        out = decompressor.decompress(self.compressed[:9])
+        for block in blocks:
+            out += decompressor.decompress(
+                self.compressed[block.offset : block.offset + 8] + block.data
+            )
+        self.assertEqual(out, data)
+
+    def test_file(self):
+        blocks = list(iter_blocks(io.BytesIO(self.compressed)))
+        self.check(blocks)
+        self.assertIsNone(blocks[0].data)
+
+    def test_truncated(self):
+        blocks = list(iter_blocks(self.compressed))
+        self.assertEqual(list(iter_blocks(self.compressed[:-1]))[-1], blocks[-2])
+        truncated = io.BytesIO(self.compressed[:-1])
+        self.assertEqual(len(list(iter_blocks(truncated))), len(blocks) - 1)
+
+    def test_state(self):
+        state = bz3.BZ3State(65 * 1024)
+        buf = bytearray(bz3.bound(65 * 1024))
+        stream = bytearray(self.compressed[:9])
+        for start in range(0, len(data), 65 * 1024):
+            chunk = data[start : start + 65 * 1024]
+            buf[: len(chunk)] = chunk
+            new_size = state.encode_block(buf, len(chunk))
+            stream += new_size.to_bytes(4, "little") + len(chunk).to_bytes(4, "little")
+            stream += buf[:new_size]
+        self.assertEqual(bz3.decompress(stream), data)
+        self.assertEqual(state.last_error, 0)
+
+        for block in iter_blocks(stream):
+            buf[: block.compressed_size] = block.data
+            size = state.decode_block(buf, block.compressed_size, block.original_size)
+            self.assertEqual(size, block.original_size)
+            start = block.uncompressed_offset
+            self.assertEqual(buf[:size], data[start : start + size])
+        with self.assertRaises(ValueError):
+            state.encode_block(bytearray(10), 100)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            list(iter_blocks(b"BZ3v2" + self.compressed[5:]))
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import io
+import random
+import sys
+from unittest import TestCase
+
+sys.path.append(".")
+
+import bz3
+from bz3.backends import FILTER_DELTA, BZ3Compressor, cdc_cut
+from bz3.executor import ExecutorCompressor
+
+BLOCK_SIZE = 65 * 1024
+
+rng = random.Random(3)
+data = b"".join(
+    b"%d,%s\n" % (i, bytes(rng.randrange(97, 123) for _ in range(i % 40)))
+    for i in range(40000)
+)
+
+
+def payloads(stream: bytes) -> list:
+    return [bytes(b.data) for b in bz3.iter_blocks(stream)]
+
+
+class TestCdc(TestCase):
+    def test_shift(self):
+        # an insertion near the start shifts every fixed block, but only the
+        # content-defined blocks around it change
+        edited = data[:1000] + b"inserted" + data[1000:]
+        fixed = set(payloads(bz3.compress(data, BLOCK_SIZE)))
+        self.assertFalse(fixed & set(payloads(bz3.compress(edited, BLOCK_SIZE))))
+        before = payloads(bz3.compress(data, BLOCK_SIZE, cdc=True))
+        after = payloads(bz3.compress(edited, BLOCK_SIZE, cdc=True))
+        self.assertGreater(len(before), 10)
+        self.assertLessEqual(len(set(after) - set(before)), 2)
+
+    def test_sizes(self):
+        stream = bz3.compress(data, BLOCK_SIZE, cdc=True)
+        blocks = list(bz3.iter_blocks(stream))
+        for block in blocks[:-1]:
+            self.assertGreater(block.original_size, BLOCK_SIZE // 8)
+            self.assertLessEqual(block.original_size, BLOCK_SIZE)
+        self.assertEqual(
+            [b.original_size for b in blocks[:-1]],
+            [cdc_cut(data[b.uncompressed_offset :], BLOCK_SIZE) for b in blocks[:-1]],
+        )
+        self.assertEqual(bz3.decompress(stream), data)
+        self.assertEqual(cdc_cut(b"", BLOCK_SIZE), 0)
+        self.assertEqual(cdc_cut(b"abc", BLOCK_SIZE), 3)
+
+    def test_apis(self):
+        expected = bz3.compress(data, BLOCK_SIZE, cdc=True)
+        # the cuts don't depend on how the input is split
+        for chunk in (1000, 100000):
+            with self.subTest(chunk=chunk):
+                compressor = BZ3Compressor(BLOCK_SIZE, cdc=True)
+                out = io.BytesIO()
+                for i in range(0, len(data), chunk):
+                    compressor.compress_to(data[i : i + chunk], out)
+                compressor.flush_to(out)
+                self.assertEqual(out.getvalue(), expected)
+        compressor = BZ3Compressor(BLOCK_SIZE, cdc=True)
+        out = bytearray(compressor.compress_bound(len(data)))
+        size = compressor.compress_into(data, out)
+        tail = bytearray(compressor.flush_bound())
+        self.assertEqual(
+            bytes(out[:size]) + bytes(tail[: compressor.flush_into(tail)]), expected
+        )
+        executor = bz3.Executor(3)
+        try:
+            compressor = ExecutorCompressor(BLOCK_SIZE, executor, cdc=True)
+            self.assertEqual(
+                compressor.compress(data[:200000])
+                + compressor.compress(data[200000:])
+                + compressor.flush(),
+                expected,
+            )
+        finally:
+            executor.shutdown()
+        buffer = io.BytesIO()
+        with bz3.open(buffer, "wb", BLOCK_SIZE, cdc=True) as f:
+            f.write(data)
+        self.assertEqual(buffer.getvalue(), expected)
+        filtered = bz3.compress(data, BLOCK_SIZE, 1, FILTER_DELTA, 2, cdc=True)
+        self.assertEqual(bz3.decompress(filtered), data)
@@ -0,0 +1,87 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import os
+import sys
+import tempfile
+from unittest import TestCase
+
+sys.path.append(".")
+
+from bz3.__main__ import main
+
+data = b"".join(b"line %d of the cli test\n" % i for i in range(200000))
+
+
+class TestCli(TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "input.txt")
+        with open(self.path, "wb") as f:
+            f.write(data)
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def roundtrip(self, *args):
+        self.assertEqual(main(["-e", "-f", *args, self.path]), 0)
+        os.remove(self.path)
+        self.assertEqual(main(["-t", *args, self.path + ".bz3"]), 0)
+        self.assertEqual(main(["-d", *args, self.path + ".bz3"]), 0)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_single(self):
+        self.roundtrip("-b", "1")
+
+    def test_threads(self):
+        self.roundtrip("-b", "1", "-j", "4")
+
+    def test_batch(self):
+        for i in range(4):
+            with open(os.path.join(self.dir.name, "%d.txt" % i), "wb") as f:
+                f.write(data[i:])
+        self.assertEqual(main(["-e", "--batch", "-j", "4", self.dir.name]), 0)
+        for i in range(4):
+            os.remove(os.path.join(self.dir.name, "%d.txt" % i))
+        self.assertEqual(main(["-d", "-f", "--batch", "-j", "4", self.dir.name]), 0)
+        for i in range(4):
+            with open(os.path.join(self.dir.name, "%d.txt" % i), "rb") as f:
+                self.assertEqual(f.read(), data[i:])
+
+    def test_batch_stdout(self):
+        with self.assertRaises(SystemExit):
+            main(["-e", "--batch", "-c", self.dir.name])
+
+    def test_truncated(self):
+        self.assertEqual(main(["-e", self.path]), 0)
+        with open(self.path + ".bz3", "r+b") as f:
+            f.truncate(1000)
+        os.remove(self.path)
+        for jobs in ("1", "4"):
+            with self.subTest(jobs=jobs):
+                self.assertEqual(main(["-t", "-j", jobs, self.path + ".bz3"]), 1)
+                self.assertEqual(main(["-d", "-j", jobs, self.path + ".bz3"]), 1)
+                self.assertFalse(os.path.exists(self.path))
+
+    def test_two_files(self):
+        packed = os.path.join(self.dir.name, "packed.bz3")
+        out = os.path.join(self.dir.name, "out.txt")
+        self.assertEqual(main(["-e", self.path, packed]), 0)
+        self.assertEqual(main(["-t", packed, out]), 0)
+        self.assertFalse(os.path.exists(out))
+        with open(packed, "r+b") as f:
+            f.truncate(1000)
+        self.assertEqual(main(["-d", packed, out]), 1)
+        self.assertFalse(os.path.exists(out))
+
+    def test_refuse_overwrite(self):
+        self.assertEqual(main([self.path]), 0)
+        self.assertEqual(main([self.path]), 1)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
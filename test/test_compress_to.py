@@ -0,0 +1,113 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import io
+import os
+import sys
+import tempfile
+from unittest import TestCase
+
+sys.path.append(".")
+
+import bz3
+from bz3.backends import BZ3Compressor
+
+try:
+    from bz3.backends import BZ3OmpCompressor
+except ImportError:
+    BZ3OmpCompressor = None
+
+data = b"".join(b"compress_to %d\n" % i for i in range(40000))
+
+
+class TestCompressTo(TestCase):
+    def factories(self):
+        yield lambda: BZ3Compressor(65 * 1024)
+        if BZ3OmpCompressor is not None:
+            yield lambda: BZ3OmpCompressor(65 * 1024, 3)
+
+    def expected(self, factory):
+        compressor = factory()
+        return (
+            compressor.compress(data[:100])
+            + compressor.compress(data[100:])
+            + compressor.flush()
+        )
+
+    def test_file_object(self):
+        for factory in self.factories():
+            compressor = factory()
+            out = io.BytesIO()
+            written = compressor.compress_to(data[:100], out)
+            written += compressor.compress_to(data[100:], out)
+            written += compressor.flush_to(out)
+            self.assertEqual(written, len(out.getvalue()))
+            self.assertEqual(out.getvalue(), self.expected(factory))
+            self.assertEqual(compressor.flush_to(out), 0)
+
+    def test_fd(self):
+        for factory in self.factories():
+            compressor = factory()
+            with tempfile.TemporaryFile() as f:
+                fd = f.fileno()
+                written = compressor.compress_to(data[:100], fd)
+                written += compressor.compress_to(data[100:], fd)
+                written += compressor.flush_to(fd)
+                f.seek(0)
+                self.assertEqual(f.read(), self.expected(factory))
+                self.assertEqual(written, f.tell())
+
+    def test_invalid_out(self):
+        with self.assertRaises(TypeError):
+            BZ3Compressor(65 * 1024).compress_to(b"", object())
+        with self.assertRaises(OSError):
+            BZ3Compressor(65 * 1024).compress_to(b"", -1)
+
+    def test_bz3file(self):
+        out = io.BytesIO()
+        with bz3.open(out, "wb", block_size=65 * 1024) as f:
+            f.write(data)
+        self.assertEqual(bz3.decompress(out.getvalue()), data)
+
+
+class TestCompressInto(TestCase):
+    factories = TestCompressTo.factories
+    expected = TestCompressTo.expected
+
+    def test_compress_into(self):
+        for factory in self.factories():
+            compressor = factory()
+            out = bytearray(
+                compressor.compress_bound(len(data)) + compressor.flush_bound()
+            )
+            pos = compressor.compress_into(data[:100], out)
+            self.assertEqual(pos, 9)
+            view = memoryview(out)
+            pos += compressor.compress_into(data[100:], view[pos:])
+            tail = bytearray(compressor.flush_bound())
+            written = compressor.flush_into(tail)
+            self.assertEqual(bytes(out[:pos]) + tail[:written], self.expected(factory))
+            self.assertEqual(compressor.flush_bound(), 0)
+            self.assertEqual(compressor.flush_into(bytearray()), 0)
+
+    def test_too_small(self):
+        for factory in self.factories():
+            compressor = factory()
+            needed = compressor.compress_bound(len(data))
+            with self.assertRaisesRegex(ValueError, "need 1 more bytes"):
+                compressor.compress_into(data, bytearray(needed - 1))
+            # nothing was consumed, the call can be retried
+            out = bytearray(needed)
+            pos = compressor.compress_into(data, out)
+            out = out[:pos] + bytearray(compressor.flush_bound())
+            pos += compressor.flush_into(memoryview(out)[pos:])
+            self.assertEqual(bz3.decompress(bytes(out[:pos])), data)
+            with self.assertRaises((TypeError, BufferError)):
+                factory().compress_into(b"", b"readonly")
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
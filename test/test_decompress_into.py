@@ -0,0 +1,111 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import io
+import os
+import sys
+from unittest import TestCase, skipIf
+
+sys.path.append(".")
+
+import bz3
+from bz3.backends import FILTER_SHUFFLE, BZ3Decompressor
+
+try:
+    from bz3.backends import BZ3OmpDecompressor
+except ImportError:
+    BZ3OmpDecompressor = None
+
+BLOCK_SIZE = 65 * 1024
+
+data = b"".join(b"%d,%s\n" % (i, os.urandom(i % 7)) for i in range(60000))
+compressed = bz3.compress(data, BLOCK_SIZE)
+filtered = bz3.compress(data, BLOCK_SIZE, 1, FILTER_SHUFFLE, 4)
+
+
+def drive(decompressor, stream: bytes, chunk: int, out_size: int) -> bytes:
+    """Feed stream in chunks, decompressing into an out_size buffer"""
+    result = bytearray()
+    out = bytearray(out_size)
+    pos = 0
+    pending = memoryview(b"")
+    while True:
+        if not pending and pos < len(stream):
+            pending = memoryview(stream)[pos : pos + chunk]
+            pos += chunk
+        written, consumed = decompressor.decompress_into(pending, out)
+        result += out[:written]
+        pending = pending[consumed:]
+        if not written and not pending and pos >= len(stream):
+            return bytes(result)
+
+
+class TestDecompressInto(TestCase):
+    def test_roundtrip(self):
+        for stream in (compressed, filtered):
+            for chunk, out_size in (
+                (5, 100),
+                (4096, 1),
+                (10**6, 10**6),
+                (70000, 3 * BLOCK_SIZE),
+            ):
+                with self.subTest(chunk=chunk, out_size=out_size):
+                    self.assertEqual(
+                        drive(BZ3Decompressor(), stream, chunk, out_size), data
+                    )
+
+    @skipIf(BZ3OmpDecompressor is None, "no openmp backend")
+    def test_omp(self):
+        for stream in (compressed, filtered):
+            for chunk, out_size in ((4096, 1000), (10**6, 10**6), (10**6, 100000)):
+                with self.subTest(chunk=chunk, out_size=out_size):
+                    decompressor = BZ3OmpDecompressor(3)
+                    self.assertEqual(drive(decompressor, stream, chunk, out_size), data)
+
+    def test_consumed(self):
+        decompressor = BZ3Decompressor()
+        out = bytearray(10)
+        written, consumed = decompressor.decompress_into(compressed, out)
+        self.assertEqual((written, bytes(out)), (10, data[:10]))
+        self.assertLess(consumed, len(compressed))
+        # the rest of the block comes first, out is only filled with whole blocks
+        out = bytearray(len(data))
+        written, consumed2 = decompressor.decompress_into(compressed[consumed:], out)
+        self.assertEqual(consumed + consumed2, len(compressed))
+        self.assertEqual(bytes(out[:written]), data[10:])
+
+    def test_mixed(self):
+        decompressor = BZ3Decompressor()
+        out = bytearray(1000)
+        written, consumed = decompressor.decompress_into(filtered, out)
+        rest = decompressor.decompress(filtered[consumed:])
+        self.assertEqual(bytes(out[:written]) + rest, data)
+
+    def test_header(self):
+        decompressor = BZ3Decompressor()
+        self.assertEqual(
+            decompressor.decompress_into(filtered[:10], bytearray(10)), (0, 10)
+        )
+        self.assertEqual(decompressor.decompress_into(b"", bytearray(10)), (0, 0))
+        out = bytearray(len(data))
+        written, consumed = decompressor.decompress_into(filtered[10:], out)
+        self.assertEqual(bytes(out[:written]), data)
+        with self.assertRaises(ValueError):
+            BZ3Decompressor().decompress_into(b"BZ3v2" + bytes(20), bytearray(10))
+
+    def test_file(self):
+        with bz3.open(io.BytesIO(compressed)) as f:
+            out = bytearray(len(data) + 10)
+            size = 0
+            while True:
+                n = f.readinto(memoryview(out)[size:])
+                if not n:
+                    break
+                size += n
+            self.assertEqual(bytes(out[:size]), data)
+        with bz3.open(io.BytesIO(filtered)) as f:
+            self.assertEqual(f.read(7), data[:7])
+            f.seek(100000)
+            self.assertEqual(f.read(10), data[100000:100010])
+            self.assertEqual(f.read(), data[100010:])
@@ -0,0 +1,160 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import io
+import os
+import sys
+import tarfile
+import threading
+from unittest import TestCase
+
+sys.path.append(".")
+
+import bz3
+import bz3.tarfile
+from bz3.backends import FILTER_DELTA
+from bz3.executor import ExecutorCompressor, ExecutorDecompressor, imap
+
+BLOCK_SIZE = 65 * 1024
+
+data = b"".join(b"%d,%s\n" % (i, os.urandom(i % 7)) for i in range(60000))
+compressed = bz3.compress(data, BLOCK_SIZE)
+
+
+def workers() -> int:
+    return sum(t.name.startswith("bz3-worker") for t in threading.enumerate())
+
+
+class TestExecutor(TestCase):
+    def setUp(self):
+        self.executor = bz3.Executor(3)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        bz3.set_default_executor(None)
+
+    def test_fair(self):
+        executor = bz3.Executor(1)
+        gate = threading.Event()
+        order = []
+        executor.submit(gate.wait)  # holds the only worker until both streams queued
+        a, b = executor.stream(), executor.stream()
+        jobs = [a.submit(order.append, "a%d" % i) for i in range(4)]
+        jobs += [b.submit(order.append, "b%d" % i) for i in range(2)]
+        gate.set()
+        for job in jobs:
+            job.result()
+        self.assertEqual(order, ["a0", "b0", "a1", "b1", "a2", "a3"])
+        executor.shutdown()
+        with self.assertRaises(RuntimeError):
+            executor.submit(print)
+
+    def test_oneshot(self):
+        self.assertEqual(
+            bz3.compress(data, BLOCK_SIZE, executor=self.executor), compressed
+        )
+        self.assertEqual(bz3.decompress(compressed, executor=self.executor), data)
+        filtered = bz3.compress(data, BLOCK_SIZE, 1, FILTER_DELTA, 2)
+        self.assertEqual(bz3.decompress(filtered, executor=self.executor), data)
+        # the default executor takes over whenever more than a thread is asked for
+        self.assertIsNone(bz3.set_default_executor(self.executor))
+        self.assertIs(bz3.get_default_executor(), self.executor)
+        self.assertEqual(bz3.compress(data, BLOCK_SIZE, 8), compressed)
+        self.assertEqual(bz3.decompress(compressed, 8), data)
+        self.assertLessEqual(workers(), 3)
+
+    def test_streaming(self):
+        compressor = ExecutorCompressor(
+            BLOCK_SIZE, self.executor, probe=7.9, allow_stored=True
+        )
+        out = b"".join(
+            compressor.compress(data[i : i + 100000])
+            for i in range(0, len(data), 100000)
+        )
+        out += compressor.flush()
+        self.assertEqual(
+            out, bz3.compress(data, BLOCK_SIZE, probe=7.9, allow_stored=True)
+        )
+        self.assertEqual(compressor.blocks, len(list(bz3.iter_blocks(out))))
+        noise = os.urandom(3 * BLOCK_SIZE)
+        compressor = ExecutorCompressor(
+            BLOCK_SIZE, self.executor, probe=7.9, allow_stored=True
+        )
+        writes = []
+
+        class Sink:
+            def write(self, frame):
+                writes.append(bytes(frame))
+
+        written = compressor.compress_to(noise, Sink())
+        written += compressor.flush_to(Sink())
+        # the header, then every frame as it is encoded
+        self.assertEqual(len(writes), 1 + 3)
+        self.assertEqual(written, sum(map(len, writes)))
+        self.assertEqual(bz3.decompress(b"".join(writes)), noise)
+        self.assertEqual((compressor.blocks, compressor.stored_blocks), (3, 3))
+        for chunk, out_size in ((5000, 1000), (10**6, 10**6), (300, 7)):
+            with self.subTest(chunk=chunk, out_size=out_size):
+                decompressor = ExecutorDecompressor(self.executor)
+                result = bytearray()
+                buffer = bytearray(out_size)
+                for i in range(0, len(compressed), chunk):
+                    written, consumed = decompressor.decompress_into(
+                        compressed[i : i + chunk], buffer
+                    )
+                    self.assertEqual(consumed, len(compressed[i : i + chunk]))
+                    result += buffer[:written]
+                while True:
+                    written, _ = decompressor.decompress_into(b"", buffer)
+                    if not written:
+                        break
+                    result += buffer[:written]
+                self.assertEqual(bytes(result), data)
+        with self.assertRaises(ValueError):
+            ExecutorDecompressor(self.executor).decompress(b"BZ3v2" + bytes(20))
+        with self.assertRaises(ValueError):
+            ExecutorCompressor(BLOCK_SIZE)  # no default executor
+
+    def test_imap_error(self):
+        class Broken(bz3.Executor):
+            def stream(self):
+                raise RuntimeError("no stream")
+
+        executor = Broken(2)
+        with self.assertRaisesRegex(RuntimeError, "no stream"):
+            list(imap(len, [(b"a",)], 2, executor))
+        executor.shutdown()
+
+    def test_files(self):
+        bz3.set_default_executor(self.executor)
+        buffers = [io.BytesIO() for _ in range(10)]
+        files = [bz3.open(b, "wb", BLOCK_SIZE, num_threads=8) for b in buffers]
+        for i in range(0, len(data), 50000):
+            for f in files:
+                f.write(data[i : i + 50000])
+        self.assertEqual(files[0].num_threads, 3)
+        for f in files:
+            f.close()
+        self.assertLessEqual(workers(), 3)
+        for b in buffers:
+            self.assertEqual(b.getvalue(), compressed)
+        files = [bz3.open(io.BytesIO(compressed), num_threads="auto") for _ in range(5)]
+        for f in files:
+            f.seek(200000)
+            self.assertEqual(f.read(100), data[200000:200100])
+            self.assertEqual(f.read(), data[200100:])
+            f.close()
+        self.assertLessEqual(workers(), 3)
+
+    def test_tarfile(self):
+        buffer = io.BytesIO()
+        with bz3.tarfile.open(
+            fileobj=buffer, mode="w", block_size=BLOCK_SIZE, executor=self.executor
+        ) as tar:
+            info = tarfile.TarInfo("data")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        buffer.seek(0)
+        with bz3.tarfile.open(fileobj=buffer, executor=self.executor) as tar:
+            self.assertEqual(tar.extractfile("data").read(), data)
@@ -0,0 +1,147 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import io
+import os
+import sys
+import tempfile
+import tracemalloc
+from unittest import TestCase
+
+sys.path.append(".")
+
+import bz3
+from bz3 import bound, compress_file, decompress_file
+
+BLOCK_SIZE = 1024 * 1024
+data = os.urandom(BLOCK_SIZE // 2) * 16  # 8 blocks
+
+
+class _Sink:
+    """Output that only counts, so it allocates nothing itself."""
+
+    def __init__(self):
+        self.size = 0
+
+    def read(self, size=-1):
+        return b""
+
+    def write(self, b):
+        self.size += len(b)
+        return len(b)
+
+    def flush(self):
+        pass
+
+
+class _ReadOnly:
+    """Input without readinto, served with read()."""
+
+    def __init__(self, data):
+        self._fp = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._fp.read(size)
+
+    def write(self, b):
+        raise io.UnsupportedOperation
+
+
+def traced_peak(func, *args):
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        func(*args)
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+
+
+class TestFileAlloc(TestCase):
+    def test_roundtrip(self):
+        compressed = io.BytesIO()
+        compress_file(io.BytesIO(data), compressed, BLOCK_SIZE)
+        self.assertEqual(bz3.decompress(compressed.getvalue()), data)
+        out = io.BytesIO()
+        decompress_file(io.BytesIO(compressed.getvalue()), out)
+        self.assertEqual(out.getvalue(), data)
+        # inputs without readinto still work
+        fallback = io.BytesIO()
+        compress_file(_ReadOnly(data), fallback, BLOCK_SIZE)
+        self.assertEqual(fallback.getvalue(), compressed.getvalue())
+        out = io.BytesIO()
+        decompress_file(_ReadOnly(compressed.getvalue()), out)
+        self.assertEqual(out.getvalue(), data)
+
+    def test_no_block_allocations(self):
+        # the only block-sized allocation left is the native work buffer,
+        # nothing is allocated per block for reading or writing
+        limit = bound(BLOCK_SIZE) + 64 * 1024
+        sink = _Sink()
+        peak = traced_peak(compress_file, io.BytesIO(data), sink, BLOCK_SIZE)
+        self.assertLess(peak, limit)
+        compressed = io.BytesIO()
+        compress_file(io.BytesIO(data), compressed, BLOCK_SIZE)
+        compressed.seek(0)
+        sink = _Sink()
+        peak = traced_peak(decompress_file, compressed, sink)
+        self.assertLess(peak, limit)
+        self.assertEqual(sink.size, len(data))
+
+    def test_parallel(self):
+        compressed = io.BytesIO()
+        compress_file(io.BytesIO(data), compressed, BLOCK_SIZE)
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "data.bz3")
+            dst = os.path.join(tmp, "data")
+            with open(src, "wb") as f:
+                f.write(b"junk" + compressed.getvalue())
+            for num_threads, executor in ((3, None), (1, bz3.Executor(2))):
+                with self.subTest(num_threads=num_threads):
+                    with open(src, "rb") as inp, open(dst, "wb") as out:
+                        inp.seek(4)  # the stream starts where the file is
+                        out.write(b"head")
+                        decompress_file(inp, out, num_threads, executor)
+                        self.assertEqual(out.tell(), 4 + len(data))
+                    with open(dst, "rb") as f:
+                        self.assertEqual(f.read(), b"head" + data)
+                    if executor is not None:
+                        executor.shutdown()
+            # pwrite ignores the offset on O_APPEND files, these go the sequential way
+            with open(dst, "wb") as f:
+                f.write(b"head")
+            fd = os.open(dst, os.O_WRONLY | os.O_APPEND)
+            with open(src, "rb") as inp, open(dst, "ab") as out, open(fd, "wb") as raw:
+                inp.seek(4)
+                decompress_file(inp, out, 3)
+                inp.seek(4)
+                decompress_file(inp, raw, 3)
+            with open(dst, "rb") as f:
+                self.assertEqual(f.read(), b"head" + data + data)
+            with open(src, "wb") as f:
+                f.write(compressed.getvalue()[:-100])  # the last block is torn
+            with open(src, "rb") as inp, open(dst, "wb") as out:
+                decompress_file(inp, out, 3)
+            with open(dst, "rb") as f:
+                self.assertEqual(f.read(), data[: len(data) - BLOCK_SIZE])
+
+    def test_filtered(self):
+        compressed = bz3.compress(data, BLOCK_SIZE, 1, bz3.FILTER_SHUFFLE, 4)
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "data.bz3")
+            dst = os.path.join(tmp, "data")
+            with open(src, "wb") as f:
+                f.write(compressed)
+            for num_threads in (1, 3):
+                with self.subTest(num_threads=num_threads):
+                    with open(src, "rb") as inp, open(dst, "wb") as out:
+                        decompress_file(inp, out, num_threads)
+                    with open(dst, "rb") as f:
+                        self.assertEqual(f.read(), data)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
@@ -0,0 +1,229 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import io
+import os
+import struct
+import sys
+import tarfile
+import tempfile
+from unittest import TestCase, skipIf
+
+sys.path.append(".")
+
+import bz3
+import bz3.tarfile
+from bz3.backends import (
+    FILTER_BITSHUFFLE,
+    FILTER_DELTA,
+    FILTER_NONE,
+    FILTER_SHUFFLE,
+    BZ3Compressor,
+    BZ3Decompressor,
+    unfilter_into,
+)
+
+try:
+    from bz3.backends import BZ3OmpCompressor, BZ3OmpDecompressor
+except ImportError:
+    BZ3OmpCompressor = BZ3OmpDecompressor = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FILTERS = (FILTER_NONE, FILTER_SHUFFLE, FILTER_BITSHUFFLE, FILTER_DELTA)
+
+# slowly changing doubles plus an odd tail, so blocks don't split into whole elements
+data = b"".join(struct.pack("<d", i * 0.25) for i in range(60000)) + os.urandom(13)
+
+
+class TestFilters(TestCase):
+    def test_roundtrip(self):
+        for filter in FILTERS:
+            for typesize in (1, 2, 3, 4, 8, 13, 255):
+                with self.subTest(filter=filter, typesize=typesize):
+                    compressed = bz3.compress(data, 65 * 1024, 1, filter, typesize)
+                    self.assertEqual(bz3.decompress(compressed), data)
+
+    def test_streaming(self):
+        compressor = BZ3Compressor(65 * 1024, FILTER_SHUFFLE, 8)
+        compressed = compressor.compress(data[:1000])
+        compressed += compressor.compress(data[1000:]) + compressor.flush()
+        self.assertEqual(compressed[:4], b"BZ3F")
+        decompressor = BZ3Decompressor()
+        out = b"".join(
+            decompressor.decompress(compressed[i : i + 5]) for i in range(0, 40, 5)
+        )
+        out += decompressor.decompress(compressed[40:])
+        self.assertEqual(out, data)
+        self.assertEqual((decompressor.filter, decompressor.typesize), (1, 8))
+
+    def test_compress_into(self):
+        for filter in FILTERS:
+            compressor = BZ3Compressor(65 * 1024, filter, 4)
+            out = bytearray(compressor.compress_bound(len(data)))
+            size = compressor.compress_into(data, out)
+            tail = bytearray(compressor.flush_bound())
+            tail_size = compressor.flush_into(tail)
+            self.assertEqual(bz3.decompress(bytes(out[:size] + tail[:tail_size])), data)
+
+    @skipIf(BZ3OmpCompressor is None, "no openmp backend")
+    def test_omp(self):
+        for filter in FILTERS:
+            compressed = bz3.compress(data, 65 * 1024, 3, filter, 8)
+            self.assertEqual(bz3.compress(data, 65 * 1024, 1, filter, 8), compressed)
+            self.assertEqual(bz3.decompress(compressed, 2), data)
+
+    def test_shuffle_helps(self):
+        plain = bz3.compress(data[:-13], 1024 * 1024)
+        shuffled = bz3.compress(data[:-13], 1024 * 1024, 1, FILTER_SHUFFLE, 8)
+        self.assertLess(len(shuffled), len(plain))
+
+    def test_unfilter_into(self):
+        out = bytearray(10)
+        unfilter_into(b"\x01\x01\x01", out, FILTER_DELTA, 1)
+        self.assertEqual(out[:3], b"\x01\x02\x03")
+        with self.assertRaises(ValueError):
+            unfilter_into(b"abc", bytearray(2), FILTER_NONE, 1)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            BZ3Compressor(65 * 1024, 4, 1)
+        with self.assertRaises(ValueError):
+            BZ3Compressor(65 * 1024, FILTER_SHUFFLE, 0)
+        with self.assertRaises(ValueError):
+            BZ3Compressor(65 * 1024, FILTER_SHUFFLE, 256)
+        compressed = bytearray(bz3.compress(data, 65 * 1024, 1, FILTER_SHUFFLE, 8))
+        compressed[4] = 9
+        with self.assertRaises(ValueError):
+            bz3.decompress(bytes(compressed))
+
+
+class TestFilteredStreams(TestCase):
+    """The block-level readers on streams with a BZ3F header."""
+
+    data = b"".join(b"record %08d\n" % i for i in range(30000))
+
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "filtered.bz3")
+        self.compressed = bz3.compress(self.data, 65 * 1024, 1, FILTER_SHUFFLE, 4)
+        with open(self.path, "wb") as f:
+            f.write(self.compressed)
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def test_header(self):
+        header = bz3.parse_stream_header(self.compressed)
+        self.assertEqual(header, (17, 65 * 1024, FILTER_SHUFFLE, 4, 0))
+        self.assertIsNone(bz3.parse_stream_header(self.compressed[:12]))
+        with open(self.path, "rb") as f:
+            self.assertEqual(bz3.read_stream_header(f), header)
+            self.assertEqual(f.tell(), 17)
+        blocks = list(bz3.iter_blocks(self.compressed))
+        self.assertEqual(blocks[0].offset, 17)
+        self.assertEqual(sum(block.original_size for block in blocks), len(self.data))
+        self.assertEqual(
+            list(bz3.iter_blocks(self.path)), [b._replace(data=None) for b in blocks]
+        )
+
+    def test_file_functions(self):
+        with open(self.path, "rb") as f:
+            self.assertTrue(bz3.test_file(f, True))
+        for function in (bz3.backends.decompress_file, bz3.recover_file):
+            with open(self.path, "rb") as f:
+                out = io.BytesIO()
+                function(f, out)
+                self.assertEqual(out.getvalue(), self.data)
+        out_path = os.path.join(self.dir.name, "out")
+        for num_threads in (1, 2):
+            with open(self.path, "rb") as f, open(out_path, "wb") as out:
+                bz3.decompress_file(f, out, num_threads)
+            with open(out_path, "rb") as f:
+                self.assertEqual(f.read(), self.data)
+
+    def test_pread(self):
+        cache = bz3.BlockCache(1024 * 1024)
+        for block_cache in (None, cache):
+            with bz3.open(self.path, "rb", block_cache=block_cache) as f:
+                for offset in (0, 70000, 200000, len(self.data) - 5):
+                    self.assertEqual(
+                        f.pread(offset, 100000), self.data[offset : offset + 100000]
+                    )
+        self.assertGreater(cache.cache_info().blocks, 0)
+
+    def test_grep(self):
+        self.assertEqual(
+            list(bz3.grep(rb"record 0001234.", self.path, 2)),
+            [(16 * i, b"record %08d" % i) for i in range(12340, 12350)],
+        )
+
+    def test_shards(self):
+        shards = bz3.plan_shards(self.path, 3)
+        self.assertEqual(shards[0].filter, FILTER_SHUFFLE)
+        result = b""
+        for shard in shards:
+            with bz3.open_shard(shard) as f:
+                result += f.read()
+        self.assertEqual(result, self.data)
+
+    def test_tarfile(self):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            info = tarfile.TarInfo("data")
+            info.size = len(self.data)
+            tar.addfile(info, io.BytesIO(self.data))
+        compressed = bz3.compress(buffer.getvalue(), 65 * 1024, 1, FILTER_DELTA, 1)
+        with bz3.tarfile.open(fileobj=io.BytesIO(compressed), num_threads=2) as tar:
+            self.assertEqual(tar.extractfile("data").read(), self.data)
+
+
+@skipIf(np is None, "numpy is not installed")
+class TestArray(TestCase):
+    def test_roundtrip(self):
+        arrays = [
+            np.linspace(0, 1, 100000).reshape(100, 1000),
+            np.random.default_rng(1).integers(-50, 50, 300001).cumsum().astype(">i4"),
+            np.zeros((0, 3), dtype=np.float32),
+            np.array(3.5),
+            np.ones(10, dtype=[("a", "<i2"), ("b", "<f8")]),
+            np.arange(90000, dtype=np.int64)[::3],  # not contiguous
+        ]
+        for arr in arrays:
+            for filter in FILTERS:
+                with self.subTest(dtype=arr.dtype, shape=arr.shape, filter=filter):
+                    compressed = bz3.compress_array(arr, 65 * 1024, filter=filter)
+                    result = bz3.decompress_array(compressed, num_threads=3)
+                    self.assertEqual(result.dtype, arr.dtype)
+                    self.assertEqual(result.shape, arr.shape)
+                    self.assertTrue(np.array_equal(result, arr))
+
+    def test_out(self):
+        arr = np.random.default_rng(0).normal(size=(200, 300))
+        compressed = bz3.compress_array(arr, 65 * 1024)
+        out = np.empty_like(arr)
+        self.assertIs(bz3.decompress_array(compressed, out), out)
+        self.assertTrue(np.array_equal(out, arr))
+        executor = bz3.Executor(2)
+        try:
+            compressed = bz3.compress_array(arr, 65 * 1024, executor=executor)
+            result = bz3.decompress_array(compressed, executor=executor)
+            self.assertTrue(np.array_equal(result, arr))
+        finally:
+            executor.shutdown()
+        with self.assertRaises(ValueError):
+            bz3.decompress_array(compressed, np.empty((300, 200)))
+        with self.assertRaises(ValueError):
+            bz3.decompress_array(compressed, np.empty((200, 300), dtype=np.float32))
+        with self.assertRaises(ValueError):
+            bz3.decompress_array(compressed, np.empty((300, 200)).T)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            bz3.compress_array(np.array([object()]))
+        with self.assertRaises(ValueError):
+            bz3.decompress_array(bz3.compress(b"x" * 100))
@@ -0,0 +1,76 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import io
+import os
+import sys
+import time
+from unittest import TestCase, skipUnless
+
+sys.path.append(".")
+
+import bz3
+
+
+class TestFlush(TestCase):
+    def test_flush(self):
+        out = io.BytesIO()
+        with bz3.open(out, "wb", block_size=65 * 1024) as f:
+            f.write(b"first line\n")
+            self.assertEqual(
+                out.getvalue(), b"BZ3v1" + (65 * 1024).to_bytes(4, "little")
+            )
+            f.flush()
+            self.assertEqual(bz3.decompress(out.getvalue()), b"first line\n")
+            f.flush()  # nothing buffered, no empty block
+            size = len(out.getvalue())
+            self.assertEqual(len(list(bz3.iter_blocks(out.getvalue()))), 1)
+            f.write(b"second line\n")
+            self.assertEqual(len(out.getvalue()), size)
+        self.assertEqual(bz3.decompress(out.getvalue()), b"first line\nsecond line\n")
+
+    @skipUnless(hasattr(bz3.backends, "BZ3OmpCompressor"), "needs openmp")
+    def test_flush_threads(self):
+        out = io.BytesIO()
+        with bz3.open(out, "wb", block_size=65 * 1024, num_threads=2) as f:
+            f.write(b"1" * 100000)
+            f.flush()
+            self.assertEqual(bz3.decompress(out.getvalue()), b"1" * 100000)
+            f.write(b"2" * 10)
+        self.assertEqual(bz3.decompress(out.getvalue()), b"1" * 100000 + b"2" * 10)
+
+    def test_max_latency(self):
+        out = io.BytesIO()
+        with bz3.open(out, "wb", block_size=65 * 1024, max_latency=0.1) as f:
+            f.write(b"quiet\n")
+            deadline = time.monotonic() + 5
+            while len(out.getvalue()) <= 9 and time.monotonic() < deadline:
+                time.sleep(0.02)
+            self.assertEqual(bz3.decompress(out.getvalue()), b"quiet\n")
+            # a burst fills whole blocks before the timer fires
+            for _ in range(64):
+                f.write(b"x" * 8192)
+            time.sleep(0.3)
+        sizes = [b.original_size for b in bz3.iter_blocks(out.getvalue())]
+        # the partial block after the burst is closed by the timer
+        self.assertEqual(sizes, [6] + [65 * 1024] * 7 + [64 * 8192 - 7 * 65 * 1024])
+        with self.assertRaises(ValueError):
+            bz3.open(io.BytesIO(), "wb", max_latency=0)
+
+    def test_max_latency_cdc(self):
+        # content-defined cuts hold back a tail that isn't len(data) % block_size
+        data = os.urandom(65 * 1024)
+        out = io.BytesIO()
+        with bz3.open(out, "wb", block_size=65 * 1024, cdc=True, max_latency=0.2) as f:
+            f.write(data)
+            deadline = time.monotonic() + 5
+            while bz3.decompress(out.getvalue()) != data:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.02)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
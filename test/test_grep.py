@@ -0,0 +1,100 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import io
+import os
+import re
+import sys
+import tempfile
+from unittest import TestCase
+
+sys.path.append(".")
+
+import bz3
+
+# long lines without a common period, so that many of them straddle blocks
+lines = [b"line %d %s" % (i, b"x" * (i % 997)) for i in range(40000)]
+lines[123] += b" needle"
+lines[20000] += b" needle"
+lines[-1] += b" needle"
+data = b"\n".join(lines)  # no trailing newline
+
+
+def expected(pattern):
+    ret = []
+    offset = 0
+    for line in lines:
+        if re.search(pattern, line):
+            ret.append((offset, line))
+        offset += len(line) + 1
+    return ret
+
+
+class TestGrep(TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        fd, cls.path = tempfile.mkstemp(suffix=".bz3")
+        with os.fdopen(fd, "wb") as f:
+            f.write(bz3.compress(data, 65 * 1024))
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        os.remove(cls.path)
+
+    def test_matches(self):
+        for pattern in (b"needle", b"^line 3999\\d ", b"3 x* needle$"):
+            want = expected(pattern)
+            self.assertTrue(want)
+            for num_threads in (1, 4, "auto"):
+                self.assertEqual(list(bz3.grep(pattern, self.path, num_threads)), want)
+
+    def test_straddle(self):
+        # every line longer than a block boundary distance is found whole
+        want = expected(b"x")
+        got = list(bz3.grep(re.compile(b"x"), self.path, 3))
+        self.assertEqual(got, want)
+        for offset, line in got[:: len(got) // 50]:
+            self.assertEqual(data[offset : offset + len(line)], line)
+
+    def test_max_count(self):
+        self.assertEqual(
+            list(bz3.grep(b"needle", self.path, 4, max_count=1)),
+            expected(b"needle")[:1],
+        )
+        self.assertEqual(
+            list(bz3.grep(b"needle", self.path, 4, max_count=2)),
+            expected(b"needle")[:2],
+        )
+        with self.assertRaises(ValueError):
+            list(bz3.grep(b"needle", self.path, max_count=0))
+        with self.assertRaises(ValueError):
+            list(bz3.grep(b"needle", self.path, -1))
+
+    def test_executor(self):
+        executor = bz3.Executor(2)
+        try:
+            got = list(bz3.grep(b"needle", self.path, executor=executor))
+            self.assertEqual(got, expected(b"needle"))
+            # stopping early cancels the blocks not started, the executor stays usable
+            matches = bz3.grep(b"x", self.path, executor=executor)
+            self.assertEqual(next(matches), expected(b"x")[0])
+            matches.close()
+            self.assertEqual(
+                list(bz3.grep(b"needle", self.path, 1, 2, executor)),
+                expected(b"needle")[:2],
+            )
+        finally:
+            executor.shutdown()
+
+    def test_file_object(self):
+        with open(self.path, "rb") as f:
+            self.assertEqual(list(bz3.grep(b"needle", f, 2)), expected(b"needle"))
+        buffer = io.BytesIO(bz3.compress(data, 65 * 1024))
+        self.assertEqual(list(bz3.grep(b"needle", buffer, 2)), expected(b"needle"))
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
@@ -0,0 +1,52 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import os
+import pickle
+import sys
+from unittest import TestCase
+
+sys.path.append(".")
+
+import bz3
+
+BLOCK_SIZE = 65 * 1024
+
+data = bytearray(b"".join(b"%d,%s\n" % (i, os.urandom(i % 7)) for i in range(60000)))
+
+
+class TestPickle(TestCase):
+    def test_roundtrip(self):
+        obj = {
+            "data": data,  # out of band, protocol 5 pickles bytearray by PickleBuffer
+            "view": pickle.PickleBuffer(bytes(data[:100000])),
+            "empty": bytearray(),
+            "meta": [1, "two", 3.0],
+        }
+        for num_threads in (1, 3):
+            with self.subTest(num_threads=num_threads):
+                out = bz3.dumps(obj, BLOCK_SIZE, num_threads)
+                self.assertIsInstance(out, bytearray)  # not copied into bytes
+                self.assertLess(len(out), len(data))
+                back = bz3.loads(out, num_threads)
+                self.assertEqual(back["data"], data)
+                self.assertEqual(bytes(back["view"]), bytes(data[:100000]))
+                self.assertEqual(back["empty"], bytearray())
+                self.assertEqual(back["meta"], [1, "two", 3.0])
+        self.assertEqual(bz3.dumps(obj, BLOCK_SIZE, 3), bz3.dumps(obj, BLOCK_SIZE))
+
+    def test_executor(self):
+        executor = bz3.Executor(2)
+        try:
+            out = bz3.dumps([data, data], BLOCK_SIZE, executor=executor)
+            self.assertEqual(bz3.loads(out, executor=executor), [data, data])
+        finally:
+            executor.shutdown()
+
+    def test_invalid(self):
+        out = bz3.dumps(data, BLOCK_SIZE)
+        with self.assertRaises(ValueError):
+            bz3.loads(b"BZ3Q" + out[4:])
+        with self.assertRaises(ValueError):
+            bz3.loads(out[:-10])
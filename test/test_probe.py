@@ -0,0 +1,143 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import os
+import sys
+from io import BytesIO
+from unittest import TestCase, skipIf
+
+sys.path.append(".")
+
+import bz3
+from bz3.backends import (
+    FILTER_NONE,
+    STREAM_STORED,
+    BZ3Compressor,
+    BZ3Decompressor,
+    BZ3State,
+    bound,
+)
+
+try:
+    from bz3.backends import BZ3OmpCompressor
+except ImportError:
+    BZ3OmpCompressor = None
+
+BLOCK_SIZE = 65 * 1024
+
+noise = os.urandom(3 * BLOCK_SIZE)
+text = b"".join(b"line %d of some text\n" % i for i in range(20000))
+# random data that repeats itself within a block, which the encoder does shrink
+repeated = os.urandom(BLOCK_SIZE // 2) * 2
+
+
+class TestProbe(TestCase):
+    def test_noise_stored(self):
+        compressor = BZ3Compressor(BLOCK_SIZE, probe=7.9, allow_stored=True)
+        compressed = compressor.compress(noise) + compressor.flush()
+        self.assertEqual((compressor.blocks, compressor.stored_blocks), (3, 3))
+        self.assertEqual(len(compressed), 17 + 3 * (8 + 8 + BLOCK_SIZE))
+        # stock decoders would fail on the first stored block, the header keeps them out
+        self.assertEqual(
+            bz3.parse_stream_header(compressed),
+            (17, BLOCK_SIZE, FILTER_NONE, 1, STREAM_STORED),
+        )
+        self.assertEqual(bz3.decompress(compressed), noise)
+        self.assertEqual(BZ3Decompressor().decompress(compressed), noise)
+
+    def test_compressible_encoded(self):
+        for data in (text, repeated):
+            compressor = BZ3Compressor(BLOCK_SIZE, probe=7.9, allow_stored=True)
+            compressed = compressor.compress(data) + compressor.flush()
+            self.assertEqual(compressor.stored_blocks, 0)
+            self.assertLess(len(compressed), len(data))
+            self.assertEqual(bz3.decompress(compressed), data)
+
+    def test_mixed(self):
+        data = text[:BLOCK_SIZE] + noise[:BLOCK_SIZE] + text[BLOCK_SIZE:]
+        compressed = bz3.compress(data, BLOCK_SIZE, probe=7.9, allow_stored=True)
+        self.assertEqual(bz3.decompress(compressed), data)
+        self.assertLess(len(compressed), len(bz3.compress(noise[:BLOCK_SIZE])) + 20000)
+
+    def test_disabled(self):
+        compressor = BZ3Compressor(BLOCK_SIZE)
+        compressed = compressor.compress(noise) + compressor.flush()
+        self.assertEqual((compressor.probe, compressor.stored_blocks), (0, 0))
+        self.assertEqual(compressed[:5], b"BZ3v1")
+        self.assertEqual(compressor.blocks, 3)
+        # stored blocks are opt-in, probe alone keeps the stream readable by libbz3
+        compressor = BZ3Compressor(BLOCK_SIZE, probe=7.9)
+        self.assertEqual(compressor.compress(noise) + compressor.flush(), compressed)
+        self.assertEqual((compressor.probe, compressor.stored_blocks), (0, 0))
+        self.assertEqual(bz3.compress(noise, BLOCK_SIZE, probe=0.5), compressed)
+        output = BytesIO()
+        bz3.compress_file(BytesIO(noise), output, BLOCK_SIZE, 7.9)
+        self.assertEqual(output.getvalue(), compressed)
+
+    @skipIf(BZ3OmpCompressor is None, "no openmp backend")
+    def test_omp(self):
+        data = noise + text
+        compressor = BZ3OmpCompressor(BLOCK_SIZE, 3, probe=7.9, allow_stored=True)
+        compressed = compressor.compress(data) + compressor.flush()
+        self.assertEqual(compressor.stored_blocks, 3)
+        self.assertEqual(
+            compressed, bz3.compress(data, BLOCK_SIZE, probe=7.9, allow_stored=True)
+        )
+        self.assertEqual(bz3.decompress(compressed, 3), data)
+
+    def test_file(self):
+        output = BytesIO()
+        bz3.compress_file(BytesIO(noise), output, BLOCK_SIZE, 7.9, allow_stored=True)
+        self.assertLess(len(output.getvalue()), len(noise) + 100)
+        self.assertTrue(bz3.test_file(BytesIO(output.getvalue())))
+        result = BytesIO()
+        bz3.decompress_file(BytesIO(output.getvalue()), result)
+        self.assertEqual(result.getvalue(), noise)
+
+        buffer = BytesIO()
+        with bz3.open(buffer, "wb", BLOCK_SIZE, probe=7.9, allow_stored=True) as f:
+            f.write(noise)
+        with bz3.open(BytesIO(buffer.getvalue()), "rb") as f:
+            f.seek(BLOCK_SIZE + 10)
+            self.assertEqual(f.read(100), noise[BLOCK_SIZE + 10 : BLOCK_SIZE + 110])
+
+    def test_state(self):
+        compressed = bz3.compress(
+            noise[:BLOCK_SIZE], BLOCK_SIZE, probe=7.9, allow_stored=True
+        )
+        buffer = bytearray(bound(BLOCK_SIZE))
+        payload = compressed[25:]
+        buffer[: len(payload)] = payload
+        state = BZ3State(BLOCK_SIZE)
+        bad = bytearray(buffer)
+        bad[len(payload) - 1] ^= 1
+        with self.assertRaises(ValueError):
+            state.decode_block(bad, len(payload), BLOCK_SIZE)
+        self.assertEqual(
+            state.decode_block(buffer, len(payload), BLOCK_SIZE), BLOCK_SIZE
+        )
+        self.assertEqual(buffer[:BLOCK_SIZE], noise[:BLOCK_SIZE])
+        self.assertEqual((state.last_error, state.error()), (0, None))
+
+    def test_corrupted(self):
+        compressed = bytearray(
+            bz3.compress(noise[:BLOCK_SIZE], BLOCK_SIZE, probe=7.9, allow_stored=True)
+        )
+        compressed[-1] ^= 1
+        with self.assertRaises(ValueError):
+            bz3.decompress(bytes(compressed))
+        self.assertFalse(bz3.test_file(BytesIO(bytes(compressed))))
+
+    def test_invalid(self):
+        for probe in (-1, 8.5):
+            with self.assertRaises(ValueError):
+                BZ3Compressor(BLOCK_SIZE, probe=probe, allow_stored=True)
+        compressed = bz3.compress(noise, BLOCK_SIZE, probe=7.9, allow_stored=True)
+        for i, value in ((6, 0), (6, 3), (7, 1)):  # no flag, unknown flags, reserved
+            header = bytearray(compressed[:17])
+            header[i] = value
+            with self.assertRaises(ValueError):
+                bz3.decompress(bytes(header) + compressed[17:])
+            with self.assertRaises(ValueError):
+                bz3.parse_stream_header(header)
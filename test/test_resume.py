@@ -0,0 +1,153 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from io import BytesIO
+from unittest import TestCase
+
+sys.path.append(".")
+
+import bz3
+from bz3.backends import resume_output
+
+BLOCK_SIZE = 65 * 1024
+
+data = b"".join(b"%d,%s\n" % (i, os.urandom(i % 5)) for i in range(80000))
+
+
+def compressed_file() -> bytes:
+    output = BytesIO()
+    bz3.compress_file(BytesIO(data), output, BLOCK_SIZE)
+    return output.getvalue()
+
+
+complete = compressed_file()
+blocks = list(bz3.iter_blocks(BytesIO(complete)))
+
+
+class Unseekable:  # read and write only, like a pipe
+    def __init__(self, data: bytes):
+        self._data = BytesIO(data)
+
+    def read(self, size=-1):
+        return self._data.read(size)
+
+    def write(self, data):
+        raise OSError
+
+
+class TestResume(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "out.bz3")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def resume(self, partial: bytes, input=None) -> bytes:
+        with open(self.path, "wb") as f:
+            f.write(partial)
+        with open(self.path, "a+b") as f:
+            bz3.compress_file(
+                BytesIO(data) if input is None else input, f, BLOCK_SIZE, resume=True
+            )
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def test_torn(self):
+        for cut in (
+            0,
+            5,
+            9,
+            13,
+            blocks[2].offset,
+            blocks[2].offset + 6,
+            blocks[2].offset + 500,
+            len(complete) - 1,
+        ):
+            with self.subTest(cut=cut):
+                self.assertEqual(self.resume(complete[:cut]), complete)
+        self.assertEqual(self.resume(complete[:1000], Unseekable(data)), complete)
+
+    def test_garbage(self):
+        partial = complete[: blocks[3].offset]
+        # a zero filled tail, as left behind by a crash before the data was written
+        self.assertEqual(self.resume(partial + bytes(5000)), complete)
+        # the last block is complete by its headers but its payload is damaged
+        damaged = bytearray(partial)
+        damaged[-100] ^= 0xFF
+        self.assertEqual(self.resume(bytes(damaged)), complete)
+
+    def test_complete(self):
+        self.assertEqual(self.resume(complete), complete)
+        output = BytesIO(complete)
+        self.assertEqual(resume_output(output, BLOCK_SIZE), len(data))
+        self.assertEqual(output.getvalue(), complete)
+        output = BytesIO(complete[:7])
+        self.assertEqual(resume_output(output, BLOCK_SIZE), -1)
+        self.assertEqual(output.getvalue(), b"")
+
+    def test_mismatch(self):
+        with self.assertRaises(ValueError):
+            resume_output(BytesIO(complete), 2 * BLOCK_SIZE)
+        with self.assertRaises(ValueError):
+            resume_output(BytesIO(b"BZ3v2" + complete[5:]), BLOCK_SIZE)
+        # the input has less data than the output already holds
+        with self.assertRaises(ValueError):
+            self.resume(complete, BytesIO(data[:1000]))
+        with self.assertRaises(ValueError):
+            self.resume(complete, Unseekable(data[:1000]))
+
+    def test_probe(self):
+        output = BytesIO()
+        bz3.compress_file(
+            BytesIO(data), output, BLOCK_SIZE, probe=7.9, allow_stored=True
+        )
+        stored = output.getvalue()
+        self.assertEqual(stored[:4], b"BZ3F")
+        partial = stored[: list(bz3.iter_blocks(stored))[3].offset + 10]
+        self.assertEqual(
+            resume_output(BytesIO(partial), BLOCK_SIZE, 7.9, allow_stored=True),
+            blocks[3].uncompressed_offset,
+        )
+        self.assertEqual(
+            resume_output(BytesIO(partial), BLOCK_SIZE), blocks[3].uncompressed_offset
+        )
+        self.assertEqual(
+            resume_output(BytesIO(stored[:12]), BLOCK_SIZE, 7.9, allow_stored=True), -1
+        )
+        with open(self.path, "wb") as f:
+            f.write(partial)
+        with open(self.path, "a+b") as f:
+            bz3.compress_file(
+                BytesIO(data), f, BLOCK_SIZE, 7.9, resume=True, allow_stored=True
+            )
+        with open(self.path, "rb") as f:
+            self.assertEqual(bz3.decompress(f.read()), data)
+        # blocks can't be stored in a stream without the flag
+        with self.assertRaises(ValueError):
+            resume_output(BytesIO(complete), BLOCK_SIZE, 7.9, allow_stored=True)
+
+    def test_file(self):
+        with bz3.open(self.path, "wb", BLOCK_SIZE) as f:
+            f.write(data[:300000])
+        with open(self.path, "r+b") as f:
+            f.truncate(blocks[3].offset + 10)  # the crash
+        with bz3.open(self.path, "ab", BLOCK_SIZE, resume=True) as f:
+            offset = f.tell()
+            self.assertEqual(offset, blocks[3].uncompressed_offset)
+            f.write(data[offset:])
+        with bz3.open(self.path, "rb") as f:
+            self.assertEqual(f.read(), data)
+        os.remove(self.path)
+        with bz3.open(self.path, "a", BLOCK_SIZE, resume=True) as f:
+            self.assertEqual(f.tell(), 0)
+            f.write(data)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), complete)
+        with self.assertRaises(ValueError):
+            bz3.open(self.path, "wb", BLOCK_SIZE, resume=True)
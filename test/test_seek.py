@@ -2,8 +2,12 @@
 Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
 """
 
+import io
 import os
 import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from random import Random
 from unittest import TestCase
 
 sys.path.append(".")
@@ -35,6 +39,91 @@ class TestSeek(TestCase):
         print("done")
 
 
+class TestPread(TestCase):
+    data = b"".join(b"record %08d\n" % i for i in range(100000))
+
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "pread.bz3")
+        with bz3.open(self.path, "wb", block_size=65 * 1024) as f:
+            f.write(self.data)
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def check(self, f):
+        rng = Random(0)
+        offsets = [rng.randrange(len(self.data) + 10) for _ in range(200)]
+
+        def task(offset):
+            self.assertEqual(
+                f.pread(offset, 100000), self.data[offset : offset + 100000]
+            )
+
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(task, offsets))
+
+    def test_pread(self):
+        with bz3.open(self.path, "rb") as f:
+            self.assertEqual(f.read(10), self.data[:10])
+            self.check(f)
+            self.assertEqual(f.tell(), 10)
+            self.assertEqual(f.read(10), self.data[10:20])
+            buf = bytearray(50)
+            self.assertEqual(f.preadinto(len(self.data) - 20, buf), 20)
+            self.assertEqual(bytes(buf[:20]), self.data[-20:])
+
+    def test_pread_fileobj(self):
+        with open(self.path, "rb") as raw:
+            fp = io.BytesIO(raw.read())
+        with bz3.open(fp, "rb") as f:
+            self.assertEqual(f.read(10), self.data[:10])
+            self.check(f)
+            self.assertEqual(f.read(10), self.data[10:20])
+
+
+class TestBlockCache(TestCase):
+    data = TestPread.data
+
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "cache.bz3")
+        with bz3.open(self.path, "wb", block_size=65 * 1024) as f:
+            f.write(self.data)
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def test_shared(self):
+        cache = bz3.BlockCache(4 * 1024 * 1024)
+        rng = Random(0)
+        with bz3.open(self.path, "rb", block_cache=cache) as f1, bz3.open(
+            self.path, "rb", block_cache=cache
+        ) as f2:
+            for _ in range(200):
+                offset = rng.randrange(len(self.data))
+                for f in (f1, f2):
+                    f.seek(offset)
+                    self.assertEqual(f.read(20), self.data[offset : offset + 20])
+            f1.seek(-10, 2)
+            self.assertEqual(f1.read(), self.data[-10:])
+            f2.seek(0)
+            self.assertEqual(f2.read(), self.data)
+        info = cache.cache_info()
+        self.assertGreater(info.hits, info.misses)
+        self.assertLessEqual(info.currsize, info.maxsize)
+        self.assertEqual(info.evictions, 0)
+
+    def test_evict(self):
+        cache = bz3.BlockCache(3 * 65 * 1024)
+        with bz3.open(self.path, "rb", block_cache=cache) as f:
+            self.assertEqual(f.read(), self.data)
+        info = cache.cache_info()
+        self.assertEqual(info.blocks, 3)
+        self.assertGreater(info.evictions, 0)
+        self.assertLessEqual(info.currsize, info.maxsize)
+
+
 if __name__ == "__main__":
     import unittest
 
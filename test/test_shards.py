@@ -0,0 +1,88 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import os
+import pickle
+import sys
+import tempfile
+from unittest import TestCase
+
+sys.path.append(".")
+
+import bz3
+
+
+def make_records(delimiter):
+    records = [b"record %d %s" % (i, b"y" * (i * 7 % 1500)) for i in range(30000)]
+    records[100] = b"z" * (200 * 1024)  # longer than a few blocks
+    return delimiter.join(records)
+
+
+class TestShards(TestCase):
+    def setUp(self) -> None:
+        fd, self.path = tempfile.mkstemp(suffix=".bz3")
+        os.close(fd)
+
+    def tearDown(self) -> None:
+        os.remove(self.path)
+
+    def write(self, data):
+        with open(self.path, "wb") as f:
+            f.write(bz3.compress(data, 65 * 1024))
+
+    def read_shards(self, shards):
+        ret = []
+        for shard in shards:
+            with bz3.open_shard(pickle.loads(pickle.dumps(shard))) as f:
+                ret.append(f.read())
+        return ret
+
+    def check(self, data, delimiter):
+        self.write(data)
+        for n in (1, 2, 7, 1000):
+            shards = bz3.plan_shards(self.path, n, delimiter)
+            self.assertLessEqual(len(shards), n)
+            self.assertEqual(shards[0].uncompressed_start, 0)
+            for prev, shard in zip(shards, shards[1:]):
+                self.assertEqual(prev.uncompressed_end, shard.uncompressed_start)
+                self.assertEqual(prev.end_offset, shard.offset)
+            parts = self.read_shards(shards)
+            self.assertEqual(b"".join(parts), data)
+            for part in parts[:-1]:
+                self.assertTrue(not part or part.endswith(delimiter))
+
+    def test_newline(self):
+        data = make_records(b"\n")
+        self.check(data, b"\n")
+        self.check(data + b"\n", b"\n")
+
+    def test_multibyte_delimiter(self):
+        self.check(make_records(b"\r\n"), b"\r\n")
+        self.check(make_records(b"<|>"), b"<|>")
+
+    def test_delimiter_on_block_boundary(self):
+        # records of exactly one block, the delimiter straddles every boundary
+        block = 65 * 1024
+        data = (b"a" * (block - 1) + b"\r\n" + b"b" * (block - 3) + b"\r\n") * 4
+        self.check(data, b"\r\n")
+        self.check(data.replace(b"\r\n", b"\n"), b"\n")
+
+    def test_no_delimiter(self):
+        data = os.urandom(1024).replace(b"\n", b"") * 300
+        self.write(data)
+        shards = bz3.plan_shards(self.path, 4)
+        self.assertEqual(self.read_shards(shards), [data, b"", b"", b""])
+
+    def test_invalid(self):
+        self.write(b"123\n")
+        with self.assertRaises(ValueError):
+            bz3.plan_shards(self.path, 0)
+        with self.assertRaises(ValueError):
+            bz3.plan_shards(self.path, 2, b"")
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
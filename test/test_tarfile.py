@@ -0,0 +1,132 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+from unittest import TestCase
+
+sys.path.append(".")
+
+import bz3
+import bz3.tarfile
+
+BLOCK_SIZE = 65 * 1024
+
+
+def make_tree(root: str) -> dict:
+    files = {
+        "a.txt": b"hello\n" * 50000,
+        "sub/b.bin": os.urandom(200000),
+        "sub/empty": b"",
+        "sub/deep/c.txt": b"".join(b"%d\n" % i for i in range(30000)),
+    }
+    for name, data in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+    return files
+
+
+class TestTarfile(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, "src")
+        self.files = make_tree(self.src)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def check_tree(self, root: str):
+        for name, data in self.files.items():
+            with open(os.path.join(root, name), "rb") as f:
+                self.assertEqual(f.read(), data)
+
+    def test_roundtrip(self):
+        archive = os.path.join(self.tmp, "x.tar.bz3")
+        for mode, num_threads in (("w", 1), ("w|bz3", 3), ("x:bz3", 2)):
+            with self.subTest(mode=mode, num_threads=num_threads):
+                if os.path.exists(archive):
+                    os.remove(archive)
+                with bz3.tarfile.open(
+                    archive, mode, block_size=BLOCK_SIZE, num_threads=num_threads
+                ) as tar:
+                    tar.add(self.src, "src")
+                # a plain bzip3 stream of a tar archive
+                with bz3.open(archive, "rb") as f:
+                    with tarfile.open(fileobj=f, mode="r|") as tar:
+                        names = sorted(m.name for m in tar)
+                self.assertIn("src/sub/deep/c.txt", names)
+                out = os.path.join(self.tmp, "out%d" % num_threads)
+                with bz3.tarfile.open(archive, num_threads=num_threads) as tar:
+                    tar.extractall(out)
+                self.check_tree(os.path.join(out, "src"))
+
+    def test_random_access(self):
+        buffer = io.BytesIO()
+        with bz3.tarfile.open(fileobj=buffer, mode="w", block_size=BLOCK_SIZE) as tar:
+            tar.add(self.src, "src")
+        self.assertFalse(buffer.closed)
+        buffer.seek(0)
+        with bz3.tarfile.open(fileobj=buffer, num_threads=2) as tar:
+            names = tar.getnames()
+            # members are read back out of order, jumping between blocks
+            for name in reversed(sorted(self.files)):
+                self.assertEqual(
+                    tar.extractfile("src/" + name).read(), self.files[name]
+                )
+            self.assertEqual(tar.getnames(), names)
+
+    def test_stream(self):
+        buffer = io.BytesIO()
+        with bz3.tarfile.open(fileobj=buffer, mode="w|", block_size=BLOCK_SIZE) as tar:
+            tar.add(self.src, "src")
+
+        class Pipe(io.RawIOBase):  # readable, but not seekable
+            def __init__(self, data):
+                self._data = io.BytesIO(data)
+
+            def readable(self):
+                return True
+
+            def readinto(self, b):
+                return self._data.readinto(memoryview(b)[:1000])
+
+        with bz3.tarfile.open(fileobj=Pipe(buffer.getvalue()), mode="r|") as tar:
+            for member in tar:
+                if member.isfile():
+                    data = tar.extractfile(member).read()
+                    self.assertEqual(data, self.files[member.name[4:]])
+            with self.assertRaises(io.UnsupportedOperation):
+                tar.extractfile("src/a.txt").read()
+
+    def test_shutil(self):
+        bz3.tarfile.register_shutil(num_threads=2, block_size=BLOCK_SIZE)
+        bz3.tarfile.register_shutil(num_threads=2, block_size=BLOCK_SIZE)
+        try:
+            archive = shutil.make_archive(
+                os.path.join(self.tmp, "archive"), "bz3tar", self.src
+            )
+            self.assertTrue(archive.endswith(".tar.bz3"))
+            out = os.path.join(self.tmp, "unpacked")
+            shutil.unpack_archive(archive, out)
+            self.check_tree(out)
+        finally:
+            shutil.unregister_archive_format("bz3tar")
+            shutil.unregister_unpack_format("bz3tar")
+
+    def test_invalid(self):
+        path = os.path.join(self.tmp, "bad.tar.bz3")
+        with open(path, "wb") as f:
+            f.write(b"not bzip3 data")
+        with self.assertRaises(tarfile.ReadError):
+            bz3.tarfile.open(path)
+        with self.assertRaises(ValueError):
+            bz3.tarfile.open(path, "r:gz")
+        with self.assertRaises(ValueError):
+            bz3.tarfile.open(path, "a")
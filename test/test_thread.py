@@ -2,7 +2,9 @@
 Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
 """
 
+import os
 import sys
+import sysconfig
 import time
 from concurrent.futures import ThreadPoolExecutor, wait
 from unittest import TestCase
@@ -10,6 +12,7 @@ from unittest import TestCase
 sys.path.append(".")
 
 import bz3
+from bz3.backends import BZ3Compressor, BZ3Decompressor
 
 
 class TestThread(TestCase):
@@ -31,6 +34,41 @@ class TestThread(TestCase):
         print("singlethread done")
         print(f"{time.time() - start}")
 
+    def test_shared_compressor(self):
+        # concurrent calls on one object are serialized, never interleaved
+        compressor = BZ3Compressor(65 * 1024)
+        chunk = b"a" * 100000
+        stream = [compressor.compress(b"")]
+        with ThreadPoolExecutor(8) as pool:
+            stream.extend(pool.map(compressor.compress, [chunk] * 64))
+        stream.append(compressor.flush())
+        # the frames of one byte value may land in any order, but whole
+        decoded = BZ3Decompressor().decompress(b"".join(stream))
+        self.assertEqual(decoded, chunk * 64)
+
+    def test_scaling(self):
+        # benchmark: the speedup only prints, it depends on the machine and on
+        # a free-threaded build. Concurrent calls must match the serial output
+        data = os.urandom(1024) * 4096  # 4 MiB, cheap to match but not trivial
+        expected = bz3.compress(data)
+        num_threads = min(os.cpu_count() or 1, 8)
+        jobs = 4 * num_threads
+
+        def run(workers):
+            start = time.perf_counter()
+            with ThreadPoolExecutor(workers) as pool:
+                results = list(pool.map(lambda _: bz3.compress(data), range(jobs)))
+            self.assertEqual(results, [expected] * jobs)
+            return time.perf_counter() - start
+
+        single = run(1)
+        multi = run(num_threads)
+        free_threaded = bool(sysconfig.get_config_var("Py_GIL_DISABLED"))
+        print(
+            f"{num_threads} threads: {single / multi:.2f}x speedup, "
+            f"free-threaded={free_threaded}"
+        )
+
 
 if __name__ == "__main__":
     import unittest
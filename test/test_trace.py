@@ -0,0 +1,96 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import io
+import json
+import os
+import sys
+from unittest import TestCase, skipIf
+
+sys.path.append(".")
+
+import bz3
+import bz3.trace
+from bz3.backends import FILTER_DELTA, BZ3Compressor
+
+try:
+    from bz3.backends import BZ3OmpCompressor, BZ3OmpDecompressor
+except ImportError:
+    BZ3OmpCompressor = BZ3OmpDecompressor = None
+
+BLOCK_SIZE = 65 * 1024
+
+data = b"".join(b"%d,%s\n" % (i, os.urandom(i % 7)) for i in range(60000))
+compressed = bz3.compress(data, BLOCK_SIZE)
+blocks = len(list(bz3.iter_blocks(compressed)))
+
+
+class TestTrace(TestCase):
+    def tearDown(self):
+        bz3.trace.disable()
+        bz3.trace.clear()
+
+    def kinds(self):
+        return [e.kind for e in bz3.trace.events()]
+
+    def test_disabled(self):
+        bz3.trace.clear()
+        bz3.compress(data, BLOCK_SIZE)
+        self.assertEqual(bz3.trace.events(), [])
+
+    def test_blocks(self):
+        with bz3.trace.tracing():
+            bz3.decompress(bz3.compress(data, BLOCK_SIZE))
+        kinds = self.kinds()
+        self.assertEqual(kinds.count("encode"), blocks)
+        self.assertEqual(kinds.count("decode"), blocks)
+        self.assertEqual(kinds.count("stage"), blocks)
+        self.assertEqual(kinds.count("assemble"), blocks)
+        for e in bz3.trace.events():
+            self.assertLessEqual(e.start_ns, e.end_ns)
+            self.assertGreater(e.arg, 0)
+        with bz3.trace.tracing():
+            compressor = BZ3Compressor(BLOCK_SIZE, FILTER_DELTA, 2)
+            compressor.compress_to(data, io.BytesIO())
+        self.assertIn("write", self.kinds())
+
+    def test_ring(self):
+        with bz3.trace.tracing(capacity=5):
+            bz3.compress(data, BLOCK_SIZE)
+        recorded = bz3.trace.events()
+        self.assertEqual(len(recorded), 5)  # the newest only
+        self.assertEqual(recorded[-1].kind, "encode")
+        self.assertEqual(
+            recorded, sorted(recorded, key=lambda e: e.end_ns)
+        )  # oldest first
+        with self.assertRaises(ValueError):
+            bz3.trace.enable(0)
+
+    @skipIf(BZ3OmpCompressor is None, "no openmp backend")
+    def test_waves(self):
+        with bz3.trace.tracing():
+            compressor = BZ3OmpCompressor(BLOCK_SIZE, 4)
+            out = compressor.compress(data) + compressor.flush()
+            BZ3OmpDecompressor(4).decompress(out)
+        recorded = bz3.trace.events()
+        waves = [e for e in recorded if e.kind == "wave"]
+        self.assertEqual(sum(e.arg for e in waves), 2 * blocks)
+        for e in recorded:
+            if e.kind == "encode":  # every block falls in a wave
+                self.assertTrue(
+                    any(w.start_ns <= e.start_ns <= e.end_ns <= w.end_ns for w in waves)
+                )
+
+    def test_dump(self):
+        with bz3.trace.tracing():
+            bz3.compress(data, BLOCK_SIZE)
+        out = io.StringIO()
+        bz3.trace.dump(out)
+        trace = json.loads(out.getvalue())["traceEvents"]
+        complete = [e for e in trace if e["ph"] == "X"]
+        self.assertEqual(len(complete), len(bz3.trace.events()))
+        self.assertEqual(set(e["name"] for e in complete), {"stage", "encode"})
+        names = {e["tid"]: e["args"]["name"] for e in trace if e["ph"] == "M"}
+        self.assertEqual(names[complete[0]["tid"]], "MainThread")
+        self.assertEqual(complete[0]["args"], {"size": BLOCK_SIZE})
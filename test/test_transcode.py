@@ -0,0 +1,92 @@
+"""
+Copyright (c) 2008-2025 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import shutil
+import sys
+import tempfile
+from unittest import TestCase
+
+sys.path.append(".")
+
+import bz3
+
+BLOCK_SIZE = 65 * 1024
+
+data = b"".join(b"%d,%s\n" % (i, os.urandom(i % 7)) for i in range(60000))
+expected = bz3.compress(data, BLOCK_SIZE)
+
+
+class Unseekable:  # a pipe
+    def __init__(self, data: bytes):
+        self._data = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._data.read(size)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+
+class TestTranscode(TestCase):
+    def test_formats(self):
+        sources = {
+            "gz": gzip.compress(data),
+            "bz2": bz2.compress(data),
+            "xz": lzma.compress(data),
+            "bz3": bz3.compress(data, 2 * BLOCK_SIZE),  # another block size
+        }
+        for format, source in sources.items():
+            for num_threads in (1, 3):
+                with self.subTest(format=format, num_threads=num_threads):
+                    out = io.BytesIO()
+                    stats = bz3.transcode(
+                        io.BytesIO(source), out, BLOCK_SIZE, num_threads
+                    )
+                    self.assertEqual(out.getvalue(), expected)
+                    self.assertEqual(stats.format, format)
+                    self.assertEqual(stats.bytes_read, len(source))
+                    self.assertEqual(stats.bytes_decoded, len(data))
+                    self.assertEqual(stats.bytes_written, len(expected))
+                    self.assertGreater(stats.throughput, 0)
+
+    def test_paths(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmp, "data.gz")
+            dst = os.path.join(tmp, "data.bz3")
+            with gzip.open(src, "wb") as f:
+                f.write(data)
+            bz3.transcode(src, dst, BLOCK_SIZE, "auto")
+            with bz3.open(dst) as f:
+                self.assertEqual(f.read(), data)
+            # a damaged source leaves no output behind
+            with open(src, "r+b") as f:
+                f.truncate(os.path.getsize(src) // 2)
+            os.remove(dst)
+            with self.assertRaises(EOFError):
+                bz3.transcode(src, dst, BLOCK_SIZE)
+            self.assertFalse(os.path.exists(dst))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_unseekable(self):
+        source = bz2.compress(data)
+        with self.assertRaises(ValueError):
+            bz3.transcode(Unseekable(source), io.BytesIO(), BLOCK_SIZE)
+        out = io.BytesIO()
+        stats = bz3.transcode(Unseekable(source), out, BLOCK_SIZE, format="bz2")
+        self.assertEqual(out.getvalue(), expected)
+        self.assertIsNone(stats.bytes_read)
+        with self.assertRaises(ValueError):
+            bz3.transcode(io.BytesIO(data), io.BytesIO(), BLOCK_SIZE)  # not compressed
+        with self.assertRaises(ValueError):
+            bz3.transcode(io.BytesIO(source), io.BytesIO(), BLOCK_SIZE, format="zip")